@@ -0,0 +1,30 @@
+"""Drop events.session_id foreign key (sessions are written when finished)
+
+Revision ID: 007_drop_events_session_fk
+Revises: 006_add_download_proxies
+Create Date: 2025-10-06 12:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '007_drop_events_session_fk'
+down_revision = '006_add_download_proxies'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Events reference sessions that are still open in Redis, so the FK cannot hold"""
+    op.execute("ALTER TABLE events DROP CONSTRAINT IF EXISTS events_session_id_fkey")
+
+
+def downgrade() -> None:
+    # Строки без сессии в БД не пройдут проверку внешнего ключа
+    op.execute("""
+        UPDATE events SET session_id = NULL
+        WHERE session_id IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM sessions WHERE sessions.id = events.session_id)
+    """)
+    op.create_foreign_key('events_session_id_fkey', 'events', 'sessions', ['session_id'], ['id'])
@@ -0,0 +1,94 @@
+"""Partition events by month and add analytics indexes
+
+Revision ID: 008_partition_events_by_month
+Revises: 007_drop_events_session_fk
+Create Date: 2025-10-07 12:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '008_partition_events_by_month'
+down_revision = '007_drop_events_session_fk'
+branch_labels = None
+depends_on = None
+
+# Сколько месяцев вперед создаются партиции при миграции
+# (дальше их поддерживает database.partitions.EventPartitionManager)
+MONTHS_AHEAD = 2
+
+
+def upgrade() -> None:
+    """Rebuild events as a RANGE (ts) partitioned table with one partition per month"""
+    op.execute("ALTER TABLE events RENAME TO events_legacy")
+    op.execute("ALTER SEQUENCE events_id_seq OWNED BY NONE")
+
+    # Первичный ключ партиционированной таблицы обязан включать ключ партиции
+    op.execute("""
+        CREATE TABLE events (
+            id BIGINT NOT NULL DEFAULT nextval('events_id_seq'),
+            user_id INTEGER REFERENCES users (id),
+            ts TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            event_type TEXT NOT NULL,
+            command TEXT,
+            session_id UUID,
+            PRIMARY KEY (id, ts)
+        ) PARTITION BY RANGE (ts)
+    """)
+    op.execute("ALTER SEQUENCE events_id_seq OWNED BY events.id")
+
+    # Индексы объявляются на родителе и создаются в каждой партиции
+    op.execute("CREATE INDEX idx_events_user_ts ON events (user_id, ts)")
+    op.execute("CREATE INDEX idx_events_ts_brin ON events USING brin (ts)")
+    op.execute("CREATE INDEX idx_events_command_ts ON events (ts, command) WHERE command IS NOT NULL")
+
+    # Партиции от месяца самого старого события до MONTHS_AHEAD вперед
+    op.execute(f"""
+        DO $$
+        DECLARE
+            month_start DATE := date_trunc('month', COALESCE(
+                (SELECT MIN(ts) FROM events_legacy), NOW() AT TIME ZONE 'UTC'))::date;
+            last_month DATE := (date_trunc('month', NOW() AT TIME ZONE 'UTC')
+                                + INTERVAL '{MONTHS_AHEAD} months')::date;
+        BEGIN
+            WHILE month_start <= last_month LOOP
+                EXECUTE format(
+                    'CREATE TABLE IF NOT EXISTS %I PARTITION OF events FOR VALUES FROM (%L) TO (%L)',
+                    'events_' || to_char(month_start, 'YYYY_MM'),
+                    month_start, (month_start + INTERVAL '1 month')::date
+                );
+                month_start := (month_start + INTERVAL '1 month')::date;
+            END LOOP;
+        END $$
+    """)
+    # Страховка на случай, если новые партиции не были созданы вовремя
+    op.execute("CREATE TABLE events_default PARTITION OF events DEFAULT")
+
+    op.execute("""
+        INSERT INTO events (id, user_id, ts, event_type, command, session_id)
+        SELECT id, user_id, ts, event_type, command, session_id FROM events_legacy
+    """)
+    op.execute("DROP TABLE events_legacy")
+    op.execute("ANALYZE events")
+
+
+def downgrade() -> None:
+    op.execute("ALTER TABLE events RENAME TO events_partitioned")
+    op.execute("ALTER SEQUENCE events_id_seq OWNED BY NONE")
+    op.execute("""
+        CREATE TABLE events (
+            id INTEGER PRIMARY KEY DEFAULT nextval('events_id_seq'),
+            user_id INTEGER REFERENCES users (id),
+            ts TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            event_type TEXT NOT NULL,
+            command TEXT,
+            session_id UUID
+        )
+    """)
+    op.execute("ALTER SEQUENCE events_id_seq OWNED BY events.id")
+    op.execute("""
+        INSERT INTO events (id, user_id, ts, event_type, command, session_id)
+        SELECT id, user_id, ts, event_type, command, session_id FROM events_partitioned
+    """)
+    op.execute("DROP TABLE events_partitioned")
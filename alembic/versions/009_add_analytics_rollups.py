@@ -0,0 +1,78 @@
+"""Add daily/hourly analytics rollup tables
+
+Revision ID: 009_add_analytics_rollups
+Revises: 008_partition_events_by_month
+Create Date: 2025-10-08 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '009_add_analytics_rollups'
+down_revision = '008_partition_events_by_month'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Create rollup tables maintained by database.rollups.RollupManager"""
+    op.create_table(
+        'rollup_watermarks',
+        sa.Column('name', sa.String(50), primary_key=True),
+        sa.Column('last_id', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('last_ts', sa.DateTime(), nullable=True, comment='ts of the last processed row'),
+        sa.Column('updated_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+    )
+
+    op.create_table(
+        'rollup_daily_users',
+        sa.Column('day', sa.Date(), primary_key=True),
+        sa.Column('user_id', sa.Integer(), primary_key=True),
+        sa.Column('events', sa.Integer(), nullable=False, server_default='0'),
+    )
+    # Для когорт: активность пользователя по дням
+    op.create_index('idx_rollup_daily_users_user', 'rollup_daily_users', ['user_id', 'day'])
+
+    op.create_table(
+        'rollup_daily_commands',
+        sa.Column('day', sa.Date(), primary_key=True),
+        sa.Column('command', sa.Text(), primary_key=True),
+        sa.Column('count', sa.Integer(), nullable=False, server_default='0'),
+    )
+
+    op.create_table(
+        'rollup_hourly_events',
+        sa.Column('hour', sa.DateTime(), primary_key=True),
+        sa.Column('events', sa.Integer(), nullable=False, server_default='0'),
+    )
+
+    op.create_table(
+        'rollup_daily_new_users',
+        sa.Column('day', sa.Date(), primary_key=True),
+        sa.Column('users', sa.Integer(), nullable=False, server_default='0'),
+    )
+
+    op.create_table(
+        'rollup_daily_sessions',
+        sa.Column('day', sa.Date(), primary_key=True),
+        sa.Column('sessions', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('timed_sessions', sa.Integer(), nullable=False, server_default='0',
+                  comment='Finished sessions with duration > 0'),
+        sa.Column('duration_seconds', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('events', sa.BigInteger(), nullable=False, server_default='0'),
+    )
+    # Пересчет статистики сессий за последние дни
+    op.create_index('idx_sessions_started_at', 'sessions', ['started_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('idx_sessions_started_at', table_name='sessions')
+    op.drop_table('rollup_daily_sessions')
+    op.drop_table('rollup_daily_new_users')
+    op.drop_table('rollup_hourly_events')
+    op.drop_table('rollup_daily_commands')
+    op.drop_index('idx_rollup_daily_users_user', table_name='rollup_daily_users')
+    op.drop_table('rollup_daily_users')
+    op.drop_table('rollup_watermarks')
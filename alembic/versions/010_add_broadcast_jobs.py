@@ -0,0 +1,61 @@
+"""Add broadcast job and delivery tables
+
+Revision ID: 010_add_broadcast_jobs
+Revises: 009_add_analytics_rollups
+Create Date: 2025-10-10 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '010_add_broadcast_jobs'
+down_revision = '009_add_analytics_rollups'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Create tables used by services.broadcast.BroadcastEngine"""
+    op.create_table(
+        'broadcast_jobs',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('status', sa.String(20), nullable=False, server_default='pending',
+                  comment='pending | running | done | cancelled'),
+        sa.Column('segment', sa.String(20), nullable=False),
+        sa.Column('content', sa.Text(), nullable=False, comment='JSON of the forwarded message'),
+        sa.Column('admin_chat_id', sa.BigInteger(), nullable=True),
+        sa.Column('progress_message_id', sa.BigInteger(), nullable=True),
+        sa.Column('total', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('sent', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('blocked', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('failed', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('last_user_id', sa.BigInteger(), nullable=False, server_default='0',
+                  comment='users.id of the last fully processed page'),
+        sa.Column('created_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+    )
+    # Поиск незавершенных заданий при запуске
+    op.create_index('idx_broadcast_jobs_active', 'broadcast_jobs', ['id'],
+                    postgresql_where=sa.text("status IN ('pending', 'running')"))
+
+    op.create_table(
+        'broadcast_deliveries',
+        sa.Column('job_id', sa.Integer(), sa.ForeignKey('broadcast_jobs.id', ondelete='CASCADE'),
+                  primary_key=True),
+        sa.Column('user_id', sa.Integer(), primary_key=True),
+        sa.Column('tg_id', sa.BigInteger(), nullable=False),
+        sa.Column('status', sa.String(10), nullable=False, comment='sent | blocked | failed'),
+        sa.Column('error', sa.String(255), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='1'),
+        sa.Column('created_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('broadcast_deliveries')
+    op.drop_index('idx_broadcast_jobs_active', table_name='broadcast_jobs')
+    op.drop_table('broadcast_jobs')
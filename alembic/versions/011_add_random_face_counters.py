@@ -0,0 +1,33 @@
+"""Add Random Face daily counters
+
+Revision ID: 011_add_random_face_counters
+Revises: 010_add_broadcast_jobs
+Create Date: 2025-10-12 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '011_add_random_face_counters'
+down_revision = '010_add_broadcast_jobs'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Daily Random Face usage written through from database.quotas"""
+    op.create_table(
+        'random_face_daily_counters',
+        sa.Column('user_id', sa.BigInteger(), nullable=False, comment='Telegram user ID'),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False, server_default='0'),
+        sa.PrimaryKeyConstraint('user_id', 'day')
+    )
+    op.create_index('ix_random_face_daily_counters_day', 'random_face_daily_counters', ['day'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_random_face_daily_counters_day', table_name='random_face_daily_counters')
+    op.drop_table('random_face_daily_counters')
@@ -0,0 +1,28 @@
+"""Add broadcast job lease columns
+
+Revision ID: 012_add_broadcast_lease
+Revises: 011_add_random_face_counters
+Create Date: 2025-10-14 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '012_add_broadcast_lease'
+down_revision = '011_add_random_face_counters'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Owner and heartbeat of a running job (services.broadcast lease)"""
+    op.add_column('broadcast_jobs', sa.Column('owner', sa.String(255), nullable=True,
+                                              comment='host:pid of the process running the job'))
+    op.add_column('broadcast_jobs', sa.Column('heartbeat_at', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('broadcast_jobs', 'heartbeat_at')
+    op.drop_column('broadcast_jobs', 'owner')
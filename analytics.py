@@ -2,10 +2,14 @@
 Аналитика для бота - метрики и статистика
 """
 
+import asyncio
 import logging
 from typing import Dict, List, Tuple, Any
 from datetime import datetime, timedelta
 from database import Database
+from database.active_users import MAU_DAYS, WAU_DAYS, active_users, window_start
+from database.retention import DEFAULT_OFFSETS, RetentionEngine, RetentionMatrix
+from database.recipients import RecipientSource, count_segments
 
 logger = logging.getLogger(__name__)
 
@@ -14,24 +18,31 @@ class Analytics:
 
     def __init__(self, database: Database):
         self.db = database
+        self.retention = RetentionEngine(database)
 
     async def get_dau_wau_mau(self) -> Dict[str, int]:
         """Получает DAU, WAU, MAU (Daily/Weekly/Monthly Active Users)"""
+        # HyperLogLog в Redis: чтение O(1), погрешность меньше 1%
+        counts = await active_users.counts()
+        if counts is not None:
+            return counts
+
         try:
-            # Получаем текущую дату
-            now = datetime.now()
-            today = now.date()
-            week_ago = today - timedelta(days=7)
-            month_ago = today - timedelta(days=30)
+            # Агрегаты считаются по дням UTC; окна те же, что у HLL (включая сегодня)
+            today = datetime.utcnow().date()
+            week_ago = window_start(WAU_DAYS, today)
+            month_ago = window_start(MAU_DAYS, today)
 
-            # Запрос для подсчета активных пользователей (используем правильные имена полей)
+            # Дневная активность пользователей из агрегатов (database/rollups.py),
+            # заблокировавшие бота не считаются
             query = """
                 SELECT
-                    COUNT(DISTINCT CASE WHEN DATE(last_seen_at) >= %s THEN id END) as dau,
-                    COUNT(DISTINCT CASE WHEN DATE(last_seen_at) >= %s THEN id END) as wau,
-                    COUNT(DISTINCT CASE WHEN DATE(last_seen_at) >= %s THEN id END) as mau
-                FROM users
-                WHERE is_blocked = false
+                    COUNT(DISTINCT CASE WHEN d.day >= %s THEN d.user_id END) as dau,
+                    COUNT(DISTINCT CASE WHEN d.day >= %s THEN d.user_id END) as wau,
+                    COUNT(DISTINCT d.user_id) as mau
+                FROM rollup_daily_users d
+                JOIN users u ON u.id = d.user_id
+                WHERE d.day >= %s AND u.is_blocked = false
             """
 
             result = await self.db.execute(query, (today, week_ago, month_ago), fetch=True)
@@ -75,59 +86,25 @@ class Analytics:
             logger.error(f"Error getting total users: {e}")
             return {'total': 0, 'active': 0, 'blocked': 0}
 
+    async def get_retention_matrix(self, periods: int = 30) -> RetentionMatrix:
+        """Матрица удержания когорт D1/D7/D30 (один запрос, кэшируется)"""
+        return await self.retention.get_matrix(DEFAULT_OFFSETS, periods)
+
     async def get_average_retention(self, days: int, period_days: int = 30) -> float:
         """
         Получает средний retention rate для указанного количества дней
 
         Args:
             days: Количество дней для расчета (1, 7, 30)
-            period_days: Период анализа в днях
+            period_days: Сколько последних когорт усреднять
 
         Returns:
             Процент удержания пользователей
         """
         try:
-            # Получаем дату начала периода
-            end_date = datetime.now().date()
-            start_date = end_date - timedelta(days=period_days)
-
-            query = """
-                WITH user_cohorts AS (
-                    SELECT
-                        DATE(first_seen_at) as cohort_date,
-                        id as user_id,
-                        DATE(last_seen_at) as last_active_date
-                    FROM users
-                    WHERE DATE(first_seen_at) >= %s
-                    AND DATE(first_seen_at) <= %s
-                    AND is_blocked = false
-                ),
-                retention_calc AS (
-                    SELECT
-                        cohort_date,
-                        COUNT(DISTINCT user_id) as cohort_size,
-                        COUNT(DISTINCT CASE
-                            WHEN last_active_date >= cohort_date + INTERVAL '%s days'
-                            THEN user_id
-                        END) as retained_users
-                    FROM user_cohorts
-                    GROUP BY cohort_date
-                )
-                SELECT
-                    AVG(CASE
-                        WHEN cohort_size > 0
-                        THEN (retained_users::float / cohort_size::float) * 100
-                        ELSE 0
-                    END) as avg_retention
-                FROM retention_calc
-            """
-
-            result = await self.db.execute(query, (start_date, end_date, days), fetch=True)
-
-            if result:
-                return round(result[0]['avg_retention'] or 0, 2)
-            else:
-                return 0.0
+            offsets = tuple(sorted(set(DEFAULT_OFFSETS) | {days}))
+            matrix = await self.retention.get_matrix(offsets, period_days)
+            return matrix.average(days, period_days)
 
         except Exception as e:
             logger.error(f"Error calculating retention for {days} days: {e}")
@@ -145,29 +122,28 @@ class Analytics:
         """
         try:
             # Получаем дату начала периода
-            end_date = datetime.now().date()
+            end_date = datetime.utcnow().date()
             start_date = end_date - timedelta(days=days)
+            previous_start = start_date - timedelta(days=days)
 
+            # Активные в предыдущем периоде, которые не вернулись в текущем
             query = """
-                WITH active_users AS (
-                    SELECT id as user_id
-                    FROM users
-                    WHERE is_blocked = false
-                    AND DATE(last_seen_at) >= %s
+                WITH previous AS (
+                    SELECT DISTINCT user_id FROM rollup_daily_users
+                    WHERE day >= %s AND day < %s
                 ),
-                churned_users AS (
-                    SELECT id as user_id
-                    FROM users
-                    WHERE is_blocked = false
-                    AND DATE(last_seen_at) < %s
-                    AND id IN (SELECT user_id FROM active_users)
+                current AS (
+                    SELECT DISTINCT user_id FROM rollup_daily_users
+                    WHERE day >= %s
                 )
                 SELECT
-                    (COUNT(*)::float / NULLIF((SELECT COUNT(*) FROM active_users), 0)) * 100 as churn_rate
-                FROM churned_users
+                    (COUNT(*) FILTER (WHERE current.user_id IS NULL)::float
+                     / NULLIF(COUNT(*), 0)) * 100 as churn_rate
+                FROM previous
+                LEFT JOIN current ON current.user_id = previous.user_id
             """
 
-            result = await self.db.execute(query, (start_date, end_date), fetch=True)
+            result = await self.db.execute(query, (previous_start, start_date, start_date), fetch=True)
 
             if result:
                 return round(result[0]['churn_rate'] or 0, 2)
@@ -317,24 +293,17 @@ class Analytics:
     async def get_detailed_metrics(self) -> Dict[str, Any]:
         """Получает детальную аналитику для админ панели"""
         try:
-            # Получаем базовые метрики
-            dau_wau_mau = await self.get_dau_wau_mau()
-            total_users = await self.get_total_users()
-
-            # Получаем retention rates
-            retention = {
-                'D1': await self.get_average_retention(1),
-                'D7': await self.get_average_retention(7),
-                'D30': await self.get_average_retention(30)
-            }
-
-            churn_rate = await self.get_churn_rate()
-
-            # Получаем использование функций
-            feature_usage = await self.get_feature_usage_stats()
-
-            # Получаем производительность системы
-            performance = await self.get_system_performance()
+            # Метрики независимы - запросы выполняются одновременно на пуле
+            (dau_wau_mau, total_users, matrix, churn_rate, feature_usage, performance) = await asyncio.gather(
+                self.get_dau_wau_mau(),
+                self.get_total_users(),
+                # Retention rates (вся матрица одним запросом)
+                self.get_retention_matrix(),
+                self.get_churn_rate(),
+                self.get_feature_usage_stats(),
+                self.get_system_performance()
+            )
+            retention = {f'D{days}': matrix.average(days) for days in DEFAULT_OFFSETS}
 
             return {
                 'users': {
@@ -363,19 +332,18 @@ class Analytics:
     async def get_command_usage(self, days: int = 30) -> List[Tuple[str, int]]:
         """Получает статистику использования команд"""
         try:
-            # Используем таблицу events вместо command_logs
+            # Дневные счетчики команд из агрегатов
             query = """
-                SELECT command, COUNT(*) as count
-                FROM events
-                WHERE ts >= NOW() - INTERVAL '%s days'
-                  AND command IS NOT NULL
-                  AND command != ''
+                SELECT command, SUM(count)::bigint as count
+                FROM rollup_daily_commands
+                WHERE day >= %s
                 GROUP BY command
                 ORDER BY count DESC
             """
 
             try:
-                result = await self.db.execute(query, (days,), fetch=True)
+                since = datetime.utcnow().date() - timedelta(days=days)
+                result = await self.db.execute(query, (since,), fetch=True)
 
                 if result:
                     return [(row['command'], row['count']) for row in result]
@@ -395,16 +363,14 @@ class Analytics:
         """Получает статистику новых пользователей по дням"""
         try:
             query = """
-                SELECT
-                    DATE(first_seen_at) as date,
-                    COUNT(*) as count
-                FROM users
-                WHERE first_seen_at >= NOW() - INTERVAL '%s days'
-                GROUP BY DATE(first_seen_at)
-                ORDER BY DATE(first_seen_at) DESC
+                SELECT day as date, users as count
+                FROM rollup_daily_new_users
+                WHERE day >= %s
+                ORDER BY day DESC
             """
 
-            result = await self.db.execute(query, (days,), fetch=True)
+            since = datetime.utcnow().date() - timedelta(days=days)
+            result = await self.db.execute(query, (since,), fetch=True)
 
             if result:
                 return [(str(row['date']), row['count']) for row in result]
@@ -420,15 +386,16 @@ class Analytics:
         try:
             query = """
                 SELECT
-                    EXTRACT(HOUR FROM ts) as hour,
-                    COUNT(*) as count
-                FROM events
-                WHERE ts >= NOW() - INTERVAL '%s days'
-                GROUP BY EXTRACT(HOUR FROM ts)
+                    EXTRACT(HOUR FROM hour) as hour,
+                    SUM(events)::bigint as count
+                FROM rollup_hourly_events
+                WHERE hour >= %s
+                GROUP BY EXTRACT(HOUR FROM hour)
                 ORDER BY hour
             """
 
-            result = await self.db.execute(query, (days,), fetch=True)
+            since = datetime.utcnow() - timedelta(days=days)
+            result = await self.db.execute(query, (since,), fetch=True)
 
             if result:
                 return [(int(row['hour']), row['count']) for row in result]
@@ -476,3 +443,41 @@ class Analytics:
         except Exception as e:
             logger.error(f"Error getting users for broadcast: {e}")
             return []
+
+    async def get_keitaro_stats(self, days: int = 7) -> Dict[str, int]:
+        """Активные профили Keitaro и число событий за период"""
+        try:
+            query = """
+                SELECT
+                    (SELECT COUNT(*) FROM keitaro_profiles WHERE enabled = true) as profiles,
+                    (SELECT COUNT(*) FROM keitaro_events WHERE created_at >= %s) as events
+            """
+            result = await self.db.execute(query, (datetime.utcnow() - timedelta(days=days),), fetch=True)
+            if result:
+                return {'profiles': result[0]['profiles'] or 0, 'events': result[0]['events'] or 0}
+            return {'profiles': 0, 'events': 0}
+
+        except Exception as e:
+            # Таблиц Keitaro может не быть
+            logger.debug(f"Error getting Keitaro stats: {e}")
+            return {'profiles': 0, 'events': 0}
+
+    def broadcast_recipients(self, segment: str = None, page_size: int = 1000) -> RecipientSource:
+        """Получатели сегмента страницами (память не зависит от числа пользователей)"""
+        return RecipientSource(self.db, segment, page_size=page_size)
+
+    async def count_broadcast_recipients(self, segment: str = None) -> int:
+        """Число получателей сегмента одним COUNT"""
+        try:
+            return await self.broadcast_recipients(segment).count()
+        except Exception as e:
+            logger.error(f"Error counting broadcast recipients: {e}")
+            return 0
+
+    async def get_segment_counts(self) -> Dict[str, int]:
+        """Размеры сегментов рассылки одним запросом"""
+        try:
+            return await count_segments(self.db)
+        except Exception as e:
+            logger.error(f"Error counting broadcast segments: {e}")
+            return {'all': 0, 'active_7d': 0, 'active_30d': 0, 'inactive_7d': 0}
@@ -0,0 +1,160 @@
+"""
+Счетчики активных пользователей на HyperLogLog в Redis
+
+Каждый активный пользователь добавляется в HLL своего дня (PFADD при
+сбросе буфера событий). DAU - PFCOUNT одного ключа, WAU/MAU - PFCOUNT по
+7/30 дневным ключам сразу (Redis объединяет их сам). Погрешность
+HyperLogLog в Redis - 0.81%, чтение не зависит от числа пользователей.
+Дни, которых нет в Redis (первый запуск, потеря данных), дозаполняются
+из rollup_daily_users.
+
+Окна те же, что у запасного расчета по rollup_daily_users в analytics.py
+(window_start): WAU - 7 дней, MAU - 30 дней, включая сегодня.
+Заблокировавшие бота исключаются из HLL не полностью: в дозаполнение
+они не попадают, но пользователь, активный в окне и заблокировавший бота
+позже, остается в HLL до конца окна (из HLL нельзя удалить элемент).
+Расчет по БД смотрит на текущий is_blocked, поэтому он может быть меньше
+на число таких пользователей.
+"""
+
+import logging
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_SQL = """
+    SELECT d.day, u.tg_id
+    FROM rollup_daily_users d
+    JOIN users u ON u.id = d.user_id
+    WHERE d.day = ANY(%s) AND u.is_blocked = false
+"""
+
+WAU_DAYS = 7
+MAU_DAYS = 30
+
+
+def window_start(days: int, today: date) -> date:
+    """Первый день окна из days дней, включая сегодня"""
+    return today - timedelta(days=days - 1)
+
+
+class ActiveUserCounter:
+    """Дневные HyperLogLog активных пользователей"""
+
+    def __init__(self, key_prefix: str = 'hll:active:', keep_days: int = 35):
+        """
+        Args:
+            key_prefix: Префикс дневных ключей
+            keep_days: Сколько дней хранить ключ (должно покрывать окно MAU)
+        """
+        self.key_prefix = key_prefix
+        self.keep_days = keep_days
+
+    @staticmethod
+    def _redis():
+        """Текущее подключение Redis (None - счетчики недоступны)"""
+        try:
+            from infra.redis import redis_manager
+            return redis_manager.redis
+        except ImportError:
+            return None
+
+    def key(self, day: date) -> str:
+        return f"{self.key_prefix}{day.isoformat()}"
+
+    def window(self, days: int, today: date) -> List[str]:
+        """Ключи последних days дней, включая сегодня"""
+        return [self.key(today - timedelta(days=offset)) for offset in range(days)]
+
+    async def record_many(self, activity: Iterable[Tuple[int, datetime]]) -> None:
+        """Добавляет (tg_id, ts) в HLL соответствующих дней"""
+        redis = self._redis()
+        if redis is None:
+            return
+
+        by_day: Dict[date, set] = {}
+        for tg_id, ts in activity:
+            by_day.setdefault(ts.date(), set()).add(tg_id)
+        if not by_day:
+            return
+
+        try:
+            pipe = redis.pipeline(transaction=False)
+            for day, users in by_day.items():
+                self._add(pipe, day, users)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Active user HLL update failed: {e}")
+
+    def _add(self, pipe, day: date, users) -> None:
+        key = self.key(day)
+        pipe.pfadd(key, *users)
+        # Ключ живет keep_days после своего дня, а не после последней записи
+        expire_at = datetime.combine(day + timedelta(days=self.keep_days), time.min, tzinfo=timezone.utc)
+        pipe.expireat(key, int(expire_at.timestamp()))
+
+    async def counts(self, today: Optional[date] = None) -> Optional[Dict[str, int]]:
+        """
+        DAU/WAU/MAU по HLL
+
+        Returns:
+            None, если Redis недоступен (вызывающий код считает по агрегатам в БД)
+        """
+        redis = self._redis()
+        if redis is None:
+            return None
+        today = today or datetime.utcnow().date()
+        try:
+            pipe = redis.pipeline(transaction=False)
+            pipe.pfcount(self.key(today))
+            pipe.pfcount(*self.window(WAU_DAYS, today))
+            pipe.pfcount(*self.window(MAU_DAYS, today))
+            dau, wau, mau = await pipe.execute()
+            return {'DAU': dau, 'WAU': wau, 'MAU': mau}
+        except Exception as e:
+            logger.warning(f"Active user HLL read failed: {e}")
+            return None
+
+    async def backfill(self, database, days: int = MAU_DAYS, today: Optional[date] = None) -> List[date]:
+        """
+        Заполняет из БД дни, которых нет в Redis
+
+        Сегодня и вчера заполняются всегда: после потери данных их ключи
+        могли уже появиться заново, но без начала дня. PFADD идемпотентен.
+
+        Returns:
+            Заполненные дни
+        """
+        redis = self._redis()
+        if redis is None:
+            return []
+        today = today or datetime.utcnow().date()
+        window = [today - timedelta(days=offset) for offset in range(days)]
+
+        pipe = redis.pipeline(transaction=False)
+        for day in window:
+            pipe.exists(self.key(day))
+        exists = await pipe.execute()
+        missing = [day for day, found in zip(window, exists) if not found or day >= today - timedelta(days=1)]
+        if not missing:
+            return []
+
+        rows = await database.execute(BACKFILL_SQL, (missing,), fetch=True) or []
+        by_day: Dict[date, set] = {}
+        for row in rows:
+            by_day.setdefault(row['day'], set()).add(row['tg_id'])
+
+        pipe = redis.pipeline(transaction=False)
+        for day, users in by_day.items():
+            users = list(users)
+            for start in range(0, len(users), 10000):
+                self._add(pipe, day, users[start:start + 10000])
+        await pipe.execute()
+
+        logger.info(f"Backfilled active user HLL for {len(by_day)} of {len(missing)} days")
+        return missing
+
+
+# Глобальные счетчики активных пользователей
+active_users = ActiveUserCounter()
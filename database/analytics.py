@@ -6,7 +6,11 @@ from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
 from sqlalchemy import func, and_, or_, distinct
 from sqlalchemy.orm import Session as DBSession
-from .models import User, Event, Session, Database
+from .retention import DEFAULT_OFFSETS, RETENTION_MATRIX_SQL, RetentionMatrix, build_matrix, matrix_params
+from .models import (
+    User, Event, Database, RollupDailyUser, RollupDailyCommand, RollupHourlyEvents,
+    RollupDailyNewUsers, RollupDailySessions
+)
 import logging
 
 logger = logging.getLogger(__name__)
@@ -21,10 +25,10 @@ class Analytics:
     def get_active_users(self, period_days: int) -> int:
         """Получить количество активных пользователей за период"""
         with self.db.get_session() as db_session:
-            cutoff_date = datetime.utcnow() - timedelta(days=period_days)
+            cutoff_date = datetime.utcnow().date() - timedelta(days=period_days - 1)
             
-            count = db_session.query(func.count(distinct(User.id))).join(Event).filter(
-                Event.ts >= cutoff_date
+            count = db_session.query(func.count(distinct(RollupDailyUser.user_id))).filter(
+                RollupDailyUser.day >= cutoff_date
             ).scalar()
             
             return count or 0
@@ -37,101 +41,65 @@ class Analytics:
             'MAU': self.get_active_users(30)
         }
     
+    def get_retention_matrix(self, offsets=DEFAULT_OFFSETS, periods: int = 30) -> RetentionMatrix:
+        """Матрица удержания когорт одним запросом по агрегатам"""
+        today = datetime.utcnow().date()
+        with self.db.get_session() as db_session:
+            rows = db_session.connection().exec_driver_sql(
+                RETENTION_MATRIX_SQL, matrix_params(offsets, periods, today)
+            ).fetchall()
+        return build_matrix(rows, offsets, today)
+    
     def get_retention(self, cohort_days_ago: int, check_day: int) -> float:
         """
         Расчет retention для когорты
         cohort_days_ago - сколько дней назад была когорта
         check_day - на какой день проверяем возвращение (1, 7, 30)
         """
-        with self.db.get_session() as db_session:
-            # Дата когорты
-            cohort_date = datetime.utcnow().date() - timedelta(days=cohort_days_ago)
-            cohort_end = cohort_date + timedelta(days=1)
-            
-            # Пользователи из когорты
-            cohort_users = db_session.query(User.id).filter(
-                and_(
-                    func.date(User.first_seen_at) >= cohort_date,
-                    func.date(User.first_seen_at) < cohort_end
-                )
-            ).all()
-            
-            cohort_user_ids = [u.id for u in cohort_users]
-            
-            if not cohort_user_ids:
-                return 0.0
-            
-            # Дата проверки
-            check_date = cohort_date + timedelta(days=check_day)
-            check_end = check_date + timedelta(days=1)
-            
-            # Вернувшиеся пользователи
-            returned_users = db_session.query(func.count(distinct(Event.user_id))).filter(
-                and_(
-                    Event.user_id.in_(cohort_user_ids),
-                    func.date(Event.ts) >= check_date,
-                    func.date(Event.ts) < check_end
-                )
-            ).scalar()
-            
-            retention = (returned_users / len(cohort_user_ids)) * 100
-            return round(retention, 1)
+        cohort_date = datetime.utcnow().date() - timedelta(days=cohort_days_ago)
+        matrix = self.get_retention_matrix((check_day,), periods=max(cohort_days_ago - check_day, 1))
+        
+        for cohort in matrix.cohorts:
+            if cohort.day == cohort_date:
+                return matrix.rate(cohort, check_day) or 0.0
+        return 0.0
     
     def get_average_retention(self, retention_day: int, periods: int = 30) -> float:
         """Средний retention за последние N периодов"""
-        retentions = []
-        
-        for days_ago in range(retention_day + 1, retention_day + periods + 1):
-            ret = self.get_retention(days_ago, retention_day)
-            if ret > 0:  # Учитываем только дни с данными
-                retentions.append(ret)
-        
-        if retentions:
-            return round(sum(retentions) / len(retentions), 1)
-        return 0.0
+        return self.get_retention_matrix((retention_day,), periods).average(retention_day, periods)
     
     def get_command_usage(self, days: int = 30) -> List[Tuple[str, int]]:
         """Получить статистику использования команд"""
         with self.db.get_session() as db_session:
-            cutoff_date = datetime.utcnow() - timedelta(days=days)
+            cutoff_date = datetime.utcnow().date() - timedelta(days=days)
+            total = func.sum(RollupDailyCommand.count)
             
             results = db_session.query(
-                Event.command,
-                func.count(Event.id).label('count')
+                RollupDailyCommand.command,
+                total.label('count')
             ).filter(
-                and_(
-                    Event.ts >= cutoff_date,
-                    Event.command.isnot(None)
-                )
-            ).group_by(Event.command).order_by(func.count(Event.id).desc()).all()
+                RollupDailyCommand.day >= cutoff_date
+            ).group_by(RollupDailyCommand.command).order_by(total.desc()).all()
             
-            return [(cmd, count) for cmd, count in results]
+            return [(cmd, int(count)) for cmd, count in results]
     
     def get_average_session_length(self, days: int = 30) -> Dict[str, float]:
         """Получить среднюю длину сессии"""
         with self.db.get_session() as db_session:
-            cutoff_date = datetime.utcnow() - timedelta(days=days)
+            cutoff_date = datetime.utcnow().date() - timedelta(days=days)
             
-            # Средняя продолжительность в секундах
-            avg_duration = db_session.query(
-                func.avg(Session.duration_seconds)
+            sessions, timed_sessions, duration, events = db_session.query(
+                func.sum(RollupDailySessions.sessions),
+                func.sum(RollupDailySessions.timed_sessions),
+                func.sum(RollupDailySessions.duration_seconds),
+                func.sum(RollupDailySessions.events)
             ).filter(
-                and_(
-                    Session.started_at >= cutoff_date,
-                    Session.ended_at.isnot(None),
-                    Session.duration_seconds > 0
-                )
-            ).scalar()
+                RollupDailySessions.day >= cutoff_date
+            ).one()
             
-            # Среднее количество событий
-            avg_events = db_session.query(
-                func.avg(Session.events_count)
-            ).filter(
-                and_(
-                    Session.started_at >= cutoff_date,
-                    Session.events_count > 0
-                )
-            ).scalar()
+            # Средняя продолжительность в секундах и среднее количество событий
+            avg_duration = float(duration) / float(timed_sessions) if timed_sessions else None
+            avg_events = float(events) / float(sessions) if sessions else None
             
             return {
                 'avg_duration_minutes': round(avg_duration / 60, 1) if avg_duration else 0,
@@ -139,36 +107,28 @@ class Analytics:
             }
     
     def get_churn_rate(self, days: int = 30) -> float:
-        """Расчет churn rate"""
+        """Расчет churn rate: активные в предыдущем периоде, не вернувшиеся в текущем"""
         with self.db.get_session() as db_session:
-            cutoff_date = datetime.utcnow() - timedelta(days=days)
+            cutoff_date = datetime.utcnow().date() - timedelta(days=days)
             
-            # Всего активных пользователей за период
-            total_users = db_session.query(
-                func.count(distinct(Event.user_id))
-            ).filter(
-                Event.ts >= cutoff_date - timedelta(days=days)
-            ).scalar()
-            
-            if not total_users:
-                return 0.0
-            
-            # Пользователи, которые были активны в первой половине периода
-            first_half_users = db_session.query(Event.user_id).filter(
+            previous_users = db_session.query(RollupDailyUser.user_id).filter(
                 and_(
-                    Event.ts >= cutoff_date - timedelta(days=days),
-                    Event.ts < cutoff_date - timedelta(days=days//2)
+                    RollupDailyUser.day >= cutoff_date - timedelta(days=days),
+                    RollupDailyUser.day < cutoff_date
                 )
             ).distinct().subquery()
             
-            # Из них не вернулись во второй половине
+            total_users = db_session.query(func.count(previous_users.c.user_id)).scalar()
+            if not total_users:
+                return 0.0
+            
             churned_users = db_session.query(
-                func.count(first_half_users.c.user_id)
+                func.count(previous_users.c.user_id)
             ).filter(
-                ~first_half_users.c.user_id.in_(
-                    db_session.query(Event.user_id).filter(
-                        Event.ts >= cutoff_date - timedelta(days=days//2)
-                    ).distinct()
+                ~previous_users.c.user_id.in_(
+                    db_session.query(RollupDailyUser.user_id).filter(
+                        RollupDailyUser.day >= cutoff_date
+                    )
                 )
             ).scalar()
             
@@ -178,17 +138,15 @@ class Analytics:
     def get_new_users(self, days: int = 30) -> List[Tuple[str, int]]:
         """Получить количество новых пользователей по дням"""
         with self.db.get_session() as db_session:
-            cutoff_date = datetime.utcnow() - timedelta(days=days)
+            cutoff_date = datetime.utcnow().date() - timedelta(days=days)
             
             results = db_session.query(
-                func.date(User.first_seen_at).label('date'),
-                func.count(User.id).label('count')
+                RollupDailyNewUsers.day,
+                RollupDailyNewUsers.users
             ).filter(
-                User.first_seen_at >= cutoff_date
-            ).group_by(
-                func.date(User.first_seen_at)
+                RollupDailyNewUsers.day >= cutoff_date
             ).order_by(
-                func.date(User.first_seen_at).desc()
+                RollupDailyNewUsers.day.desc()
             ).all()
             
             return [(date.strftime('%Y-%m-%d'), count) for date, count in results]
@@ -210,18 +168,16 @@ class Analytics:
         with self.db.get_session() as db_session:
             cutoff_date = datetime.utcnow() - timedelta(days=days)
             
+            hour = func.extract('hour', RollupHourlyEvents.hour)
+            
             results = db_session.query(
-                func.extract('hour', Event.ts).label('hour'),
-                func.count(Event.id).label('count')
+                hour.label('hour'),
+                func.sum(RollupHourlyEvents.events).label('count')
             ).filter(
-                Event.ts >= cutoff_date
-            ).group_by(
-                func.extract('hour', Event.ts)
-            ).order_by(
-                func.extract('hour', Event.ts)
-            ).all()
+                RollupHourlyEvents.hour >= cutoff_date
+            ).group_by(hour).order_by(hour).all()
             
-            return [(int(hour), count) for hour, count in results]
+            return [(int(hour), int(count)) for hour, count in results]
     
     def get_users_for_broadcast(self, segment: Optional[str] = None) -> List[int]:
         """Получить список пользователей для рассылки"""
@@ -2,6 +2,7 @@
 Асинхронная обертка для базы данных с connection pooling
 """
 
+import time
 import asyncio
 import logging
 from typing import Optional, List, Dict, Any
@@ -13,6 +14,8 @@ from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sess
 from sqlalchemy.orm import declarative_base
 from sqlalchemy import text
 
+from .query_metrics import query_metrics, query_name
+
 logger = logging.getLogger(__name__)
 
 Base = declarative_base()
@@ -101,6 +104,31 @@ class AsyncDatabase:
         async with self.pool.acquire() as connection:
             yield connection
     
+    async def _run(self, method: str, query: str, *args):
+        """Выполняет запрос методом соединения asyncpg и учитывает его в query_metrics"""
+        started = time.perf_counter()
+        async with self.connection() as conn:
+            wait = time.perf_counter() - started
+            try:
+                result = await getattr(conn, method)(query, *args)
+            except Exception as e:
+                query_metrics.record(query_name(query), query, time.perf_counter() - started,
+                                     pool_wait=wait, error=True)
+                logger.error(f"Query execution failed: {e}")
+                raise
+
+        query_metrics.record(
+            query_name(query), query, time.perf_counter() - started,
+            rows=len(result) if isinstance(result, list) else int(result is not None),
+            pool_wait=wait,
+            explain=lambda plan_sql: self._fetch_plan(plan_sql, *args),
+        )
+        return result
+
+    async def _fetch_plan(self, plan_sql: str, *args):
+        async with self.connection() as conn:
+            return await conn.fetch(plan_sql, *args)
+
     async def execute(self, query: str, *args) -> Optional[List[asyncpg.Record]]:
         """
         Выполнение сырого SQL запроса
@@ -112,30 +140,15 @@ class AsyncDatabase:
         Returns:
             Результаты запроса
         """
-        async with self.connection() as conn:
-            try:
-                return await conn.fetch(query, *args)
-            except Exception as e:
-                logger.error(f"Query execution failed: {e}")
-                raise
+        return await self._run('fetch', query, *args)
     
     async def execute_one(self, query: str, *args) -> Optional[asyncpg.Record]:
         """Выполнение запроса с одним результатом"""
-        async with self.connection() as conn:
-            try:
-                return await conn.fetchrow(query, *args)
-            except Exception as e:
-                logger.error(f"Query execution failed: {e}")
-                raise
+        return await self._run('fetchrow', query, *args)
     
     async def execute_scalar(self, query: str, *args) -> Any:
         """Выполнение запроса со скалярным результатом"""
-        async with self.connection() as conn:
-            try:
-                return await conn.fetchval(query, *args)
-            except Exception as e:
-                logger.error(f"Query execution failed: {e}")
-                raise
+        return await self._run('fetchval', query, *args)
     
     async def execute_many(self, query: str, args_list: List[tuple]):
         """Выполнение batch запросов"""
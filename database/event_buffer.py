@@ -0,0 +1,225 @@
+"""
+Буфер событий аналитики с пакетной записью в БД
+
+Обработчик только добавляет событие в кольцевой буфер в памяти. Фоновая
+задача сбрасывает буфер пачками: пользователи обновляются одним UPSERT на
+пачку, события пишутся многострочным INSERT - все в одной транзакции.
+Пользователи из кэша, у которых last_seen_at записан недавно, в UPSERT не
+попадают. Счетчики сессий ведет SessionStore, в таблицу sessions строка
+попадает только после завершения сессии.
+"""
+
+import time
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Deque, Dict, List, Optional
+
+from psycopg2.extras import execute_values
+
+from .user_cache import CachedUser, UserCache, user_cache
+from .session_store import SessionStore
+from .active_users import ActiveUserCounter, active_users
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BufferedEvent:
+    """Событие, ожидающее записи в БД"""
+    tg_id: int
+    username: Optional[str]
+    ts: datetime
+    event_type: str
+    command: Optional[str]
+    session_id: Optional[str] = None  # Назначается при сбросе
+
+
+UPSERT_USERS_SQL = """
+    INSERT INTO users (tg_id, username, first_seen_at, last_seen_at)
+    VALUES %s
+    ON CONFLICT (tg_id) DO UPDATE SET
+        username = COALESCE(EXCLUDED.username, users.username),
+        last_seen_at = GREATEST(users.last_seen_at, EXCLUDED.last_seen_at)
+    RETURNING id, tg_id, language, is_blocked
+"""
+
+INSERT_EVENTS_SQL = """
+    INSERT INTO events (user_id, ts, event_type, command, session_id)
+    VALUES %s
+"""
+
+
+class EventBuffer:
+    """Кольцевой буфер событий с фоновым сбросом"""
+
+    def __init__(self, database, max_size: int = 10000, batch_size: int = 500,
+                 flush_interval: float = 2.0, cache: Optional[UserCache] = None,
+                 sessions: Optional[SessionStore] = None, counter: Optional[ActiveUserCounter] = None):
+        """
+        Args:
+            database: Экземпляр Database
+            max_size: Предел буфера; при переполнении вытесняются самые старые события
+            batch_size: Максимум событий в одной транзакции
+            flush_interval: Максимальная задержка записи в секундах
+            cache: Кэш пользователей (по умолчанию глобальный)
+            sessions: Хранилище открытых сессий (без него события пишутся без сессии)
+            counter: HLL активных пользователей (по умолчанию глобальный)
+        """
+        self.db = database
+        self.cache = cache or user_cache
+        self.sessions = sessions
+        self.counter = counter or active_users
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._events: Deque[BufferedEvent] = deque(maxlen=max_size)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self.dropped = 0
+        self.flushed = 0
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def append(self, event: BufferedEvent) -> None:
+        """Добавляет событие (без обращения к БД)"""
+        if len(self._events) == self._events.maxlen:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"Event buffer overflow, dropped {self.dropped} events so far")
+        self._events.append(event)
+
+        if self._wakeup and len(self._events) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        """Запускает фоновый сброс в текущем event loop"""
+        if self._task and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Event buffer started (batch={self.batch_size}, interval={self.flush_interval}s)")
+
+    async def stop(self) -> None:
+        """Останавливает фоновый сброс и записывает все оставшиеся события"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        while self._events:
+            if not await self.flush():
+                logger.error(f"Event buffer stopped with {len(self._events)} unsaved events")
+                break
+        logger.info(f"Event buffer stopped, {self.flushed} events written, {self.dropped} dropped")
+
+    async def _run(self) -> None:
+        """Сбрасывает буфер по таймеру или по заполнению пачки"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            while self._events:
+                if not await self.flush():
+                    # БД недоступна - события остаются в буфере до следующего раза
+                    await asyncio.sleep(self.flush_interval)
+                    break
+                if len(self._events) < self.batch_size:
+                    break
+
+    async def flush(self) -> bool:
+        """
+        Записывает одну пачку событий
+
+        Returns:
+            False, если запись не удалась (события возвращены в буфер)
+        """
+        async with self._flush_lock:
+            batch: List[BufferedEvent] = []
+            while self._events and len(batch) < self.batch_size:
+                batch.append(self._events.popleft())
+            if not batch:
+                return True
+
+            try:
+                # Сессию назначаем один раз: при повторе после ошибки счетчики не удваиваются
+                pending = [event for event in batch if event.session_id is None]
+                if self.sessions is not None and pending:
+                    session_ids = await self.sessions.touch_many([(event.tg_id, event.ts) for event in pending])
+                    for event, session_id in zip(pending, session_ids):
+                        event.session_id = session_id
+
+                # DAU/WAU/MAU (PFADD идемпотентен, повтор пачки не искажает счетчики)
+                await self.counter.record_many((event.tg_id, event.ts) for event in batch)
+
+                # id известных пользователей берем из кэша, last_seen_at пишем не чаще интервала
+                now = time.time()
+                known: Dict[int, int] = {}
+                for tg_id in {event.tg_id for event in batch}:
+                    cached = await self.cache.get(tg_id)
+                    if cached is not None and not self.cache.last_seen_due(tg_id, now):
+                        known[tg_id] = cached.id
+
+                upserted = await self.db.run_in_transaction(
+                    lambda cursor: self._write_batch(cursor, batch, known)
+                )
+                self.flushed += len(batch)
+            except Exception as e:
+                logger.error(f"Failed to flush {len(batch)} events: {e}")
+                # Возвращаем пачку в начало буфера в исходном порядке
+                free = self._events.maxlen - len(self._events)
+                for event in reversed(batch[-free:] if free else []):
+                    self._events.appendleft(event)
+                self.dropped += max(0, len(batch) - free)
+                return False
+
+        await self.cache.store_many({
+            tg_id: CachedUser(id=user_id, language=language, is_blocked=bool(is_blocked),
+                              last_seen_written=now)
+            for user_id, tg_id, language, is_blocked in upserted
+        })
+        return True
+
+    @staticmethod
+    def _write_batch(cursor, batch: List[BufferedEvent], known: Dict[int, int]) -> List[tuple]:
+        """
+        Пишет пачку в рамках одной транзакции (выполняется в executor)
+
+        Args:
+            known: tg_id -> users.id для пользователей, которых не нужно обновлять
+
+        Returns:
+            Строки (id, tg_id, language, is_blocked) обновленных пользователей
+        """
+        # Пользователи: одна строка на tg_id
+        users: Dict[int, tuple] = {}
+        for event in batch:
+            if event.tg_id in known:
+                continue
+            first_ts, _, username = users.get(event.tg_id, (event.ts, event.ts, None))
+            users[event.tg_id] = (min(first_ts, event.ts), event.ts, event.username or username)
+
+        returned = []
+        if users:
+            user_rows = [(tg_id, username, first_ts, last_ts)
+                         for tg_id, (first_ts, last_ts, username) in sorted(users.items())]
+            returned = execute_values(cursor, UPSERT_USERS_SQL, user_rows,
+                                      page_size=len(user_rows), fetch=True)
+        user_ids = dict(known)
+        user_ids.update({tg_id: user_id for user_id, tg_id, _, _ in returned})
+
+        event_rows = [
+            (user_ids[event.tg_id], event.ts, event.event_type, event.command, event.session_id)
+            for event in batch
+        ]
+        execute_values(cursor, INSERT_EVENTS_SQL, event_rows, page_size=len(event_rows))
+        return returned
@@ -2,13 +2,21 @@
 SQLAlchemy модели для работы с базой данных
 """
 
+import time
 import asyncio
 import logging
+from contextlib import asynccontextmanager
 from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey, Text, UUID as PGUUID, Date
+from typing import Dict, Optional
+from sqlalchemy import create_engine, Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey, Text, UUID as PGUUID, Date, Float, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 
+from .user_cache import CachedUser, user_cache
+from . import pg_pool
+from .query_metrics import query_metrics, query_name
+from .quotas import GMAIL, quotas
+
 Base = declarative_base()
 
 logger = logging.getLogger(__name__)
@@ -37,17 +45,27 @@ class User(Base):
 class Event(Base):
     """Модель события"""
     __tablename__ = 'events'
+    # Месячные партиции по ts (миграция 008, обслуживание - database.partitions)
+    __table_args__ = (
+        Index('idx_events_user_ts', 'user_id', 'ts'),
+        Index('idx_events_ts_brin', 'ts', postgresql_using='brin'),
+        Index('idx_events_command_ts', 'ts', 'command', postgresql_where=text('command IS NOT NULL')),
+        {'postgresql_partition_by': 'RANGE (ts)'},
+    )
     
-    id = Column(Integer, primary_key=True, autoincrement=True)
+    # Первичный ключ партиционированной таблицы включает ключ партиции
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=True)
-    ts = Column(DateTime, nullable=False, default=datetime.utcnow)
+    ts = Column(DateTime, primary_key=True, nullable=False, default=datetime.utcnow)
     event_type = Column(Text, nullable=False)  # 'command', 'message', 'callback', etc.
     command = Column(Text, nullable=True)  # Название команды/функции
-    session_id = Column(PGUUID(as_uuid=True), ForeignKey('sessions.id'), nullable=True)
+    # Без внешнего ключа: строка сессии появляется только после ее завершения
+    session_id = Column(PGUUID(as_uuid=True), nullable=True)
     
     # Отношения
     user = relationship("User", back_populates="events")
-    session = relationship("Session", back_populates="events")
+    session = relationship("Session", back_populates="events",
+                           primaryjoin="foreign(Event.session_id) == Session.id", viewonly=True)
     
     def __repr__(self):
         return f"<Event(id={self.id}, user_id={self.user_id}, type={self.event_type}, command={self.command})>"
@@ -66,21 +84,70 @@ class Session(Base):
     
     # Отношения
     user = relationship("User", back_populates="sessions")
-    events = relationship("Event", back_populates="session", cascade="all, delete-orphan")
+    events = relationship("Event", back_populates="session",
+                          primaryjoin="Session.id == foreign(Event.session_id)", viewonly=True)
     
     def __repr__(self):
         return f"<Session(id={self.id}, user_id={self.user_id}, events={self.events_count})>"
 
 
 # Класс для работы с базой данных
+# Запросы, которые asyncpg не смог выполнить - сразу идут через psycopg2
+_executor_queries = set()
+
+
+class _PoolTransaction:
+    """Запросы внутри транзакции asyncpg"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def execute(self, query: str, params=None, fetch: bool = False):
+        converted = pg_pool.convert_query(query, params)
+        if converted is None:
+            raise ValueError(f"Query cannot be run on asyncpg: {query[:80]}")
+        return await pg_pool.run(self.connection, *converted, fetch)
+
+
+class _SyncTransaction:
+    """Запросы внутри транзакции psycopg2 (без asyncpg)"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def execute(self, query: str, params=None, fetch: bool = False):
+        def _run_query():
+            with self.connection.cursor() as cursor:
+                cursor.execute(query, params or ())
+                if fetch or cursor.description:
+                    columns = [col[0] for col in cursor.description] if cursor.description else []
+                    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+                return None
+
+        return await self.run(_run_query)
+
+
 class Database:
     """Менеджер базы данных"""
     
-    def __init__(self, database_url: str):
+    def __init__(self, database_url: str, pool_max_size: int = 20, statement_cache_size: int = 256):
+        """
+        Args:
+            database_url: URL подключения SQLAlchemy
+            pool_max_size: Размер общего пула asyncpg для execute
+            statement_cache_size: Сколько подготовленных выражений кэшировать на соединение
+        """
         # Заменяем драйвер если нужно
         if "postgresql+psycopg://" in database_url:
             database_url = database_url.replace("postgresql+psycopg://", "postgresql+psycopg2://")
         
+        self.database_url = database_url
+        self.pool_max_size = pool_max_size
+        self.statement_cache_size = statement_cache_size
         self.engine = create_engine(database_url, pool_size=10, max_overflow=20)
         self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
         
@@ -92,12 +159,67 @@ class Database:
         """Создать таблицы если их нет"""
         Base.metadata.create_all(bind=self.engine)
 
-    async def execute(self, query: str, params=None, fetch: bool = False):
-        """Выполняет SQL запрос асинхронно."""
+    async def _pool(self):
+        """Общий пул asyncpg (None - asyncpg недоступен)"""
+        return await pg_pool.get_pool(
+            self.database_url,
+            max_size=self.pool_max_size,
+            statement_cache_size=self.statement_cache_size,
+        )
+
+    async def execute(self, query: str, params=None, fetch: bool = False, name: Optional[str] = None):
+        """
+        Выполняет SQL запрос асинхронно
+        
+        Запрос в формате psycopg2 (%s, %(name)s) выполняется через общий пул
+        asyncpg; запросы, которые asyncpg не принимает, и окружение без
+        asyncpg идут через psycopg2 в executor. Задержка, строки и ожидание
+        соединения учитываются в query_metrics под именем name (по умолчанию
+        выводится из текста запроса).
+        """
+        timing = {}
+        started = time.perf_counter()
+        try:
+            result = await self._execute(query, params, fetch, timing)
+        except Exception:
+            query_metrics.record(name or query_name(query), query, time.perf_counter() - started,
+                                 pool_wait=timing.get('wait'), error=True)
+            raise
+
+        query_metrics.record(
+            name or query_name(query), query, time.perf_counter() - started,
+            rows=len(result) if isinstance(result, list) else 0,
+            pool_wait=timing.get('wait'),
+            explain=lambda plan_sql: self._execute(plan_sql, params, True, {}),
+        )
+        return result
+
+    async def _execute(self, query: str, params, fetch: bool, timing: Dict):
+        if query not in _executor_queries:
+            pool = await self._pool()
+            converted = pg_pool.convert_query(query, params) if pool is not None else None
+            if converted is not None:
+                try:
+                    return await pg_pool.run(pool, *converted, fetch, timing)
+                except pg_pool.BIND_ERRORS as e:
+                    if not pg_pool.is_bind_error(e):
+                        raise
+                    logger.debug(f"Query falls back to psycopg2 ({type(e).__name__}): {query[:80]}")
+                    _executor_queries.add(query)
+            elif pool is not None:
+                _executor_queries.add(query)
+        return await self._execute_sync(query, params, fetch, timing)
+
+    async def _execute_sync(self, query: str, params=None, fetch: bool = False, timing: Optional[Dict] = None):
+        """Выполняет запрос через psycopg2 в executor"""
         params = params or ()
+        submitted = time.perf_counter()
 
         def _run_query():
             connection = self.engine.raw_connection()
+            if timing is not None:
+                # Очередь executor + выдача соединения из пула SQLAlchemy
+                timing['wait'] = time.perf_counter() - submitted
             try:
                 with connection.cursor() as cursor:
                     cursor.execute(query, params)
@@ -119,16 +241,74 @@ class Database:
         loop = asyncio.get_running_loop()
         return await loop.run_in_executor(None, _run_query)
 
+    async def run_in_transaction(self, func):
+        """
+        Выполняет func(cursor) в одной транзакции (в executor)
+        
+        Для пакетных операций из нескольких запросов: при ошибке
+        транзакция откатывается целиком.
+        """
+        def _run():
+            connection = self.engine.raw_connection()
+            try:
+                with connection.cursor() as cursor:
+                    result = func(cursor)
+                connection.commit()
+                return result
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                connection.close()
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, _run)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Явная транзакция на одном соединении пула asyncpg
+        
+            async with db.transaction() as tx:
+                await tx.execute("UPDATE ... WHERE id = %s", (user_id,))
+        
+        Без asyncpg запросы выполняются на одном соединении psycopg2.
+        """
+        pool = await self._pool()
+        if pool is None:
+            connection = self.engine.raw_connection()
+            tx = _SyncTransaction(connection)
+            try:
+                yield tx
+                await tx.run(connection.commit)
+            except BaseException:
+                await tx.run(connection.rollback)
+                raise
+            finally:
+                connection.close()
+            return
+
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                yield _PoolTransaction(connection)
+
     async def get_user_language(self, tg_id: int) -> str:
-        """Получает сохраненный язык пользователя"""
+        """Получает сохраненный язык пользователя (из кэша профилей, если есть)"""
         try:
-            query = "SELECT language FROM users WHERE tg_id = %s"
+            cached = await user_cache.get(tg_id)
+            if cached is not None:
+                return cached.language
+            
+            query = "SELECT id, language, is_blocked FROM users WHERE tg_id = %s"
             result = await self.execute(query, (tg_id,), fetch=True)
             
-            if result and result[0]['language']:
-                return result[0]['language']
-            else:
-                return None  # Язык не установлен
+            if result:
+                row = result[0]
+                await user_cache.put(tg_id, CachedUser(
+                    id=row['id'], language=row['language'], is_blocked=bool(row['is_blocked'])
+                ))
+                return row['language']  # None, если язык не установлен
+            return None
                 
         except Exception as e:
             logger.error(f"Error getting user language: {e}")
@@ -137,26 +317,23 @@ class Database:
     async def set_user_language(self, tg_id: int, language: str, username: str = None) -> bool:
         """Сохраняет язык пользователя (создает пользователя если не существует)"""
         try:
-            # Пытаемся обновить существующего пользователя
+            # Один UPSERT вместо UPDATE + INSERT
             query = """
-                UPDATE users 
-                SET language = %s, username = COALESCE(%s, username), last_seen_at = NOW()
-                WHERE tg_id = %s
+                INSERT INTO users (tg_id, username, language, first_seen_at, last_seen_at)
+                VALUES (%s, %s, %s, NOW(), NOW())
+                ON CONFLICT (tg_id) DO UPDATE SET
+                    language = EXCLUDED.language,
+                    username = COALESCE(EXCLUDED.username, users.username),
+                    last_seen_at = EXCLUDED.last_seen_at
+                RETURNING id, is_blocked
             """
-            result = await self.execute(query, (language, username, tg_id))
-            
-            # Если пользователь не найден, создаем нового
-            if not result:
-                insert_query = """
-                    INSERT INTO users (tg_id, username, language, first_seen_at, last_seen_at)
-                    VALUES (%s, %s, %s, NOW(), NOW())
-                    ON CONFLICT (tg_id) DO UPDATE SET
-                        language = EXCLUDED.language,
-                        username = COALESCE(EXCLUDED.username, users.username),
-                        last_seen_at = EXCLUDED.last_seen_at
-                """
-                await self.execute(insert_query, (tg_id, username, language))
+            result = await self.execute(query, (tg_id, username, language), fetch=True)
             
+            if result:
+                await user_cache.put(tg_id, CachedUser(
+                    id=result[0]['id'], language=language,
+                    is_blocked=bool(result[0]['is_blocked']), last_seen_written=time.time()
+                ))
             return True
             
         except Exception as e:
@@ -165,53 +342,20 @@ class Database:
 
     async def get_gmail_usage_today(self, tg_id: int) -> int:
         """Получает количество использованных Gmail-алиасов за сегодня"""
-        try:
-            today = datetime.now().date()
-            query = """
-                SELECT count FROM gmail_alias_usage 
-                WHERE user_id = %s AND usage_date = %s
-            """
-            result = await self.execute(query, (tg_id, today), fetch=True)
-            
-            if result:
-                return result[0]['count']
-            else:
-                return 0
-                
-        except Exception as e:
-            logger.error(f"Error getting Gmail usage: {e}")
-            return 0
+        return (await quotas.usage(GMAIL, tg_id)).used
 
     async def increment_gmail_usage(self, tg_id: int, count: int) -> bool:
-        """Увеличивает счетчик использования Gmail-алиасов на указанное количество"""
-        try:
-            today = datetime.now().date()
-            
-            # Используем UPSERT для увеличения счетчика
-            query = """
-                INSERT INTO gmail_alias_usage (user_id, usage_date, count)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (user_id, usage_date) 
-                DO UPDATE SET count = gmail_alias_usage.count + %s
-            """
-            await self.execute(query, (tg_id, today, count, count))
-            
-            return True
-            
-        except Exception as e:
-            logger.error(f"Error incrementing Gmail usage: {e}")
-            return False
+        """
+        Списывает count Gmail-алиасов из дневной квоты
 
-    async def get_gmail_remaining_quota(self, tg_id: int, max_daily: int = 10) -> int:
-        """Получает оставшуюся квоту Gmail-алиасов на сегодня"""
-        try:
-            used_today = await self.get_gmail_usage_today(tg_id)
-            remaining = max_daily - used_today
-            return max(0, remaining)
-            
-        except Exception as e:
-            logger.error(f"Error getting Gmail remaining quota: {e}")
-            return 0
+        Returns:
+            False, если квоты не хватает (ничего не списано)
+        """
+        return (await quotas.consume(GMAIL, tg_id, count)).allowed
+
+    async def get_gmail_remaining_quota(self, tg_id: int, max_daily: Optional[int] = None) -> int:
+        """Получает оставшуюся квоту Gmail-алиасов на сегодня (лимит задается в quotas)"""
+        return await quotas.remaining(GMAIL, tg_id)
 
 
 class PlatformCookie(Base):
@@ -238,6 +382,26 @@ class PlatformCookie(Base):
         return f"<PlatformCookie(id={self.id}, platform={self.platform}, active={self.is_active})>"
 
 
+class DownloadProxy(Base):
+    """Модель прокси для скачивания видео"""
+    __tablename__ = 'download_proxies'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    url = Column(String(300), nullable=False, unique=True)
+    platforms = Column(String(200), nullable=True)  # Через запятую, NULL - все платформы
+    is_active = Column(Boolean, nullable=False, default=True)
+    latency_ms = Column(Float, nullable=True)  # EWMA задержки подключения
+    throughput_bps = Column(Float, nullable=True)  # EWMA скорости скачивания
+    success_count = Column(Integer, nullable=False, default=0)
+    error_count = Column(Integer, nullable=False, default=0)
+    last_checked_at = Column(DateTime, nullable=True)
+    added_by = Column(BigInteger, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<DownloadProxy(id={self.id}, latency_ms={self.latency_ms}, active={self.is_active})>"
+
+
 class GmailAliasUsage(Base):
     """Модель учета использования Gmail-алиасов"""
     __tablename__ = 'gmail_alias_usage'
@@ -276,3 +440,114 @@ class KashmailDailyCounter(Base):
     
     def __repr__(self):
         return f"<KashmailDailyCounter(user_id={self.user_id}, day={self.day}, count={self.count})>"
+
+
+class RandomFaceDailyCounter(Base):
+    """Модель дневного счетчика Random Face (копия счетчика из Redis)"""
+    __tablename__ = 'random_face_daily_counters'
+
+    user_id = Column(BigInteger, nullable=False, primary_key=True)
+    day = Column(Date, nullable=False, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<RandomFaceDailyCounter(user_id={self.user_id}, day={self.day}, count={self.count})>"
+
+
+class RollupWatermark(Base):
+    """Модель отметки инкрементального пересчета агрегатов"""
+    __tablename__ = 'rollup_watermarks'
+    
+    name = Column(String(50), primary_key=True)  # events | users | sessions
+    last_id = Column(BigInteger, nullable=False, default=0)  # id последней обработанной строки
+    last_ts = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<RollupWatermark(name={self.name}, last_id={self.last_id})>"
+
+
+class RollupDailyUser(Base):
+    """Модель дневной активности пользователя"""
+    __tablename__ = 'rollup_daily_users'
+    
+    day = Column(Date, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    events = Column(Integer, nullable=False, default=0)
+
+
+class RollupDailyCommand(Base):
+    """Модель дневного счетчика команд"""
+    __tablename__ = 'rollup_daily_commands'
+    
+    day = Column(Date, primary_key=True)
+    command = Column(Text, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class RollupHourlyEvents(Base):
+    """Модель почасового счетчика событий"""
+    __tablename__ = 'rollup_hourly_events'
+    
+    hour = Column(DateTime, primary_key=True)
+    events = Column(Integer, nullable=False, default=0)
+
+
+class RollupDailyNewUsers(Base):
+    """Модель дневного счетчика новых пользователей"""
+    __tablename__ = 'rollup_daily_new_users'
+    
+    day = Column(Date, primary_key=True)
+    users = Column(Integer, nullable=False, default=0)
+
+
+class RollupDailySessions(Base):
+    """Модель дневной статистики сессий"""
+    __tablename__ = 'rollup_daily_sessions'
+    
+    day = Column(Date, primary_key=True)
+    sessions = Column(Integer, nullable=False, default=0)
+    timed_sessions = Column(Integer, nullable=False, default=0)  # Завершенные с длительностью > 0
+    duration_seconds = Column(BigInteger, nullable=False, default=0)
+    events = Column(BigInteger, nullable=False, default=0)
+
+
+class BroadcastJob(Base):
+    """Модель задания рассылки"""
+    __tablename__ = 'broadcast_jobs'
+    
+    id = Column(Integer, primary_key=True)
+    status = Column(String(20), nullable=False, default='pending')  # pending | running | done | cancelled
+    segment = Column(String(20), nullable=False)
+    content = Column(Text, nullable=False)  # JSON пересланного сообщения
+    admin_chat_id = Column(BigInteger, nullable=True)
+    progress_message_id = Column(BigInteger, nullable=True)
+    total = Column(Integer, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    blocked = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    last_user_id = Column(BigInteger, nullable=False, default=0)  # users.id последней обработанной страницы
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('idx_broadcast_jobs_active', 'id', postgresql_where=text("status IN ('pending', 'running')")),
+    )
+    
+    def __repr__(self):
+        return f"<BroadcastJob(id={self.id}, status={self.status}, sent={self.sent}/{self.total})>"
+
+
+class BroadcastDelivery(Base):
+    """Модель результата рассылки одному получателю"""
+    __tablename__ = 'broadcast_deliveries'
+    
+    job_id = Column(Integer, ForeignKey('broadcast_jobs.id', ondelete='CASCADE'), primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    tg_id = Column(BigInteger, nullable=False)
+    status = Column(String(10), nullable=False)  # sent | blocked | failed
+    error = Column(String(255), nullable=True)
+    attempts = Column(Integer, nullable=False, default=1)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
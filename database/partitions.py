@@ -0,0 +1,182 @@
+"""
+Обслуживание месячных партиций таблицы events
+
+Таблица events партиционирована по ts (миграция 008). Фоновая задача
+заранее создает партиции на ближайшие месяцы и, если задан срок хранения,
+удаляет партиции старше него - удаление партиции вместо DELETE не
+оставляет мертвых строк и не требует VACUUM.
+
+Если обслуживание не успело, события месяца без партиции попадают в
+events_default. CREATE TABLE ... PARTITION OF для такого месяца
+невозможен (нарушит ограничение default-партиции), поэтому партиция
+создается отдельной таблицей, строки месяца переносятся в нее из
+default, и только затем она подключается (ATTACH PARTITION).
+"""
+
+import re
+import asyncio
+import logging
+from datetime import date, datetime
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+PARENT_TABLE = 'events'
+PARTITION_NAME_RE = re.compile(r'^events_(\d{4})_(\d{2})$')
+
+LIST_PARTITIONS_SQL = """
+    SELECT child.relname
+    FROM pg_inherits
+    JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE parent.relname = %s AND parent.relkind = 'p'
+"""
+
+IS_PARTITIONED_SQL = "SELECT 1 FROM pg_class WHERE relname = %s AND relkind = 'p'"
+
+DEFAULT_PARTITION_SQL = """
+    SELECT partdefid::regclass::text FROM pg_partitioned_table
+    WHERE partrelid = %s::regclass AND partdefid <> 0
+"""
+
+
+def month_start(value) -> date:
+    """Первое число месяца"""
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{PARENT_TABLE}_{month:%Y_%m}"
+
+
+def partition_month(name: str) -> Optional[date]:
+    """Месяц партиции по имени (None - не месячная партиция, например events_default)"""
+    match = PARTITION_NAME_RE.match(name)
+    if not match:
+        return None
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def create_partition_sql(month: date) -> str:
+    return (
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF {PARENT_TABLE} "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    )
+
+
+def move_from_default_sql(month: date, default: str) -> List[str]:
+    """Создание партиции месяца, строки которого уже лежат в default-партиции"""
+    name = partition_name(month)
+    start, end = month.isoformat(), add_months(month, 1).isoformat()
+    return [
+        f"CREATE TABLE {name} (LIKE {PARENT_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)",
+        f"WITH moved AS (DELETE FROM {default} WHERE ts >= '{start}' AND ts < '{end}' RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved",
+        # Индексы и внешние ключи родителя создаются при подключении
+        f"ALTER TABLE {PARENT_TABLE} ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')",
+    ]
+
+
+class EventPartitionManager:
+    """Создание будущих и удаление устаревших партиций events"""
+
+    def __init__(self, database, months_ahead: int = 2, retention_months: int = 0):
+        """
+        Args:
+            database: Экземпляр Database
+            months_ahead: На сколько месяцев вперед держать готовые партиции
+            retention_months: Сколько полных месяцев хранить (0 - хранить все)
+        """
+        self.db = database
+        self.months_ahead = months_ahead
+        self.retention_months = retention_months
+        self._task: Optional[asyncio.Task] = None
+
+    def _maintenance(self, now: Optional[datetime] = None):
+        """Один проход обслуживания (выполняется в executor)"""
+        current = month_start(now or datetime.utcnow())
+
+        def _maintain(cursor):
+            cursor.execute(IS_PARTITIONED_SQL, (PARENT_TABLE,))
+            if not cursor.fetchone():
+                # Миграция 008 не применена - обслуживать нечего
+                return [], []
+
+            cursor.execute(LIST_PARTITIONS_SQL, (PARENT_TABLE,))
+            existing = {partition_month(name) for name, in cursor.fetchall()}
+
+            # Месяцы, события которых попали в default-партицию (обычно она пуста)
+            cursor.execute(DEFAULT_PARTITION_SQL, (PARENT_TABLE,))
+            row = cursor.fetchone()
+            default = row[0] if row else None
+            stranded = set()
+            if default:
+                cursor.execute(f"SELECT DISTINCT date_trunc('month', ts)::date FROM {default}")
+                stranded = {month_start(month) for month, in cursor.fetchall()}
+
+            wanted = {add_months(current, offset) for offset in range(self.months_ahead + 1)}
+            created = []
+            for month in sorted((wanted | stranded) - existing):
+                if month in stranded:
+                    for sql in move_from_default_sql(month, default):
+                        cursor.execute(sql)
+                else:
+                    cursor.execute(create_partition_sql(month))
+                existing.add(month)
+                created.append(partition_name(month))
+
+            dropped = []
+            if self.retention_months > 0:
+                oldest_kept = add_months(current, -self.retention_months)
+                for month in sorted(m for m in existing if m is not None and m < oldest_kept):
+                    cursor.execute(f"DROP TABLE IF EXISTS {partition_name(month)}")
+                    dropped.append(partition_name(month))
+
+            return created, dropped
+
+        return _maintain
+
+    async def maintain(self, now: Optional[datetime] = None):
+        """
+        Создает недостающие партиции и удаляет устаревшие
+
+        Returns:
+            Tuple[созданные партиции, удаленные партиции]
+        """
+        created, dropped = await self.db.run_in_transaction(self._maintenance(now))
+        if created:
+            logger.info(f"Created event partitions: {', '.join(created)}")
+        if dropped:
+            logger.info(f"Dropped expired event partitions: {', '.join(dropped)}")
+        return created, dropped
+
+    def start(self, interval: float = 6 * 3600) -> None:
+        """Запускает периодическое обслуживание партиций"""
+        if self._task and not self._task.done():
+            return
+
+        async def _loop():
+            while True:
+                try:
+                    await self.maintain()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Event partition maintenance failed: {e}")
+                await asyncio.sleep(interval)
+
+        self._task = asyncio.create_task(_loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
@@ -0,0 +1,243 @@
+"""
+Общий пул asyncpg для Database.execute
+
+Все экземпляры Database с одной строкой подключения используют один пул
+asyncpg на процесс: запросы выполняются без перехода в поток executor и
+без отдельного COMMIT на каждый запрос (autocommit), подготовленные
+выражения кэшируются на соединениях пула.
+
+Вызовы в стиле psycopg2 (%s, %(name)s, %%) переводятся в $1..$n.
+Запросы, которые asyncpg выполнить не может (плейсхолдер внутри
+строкового литерала, кортеж для IN, параметр без выводимого типа),
+выполняются старым путем через psycopg2 - такой запрос запоминается и
+сразу идет туда.
+
+Колонки json/jsonb декодируются в списки и словари, как в psycopg2 (без
+кодека asyncpg вернул бы строку).
+"""
+
+import re
+import json
+import time
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import asyncpg
+except ImportError:  # asyncpg есть только в production-зависимостях
+    asyncpg = None
+
+logger = logging.getLogger(__name__)
+
+DOLLAR_TAG_RE = re.compile(r'\$[A-Za-z_]*\$')
+
+# Ошибки привязки параметров: возникают до выполнения запроса, поэтому
+# повтор через psycopg2 безопасен (вне явной транзакции)
+if asyncpg is not None:
+    BIND_ERRORS = (
+        asyncpg.exceptions.DataError,
+        asyncpg.exceptions.IndeterminateDatatypeError,
+        asyncpg.exceptions.AmbiguousParameterError,
+        asyncpg.exceptions.UndefinedFunctionError,
+        asyncpg.exceptions.DatatypeMismatchError,
+    )
+else:
+    BIND_ERRORS = ()
+
+
+def is_bind_error(error: Exception) -> bool:
+    """Запрос не удалось подготовить или передать параметры (а не ошибка выполнения)"""
+    if not isinstance(error, BIND_ERRORS):
+        return False
+    if type(error) is asyncpg.exceptions.DataError:
+        # Сам asyncpg не смог закодировать аргумент (например, str для int)
+        return str(error).startswith('invalid input for query argument')
+    # Подклассы DataError - ошибки данных при выполнении на сервере
+    return not isinstance(error, asyncpg.exceptions.DataError)
+
+
+_pools: Dict[str, Any] = {}
+_pool_locks: Dict[str, asyncio.Lock] = {}
+_disabled: Dict[str, str] = {}
+
+
+def asyncpg_dsn(database_url: str) -> str:
+    """URL SQLAlchemy (postgresql+psycopg2://...) -> DSN asyncpg"""
+    scheme, sep, rest = database_url.partition('://')
+    return f"{scheme.split('+', 1)[0]}{sep}{rest}"
+
+
+def convert_query(query: str, params=None) -> Optional[Tuple[str, List[Any]]]:
+    """
+    Переводит запрос psycopg2 в формат asyncpg
+
+    Returns:
+        (запрос с $n, список аргументов) или None, если перевести нельзя
+    """
+    named = isinstance(params, dict)
+    positional = list(params) if params and not named else []
+    values = params.values() if named else positional
+    if any(isinstance(value, tuple) for value in values):
+        # psycopg2 раскрывает кортеж в (a, b, ...) для IN - в asyncpg нужен = ANY(list)
+        return None
+    args: List[Any] = []
+    names: Dict[str, int] = {}
+    out: List[str] = []
+    quote: Optional[str] = None  # "'", '"' или $tag$
+    i, n = 0, len(query)
+
+    while i < n:
+        ch = query[i]
+
+        if quote is not None:
+            if query.startswith(quote, i):
+                if quote == "'" and query.startswith("''", i):
+                    out.append("''")
+                    i += 2
+                    continue
+                out.append(quote)
+                i += len(quote)
+                quote = None
+                continue
+            if ch == '%':
+                if query.startswith('%%', i):
+                    out.append('%')
+                    i += 2
+                    continue
+                # psycopg2 подставляет значение прямо в литерал - asyncpg так не умеет
+                return None
+            out.append(ch)
+            i += 1
+            continue
+
+        if ch in ("'", '"'):
+            quote = ch
+            out.append(ch)
+            i += 1
+            continue
+        if ch == '$':
+            tag = DOLLAR_TAG_RE.match(query, i)
+            if tag:
+                quote = tag.group()
+                out.append(quote)
+                i += len(quote)
+                continue
+        if query.startswith('--', i):
+            end = query.find('\n', i)
+            end = n if end == -1 else end
+            out.append(query[i:end])
+            i = end
+            continue
+        if ch == '%':
+            if query.startswith('%%', i):
+                out.append('%')
+                i += 2
+                continue
+            if query.startswith('%s', i):
+                if named or len(args) >= len(positional):
+                    return None
+                args.append(positional[len(args)])
+                out.append(f"${len(args)}")
+                i += 2
+                continue
+            if query.startswith('%(', i):
+                end = query.find(')s', i)
+                if end == -1 or not named:
+                    return None
+                name = query[i + 2:end]
+                if name not in names:
+                    args.append(params[name])
+                    names[name] = len(args)
+                out.append(f"${names[name]}")
+                i = end + 2
+                continue
+        out.append(ch)
+        i += 1
+
+    if not named and len(args) != len(positional):
+        return None
+    return ''.join(out), args
+
+
+def _encode_json(value: Any) -> str:
+    """Параметр json/jsonb: строку (уже сериализованную, как для psycopg2) - как есть"""
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+async def init_connection(conn) -> None:
+    """Кодеки json/jsonb для нового соединения пула"""
+    for type_name in ('json', 'jsonb'):
+        await conn.set_type_codec(type_name, encoder=_encode_json, decoder=json.loads, schema='pg_catalog')
+
+
+async def get_pool(database_url: str, min_size: int = 1, max_size: int = 20,
+                   statement_cache_size: int = 256):
+    """
+    Пул asyncpg для строки подключения (создается при первом обращении)
+
+    Returns:
+        Пул или None, если asyncpg недоступен или подключиться не удалось
+    """
+    if asyncpg is None:
+        return None
+    dsn = asyncpg_dsn(database_url)
+    pool = _pools.get(dsn)
+    if pool is not None or dsn in _disabled:
+        return pool
+
+    lock = _pool_locks.setdefault(dsn, asyncio.Lock())
+    async with lock:
+        if dsn in _pools or dsn in _disabled:
+            return _pools.get(dsn)
+        try:
+            _pools[dsn] = await asyncpg.create_pool(
+                dsn,
+                min_size=min_size,
+                max_size=max_size,
+                statement_cache_size=statement_cache_size,
+                max_inactive_connection_lifetime=300,
+                command_timeout=60,
+                init=init_connection,
+            )
+            logger.info(f"asyncpg pool created (max_size={max_size})")
+        except Exception as e:
+            _disabled[dsn] = str(e)
+            logger.warning(f"asyncpg pool unavailable, using psycopg2 executor: {e}")
+            return None
+    return _pools[dsn]
+
+
+async def close_pools() -> None:
+    """Закрывает все пулы (при остановке бота)"""
+    for dsn, pool in list(_pools.items()):
+        try:
+            await pool.close()
+        except Exception as e:
+            logger.warning(f"Error closing asyncpg pool: {e}")
+        _pools.pop(dsn, None)
+
+
+async def run(connection, sql: str, args: List[Any], fetch: bool, timing: Optional[Dict] = None):
+    """
+    Выполняет переведенный запрос на соединении или пуле
+
+    Возвращает то же, что и прежний Database.execute: список словарей для
+    запросов со строками результата, None для остальных без fetch.
+
+    Args:
+        timing: Сюда записывается ожидание соединения из пула ('wait', сек)
+    """
+    if hasattr(connection, 'acquire'):
+        started = time.perf_counter()
+        async with connection.acquire() as conn:
+            if timing is not None:
+                timing['wait'] = time.perf_counter() - started
+            rows = await conn.fetch(sql, *args)
+    else:
+        rows = await connection.fetch(sql, *args)
+    if rows or fetch:
+        return [dict(row) for row in rows]
+    return None
@@ -0,0 +1,221 @@
+"""
+Метрики SQL-запросов
+
+Каждый запрос через Database.execute (и AsyncDatabase) учитывается под
+своим именем: гистограмма задержки, число строк, ошибки, время ожидания
+соединения из пула. Имя передается явно или выводится из текста запроса
+("select:users", "insert:events"). Метрики отдаются в формате Prometheus
+на /metrics webhook-сервера.
+
+Запросы дольше порога пишутся в лог; для части медленных SELECT в фоне
+выполняется EXPLAIN (ANALYZE, BUFFERS), и план тоже пишется в лог - не
+чаще раза в explain_cooldown секунд для одного имени.
+"""
+
+import re
+import time
+import random
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+VERB_RE = re.compile(r'^\s*(\w+)', re.IGNORECASE)
+TABLE_RE = {
+    'insert': re.compile(r'\binto\s+([\w.]+)', re.IGNORECASE),
+    'update': re.compile(r'^\s*update\s+([\w.]+)', re.IGNORECASE),
+}
+FROM_RE = re.compile(r'\bfrom\s+([\w.]+)', re.IGNORECASE)
+WRITE_RE = re.compile(r'\b(insert|update|delete|merge|truncate)\b', re.IGNORECASE)
+
+_names: Dict[str, str] = {}
+
+
+def query_name(query: str) -> str:
+    """Имя запроса по тексту: глагол и первая таблица"""
+    name = _names.get(query)
+    if name is not None:
+        return name
+
+    verb_match = VERB_RE.match(query)
+    verb = verb_match.group(1).lower() if verb_match else 'query'
+    table_match = TABLE_RE.get(verb, FROM_RE).search(query)
+    name = f"{verb}:{table_match.group(1).lower()}" if table_match else verb
+
+    if len(_names) < 2000:
+        _names[query] = name
+    return name
+
+
+def explain_sql(query: str) -> Optional[str]:
+    """EXPLAIN (ANALYZE, BUFFERS) для запроса только на чтение (None - запрос что-то пишет)"""
+    verb_match = VERB_RE.match(query)
+    if not verb_match or verb_match.group(1).lower() not in ('select', 'with'):
+        return None
+    if WRITE_RE.search(query):
+        return None
+    return f"EXPLAIN (ANALYZE, BUFFERS) {query}"
+
+
+class Histogram:
+    """Гистограмма с накопительными корзинами в стиле Prometheus"""
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+    def render(self, metric: str, labels: str = '') -> List[str]:
+        prefix = f"{labels}," if labels else ''
+        lines = [
+            f'{metric}_bucket{{{prefix}le="{bound}"}} {count}'
+            for bound, count in zip(self.buckets, self.counts)
+        ]
+        lines.append(f'{metric}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ''
+        lines.append(f"{metric}_sum{suffix} {self.sum:.6f}")
+        lines.append(f"{metric}_count{suffix} {self.count}")
+        return lines
+
+
+class QueryStats:
+    """Метрики одного имени запроса"""
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.rows = 0
+        self.errors = 0
+        self.slow = 0
+
+
+def _label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+class QueryMetrics:
+    """Реестр метрик запросов и захват медленных запросов"""
+
+    def __init__(self, slow_threshold: float = 0.2, explain_sample_rate: float = 0.2,
+                 explain_cooldown: float = 600.0, max_names: int = 200):
+        """
+        Args:
+            slow_threshold: С какой длительности (сек) запрос считается медленным
+            explain_sample_rate: Доля медленных запросов, для которых снимается план
+            explain_cooldown: Не чаще одного плана на имя запроса за столько секунд
+            max_names: Предел различных имен (остальные учитываются как "other")
+        """
+        self.max_names = max_names
+        self.configure(slow_threshold, explain_sample_rate, explain_cooldown)
+        self.reset()
+
+    def configure(self, slow_threshold: float = 0.2, explain_sample_rate: float = 0.2,
+                  explain_cooldown: float = 600.0) -> None:
+        self.slow_threshold = slow_threshold
+        self.explain_sample_rate = explain_sample_rate
+        self.explain_cooldown = explain_cooldown
+
+    def reset(self) -> None:
+        self.queries: Dict[str, QueryStats] = {}
+        self.pool_wait = Histogram()
+        self._explained_at: Dict[str, float] = {}
+        self._explain_tasks = set()
+
+    def _stats(self, name: str) -> QueryStats:
+        stats = self.queries.get(name)
+        if stats is None:
+            if len(self.queries) >= self.max_names:
+                name = 'other'
+            stats = self.queries.setdefault(name, QueryStats())
+        return stats
+
+    def observe(self, name: str, duration: float, rows: int = 0, pool_wait: Optional[float] = None,
+                error: bool = False) -> QueryStats:
+        """Учитывает один выполненный запрос"""
+        stats = self._stats(name)
+        stats.latency.observe(duration)
+        stats.rows += rows
+        if error:
+            stats.errors += 1
+        if duration >= self.slow_threshold:
+            stats.slow += 1
+        if pool_wait is not None:
+            self.pool_wait.observe(pool_wait)
+        return stats
+
+    def should_explain(self, name: str, now: Optional[float] = None) -> bool:
+        """Снимать ли план для медленного запроса (выборка + пауза на имя)"""
+        now = time.monotonic() if now is None else now
+        last = self._explained_at.get(name)
+        if last is not None and now - last < self.explain_cooldown:
+            return False
+        if random.random() >= self.explain_sample_rate:
+            return False
+        self._explained_at[name] = now
+        return True
+
+    def record(self, name: str, query: str, duration: float, rows: int = 0,
+               pool_wait: Optional[float] = None, error: bool = False,
+               explain: Optional[Callable[[str], Awaitable]] = None) -> None:
+        """
+        Учитывает запрос и обрабатывает медленный
+
+        Args:
+            explain: Корутина, выполняющая EXPLAIN-запрос и возвращающая строки плана
+        """
+        self.observe(name, duration, rows, pool_wait, error)
+        if error or duration < self.slow_threshold:
+            return
+
+        logger.warning(f"Slow query {name}: {duration * 1000:.0f} ms, {rows} rows")
+        plan_sql = explain_sql(query) if explain else None
+        if plan_sql and self.should_explain(name):
+            task = asyncio.create_task(self._explain(name, plan_sql, explain))
+            self._explain_tasks.add(task)
+            task.add_done_callback(self._explain_tasks.discard)
+
+    async def _explain(self, name: str, plan_sql: str, explain) -> None:
+        try:
+            rows = await explain(plan_sql) or []
+            plan = '\n'.join(str(next(iter(row.values())) if isinstance(row, dict) else row[0]) for row in rows)
+            logger.warning(f"Plan for slow query {name}:\n{plan}")
+        except Exception as e:
+            logger.debug(f"EXPLAIN for {name} failed: {e}")
+
+    def render(self) -> str:
+        """Метрики в текстовом формате Prometheus"""
+        lines = [
+            '# HELP db_query_duration_seconds SQL query latency by query name',
+            '# TYPE db_query_duration_seconds histogram',
+        ]
+        for name, stats in sorted(self.queries.items()):
+            lines.extend(stats.latency.render('db_query_duration_seconds', f'query="{_label(name)}"'))
+
+        for metric, attr, help_text in (
+            ('db_query_rows_total', 'rows', 'Rows returned by query name'),
+            ('db_query_errors_total', 'errors', 'Failed queries by query name'),
+            ('db_slow_queries_total', 'slow', 'Queries over the slow threshold by query name'),
+        ):
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} counter')
+            for name, stats in sorted(self.queries.items()):
+                lines.append(f'{metric}{{query="{_label(name)}"}} {getattr(stats, attr)}')
+
+        lines.append('# HELP db_pool_wait_seconds Time spent waiting for a pooled connection')
+        lines.append('# TYPE db_pool_wait_seconds histogram')
+        lines.extend(self.pool_wait.render('db_pool_wait_seconds'))
+        return '\n'.join(lines) + '\n'
+
+
+# Глобальный реестр метрик запросов
+query_metrics = QueryMetrics()
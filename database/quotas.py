@@ -0,0 +1,338 @@
+"""
+Дневные квоты пользователей (Gmail-алиасы, KashMail, Random Face)
+
+Счетчик квоты - ключ Redis на пользователя и день, который истекает в
+полночь. Проверка и списание - один Lua-скрипт: за один запрос к Redis и
+атомарно, поэтому две реплики не могут вместе превысить лимит. Списания
+копятся в памяти и пачкой дописываются в дневные таблицы Postgres - для
+отчетов и чтобы восстановить счетчик, если ключа в Redis нет (первый
+запрос за день после потери данных).
+
+Без Redis квота проверяется и списывается в Postgres одним условным UPSERT.
+"""
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+from typing import Dict, Optional, Tuple
+
+from psycopg2.extras import execute_values
+
+logger = logging.getLogger(__name__)
+
+GMAIL = 'gmail'
+KASHMAIL = 'kashmail'
+RANDOM_FACE = 'random_face'
+
+# KEYS: счетчик дня
+# ARGV: лимит, сколько списать (0 - только прочитать), конец дня (unix time),
+#       значение из БД ('' - не загружено)
+# Возвращает {списано (1/0), использовано}; {-1, 0} - ключа нет, нужно значение из БД
+CONSUME_SCRIPT = """
+local used = redis.call('GET', KEYS[1])
+if used then
+    used = tonumber(used)
+elseif ARGV[4] == '' then
+    return {-1, 0}
+else
+    used = tonumber(ARGV[4])
+    redis.call('SET', KEYS[1], used)
+    redis.call('EXPIREAT', KEYS[1], ARGV[3])
+end
+local amount = tonumber(ARGV[2])
+if amount > 0 and used + amount <= tonumber(ARGV[1]) then
+    used = redis.call('INCRBY', KEYS[1], amount)
+    redis.call('EXPIREAT', KEYS[1], ARGV[3])
+    return {1, used}
+end
+return {0, used}
+"""
+
+# KEYS: счетчик дня; ARGV: сколько вернуть
+# Возвращает, сколько возвращено на самом деле (счетчик не уходит ниже нуля)
+REFUND_SCRIPT = """
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+local refund = math.min(used, tonumber(ARGV[1]))
+if refund > 0 then
+    redis.call('DECRBY', KEYS[1], refund)
+end
+return refund
+"""
+
+
+@dataclass(frozen=True)
+class QuotaSpec:
+    """Описание дневной квоты"""
+    name: str
+    limit: int
+    key_prefix: str
+    table: str
+    day_column: str = 'day'
+
+
+@dataclass
+class QuotaResult:
+    """Результат проверки квоты"""
+    allowed: bool
+    used: int
+    limit: int
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.limit - self.used)
+
+
+class QuotaEngine:
+    """Проверка и списание дневных квот"""
+
+    def __init__(self, database=None, redis=None):
+        """
+        Args:
+            database: Экземпляр Database (None - без записи в Postgres)
+            redis: Клиент Redis (по умолчанию общее подключение из infra.redis)
+        """
+        self.db = database
+        self.redis = redis
+        self.specs: Dict[str, QuotaSpec] = {
+            GMAIL: QuotaSpec(GMAIL, 10, 'quota:gmail:', 'gmail_alias_usage', 'usage_date'),
+            KASHMAIL: QuotaSpec(KASHMAIL, 10, 'quota:kashmail:', 'kashmail_daily_counters'),
+            # Префикс прежних ключей сервиса - счетчики текущего дня сохраняются
+            RANDOM_FACE: QuotaSpec(RANDOM_FACE, 10, 'face:quota:', 'random_face_daily_counters'),
+        }
+        # (квота, user_id, день) -> еще не записанное в БД изменение
+        self._pending: Dict[Tuple[str, int, date], int] = {}
+        self._scripts = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def configure(self, database=None, **limits: int) -> None:
+        """Задает БД и дневные лимиты: configure(db, gmail=10, kashmail=5)"""
+        if database is not None:
+            self.db = database
+        for name, limit in limits.items():
+            spec = self.specs[name]
+            self.specs[name] = QuotaSpec(spec.name, limit, spec.key_prefix, spec.table, spec.day_column)
+
+    def limit(self, name: str) -> int:
+        return self.specs[name].limit
+
+    def _redis(self):
+        """Подключение Redis (None - квоты считаются в Postgres)"""
+        if self.redis is not None:
+            return self.redis
+        try:
+            from infra.redis import redis_manager
+            return redis_manager.redis
+        except ImportError:
+            return None
+
+    def _script(self, redis, name: str, source: str):
+        script = self._scripts.get((id(redis), name))
+        if script is None:
+            script = redis.register_script(source)
+            self._scripts[(id(redis), name)] = script
+        return script
+
+    @staticmethod
+    def today() -> date:
+        # Квоты сбрасываются в полночь по локальному времени сервера
+        return datetime.now().date()
+
+    @staticmethod
+    def _day_end(day: date) -> int:
+        return int(datetime.combine(day + timedelta(days=1), time.min).timestamp())
+
+    def key(self, name: str, user_id: int, day: date) -> str:
+        return f"{self.specs[name].key_prefix}{user_id}:{day.strftime('%Y%m%d')}"
+
+    async def consume(self, name: str, user_id: int, amount: int = 1) -> QuotaResult:
+        """
+        Списывает amount, если после этого лимит не будет превышен
+
+        Returns:
+            QuotaResult: allowed=False - ничего не списано
+        """
+        spec = self.specs[name]
+        if amount > spec.limit:
+            used = (await self.usage(name, user_id)).used
+            return QuotaResult(False, used, spec.limit)
+
+        day = self.today()
+        redis = self._redis()
+        if redis is not None:
+            try:
+                allowed, used = await self._run_consume(redis, spec, user_id, day, amount)
+                if allowed:
+                    self._add_pending(name, user_id, day, amount)
+                return QuotaResult(allowed, used, spec.limit)
+            except Exception as e:
+                logger.warning(f"Redis quota check failed for {name}, using database: {e}")
+
+        return await self._consume_db(spec, user_id, day, amount)
+
+    async def usage(self, name: str, user_id: int) -> QuotaResult:
+        """Текущее использование без списания"""
+        spec = self.specs[name]
+        day = self.today()
+        redis = self._redis()
+        if redis is not None:
+            try:
+                _, used = await self._run_consume(redis, spec, user_id, day, 0)
+                return QuotaResult(used < spec.limit, used, spec.limit)
+            except Exception as e:
+                logger.warning(f"Redis quota read failed for {name}, using database: {e}")
+
+        used = await self._load(spec, user_id, day)
+        return QuotaResult(used < spec.limit, used, spec.limit)
+
+    async def remaining(self, name: str, user_id: int) -> int:
+        return (await self.usage(name, user_id)).remaining
+
+    async def refund(self, name: str, user_id: int, amount: int = 1) -> None:
+        """Возвращает списанное (операция не удалась после списания)"""
+        spec = self.specs[name]
+        day = self.today()
+        redis = self._redis()
+        if redis is not None:
+            try:
+                refund = self._script(redis, 'refund', REFUND_SCRIPT)
+                refunded = await refund(keys=[self.key(name, user_id, day)], args=[amount])
+                self._add_pending(name, user_id, day, -int(refunded))
+                return
+            except Exception as e:
+                logger.warning(f"Redis quota refund failed for {name}, using database: {e}")
+
+        if self.db is None:
+            return
+        try:
+            await self.db.execute(
+                f"UPDATE {spec.table} SET count = GREATEST(0, count - %s) "
+                f"WHERE user_id = %s AND {spec.day_column} = %s",
+                (amount, user_id, day)
+            )
+        except Exception as e:
+            logger.error(f"Failed to refund {name} quota for user {user_id}: {e}")
+
+    async def _run_consume(self, redis, spec: QuotaSpec, user_id: int, day: date, amount: int) -> Tuple[bool, int]:
+        consume = self._script(redis, 'consume', CONSUME_SCRIPT)
+        keys = [self.key(spec.name, user_id, day)]
+        args = [spec.limit, amount, self._day_end(day)]
+        status, used = await consume(keys=keys, args=args + [''])
+        if status == -1:
+            # Ключа нет - продолжаем счет с учтенного в БД (и еще не записанного)
+            seed = await self._load(spec, user_id, day)
+            status, used = await consume(keys=keys, args=args + [seed])
+        return status == 1, int(used)
+
+    async def _load(self, spec: QuotaSpec, user_id: int, day: date) -> int:
+        pending = self._pending.get((spec.name, user_id, day), 0)
+        if self.db is None:
+            return max(0, pending)
+        try:
+            result = await self.db.execute(
+                f"SELECT count FROM {spec.table} WHERE user_id = %s AND {spec.day_column} = %s",
+                (user_id, day), fetch=True
+            )
+        except Exception as e:
+            logger.error(f"Failed to load {spec.name} usage for user {user_id}: {e}")
+            return max(0, pending)
+        return max(0, (result[0]['count'] if result else 0) + pending)
+
+    async def _consume_db(self, spec: QuotaSpec, user_id: int, day: date, amount: int) -> QuotaResult:
+        if self.db is None:
+            return QuotaResult(True, 0, spec.limit)
+        query = f"""
+            INSERT INTO {spec.table} AS c (user_id, {spec.day_column}, count)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (user_id, {spec.day_column})
+            DO UPDATE SET count = c.count + EXCLUDED.count
+            WHERE c.count + EXCLUDED.count <= %s
+            RETURNING count
+        """
+        try:
+            result = await self.db.execute(query, (user_id, day, amount, spec.limit), fetch=True)
+        except Exception as e:
+            # Как и раньше, недоступность счетчика не блокирует пользователя
+            logger.error(f"Failed to consume {spec.name} quota for user {user_id}: {e}")
+            return QuotaResult(True, 0, spec.limit)
+        if result:
+            return QuotaResult(True, result[0]['count'], spec.limit)
+        return QuotaResult(False, await self._load(spec, user_id, day), spec.limit)
+
+    def _add_pending(self, name: str, user_id: int, day: date, amount: int) -> None:
+        if self.db is None:
+            return
+        key = (name, user_id, day)
+        total = self._pending.get(key, 0) + amount
+        if total:
+            self._pending[key] = total
+        else:
+            self._pending.pop(key, None)
+
+    async def flush(self) -> int:
+        """
+        Дописывает накопленные списания в дневные таблицы
+
+        Returns:
+            Число записанных счетчиков
+        """
+        if not self._pending or self.db is None:
+            return 0
+        pending, self._pending = self._pending, {}
+
+        by_table: Dict[QuotaSpec, list] = {}
+        for (name, user_id, day), amount in pending.items():
+            by_table.setdefault(self.specs[name], []).append((user_id, day, amount))
+
+        def _upsert(cursor):
+            for spec, rows in by_table.items():
+                execute_values(cursor, f"""
+                    INSERT INTO {spec.table} AS c (user_id, {spec.day_column}, count)
+                    VALUES %s
+                    ON CONFLICT (user_id, {spec.day_column})
+                    DO UPDATE SET count = GREATEST(0, c.count + EXCLUDED.count)
+                """, rows, page_size=len(rows))
+
+        try:
+            await self.db.run_in_transaction(_upsert)
+        except Exception:
+            # Вернем в очередь, не потеряв списания, сделанные во время записи
+            for key, amount in pending.items():
+                self._pending[key] = self._pending.get(key, 0) + amount
+            raise
+        return len(pending)
+
+    def start(self, interval: float = 5.0) -> None:
+        """Запускает периодическую запись списаний в БД"""
+        if self._task and not self._task.done():
+            return
+
+        async def _loop():
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await self.flush()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Quota flush failed: {e}")
+
+        self._task = asyncio.create_task(_loop())
+
+    async def stop(self) -> None:
+        """Останавливает запись и дописывает оставшиеся списания"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Final quota flush failed: {e}")
+
+
+# Глобальный движок квот
+quotas = QuotaEngine()
@@ -0,0 +1,121 @@
+"""
+Получатели рассылок
+
+Получатели сегмента читаются страницами по первичному ключу users
+(keyset: id > последний выданный id), поэтому в памяти всегда не больше
+одной страницы, сколько бы ни было пользователей, а место остановки
+задается одним числом. Сегменты по активности проверяются через
+EXISTS по индексу events (user_id, ts) - по одной точечной проверке на
+пользователя вместо NOT IN по всей таблице событий.
+"""
+
+import logging
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_SINCE_SQL = "EXISTS (SELECT 1 FROM events e WHERE e.user_id = u.id AND e.ts >= {cutoff})"
+
+SEGMENT_CONDITIONS = {
+    'all': 'TRUE',
+    'active_7d': ACTIVE_SINCE_SQL.format(cutoff='%(cutoff_7d)s'),
+    'active_30d': ACTIVE_SINCE_SQL.format(cutoff='%(cutoff_30d)s'),
+    'inactive_7d': 'NOT ' + ACTIVE_SINCE_SQL.format(cutoff='%(cutoff_7d)s'),
+}
+
+RECIPIENTS_PAGE_SQL = """
+    SELECT u.id, u.tg_id
+    FROM users u
+    WHERE u.is_blocked = false AND u.id > %(after_id)s AND {condition}
+    ORDER BY u.id
+    LIMIT %(limit)s
+"""
+
+RECIPIENTS_COUNT_SQL = """
+    SELECT COUNT(*) AS count
+    FROM users u
+    WHERE u.is_blocked = false AND {condition}
+"""
+
+SEGMENT_COUNTS_SQL = """
+    SELECT
+        COUNT(*) AS total,
+        COUNT(*) FILTER (WHERE {active_7d}) AS active_7d,
+        COUNT(*) FILTER (WHERE {active_30d}) AS active_30d
+    FROM users u
+    WHERE u.is_blocked = false
+""".format(active_7d=SEGMENT_CONDITIONS['active_7d'], active_30d=SEGMENT_CONDITIONS['active_30d'])
+
+
+def segment_params(now: Optional[datetime] = None) -> Dict:
+    """Границы сегментов (фиксируются один раз на всю рассылку)"""
+    now = now or datetime.utcnow()
+    return {'cutoff_7d': now - timedelta(days=7), 'cutoff_30d': now - timedelta(days=30)}
+
+
+def segment_condition(segment: Optional[str]) -> str:
+    """Условие WHERE сегмента (неизвестный сегмент - все незаблокировавшие)"""
+    return SEGMENT_CONDITIONS.get(segment or 'all', SEGMENT_CONDITIONS['all'])
+
+
+class RecipientSource:
+    """Получатели сегмента страницами по id"""
+
+    def __init__(self, database, segment: Optional[str] = None, page_size: int = 1000,
+                 now: Optional[datetime] = None):
+        """
+        Args:
+            database: Экземпляр Database
+            segment: all / active_7d / active_30d / inactive_7d
+            page_size: Сколько получателей читать за один запрос
+            now: Момент, от которого считаются сегменты по активности
+        """
+        self.db = database
+        self.segment = segment or 'all'
+        self.page_size = page_size
+        self.params = segment_params(now)
+        condition = segment_condition(self.segment)
+        self._page_sql = RECIPIENTS_PAGE_SQL.format(condition=condition)
+        self._count_sql = RECIPIENTS_COUNT_SQL.format(condition=condition)
+
+    async def count(self) -> int:
+        """Число получателей без выборки самих id"""
+        rows = await self.db.execute(self._count_sql, self.params, fetch=True)
+        return int(rows[0]['count']) if rows else 0
+
+    async def page(self, after_id: int = 0, limit: Optional[int] = None) -> List[Tuple[int, int]]:
+        """Следующая страница (users.id, tg_id) после after_id"""
+        params = dict(self.params, after_id=after_id, limit=limit or self.page_size)
+        rows = await self.db.execute(self._page_sql, params, fetch=True)
+        return [(row['id'], row['tg_id']) for row in rows or []]
+
+    async def pages(self, after_id: int = 0) -> AsyncIterator[List[Tuple[int, int]]]:
+        """Все страницы начиная после after_id (для продолжения с места остановки)"""
+        while True:
+            page = await self.page(after_id)
+            if not page:
+                return
+            yield page
+            if len(page) < self.page_size:
+                return
+            after_id = page[-1][0]
+
+    async def __aiter__(self) -> AsyncIterator[int]:
+        async for page in self.pages():
+            for _, tg_id in page:
+                yield tg_id
+
+
+async def count_segments(database, now: Optional[datetime] = None) -> Dict[str, int]:
+    """Размеры всех сегментов одним запросом"""
+    rows = await database.execute(SEGMENT_COUNTS_SQL, segment_params(now), fetch=True)
+    row = rows[0] if rows else {}
+    total = int(row.get('total') or 0)
+    active_7d = int(row.get('active_7d') or 0)
+    return {
+        'all': total,
+        'active_7d': active_7d,
+        'active_30d': int(row.get('active_30d') or 0),
+        'inactive_7d': total - active_7d,
+    }
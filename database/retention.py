@@ -0,0 +1,154 @@
+"""
+Матрица удержания когорт
+
+Вся матрица (когорты по дню первого визита x дни возврата D1/D7/D30)
+считается одним запросом по rollup_daily_users вместо отдельных запросов
+на каждую когорту и день. Результат кэшируется: агрегаты дневные, и
+пересчитывать матрицу на каждое открытие админ-панели незачем.
+
+Определения:
+- когорта - незаблокированные пользователи (is_blocked = false) с
+  первым визитом в этот день;
+- D{N} - доля когорты, активная ровно на N-й день после первого визита
+  (есть строка в rollup_daily_users за этот день). Пользователь, активный
+  только позже, в D{N} не попадает - это классический day-N retention, а
+  не "активен в день N или позже".
+"""
+
+import time
+import logging
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OFFSETS = (1, 7, 30)
+
+RETENTION_MATRIX_SQL = """
+    WITH cohorts AS (
+        SELECT id AS user_id, first_seen_at::date AS cohort_day
+        FROM users
+        WHERE first_seen_at >= %(start)s AND first_seen_at < %(end)s
+        AND is_blocked = false
+    ),
+    sizes AS (
+        SELECT cohort_day, COUNT(*) AS size FROM cohorts GROUP BY cohort_day
+    ),
+    returns AS (
+        SELECT c.cohort_day, o.day_offset, COUNT(*) AS returned
+        FROM cohorts c
+        CROSS JOIN unnest(%(offsets)s::int[]) AS o (day_offset)
+        JOIN rollup_daily_users d ON d.user_id = c.user_id AND d.day = c.cohort_day + o.day_offset
+        GROUP BY c.cohort_day, o.day_offset
+    )
+    SELECT s.cohort_day, s.size, r.day_offset, r.returned
+    FROM sizes s
+    LEFT JOIN returns r ON r.cohort_day = s.cohort_day
+    ORDER BY s.cohort_day, r.day_offset
+"""
+
+
+@dataclass
+class Cohort:
+    """Когорта пользователей одного дня первого визита"""
+    day: date
+    size: int
+    returned: Dict[int, int] = field(default_factory=dict)  # смещение в днях -> вернувшиеся
+
+
+@dataclass
+class RetentionMatrix:
+    """Когорты по дням и доля вернувшихся на каждый день смещения"""
+    offsets: List[int]
+    cohorts: List[Cohort]
+    today: date
+
+    def is_mature(self, cohort: Cohort, offset: int) -> bool:
+        """Прошел ли день D{offset} этой когорты целиком"""
+        return cohort.day + timedelta(days=offset) < self.today
+
+    def rate(self, cohort: Cohort, offset: int) -> Optional[float]:
+        """Процент вернувшихся (None - день еще не наступил)"""
+        if not cohort.size or not self.is_mature(cohort, offset):
+            return None
+        return round(cohort.returned.get(offset, 0) / cohort.size * 100, 1)
+
+    def average(self, offset: int, periods: int = 30) -> float:
+        """Средний retention D{offset} по последним periods созревшим когортам"""
+        mature = [cohort for cohort in self.cohorts if cohort.size and self.is_mature(cohort, offset)]
+        rates = [self.rate(cohort, offset) for cohort in mature[-periods:]]
+        if not rates:
+            return 0.0
+        return round(sum(rates) / len(rates), 1)
+
+    def as_rows(self) -> List[Dict]:
+        """Строки для вывода: день, размер, проценты по смещениям"""
+        return [
+            {
+                'day': cohort.day.isoformat(),
+                'size': cohort.size,
+                **{f'D{offset}': self.rate(cohort, offset) for offset in self.offsets},
+            }
+            for cohort in self.cohorts
+        ]
+
+
+def matrix_params(offsets: Sequence[int], periods: int, today: date) -> Dict:
+    """Границы выборки когорт: последние periods созревших когорт для самого длинного смещения"""
+    return {
+        'start': today - timedelta(days=max(offsets) + periods),
+        'end': today,
+        'offsets': list(offsets),
+    }
+
+
+def build_matrix(rows: Iterable, offsets: Sequence[int], today: date) -> RetentionMatrix:
+    """
+    Собирает матрицу из строк RETENTION_MATRIX_SQL
+
+    Args:
+        rows: (cohort_day, size, day_offset, returned); day_offset и returned
+              равны None у когорт, из которых никто не вернулся
+    """
+    cohorts: Dict[date, Cohort] = {}
+    for cohort_day, size, day_offset, returned in rows:
+        cohort = cohorts.setdefault(cohort_day, Cohort(day=cohort_day, size=int(size)))
+        if day_offset is not None:
+            cohort.returned[int(day_offset)] = int(returned)
+    return RetentionMatrix(offsets=list(offsets), cohorts=sorted(cohorts.values(), key=lambda c: c.day),
+                           today=today)
+
+
+class RetentionEngine:
+    """Расчет матрицы удержания с кэшированием"""
+
+    def __init__(self, database, cache_ttl: float = 600.0):
+        """
+        Args:
+            database: Экземпляр Database
+            cache_ttl: Сколько секунд отдавать матрицу из кэша
+        """
+        self.db = database
+        self.cache_ttl = cache_ttl
+        self._cache: Dict[tuple, tuple] = {}
+
+    async def get_matrix(self, offsets: Sequence[int] = DEFAULT_OFFSETS, periods: int = 30,
+                         today: Optional[date] = None) -> RetentionMatrix:
+        """Матрица удержания одним запросом (или из кэша)"""
+        today = today or datetime.utcnow().date()
+        key = (tuple(offsets), periods, today)
+        cached = self._cache.get(key)
+        if cached and time.monotonic() - cached[0] < self.cache_ttl:
+            return cached[1]
+
+        rows = await self.db.execute(RETENTION_MATRIX_SQL, matrix_params(offsets, periods, today), fetch=True)
+        matrix = build_matrix(
+            ((row['cohort_day'], row['size'], row['day_offset'], row['returned']) for row in rows or []),
+            offsets, today
+        )
+        self._cache = {key: (time.monotonic(), matrix)}
+        return matrix
+
+    def invalidate(self) -> None:
+        self._cache.clear()
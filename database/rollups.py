@@ -0,0 +1,261 @@
+"""
+Инкрементальные агрегаты для админской аналитики
+
+Админ-панель читает только rollup-таблицы (миграция 009), поэтому время
+ответа не зависит от размера events. Фоновая задача дописывает в агрегаты
+только новые строки: для events и users хранится отметка - id последней
+обработанной строки. Пачка событий, обновление агрегатов и отметка
+пишутся одним запросом в одной транзакции, поэтому повторный запуск или
+падение посреди прохода не дают двойного счета. Статистика сессий
+пересчитывается целиком за последние дни (сессии пишутся в БД после
+завершения, с задержкой).
+
+Отметка по id верна, пока строки коммитятся в порядке id - то есть при
+одном процессе, пишущем events и users. Если пишут несколько (main.py и
+main_webhook, реплики - у каждого свой EventBuffer), транзакция с
+меньшими id может закоммититься после прохода и будет пропущена. Поэтому
+раз в reconcile_interval агрегаты за последние RECONCILE_DAYS дней
+пересчитываются заново по одному снимку (REPEATABLE READ), заодно
+учитываются все строки после отметки, как бы ни отставал их ts. Теряются
+только строки, которые закоммичены с опозданием и при этом старше окна.
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# События попадают в БД с задержкой буфера, поэтому ts новых строк может
+# быть меньше ts уже обработанных; запас только ограничивает партиции для поиска
+# (строки с большим отставанием учитывает сверка)
+WATERMARK_MARGIN = timedelta(days=1)
+# За сколько последних дней пересчитывается статистика сессий
+SESSION_RECOMPUTE_DAYS = 2
+# За сколько последних дней агрегаты events и users пересчитываются при сверке
+RECONCILE_DAYS = 2
+
+# Один снимок на всю сверку: удаление, пересчет и новая отметка согласованы
+REPEATABLE_READ_SQL = "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"
+
+INIT_WATERMARK_SQL = "INSERT INTO rollup_watermarks (name) VALUES (%s) ON CONFLICT (name) DO NOTHING"
+
+# Блокировка строки не дает двум процессам обработать одну пачку
+LOCK_WATERMARK_SQL = "SELECT last_id, last_ts FROM rollup_watermarks WHERE name = %s FOR UPDATE"
+
+UPDATE_WATERMARK_SQL = """
+    UPDATE rollup_watermarks SET last_id = %s, last_ts = %s, updated_at = NOW()
+    WHERE name = %s
+"""
+
+EVENTS_ROLLUP_TEMPLATE = """
+    WITH batch AS (
+        SELECT id, user_id, ts, command
+        FROM events
+        {batch_filter}
+    ),
+    daily_users AS (
+        INSERT INTO rollup_daily_users (day, user_id, events)
+        SELECT ts::date, user_id, COUNT(*) FROM batch
+        WHERE user_id IS NOT NULL
+        GROUP BY 1, 2
+        ON CONFLICT (day, user_id) DO UPDATE SET events = rollup_daily_users.events + EXCLUDED.events
+    ),
+    daily_commands AS (
+        INSERT INTO rollup_daily_commands (day, command, count)
+        SELECT ts::date, command, COUNT(*) FROM batch
+        WHERE command IS NOT NULL AND command != ''
+        GROUP BY 1, 2
+        ON CONFLICT (day, command) DO UPDATE SET count = rollup_daily_commands.count + EXCLUDED.count
+    ),
+    hourly AS (
+        INSERT INTO rollup_hourly_events (hour, events)
+        SELECT date_trunc('hour', ts), COUNT(*) FROM batch
+        GROUP BY 1
+        ON CONFLICT (hour) DO UPDATE SET events = rollup_hourly_events.events + EXCLUDED.events
+    )
+    SELECT MAX(id), MAX(ts), COUNT(*) FROM batch
+"""
+
+NEW_USERS_ROLLUP_TEMPLATE = """
+    WITH batch AS (
+        SELECT id, first_seen_at
+        FROM users
+        {batch_filter}
+    ),
+    daily AS (
+        INSERT INTO rollup_daily_new_users (day, users)
+        SELECT first_seen_at::date, COUNT(*) FROM batch
+        GROUP BY 1
+        ON CONFLICT (day) DO UPDATE SET users = rollup_daily_new_users.users + EXCLUDED.users
+    )
+    SELECT MAX(id), MAX(first_seen_at), COUNT(*) FROM batch
+"""
+
+ROLLUP_EVENTS_SQL = EVENTS_ROLLUP_TEMPLATE.format(batch_filter="""WHERE id > %(last_id)s AND ts >= %(since)s
+        ORDER BY id
+        LIMIT %(limit)s""")
+
+ROLLUP_NEW_USERS_SQL = NEW_USERS_ROLLUP_TEMPLATE.format(batch_filter="""WHERE id > %(last_id)s
+        ORDER BY id
+        LIMIT %(limit)s""")
+
+# Сверка: все строки окна (агрегаты окна перед этим удаляются) и все строки после отметки
+RECONCILE_EVENTS_SQL = EVENTS_ROLLUP_TEMPLATE.format(
+    batch_filter="WHERE ts >= %(since)s OR id > %(last_id)s"
+)
+
+RECONCILE_NEW_USERS_SQL = NEW_USERS_ROLLUP_TEMPLATE.format(
+    batch_filter="WHERE first_seen_at >= %(since)s OR id > %(last_id)s"
+)
+
+DELETE_EVENT_DAYS_SQL = [
+    "DELETE FROM rollup_daily_users WHERE day >= %(since)s",
+    "DELETE FROM rollup_daily_commands WHERE day >= %(since)s",
+    "DELETE FROM rollup_hourly_events WHERE hour >= %(since)s",
+]
+
+DELETE_NEW_USER_DAYS_SQL = [
+    "DELETE FROM rollup_daily_new_users WHERE day >= %(since)s",
+]
+
+DELETE_SESSION_DAYS_SQL = "DELETE FROM rollup_daily_sessions WHERE day >= %(since)s"
+
+ROLLUP_SESSIONS_SQL = """
+    INSERT INTO rollup_daily_sessions (day, sessions, timed_sessions, duration_seconds, events)
+    SELECT
+        started_at::date,
+        COUNT(*) FILTER (WHERE events_count > 0),
+        COUNT(*) FILTER (WHERE ended_at IS NOT NULL AND duration_seconds > 0),
+        COALESCE(SUM(duration_seconds) FILTER (WHERE ended_at IS NOT NULL AND duration_seconds > 0), 0),
+        COALESCE(SUM(events_count) FILTER (WHERE events_count > 0), 0)
+    FROM sessions
+    WHERE started_at >= %(since)s
+    GROUP BY 1
+"""
+
+
+class RollupManager:
+    """Фоновое обновление агрегатов по отметкам"""
+
+    def __init__(self, database, batch_size: int = 50000):
+        """
+        Args:
+            database: Экземпляр Database
+            batch_size: Максимум строк events/users в одной транзакции
+        """
+        self.db = database
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _lock_watermark(cursor, name: str):
+        cursor.execute(INIT_WATERMARK_SQL, (name,))
+        cursor.execute(LOCK_WATERMARK_SQL, (name,))
+        return cursor.fetchone()
+
+    def _step(self, name: str, sql: str, cursor) -> int:
+        """Обрабатывает одну пачку строк после отметки (выполняется в executor)"""
+        last_id, last_ts = self._lock_watermark(cursor, name)
+        since = last_ts - WATERMARK_MARGIN if last_ts else datetime.min
+        cursor.execute(sql, {'last_id': last_id, 'since': since, 'limit': self.batch_size})
+        max_id, max_ts, count = cursor.fetchone()
+        if count:
+            cursor.execute(UPDATE_WATERMARK_SQL, (max_id, max(max_ts, last_ts or max_ts), name))
+        return count
+
+    def _reconcile_step(self, name: str, sql: str, delete_sqls, since: datetime, cursor) -> int:
+        """Пересчитывает агрегаты окна и дописывает строки после отметки (выполняется в executor)"""
+        cursor.execute(REPEATABLE_READ_SQL)
+        last_id, last_ts = self._lock_watermark(cursor, name)
+        for delete_sql in delete_sqls:
+            cursor.execute(delete_sql, {'since': since})
+        cursor.execute(sql, {'last_id': last_id, 'since': since})
+        max_id, max_ts, count = cursor.fetchone()
+        if count:
+            cursor.execute(UPDATE_WATERMARK_SQL, (max(max_id, last_id), max(max_ts, last_ts or max_ts), name))
+        return count
+
+    def _sessions_step(self, cursor, now: datetime) -> None:
+        """Пересчитывает статистику сессий за последние дни"""
+        _, last_ts = self._lock_watermark(cursor, 'sessions')
+        if last_ts:
+            since = (now - timedelta(days=SESSION_RECOMPUTE_DAYS)).date()
+        else:
+            since = datetime.min.date()
+        cursor.execute(DELETE_SESSION_DAYS_SQL, {'since': since})
+        cursor.execute(ROLLUP_SESSIONS_SQL, {'since': since})
+        cursor.execute(UPDATE_WATERMARK_SQL, (0, now, 'sessions'))
+
+    async def _drain(self, name: str, sql: str) -> int:
+        total = 0
+        while True:
+            count = await self.db.run_in_transaction(lambda cursor: self._step(name, sql, cursor))
+            total += count
+            if count < self.batch_size:
+                return total
+
+    async def refresh(self, now: Optional[datetime] = None) -> Dict[str, int]:
+        """
+        Дописывает в агрегаты все строки после отметок
+
+        Returns:
+            Число обработанных событий и пользователей
+        """
+        now = now or datetime.utcnow()
+        events = await self._drain('events', ROLLUP_EVENTS_SQL)
+        users = await self._drain('users', ROLLUP_NEW_USERS_SQL)
+        await self.db.run_in_transaction(lambda cursor: self._sessions_step(cursor, now))
+        return {'events': events, 'users': users}
+
+    async def reconcile(self, now: Optional[datetime] = None) -> Dict[str, int]:
+        """
+        Пересчитывает агрегаты events и users за последние RECONCILE_DAYS дней
+
+        Returns:
+            Число строк, учтенных при пересчете
+        """
+        now = now or datetime.utcnow()
+        since = datetime.combine((now - timedelta(days=RECONCILE_DAYS)).date(), datetime.min.time())
+        events = await self.db.run_in_transaction(
+            lambda cursor: self._reconcile_step('events', RECONCILE_EVENTS_SQL, DELETE_EVENT_DAYS_SQL, since, cursor)
+        )
+        users = await self.db.run_in_transaction(
+            lambda cursor: self._reconcile_step('users', RECONCILE_NEW_USERS_SQL, DELETE_NEW_USER_DAYS_SQL,
+                                                since, cursor)
+        )
+        return {'events': events, 'users': users}
+
+    def start(self, interval: float = 60.0, reconcile_interval: float = 3600.0) -> None:
+        """Запускает периодическое обновление агрегатов и их сверку"""
+        if self._task and not self._task.done():
+            return
+
+        async def _loop():
+            loop = asyncio.get_running_loop()
+            last_reconcile = loop.time()
+            while True:
+                try:
+                    if loop.time() - last_reconcile >= reconcile_interval:
+                        last_reconcile = loop.time()
+                        await self.reconcile()
+                    processed = await self.refresh()
+                    if processed['events'] or processed['users']:
+                        logger.debug(f"Rollups updated: {processed}")
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Rollup refresh failed: {e}")
+                await asyncio.sleep(interval)
+
+        self._task = asyncio.create_task(_loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
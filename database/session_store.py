@@ -0,0 +1,338 @@
+"""
+Агрегация сессий пользователей в Redis
+
+Открытая сессия живет в хэше Redis по пользователю (id, начало, последнее
+событие, число событий) со скользящим сроком жизни. Каждое событие
+обновляет хэш одним Lua-скриптом: если пауза превысила таймаут, прежняя
+сессия уходит в список завершенных, и начинается новая. В Postgres сессия
+пишется один раз - после завершения, пачкой.
+
+Без Redis то же самое делается в памяти процесса.
+"""
+
+import json
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+from psycopg2.extras import execute_values
+
+logger = logging.getLogger(__name__)
+
+
+# KEYS: хэш сессии, zset активных сессий, список завершенных
+# ARGV: tg_id, ts, id новой сессии, таймаут, TTL хэша
+TOUCH_SCRIPT = """
+local ts = tonumber(ARGV[2])
+local last = tonumber(redis.call('HGET', KEYS[1], 'last_ts') or '0')
+if last > 0 and ts - last >= tonumber(ARGV[4]) then
+    local s = redis.call('HMGET', KEYS[1], 'id', 'started_at', 'events')
+    redis.call('RPUSH', KEYS[3], cjson.encode({
+        id = s[1], tg_id = ARGV[1], started_at = tonumber(s[2]),
+        ended_at = last, events = tonumber(s[3])
+    }))
+    redis.call('DEL', KEYS[1])
+    last = 0
+end
+if last == 0 then
+    redis.call('HSET', KEYS[1], 'id', ARGV[3], 'started_at', ARGV[2], 'last_ts', ARGV[2], 'events', 1)
+    last = ts
+else
+    if ts > last then
+        redis.call('HSET', KEYS[1], 'last_ts', ARGV[2])
+        last = ts
+    end
+    redis.call('HINCRBY', KEYS[1], 'events', 1)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('ZADD', KEYS[2], last, ARGV[1])
+return redis.call('HGET', KEYS[1], 'id')
+"""
+
+# KEYS: zset активных сессий, список завершенных
+# ARGV: граница неактивности, префикс хэшей, максимум сессий за вызов
+CLAIM_SCRIPT = """
+local users = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[3]))
+for _, tg_id in ipairs(users) do
+    local key = ARGV[2] .. tg_id
+    local s = redis.call('HMGET', key, 'id', 'started_at', 'last_ts', 'events')
+    if s[1] then
+        redis.call('RPUSH', KEYS[2], cjson.encode({
+            id = s[1], tg_id = tg_id, started_at = tonumber(s[2]),
+            ended_at = tonumber(s[3]), events = tonumber(s[4])
+        }))
+        redis.call('DEL', key)
+    end
+    redis.call('ZREM', KEYS[1], tg_id)
+end
+return #users
+"""
+
+INSERT_SESSIONS_SQL = """
+    INSERT INTO sessions (id, user_id, started_at, ended_at, events_count, duration_seconds)
+    SELECT v.id::uuid, u.id, v.started_at, v.ended_at, v.events_count, v.duration_seconds
+    FROM (VALUES %s) AS v (id, tg_id, started_at, ended_at, events_count, duration_seconds)
+    LEFT JOIN users u ON u.tg_id = v.tg_id
+    ON CONFLICT (id) DO NOTHING
+"""
+
+# Сессии, открытые до перехода на Redis (ended_at так и не записан)
+CLOSE_STALE_SESSIONS_SQL = """
+    UPDATE sessions
+    SET ended_at = started_at + make_interval(secs => %(timeout)s),
+        duration_seconds = GREATEST(duration_seconds, %(timeout)s)
+    WHERE ended_at IS NULL
+      AND started_at < (NOW() AT TIME ZONE 'UTC') - make_interval(secs => %(timeout)s)
+"""
+
+
+def _epoch(ts: datetime) -> float:
+    """datetime в UTC без tzinfo -> unix time"""
+    return ts.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _utc(epoch: float) -> datetime:
+    return datetime.fromtimestamp(epoch, tz=timezone.utc).replace(tzinfo=None)
+
+
+@dataclass
+class FinishedSession:
+    """Завершенная сессия, ожидающая записи в БД"""
+    id: str
+    tg_id: int
+    started_at: float
+    ended_at: float
+    events: int
+
+    def as_row(self) -> tuple:
+        return (self.id, self.tg_id, _utc(self.started_at), _utc(self.ended_at),
+                self.events, int(self.ended_at - self.started_at))
+
+
+class SessionStore:
+    """Открытые сессии в Redis (или в памяти) и пакетная запись завершенных"""
+
+    def __init__(self, database, timeout: int = 1800, batch_size: int = 500,
+                 key_prefix: str = 'session:user:'):
+        """
+        Args:
+            database: Экземпляр Database
+            timeout: Пауза без событий, после которой сессия завершается, сек
+            batch_size: Максимум сессий в одном INSERT
+            key_prefix: Префикс хэшей открытых сессий
+        """
+        self.db = database
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.key_prefix = key_prefix
+        self.active_key = 'sessions:active'
+        self.finished_key = 'sessions:finished'
+        # Хэш живет дольше таймаута, чтобы сборщик успел его забрать
+        self.ttl = timeout * 2
+        # Запасной вариант без Redis: tg_id -> [id, started_at, last_ts, events]
+        self._local: Dict[int, list] = {}
+        self._local_finished: List[FinishedSession] = []
+        self._scripts = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _redis():
+        """Текущее подключение Redis (None - сессии хранятся в памяти)"""
+        try:
+            from infra.redis import redis_manager
+            return redis_manager.redis
+        except ImportError:
+            return None
+
+    def _script(self, redis, name: str, source: str):
+        script = self._scripts.get((id(redis), name))
+        if script is None:
+            script = redis.register_script(source)
+            self._scripts[(id(redis), name)] = script
+        return script
+
+    async def touch_many(self, events: List[tuple]) -> List[str]:
+        """
+        Учитывает события в открытых сессиях
+
+        Args:
+            events: (tg_id, ts) в порядке поступления
+
+        Returns:
+            id сессии для каждого события
+        """
+        if not events:
+            return []
+
+        redis = self._redis()
+        if redis is not None:
+            try:
+                touch = self._script(redis, 'touch', TOUCH_SCRIPT)
+                pipe = redis.pipeline(transaction=False)
+                for tg_id, ts in events:
+                    await touch(
+                        keys=[f"{self.key_prefix}{tg_id}", self.active_key, self.finished_key],
+                        args=[tg_id, _epoch(ts), str(uuid4()), self.timeout, self.ttl],
+                        client=pipe
+                    )
+                return [str(session_id) for session_id in await pipe.execute()]
+            except Exception as e:
+                logger.warning(f"Session store Redis update failed, using memory: {e}")
+
+        return [self._touch_local(tg_id, _epoch(ts)) for tg_id, ts in events]
+
+    def _touch_local(self, tg_id: int, ts: float) -> str:
+        session = self._local.get(tg_id)
+        if session and ts - session[2] >= self.timeout:
+            self._local_finished.append(FinishedSession(session[0], tg_id, session[1], session[2], session[3]))
+            session = None
+        if session is None:
+            session = self._local[tg_id] = [str(uuid4()), ts, ts, 0]
+        session[2] = max(session[2], ts)
+        session[3] += 1
+        return session[0]
+
+    async def claim_stale(self, now: Optional[float] = None) -> int:
+        """Переводит сессии без событий дольше таймаута в завершенные"""
+        now = datetime.now(timezone.utc).timestamp() if now is None else now
+        cutoff = now - self.timeout
+
+        stale = [tg_id for tg_id, session in self._local.items() if session[2] <= cutoff]
+        for tg_id in stale:
+            session_id, started_at, last_ts, events = self._local.pop(tg_id)
+            self._local_finished.append(FinishedSession(session_id, tg_id, started_at, last_ts, events))
+        claimed = len(stale)
+
+        redis = self._redis()
+        if redis is not None:
+            try:
+                claim = self._script(redis, 'claim', CLAIM_SCRIPT)
+                while True:
+                    count = await claim(keys=[self.active_key, self.finished_key],
+                                        args=[cutoff, self.key_prefix, self.batch_size])
+                    claimed += count
+                    if count < self.batch_size:
+                        break
+            except Exception as e:
+                logger.warning(f"Session store Redis claim failed: {e}")
+        return claimed
+
+    async def flush_finished(self) -> int:
+        """
+        Пишет завершенные сессии в БД пачками
+
+        Записи удаляются из очереди только после коммита; повторная запись
+        той же сессии отбрасывается ON CONFLICT.
+
+        Returns:
+            Число записанных сессий
+        """
+        written = 0
+        while self._local_finished:
+            batch = self._local_finished[:self.batch_size]
+            await self._insert(batch)
+            del self._local_finished[:len(batch)]
+            written += len(batch)
+
+        redis = self._redis()
+        if redis is None:
+            return written
+        while True:
+            raw = await redis.lrange(self.finished_key, 0, self.batch_size - 1)
+            if not raw:
+                break
+            batch = []
+            for item in raw:
+                try:
+                    data = json.loads(item)
+                    batch.append(FinishedSession(data['id'], int(data['tg_id']), float(data['started_at']),
+                                                 float(data['ended_at']), int(data['events'])))
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.error(f"Dropping malformed session record {item!r}: {e}")
+            if batch:
+                await self._insert(batch)
+            await redis.ltrim(self.finished_key, len(raw), -1)
+            written += len(batch)
+        return written
+
+    async def _insert(self, batch: List[FinishedSession]) -> None:
+        rows = [session.as_row() for session in batch]
+        await self.db.run_in_transaction(
+            lambda cursor: execute_values(cursor, INSERT_SESSIONS_SQL, rows, page_size=len(rows))
+        )
+
+    async def close_stale_rows(self) -> int:
+        """Закрывает в БД сессии, оставшиеся открытыми (одним UPDATE)"""
+        def _update(cursor):
+            cursor.execute(CLOSE_STALE_SESSIONS_SQL, {'timeout': self.timeout})
+            return cursor.rowcount
+
+        return await self.db.run_in_transaction(_update)
+
+    async def collect(self) -> int:
+        """Один проход сборщика: завершает неактивные сессии и пишет их в БД"""
+        await self.claim_stale()
+        return await self.flush_finished()
+
+    def start(self, interval: float = 300.0) -> None:
+        """Запускает периодическую сборку сессий в текущем event loop"""
+        if self._task and not self._task.done():
+            return
+
+        async def _loop():
+            try:
+                closed = await self.close_stale_rows()
+                if closed:
+                    logger.info(f"Closed {closed} stale sessions")
+            except Exception as e:
+                logger.error(f"Error closing stale sessions: {e}")
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    written = await self.collect()
+                    if written:
+                        logger.info(f"Wrote {written} finished sessions")
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Session collector error: {e}")
+
+        self._task = asyncio.create_task(_loop())
+
+    async def stop(self) -> None:
+        """Останавливает сборщик и записывает уже завершенные сессии"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+        # Открытые сессии в Redis переживают перезапуск; из памяти - завершаем
+        for tg_id, (session_id, started_at, last_ts, events) in self._local.items():
+            self._local_finished.append(FinishedSession(session_id, tg_id, started_at, last_ts, events))
+        self._local.clear()
+        try:
+            await self.flush_finished()
+        except Exception as e:
+            logger.error(f"Failed to write finished sessions on shutdown: {e}")
+
+    async def end(self, tg_id: int) -> None:
+        """Завершает открытую сессию пользователя сразу"""
+        session = self._local.pop(tg_id, None)
+        if session:
+            self._local_finished.append(FinishedSession(session[0], tg_id, session[1], session[2], session[3]))
+
+        redis = self._redis()
+        if redis is not None:
+            try:
+                # Граница в будущем - забираем сессию независимо от паузы
+                claim = self._script(redis, 'claim', CLAIM_SCRIPT)
+                await redis.zadd(self.active_key, {str(tg_id): 0}, xx=True)
+                await claim(keys=[self.active_key, self.finished_key], args=[0, self.key_prefix, self.batch_size])
+            except Exception as e:
+                logger.warning(f"Session store Redis end failed: {e}")
@@ -4,12 +4,12 @@
 
 import logging
 from datetime import datetime, timedelta
-from uuid import uuid4
-from typing import Optional, Dict
+from typing import Optional
 from telegram import Update
 from telegram.ext import ContextTypes
-from sqlalchemy.orm import Session as DBSession
-from .models import User, Event, Session, Database
+from .models import Database
+from .event_buffer import EventBuffer, BufferedEvent
+from .session_store import SessionStore
 
 logger = logging.getLogger(__name__)
 
@@ -17,59 +17,28 @@ logger = logging.getLogger(__name__)
 class EventTracker:
     """Класс для отслеживания событий пользователей"""
     
-    def __init__(self, database: Database):
+    def __init__(self, database: Database, buffer_size: int = 10000, batch_size: int = 500,
+                 flush_interval: float = 2.0, session_collect_interval: float = 300.0):
         self.db = database
         self.session_timeout = timedelta(minutes=30)  # Сессия считается завершенной после 30 минут неактивности
-        
-    def get_or_create_user(self, db_session: DBSession, tg_id: int, username: Optional[str] = None) -> User:
-        """Получить или создать пользователя"""
-        user = db_session.query(User).filter_by(tg_id=tg_id).first()
-        
-        if not user:
-            user = User(
-                tg_id=tg_id,
-                username=username,
-                first_seen_at=datetime.utcnow(),
-                last_seen_at=datetime.utcnow()
-            )
-            db_session.add(user)
-            db_session.commit()
-            logger.info(f"Created new user: {tg_id} ({username})")
-        else:
-            # Обновляем last_seen_at и username
-            user.last_seen_at = datetime.utcnow()
-            if username and user.username != username:
-                user.username = username
-            db_session.commit()
-            
-        return user
+        self.session_collect_interval = session_collect_interval
+        # Открытые сессии - в Redis, в БД пишутся только завершенные
+        self.sessions = SessionStore(database, timeout=int(self.session_timeout.total_seconds()),
+                                     batch_size=batch_size)
+        # События пишутся в БД пачками из фоновой задачи
+        self.buffer = EventBuffer(database, max_size=buffer_size, batch_size=batch_size,
+                                  flush_interval=flush_interval, sessions=self.sessions)
     
-    def get_or_create_session(self, db_session: DBSession, user: User, context: ContextTypes.DEFAULT_TYPE) -> Session:
-        """Получить или создать сессию для пользователя"""
-        # Проверяем, есть ли активная сессия в контексте
-        session_id = context.user_data.get('session_id')
-        
-        if session_id:
-            session = db_session.query(Session).filter_by(id=session_id).first()
-            if session and (datetime.utcnow() - session.started_at) < self.session_timeout:
-                # Сессия еще активна
-                return session
-        
-        # Создаем новую сессию
-        session = Session(
-            id=uuid4(),
-            user_id=user.id,
-            started_at=datetime.utcnow()
-        )
-        db_session.add(session)
-        db_session.commit()
-        
-        # Сохраняем ID сессии в контексте
-        context.user_data['session_id'] = session.id
-        logger.info(f"Created new session for user {user.tg_id}: {session.id}")
-        
-        return session
+    def start(self):
+        """Запускает фоновую запись событий и сборку сессий (вызывать из работающего event loop)"""
+        self.buffer.start()
+        self.sessions.start(self.session_collect_interval)
     
+    async def stop(self):
+        """Останавливает запись, сохраняя все накопленные события и завершенные сессии"""
+        await self.buffer.stop()
+        await self.sessions.stop()
+        
     async def track_event(
         self,
         update: Update,
@@ -77,82 +46,45 @@ class EventTracker:
         event_type: str,
         command: Optional[str] = None
     ):
-        """Отслеживать событие"""
+        """Отслеживать событие (только добавление в буфер, запись - в фоне)"""
         try:
             if not update.effective_user:
                 return
             
-            with self.db.get_session() as db_session:
-                # Получаем или создаем пользователя
-                user = self.get_or_create_user(
-                    db_session,
-                    update.effective_user.id,
-                    update.effective_user.username
-                )
-                
-                # Получаем или создаем сессию
-                session = self.get_or_create_session(db_session, user, context)
-                
-                # Создаем событие
-                event = Event(
-                    user_id=user.id,
-                    ts=datetime.utcnow(),
-                    event_type=event_type,
-                    command=command,
-                    session_id=session.id
-                )
-                db_session.add(event)
-                
-                # Обновляем счетчик событий в сессии
-                session.events_count += 1
-                session.duration_seconds = int((datetime.utcnow() - session.started_at).total_seconds())
-                
-                db_session.commit()
-                logger.debug(f"Tracked event: {event_type} - {command} for user {user.tg_id}")
-                
+            # Сессия назначается при сбросе буфера
+            self.buffer.append(BufferedEvent(
+                tg_id=update.effective_user.id,
+                username=update.effective_user.username,
+                ts=datetime.utcnow(),
+                event_type=event_type,
+                command=command
+            ))
+            
         except Exception as e:
             logger.error(f"Error tracking event: {e}")
     
-    async def end_session(self, context: ContextTypes.DEFAULT_TYPE):
-        """Завершить текущую сессию"""
-        session_id = context.user_data.get('session_id')
-        if not session_id:
-            return
-        
+    async def end_session(self, tg_id: int):
+        """Завершить текущую сессию пользователя"""
         try:
-            with self.db.get_session() as db_session:
-                session = db_session.query(Session).filter_by(id=session_id).first()
-                if session and not session.ended_at:
-                    session.ended_at = datetime.utcnow()
-                    session.duration_seconds = int((session.ended_at - session.started_at).total_seconds())
-                    db_session.commit()
-                    logger.info(f"Ended session {session_id}")
-                    
-                # Удаляем из контекста
-                context.user_data.pop('session_id', None)
+            # События пользователя должны попасть в сессию до ее закрытия
+            while len(self.buffer) and await self.buffer.flush():
+                pass
+            
+            await self.sessions.end(tg_id)
+            await self.sessions.flush_finished()
+            logger.info(f"Ended session of user {tg_id}")
                 
         except Exception as e:
             logger.error(f"Error ending session: {e}")
     
-    def close_old_sessions(self):
-        """Закрыть старые незавершенные сессии"""
+    async def close_old_sessions(self):
+        """Закрыть старые незавершенные сессии (один UPDATE) и записать завершенные"""
         try:
-            with self.db.get_session() as db_session:
-                cutoff_time = datetime.utcnow() - self.session_timeout
-                
-                old_sessions = db_session.query(Session).filter(
-                    Session.ended_at.is_(None),
-                    Session.started_at < cutoff_time
-                ).all()
-                
-                for session in old_sessions:
-                    session.ended_at = session.started_at + self.session_timeout
-                    session.duration_seconds = int(self.session_timeout.total_seconds())
-                    
-                db_session.commit()
-                
-                if old_sessions:
-                    logger.info(f"Closed {len(old_sessions)} old sessions")
+            closed = await self.sessions.close_stale_rows()
+            written = await self.sessions.collect()
+            
+            if closed or written:
+                logger.info(f"Closed {closed} old sessions, wrote {written} finished sessions")
                     
         except Exception as e:
             logger.error(f"Error closing old sessions: {e}")
@@ -0,0 +1,176 @@
+"""
+Кэш профилей пользователей
+
+Двухуровневый кэш строки users: LRU в памяти процесса и хэши в Redis
+(общие для процессов бота). Хранится id, язык и флаг блокировки. Кэш также
+прореживает запись last_seen_at - не чаще одного раза в N секунд на
+пользователя.
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedUser:
+    """Кэшированная часть строки users"""
+    id: int
+    language: Optional[str] = None
+    is_blocked: bool = False
+    last_seen_written: float = 0.0  # time.time() последней записи last_seen_at
+
+
+class UserCache:
+    """LRU в памяти + Redis"""
+
+    def __init__(self, max_size: int = 50000, redis_ttl: int = 24 * 3600,
+                 last_seen_interval: int = 300, key_prefix: str = 'user:profile:'):
+        """
+        Args:
+            max_size: Максимум пользователей в памяти процесса
+            redis_ttl: Время жизни записи в Redis, сек
+            last_seen_interval: Минимальный интервал между записями last_seen_at, сек
+            key_prefix: Префикс ключей Redis
+        """
+        self.max_size = max_size
+        self.redis_ttl = redis_ttl
+        self.last_seen_interval = last_seen_interval
+        self.key_prefix = key_prefix
+        self._users: "OrderedDict[int, CachedUser]" = OrderedDict()
+        # Запись идет и из executor (сброс событий), и из event loop
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, max_size: Optional[int] = None, last_seen_interval: Optional[int] = None) -> None:
+        """Применяет настройки из config при старте бота"""
+        if max_size is not None:
+            self.max_size = max_size
+        if last_seen_interval is not None:
+            self.last_seen_interval = last_seen_interval
+
+    @staticmethod
+    def _redis():
+        """Текущее подключение Redis (None - кэш работает только в памяти)"""
+        try:
+            from infra.redis import redis_manager
+            return redis_manager.redis
+        except ImportError:
+            return None
+
+    def get_local(self, tg_id: int) -> Optional[CachedUser]:
+        """Читает только из памяти процесса"""
+        with self._lock:
+            user = self._users.get(tg_id)
+            if user is not None:
+                self._users.move_to_end(tg_id)
+            return user
+
+    def put_local(self, tg_id: int, user: CachedUser) -> None:
+        with self._lock:
+            current = self._users.get(tg_id)
+            if current is not None:
+                # Не теряем отметку о записи last_seen_at
+                user.last_seen_written = max(user.last_seen_written, current.last_seen_written)
+            self._users[tg_id] = user
+            self._users.move_to_end(tg_id)
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+
+    async def get(self, tg_id: int) -> Optional[CachedUser]:
+        """Читает из памяти, затем из Redis"""
+        user = self.get_local(tg_id)
+        if user is not None:
+            self.hits += 1
+            return user
+
+        redis = self._redis()
+        if redis is not None:
+            try:
+                data = await redis.hgetall(f"{self.key_prefix}{tg_id}")
+                if data and data.get('id'):
+                    user = CachedUser(
+                        id=int(data['id']),
+                        language=data.get('language') or None,
+                        is_blocked=data.get('is_blocked') == '1',
+                        last_seen_written=float(data.get('seen') or 0)
+                    )
+                    self.put_local(tg_id, user)
+                    self.hits += 1
+                    return user
+            except Exception as e:
+                logger.warning(f"User cache Redis read failed: {e}")
+
+        self.misses += 1
+        return None
+
+    async def put(self, tg_id: int, user: CachedUser) -> None:
+        """Сохраняет в памяти и в Redis"""
+        self.put_local(tg_id, user)
+        await self._store_many({tg_id: user})
+
+    async def _store_many(self, users: Dict[int, CachedUser]) -> None:
+        redis = self._redis()
+        if redis is None or not users:
+            return
+        try:
+            pipe = redis.pipeline(transaction=False)
+            for tg_id, user in users.items():
+                key = f"{self.key_prefix}{tg_id}"
+                pipe.hset(key, mapping={
+                    'id': user.id,
+                    'language': user.language or '',
+                    'is_blocked': '1' if user.is_blocked else '0',
+                    'seen': user.last_seen_written,
+                })
+                pipe.expire(key, self.redis_ttl)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"User cache Redis write failed: {e}")
+
+    async def store_many(self, users: Dict[int, CachedUser]) -> None:
+        """Сохраняет пачку пользователей (после сброса событий)"""
+        for tg_id, user in users.items():
+            self.put_local(tg_id, user)
+        await self._store_many(users)
+
+    async def update(self, tg_id: int, **fields) -> None:
+        """Меняет поля записи, если пользователь есть в кэше"""
+        user = await self.get(tg_id)
+        if user is None:
+            return
+        for name, value in fields.items():
+            setattr(user, name, value)
+        await self.put(tg_id, user)
+
+    async def invalidate(self, tg_id: int) -> None:
+        with self._lock:
+            self._users.pop(tg_id, None)
+        redis = self._redis()
+        if redis is not None:
+            try:
+                await redis.delete(f"{self.key_prefix}{tg_id}")
+            except Exception as e:
+                logger.warning(f"User cache Redis delete failed: {e}")
+
+    def last_seen_due(self, tg_id: int, now: Optional[float] = None) -> bool:
+        """Нужно ли записать last_seen_at (пользователь неизвестен или интервал истек)"""
+        user = self.get_local(tg_id)
+        if user is None:
+            return True
+        now = time.time() if now is None else now
+        return now - user.last_seen_written >= self.last_seen_interval
+
+    def clear(self) -> None:
+        with self._lock:
+            self._users.clear()
+
+
+# Глобальный кэш пользователей
+user_cache = UserCache()
@@ -0,0 +1,172 @@
+"""
+Дедупликация postback Keitaro
+
+Первый запрос с данным (профиль, tx_id) "захватывает" его командой Redis
+SET NX EX - атомарно для всех реплик, поэтому из одновременных повторов
+Keitaro уведомление отправит только один. Запись в keitaro_events
+остается журналом обработки.
+
+Ключ на каждый tx_id живет не дольше max_key_ttl. Если окно
+дедупликации профиля длиннее, старая часть окна проверяется по
+bloom-фильтрам в Redis (битовая карта на каждый интервал max_key_ttl):
+"точно не было" - ответ сразу, "возможно было" - уточняется в Postgres.
+
+Без Redis дубликат ищется в keitaro_events, как раньше. Событие, которое
+не удалось обработать, захват отпускает (release): повтор Keitaro или
+следующая pull-выгрузка обработает его заново. Поэтому в keitaro_events
+дубликатом считается только отправленное событие (processed = true).
+"""
+
+import time
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_SQL = """
+    SELECT id FROM keitaro_events
+    WHERE profile_id = %s
+    AND transaction_id = %s
+    AND processed = true
+    AND created_at > %s
+    LIMIT 1
+"""
+
+# KEYS: битовые карты интервалов, текущий первым
+# ARGV: TTL текущей карты (сек, только продлевается), затем номера битов элемента
+# Возвращает 1, если все биты уже стоят в одной из карт (элемент, возможно, был);
+# элемент добавляется в текущую карту
+BLOOM_SCRIPT = """
+local seen = 0
+for i = 1, #KEYS do
+    local all = 1
+    for j = 2, #ARGV do
+        if redis.call('GETBIT', KEYS[i], ARGV[j]) == 0 then
+            all = 0
+            break
+        end
+    end
+    if all == 1 then
+        seen = 1
+        break
+    end
+end
+for j = 2, #ARGV do
+    redis.call('SETBIT', KEYS[1], ARGV[j], 1)
+end
+if redis.call('TTL', KEYS[1]) < tonumber(ARGV[1]) then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return seen
+"""
+
+
+class PostbackDeduplicator:
+    """Захват tx_id postback (повторы отбрасываются)"""
+
+    def __init__(self, database=None, redis=None, key_prefix: str = 'keitaro:dedup:',
+                 max_key_ttl: int = 86400, bloom_bits: int = 1 << 23, bloom_hashes: int = 7):
+        """
+        Args:
+            database: Экземпляр Database (проверка без Redis и уточнение bloom-фильтра)
+            redis: Клиент Redis (по умолчанию общее подключение из infra.redis)
+            key_prefix: Префикс ключей
+            max_key_ttl: Дольше этого окно проверяется bloom-фильтром, сек
+            bloom_bits: Размер битовой карты интервала (8M бит = 1 МБ, ~1% ложных
+                срабатываний на 800 тысяч событий за интервал)
+            bloom_hashes: Число хешей bloom-фильтра
+        """
+        self.db = database
+        self.redis = redis
+        self.key_prefix = key_prefix
+        self.max_key_ttl = max_key_ttl
+        self.bloom_bits = bloom_bits
+        self.bloom_hashes = bloom_hashes
+        self._scripts = {}
+
+    def _redis(self):
+        """Подключение Redis (None - проверка по БД)"""
+        if self.redis is not None:
+            return self.redis
+        try:
+            from infra.redis import redis_manager
+            return redis_manager.redis
+        except ImportError:
+            return None
+
+    def _script(self, redis):
+        script = self._scripts.get(id(redis))
+        if script is None:
+            script = redis.register_script(BLOOM_SCRIPT)
+            self._scripts[id(redis)] = script
+        return script
+
+    def key(self, profile_id: int, tx_id: str) -> str:
+        return f"{self.key_prefix}{profile_id}:{tx_id}"
+
+    def bloom_keys(self, ttl: int, now: Optional[float] = None) -> List[str]:
+        """Битовые карты интервалов, покрывающих окно ttl (текущая первой)"""
+        current = int((now if now is not None else time.time()) // self.max_key_ttl)
+        count = -(-ttl // self.max_key_ttl) + 1
+        return [f"{self.key_prefix}bloom:{current - offset}" for offset in range(count)]
+
+    def bloom_bits_for(self, profile_id: int, tx_id: str) -> List[int]:
+        """Номера битов элемента (двойное хеширование)"""
+        digest = hashlib.blake2b(f"{profile_id}:{tx_id}".encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % self.bloom_bits for i in range(self.bloom_hashes)]
+
+    async def claim(self, profile_id: int, tx_id: str, ttl: int) -> bool:
+        """
+        Захватывает tx_id на ttl секунд
+
+        Returns:
+            bool: True - событие новое, False - дубликат
+        """
+        redis = self._redis()
+        if redis is None:
+            return not await self.seen_in_database(profile_id, tx_id, ttl)
+
+        try:
+            if not await redis.set(self.key(profile_id, tx_id), '1', nx=True, ex=min(ttl, self.max_key_ttl)):
+                return False
+            if ttl <= self.max_key_ttl:
+                return True
+            # Длинное окно: за пределами жизни ключа - bloom-фильтр
+            maybe_seen = await self._script(redis)(
+                keys=self.bloom_keys(ttl),
+                args=[ttl + self.max_key_ttl] + self.bloom_bits_for(profile_id, tx_id)
+            )
+        except Exception as e:
+            logger.warning(f"Redis postback dedup failed, using database: {e}")
+            return not await self.seen_in_database(profile_id, tx_id, ttl)
+
+        if maybe_seen:
+            return not await self.seen_in_database(profile_id, tx_id, ttl)
+        return True
+
+    async def release(self, profile_id: int, tx_id: str) -> None:
+        """
+        Отпускает захват tx_id, если событие не удалось обработать
+
+        Бит bloom-фильтра не снимается: для длинного окна повтор уточнится
+        в keitaro_events, где неотправленное событие дубликатом не считается.
+        """
+        redis = self._redis()
+        if redis is None:
+            return
+        try:
+            await redis.delete(self.key(profile_id, tx_id))
+        except Exception as e:
+            logger.warning(f"Failed to release postback dedup key {profile_id}:{tx_id}: {e}")
+
+    async def seen_in_database(self, profile_id: int, tx_id: str, ttl: int) -> bool:
+        """Есть ли событие в keitaro_events за последние ttl секунд"""
+        if self.db is None:
+            return False
+        threshold = datetime.utcnow() - timedelta(seconds=ttl)
+        result = await self.db.execute(DUPLICATE_SQL, (profile_id, tx_id, threshold), fetch=True)
+        return bool(result)
@@ -0,0 +1,389 @@
+"""
+Очередь доставки событий Keitaro в Telegram
+
+Postback подтверждается сразу после проверки и дедупликации, событие
+кладется в Redis Stream (переживает перезапуск, общий для реплик через
+группу потребителей). Фоновый обработчик забирает события пачками и
+отправляет их с учетом лимитов Telegram: общего на бота (TokenBucket) и
+на чат (RateLimiter, в Redis - общий для реплик). Пока чат ждет своей
+очереди, его события копятся и уходят одним сообщением-сводкой.
+Результаты пишутся в keitaro_events многострочным INSERT, после чего
+события подтверждаются (XACK) и удаляются из потока. События
+упавшего обработчика забирает другой (XAUTOCLAIM) через claim_idle.
+
+События, которые ждут лимита своего чата, остаются неподтвержденными,
+поэтому обработчик раз в claim_idle / 3 продлевает их за собой (XCLAIM
+JUSTID сбрасывает время простоя) - иначе живую реплику обогнал бы
+XAUTOCLAIM другой и отправил их второй раз. События, которые все же
+забрал другой обработчик, из памяти убираются. Пока ожидающих больше
+max_pending, новые из потока не читаются - они ждут в Redis, а не в
+памяти процесса.
+
+Сетевые и прочие временные ошибки отправки возвращают неотправленные
+события в очередь чата (без подтверждения) - до max_attempts попыток.
+Окончательной неудачей считаются только отклоненные Telegram сообщения
+(BadRequest, Forbidden) и исчерпанные попытки. Если сводка из нескольких
+сообщений оборвалась на середине, уже отправленные части записываются
+как доставленные, в очередь возвращаются только неотправленные события.
+
+Без Redis очередь - в памяти процесса.
+"""
+
+import os
+import json
+import socket
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from psycopg2.extras import execute_values
+from telegram import Bot
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+from features.keitaro.templates import get_digest_parts, get_message_template
+from utils.rate_limit import RateLimiter, TokenBucket, parse_rate, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+SAVE_EVENTS_SQL = """
+    INSERT INTO keitaro_events (
+        profile_id, transaction_id, status, campaign_id, source,
+        country, revenue, processed, sent_to_chat_id, sent_to_topic_id, error
+    ) VALUES %s
+"""
+
+
+@dataclass
+class QueuedEvent:
+    """Событие, ожидающее отправки"""
+    profile_id: int
+    tx_id: str
+    event_data: Dict
+    chat_id: int
+    topic_id: Optional[int] = None
+    entry_id: Optional[str] = field(default=None, compare=False)  # id в Redis Stream
+    attempts: int = field(default=0, compare=False)  # неудачных отправок (только в памяти)
+
+    def dumps(self) -> str:
+        return json.dumps({
+            'profile_id': self.profile_id, 'tx_id': self.tx_id, 'event_data': self.event_data,
+            'chat_id': self.chat_id, 'topic_id': self.topic_id
+        })
+
+    @classmethod
+    def loads(cls, raw: str, entry_id: Optional[str] = None) -> 'QueuedEvent':
+        return cls(entry_id=entry_id, **json.loads(raw))
+
+    def row(self, processed: bool, error: Optional[str]) -> Tuple:
+        """Строка keitaro_events"""
+        data = self.event_data
+        revenue = data.get('conversion_revenue') or data.get('payout', '')
+        return (
+            self.profile_id, self.tx_id, data.get('status'), data.get('campaign_id'), data.get('source'),
+            data.get('country'), revenue, processed, self.chat_id, self.topic_id, error
+        )
+
+
+class DeliveryQueue:
+    """Очередь и фоновая отправка событий Keitaro"""
+
+    def __init__(self, bot: Bot, database, redis=None, stream: str = 'keitaro:delivery',
+                 group: str = 'delivery', rate: float = 20.0, chat_rate: str = '20/60',
+                 batch_size: int = 200, digest_size: int = 30, claim_idle: float = 60.0,
+                 max_pending: int = 1000, max_attempts: int = 5):
+        """
+        Args:
+            bot: Экземпляр бота
+            database: Экземпляр Database (журнал keitaro_events)
+            redis: Клиент Redis (по умолчанию общее подключение из infra.redis)
+            stream, group: Redis Stream и группа потребителей
+            rate: Сообщений в секунду на бота (лимит Telegram ~30)
+            chat_rate: Лимит на чат "N/секунд" (в группах Telegram - 20 в минуту)
+            batch_size: Сколько событий забирать из потока за раз
+            digest_size: Максимум событий в одной сводке (остальные - в следующую)
+            claim_idle: Через сколько секунд неподтвержденные события другого обработчика забираются
+            max_pending: Сколько ожидающих событий держать в памяти (больше - не читать поток)
+            max_attempts: Попыток отправки события при временных ошибках
+        """
+        self.bot = bot
+        self.db = database
+        self.redis = redis
+        self.stream = stream
+        self.group = group
+        self.consumer = f"{socket.gethostname()}:{os.getpid()}"
+        self.batch_size = batch_size
+        self.digest_size = digest_size
+        self.claim_idle = claim_idle
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.bucket = TokenBucket(rate)
+        self.chat_limiter = RateLimiter(*parse_rate(chat_rate), key_prefix='ratelimit:keitaro:chat:', redis=redis)
+        # (chat_id, topic_id) -> события, ожидающие отправки, в порядке поступления
+        self._pending: Dict[Tuple[int, Optional[int]], List[QueuedEvent]] = {}
+        self._local: asyncio.Queue = asyncio.Queue()
+        self._group_ready = None
+        self._last_claim = 0.0
+        self._last_refresh = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def _redis(self):
+        """Подключение Redis (None - очередь в памяти)"""
+        if self.redis is not None:
+            return self.redis
+        try:
+            from infra.redis import redis_manager
+            return redis_manager.redis
+        except ImportError:
+            return None
+
+    async def enqueue(self, event: QueuedEvent) -> None:
+        """Ставит событие в очередь (без ожидания отправки)"""
+        redis = self._redis()
+        if redis is not None:
+            try:
+                await redis.xadd(self.stream, {'event': event.dumps()})
+                return
+            except Exception as e:
+                logger.warning(f"Keitaro queue unavailable, keeping event {event.tx_id} in memory: {e}")
+        self._local.put_nowait(event)
+
+    @property
+    def pending_count(self) -> int:
+        return sum(len(events) for events in self._pending.values()) + self._local.qsize()
+
+    async def _ensure_group(self, redis) -> None:
+        if self._group_ready is redis:
+            return
+        try:
+            await redis.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except Exception as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self._group_ready = redis
+
+    async def _read(self, block: float) -> List[QueuedEvent]:
+        """Новые события: из памяти и из потока (ждет до block секунд)"""
+        events = []
+        while not self._local.empty() and len(events) < self.batch_size:
+            events.append(self._local.get_nowait())
+
+        redis = self._redis()
+        if redis is None:
+            if not events and block:
+                try:
+                    events.append(await asyncio.wait_for(self._local.get(), block))
+                except asyncio.TimeoutError:
+                    pass
+            return events
+
+        await self._ensure_group(redis)
+        loop = asyncio.get_running_loop()
+        if loop.time() - self._last_refresh >= self.claim_idle / 3:
+            self._last_refresh = loop.time()
+            await self._refresh_held(redis)
+
+        room = min(self.batch_size, self.max_pending - self.pending_count)
+        if room <= 0:
+            # Чаты не успевают за потоком - новые события подождут в Redis
+            if not events and block:
+                await asyncio.sleep(block)
+            return events
+
+        entries = []
+        if loop.time() - self._last_claim >= self.claim_idle:
+            # События обработчиков, которые упали, не подтвердив их
+            self._last_claim = loop.time()
+            result = await redis.xautoclaim(
+                self.stream, self.group, self.consumer,
+                min_idle_time=int(self.claim_idle * 1000), start_id='0-0', count=room
+            )
+            held = {event.entry_id for events in self._pending.values() for event in events}
+            entries.extend(entry for entry in result[1] if entry[0] not in held)
+        response = await redis.xreadgroup(
+            self.group, self.consumer, {self.stream: '>'}, count=room,
+            block=int(block * 1000) if block and not events and not entries else None
+        )
+        for _, stream_entries in response or []:
+            entries.extend(stream_entries)
+
+        for entry_id, fields in entries:
+            if not fields:
+                continue  # удалено из потока
+            try:
+                events.append(QueuedEvent.loads(fields['event'], entry_id))
+            except Exception as e:
+                logger.error(f"Dropping malformed Keitaro queue entry {entry_id}: {e}")
+                await redis.xack(self.stream, self.group, entry_id)
+        return events
+
+    async def _refresh_held(self, redis) -> None:
+        """Продлевает за собой ожидающие события, отданные другому обработчику - забывает"""
+        held = [event.entry_id for events in self._pending.values() for event in events if event.entry_id]
+        if not held:
+            return
+        held.sort(key=lambda entry_id: tuple(int(part) for part in entry_id.split('-')))
+        pending = await redis.xpending_range(
+            self.stream, self.group, min=held[0], max=held[-1],
+            count=len(held) + self.batch_size, consumername=self.consumer
+        )
+        owned = {item['message_id'] for item in pending}
+        lost = set(held) - owned
+        if lost:
+            # Их отправит новый владелец (или вернет нам XAUTOCLAIM)
+            logger.warning(f"{len(lost)} held Keitaro event(s) were claimed by another consumer")
+            for target, events in list(self._pending.items()):
+                kept = [event for event in events if event.entry_id not in lost]
+                if kept:
+                    self._pending[target] = kept
+                else:
+                    del self._pending[target]
+        if owned:
+            await redis.xclaim(self.stream, self.group, self.consumer, min_idle_time=0,
+                               message_ids=list(owned), justid=True)
+
+    async def run_once(self, block: float = 1.0) -> int:
+        """
+        Забирает новые события и отправляет тем чатам, чей лимит позволяет
+
+        Returns:
+            Число обработанных событий
+        """
+        # Пока есть ожидающие, ждем новых недолго - иначе их чаты ждут лишнее
+        for event in await self._read(0.2 if self._pending else block):
+            self._pending.setdefault((event.chat_id, event.topic_id), []).append(event)
+
+        sends = []
+        for target, events in list(self._pending.items()):
+            batch = events[:self.digest_size]
+            parts = self._render(batch)
+            cost = min(len(parts), self.chat_limiter.capacity)
+            allowed, _ = await self.chat_limiter.hit(str(target[0]), cost=cost)
+            if allowed:
+                if len(events) > len(batch):
+                    self._pending[target] = events[len(batch):]
+                else:
+                    del self._pending[target]
+                sends.append(self._deliver(target, parts))
+
+        results = []
+        for delivered in await asyncio.gather(*sends):
+            results.extend(delivered)
+        await self._finish(results)
+        return len(results)
+
+    @staticmethod
+    def _render(events: List[QueuedEvent]) -> List[Tuple[str, List[QueuedEvent]]]:
+        """Сообщения для чата и события, которые попали в каждое из них"""
+        if len(events) == 1:
+            return [(get_message_template(events[0].event_data), events)]
+        parts = []
+        offset = 0
+        for text, count in get_digest_parts([event.event_data for event in events]):
+            parts.append((text, events[offset:offset + count]))
+            offset += count
+        return parts
+
+    def _requeue(self, target: Tuple[int, Optional[int]], events: List[QueuedEvent]) -> None:
+        """Возвращает события в начало очереди чата (не подтверждены - переживут и падение)"""
+        if events:
+            self._pending[target] = events + self._pending.get(target, [])
+
+    async def _deliver(self, target: Tuple[int, Optional[int]],
+                       parts: List[Tuple[str, List[QueuedEvent]]]) -> List[Tuple[QueuedEvent, bool, Optional[str]]]:
+        chat_id, topic_id = target
+        results = []
+        for index, (text, events) in enumerate(parts):
+            unsent = [event for _, part in parts[index:] for event in part]
+            await self.bucket.acquire()
+            try:
+                kwargs = {'message_thread_id': topic_id} if topic_id else {}
+                await self.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML, **kwargs)
+            except RetryAfter as e:
+                # Флуд-лимит общий на бота: пауза для всех, неотправленное - обратно в очередь чата
+                self.bucket.pause(retry_after_seconds(e.retry_after))
+                self._requeue(target, unsent)
+                break
+            except Forbidden as e:
+                # Бот удален из чата - остальные части тоже не дойдут
+                logger.error(f"Keitaro chat {chat_id} is unavailable: {e}")
+                results.extend((event, False, str(e)[:255]) for event in unsent)
+                break
+            except BadRequest as e:
+                # BadRequest - подкласс NetworkError, но повтор этого сообщения не поможет
+                logger.error(f"Telegram rejected Keitaro events for {chat_id}: {e}")
+                results.extend((event, False, str(e)[:255]) for event in events)
+                continue
+            except Exception as e:
+                # Сеть, таймаут, сбой Telegram: повторим, пока не кончатся попытки
+                logger.warning(f"Failed to send Keitaro events to {chat_id}, will retry: {e}")
+                retry = []
+                for event in unsent:
+                    event.attempts += 1
+                    if event.attempts >= self.max_attempts:
+                        results.append((event, False, str(e)[:255]))
+                    else:
+                        retry.append(event)
+                self._requeue(target, retry)
+                break
+            results.extend((event, True, None) for event in events)
+
+        sent = sum(1 for _, processed, _ in results if processed)
+        if sent:
+            logger.info(f"Sent {sent} Keitaro event(s) to {chat_id}:{topic_id}")
+        return results
+
+    async def _finish(self, results: List[Tuple[QueuedEvent, bool, Optional[str]]]) -> None:
+        """Журнал в keitaro_events одним INSERT, затем подтверждение в потоке"""
+        if not results:
+            return
+        rows = [event.row(processed, error) for event, processed, error in results]
+        try:
+            await self.db.run_in_transaction(
+                lambda cursor: execute_values(cursor, SAVE_EVENTS_SQL, rows, page_size=len(rows))
+            )
+        except Exception as e:
+            # Сообщения уже отправлены - повторная отправка хуже потери записи журнала
+            logger.error(f"Failed to save {len(rows)} Keitaro events: {e}")
+
+        entry_ids = [event.entry_id for event, _, _ in results if event.entry_id]
+        redis = self._redis()
+        if entry_ids and redis is not None:
+            try:
+                pipe = redis.pipeline(transaction=False)
+                pipe.xack(self.stream, self.group, *entry_ids)
+                pipe.xdel(self.stream, *entry_ids)
+                await pipe.execute()
+            except Exception as e:
+                logger.error(f"Failed to ack Keitaro queue entries: {e}")
+
+    def start(self) -> None:
+        """Запускает фоновую отправку"""
+        if self._task and not self._task.done():
+            return
+
+        async def _loop():
+            while True:
+                try:
+                    await self.run_once()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Keitaro delivery failed: {e}")
+                    await asyncio.sleep(1)
+
+        self._task = asyncio.create_task(_loop())
+
+    async def stop(self) -> None:
+        """Останавливает отправку (события в Redis дождутся следующего запуска)"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._local.qsize() or any(event.entry_id is None for events in self._pending.values()
+                                      for event in events):
+            logger.warning(f"Keitaro delivery stopped with {self.pending_count} undelivered in-memory events")
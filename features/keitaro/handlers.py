@@ -16,6 +16,7 @@ from telegram.ext import (
 from database import Database
 from utils.localization import get_text
 from features.keitaro.templates import get_test_message
+from features.keitaro.routing import route_cache
 
 logger = logging.getLogger(__name__)
 
@@ -361,6 +362,7 @@ class KeitaroHandlers:
             WHERE owner_user_id = %s
         """
         await self.db.execute(query_sql, (new_status, user_id))
+        route_cache.invalidate(owner_user_id=user_id)
         
         status_text = get_text(context, 'keitaro_enabled' if new_status else 'keitaro_disabled')
         await query.answer(status_text, show_alert=True)
@@ -505,6 +507,8 @@ class KeitaroHandlers:
             3600,   # dedup_ttl_sec
             False   # pull_enabled
         ))
+        # Прежний secret и настройки доставки больше не действуют
+        route_cache.invalidate(owner_user_id=setup_data['owner_user_id'])
 
 
 def register_keitaro_handlers(application, database: Database):
@@ -0,0 +1,294 @@
+"""
+Pull-режим Keitaro: конверсии из отчета Admin API
+
+Для профилей с pull_enabled фоновая задача раз в interval запрашивает
+журнал конверсий Keitaro (POST /admin_api/v1/conversions/log) начиная с
+курсора pull_last_check - страницами по page_size строк, профили
+параллельно, но не больше concurrency одновременно. Курсор сохраняется
+после каждой страницы и сдвигается на конец окна, когда все страницы
+получены; следующий запрос начинается на overlap секунд раньше курсора,
+чтобы не потерять конверсии, записанные Keitaro с задержкой.
+
+Строки проходят тот же путь, что postback: дедупликация тем же
+PostbackDeduplicator (конверсия, уже пришедшая postback, повторно не
+отправляется), маршрутизация через кэш правил, отправка через очередь
+доставки. В Redis профиль захватывается на interval - реплики не
+запрашивают один и тот же отчет.
+"""
+
+import json
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+from features.keitaro.delivery import QueuedEvent
+from features.keitaro.routing import profile_from_row
+from database.keitaro_models import KeitaroProfile
+
+logger = logging.getLogger(__name__)
+
+CONVERSIONS_PATH = '/admin_api/v1/conversions/log'
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+PROFILES_SQL = """
+    SELECT * FROM keitaro_profiles
+    WHERE enabled = true AND pull_enabled = true
+    AND pull_base_url IS NOT NULL AND pull_api_key IS NOT NULL
+    ORDER BY id
+"""
+
+CURSOR_SQL = """
+    UPDATE keitaro_profiles SET pull_last_check = %s WHERE id = %s
+"""
+
+# Колонка отчета Keitaro -> параметр postback
+COLUMNS = {
+    'tid': 'transaction_id',
+    'sub_id': 'click_id',
+    'status': 'status',
+    'campaign_id': 'campaign_id',
+    'campaign': 'campaign_name',
+    'offer': 'offer_name',
+    'revenue': 'conversion_revenue',
+    'country': 'country',
+    'source': 'source',
+    'creative_id': 'creative_id',
+    'landing': 'landing_name',
+    **{f'sub_id_{i}': f'sub_id_{i}' for i in range(1, 11)},
+}
+
+# Ключ pull_filters -> колонка отчета
+FILTER_COLUMNS = {
+    'status': 'status',
+    'geo': 'country',
+}
+
+
+def build_filters(pull_filters: Any) -> List[Dict]:
+    """
+    Фильтры запроса из pull_filters профиля
+
+    Словарь {"status": [...], "geo": [...]} превращается в фильтры IN_LIST,
+    список передается в Keitaro как есть.
+    """
+    if isinstance(pull_filters, str):
+        pull_filters = json.loads(pull_filters) if pull_filters else None
+    if isinstance(pull_filters, list):
+        return pull_filters
+    filters = []
+    for key, column in FILTER_COLUMNS.items():
+        values = (pull_filters or {}).get(key)
+        if values:
+            filters.append({'name': column, 'operator': 'IN_LIST', 'expression': list(values)})
+    return filters
+
+
+def row_to_payload(row: Dict) -> Dict[str, str]:
+    """Строка отчета как payload postback"""
+    return {
+        param: '' if row.get(column) is None else str(row[column])
+        for column, param in COLUMNS.items()
+    }
+
+
+class KeitaroPullSync:
+    """Периодическая выгрузка конверсий Keitaro для профилей с pull_enabled"""
+
+    def __init__(self, server, interval: float = 300.0, page_size: int = 1000,
+                 concurrency: int = 4, overlap: int = 120, lookback: int = 3600,
+                 timeout: float = 60.0, redis=None):
+        """
+        Args:
+            server: KeitaroWebServer - его БД, дедупликация, маршрутизация и очередь доставки
+            interval: Как часто опрашивать Keitaro, сек
+            page_size: Строк отчета за запрос
+            concurrency: Сколько профилей выгружать одновременно
+            overlap: На сколько секунд раньше курсора начинать окно
+            lookback: Окно первой выгрузки (курсора еще нет), сек
+            timeout: Таймаут запроса к Keitaro, сек
+            redis: Клиент Redis (по умолчанию общее подключение из infra.redis)
+        """
+        self.server = server
+        self.interval = interval
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.overlap = overlap
+        self.lookback = lookback
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.redis = redis
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _redis(self):
+        """Подключение Redis (None - без захвата профилей)"""
+        if self.redis is not None:
+            return self.redis
+        try:
+            from infra.redis import redis_manager
+            return redis_manager.redis
+        except ImportError:
+            return None
+
+    async def _acquire(self, profile_id: int) -> bool:
+        """Захватывает выгрузку профиля на interval (другие реплики ее пропустят)"""
+        redis = self._redis()
+        if redis is None:
+            return True
+        try:
+            return bool(await redis.set(
+                f"keitaro:pull:lock:{profile_id}", '1', nx=True, ex=max(int(self.interval), 1)
+            ))
+        except Exception as e:
+            logger.warning(f"Keitaro pull lock unavailable, pulling anyway: {e}")
+            return True
+
+    def _ensure_session(self) -> None:
+        """Создает HTTP сессию если её нет"""
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=self.timeout)
+
+    async def run_once(self) -> int:
+        """
+        Выгружает новые конверсии всех профилей
+
+        Returns:
+            Сколько событий поставлено в очередь
+        """
+        rows = await self.server.db.execute(PROFILES_SQL, fetch=True) or []
+        if not rows:
+            return 0
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def _sync(profile: KeitaroProfile) -> int:
+            async with semaphore:
+                if not await self._acquire(profile.id):
+                    return 0
+                try:
+                    return await self.sync_profile(profile)
+                except Exception as e:
+                    logger.error(f"Keitaro pull failed for profile {profile.id}: {e}")
+                    return 0
+
+        results = await asyncio.gather(*(_sync(profile_from_row(row)) for row in rows))
+        return sum(results)
+
+    async def sync_profile(self, profile: KeitaroProfile, until: Optional[datetime] = None) -> int:
+        """
+        Выгружает конверсии профиля от курсора до until (по умолчанию - сейчас)
+
+        Returns:
+            Сколько событий поставлено в очередь
+        """
+        until = (until or datetime.utcnow()).replace(microsecond=0)
+        cursor = profile.pull_last_check
+        if cursor is None:
+            since = until - timedelta(seconds=self.lookback)
+        else:
+            since = cursor - timedelta(seconds=self.overlap)
+        filters = build_filters(profile.pull_filters)
+        self._ensure_session()
+
+        queued = 0
+        offset = 0
+        while True:
+            rows = await self._fetch_page(profile, since, until, filters, offset)
+            for row in rows:
+                if await self._process(profile, row):
+                    queued += 1
+
+            if len(rows) < self.page_size:
+                break
+            offset += len(rows)
+            # Страницы отсортированы по времени: после падения продолжим с последней строки
+            page_end = self._parse_time(rows[-1].get('postback_datetime'))
+            if page_end is not None and (cursor is None or page_end > cursor):
+                cursor = page_end
+                await self._save_cursor(profile.id, cursor)
+
+        await self._save_cursor(profile.id, until)
+        profile.pull_last_check = until
+        if queued:
+            logger.info(f"Keitaro pull queued {queued} event(s) for profile {profile.id}")
+        return queued
+
+    async def _fetch_page(self, profile: KeitaroProfile, since: datetime, until: datetime,
+                          filters: List[Dict], offset: int) -> List[Dict]:
+        body = {
+            'range': {'from': since.strftime(TIME_FORMAT), 'to': until.strftime(TIME_FORMAT), 'timezone': 'UTC'},
+            'columns': ['postback_datetime', *COLUMNS],
+            'filters': filters,
+            'sort': [{'name': 'postback_datetime', 'order': 'ASC'}],
+            'limit': self.page_size,
+            'offset': offset,
+        }
+        url = profile.pull_base_url.rstrip('/') + CONVERSIONS_PATH
+        async with self.session.post(url, json=body, headers={'Api-Key': profile.pull_api_key}) as response:
+            response.raise_for_status()
+            data = await response.json()
+        return data.get('rows') or []
+
+    async def _process(self, profile: KeitaroProfile, row: Dict) -> bool:
+        """Дедупликация, маршрутизация и постановка в очередь одной конверсии"""
+        event_data = self.server._extract_event_data(row_to_payload(row))
+        tx_id = event_data.get('transaction_id') or event_data.get('click_id')
+        if not tx_id:
+            tx_id = hashlib.sha256(json.dumps(row, sort_keys=True, default=str).encode()).hexdigest()[:32]
+            event_data['no_tx'] = True
+
+        if not await self.server.dedup.claim(profile.id, tx_id, profile.dedup_ttl_sec):
+            return False
+
+        try:
+            target_chat, target_topic = await self.server._route_event(profile, event_data)
+            if not target_chat:
+                return False
+            await self.server.delivery.enqueue(QueuedEvent(profile.id, tx_id, event_data, target_chat, target_topic))
+        except BaseException:
+            # Курсор не сдвинут за эту страницу - следующая выгрузка попробует снова
+            await self.server.dedup.release(profile.id, tx_id)
+            raise
+        return True
+
+    async def _save_cursor(self, profile_id: int, cursor: datetime) -> None:
+        await self.server.db.execute(CURSOR_SQL, (cursor, profile_id))
+
+    @staticmethod
+    def _parse_time(value: Optional[str]) -> Optional[datetime]:
+        try:
+            return datetime.strptime(value, TIME_FORMAT)
+        except (TypeError, ValueError):
+            return None
+
+    def start(self) -> None:
+        """Запускает периодическую выгрузку"""
+        if self._task and not self._task.done():
+            return
+
+        async def _loop():
+            while True:
+                try:
+                    await self.run_once()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Keitaro pull failed: {e}")
+                await asyncio.sleep(self.interval)
+
+        self._task = asyncio.create_task(_loop())
+
+    async def stop(self) -> None:
+        """Останавливает выгрузку (курсор сохранен - продолжим с него)"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.session and not self.session.closed:
+            await self.session.close()
@@ -0,0 +1,252 @@
+"""
+Кэш профилей и скомпилированные таблицы маршрутизации Keitaro
+
+Профиль (по secret) и его правила загружаются из БД один раз и хранятся
+в памяти до истечения ttl или до invalidate() - при изменении профиля.
+Правила компилируются в RoutingTable: точные значения campaign_id/source
+- в словарь, регулярные выражения компилируются заранее, фильтры по
+статусу и гео - битовые маски над номерами правил. Маршрут события -
+несколько поисков в словарях и AND масок, без запросов к БД.
+"""
+
+import re
+import json
+import time
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from database.keitaro_models import KeitaroProfile, MatchByType
+
+logger = logging.getLogger(__name__)
+
+# match_by -> поле события
+MATCH_FIELDS = {
+    MatchByType.CAMPAIGN_ID.value: 'campaign_id',
+    MatchByType.SOURCE.value: 'source',
+}
+
+PROFILE_SQL = """
+    SELECT * FROM keitaro_profiles
+    WHERE secret = %s AND enabled = true
+    LIMIT 1
+"""
+
+ROUTES_SQL = """
+    SELECT * FROM keitaro_routes
+    WHERE profile_id = %s
+    ORDER BY priority ASC, id ASC
+"""
+
+
+def profile_from_row(row: Dict) -> KeitaroProfile:
+    """Строка keitaro_profiles как объект профиля"""
+    # Простое преобразование в объект
+    profile = KeitaroProfile()
+    for key, value in row.items():
+        setattr(profile, key, value)
+    return profile
+
+
+def _match_by(value: Any) -> str:
+    """match_by как значение MatchByType (в БД enum хранится по имени - CAMPAIGN_ID)"""
+    if isinstance(value, MatchByType):
+        return value.value
+    return str(value).lower()
+
+
+class RoutingTable:
+    """Правила профиля, скомпилированные для быстрого поиска маршрута"""
+
+    def __init__(self, routes: List[Dict], default_chat_id: Optional[int] = None,
+                 default_topic_id: Optional[int] = None):
+        """
+        Args:
+            routes: Строки keitaro_routes в порядке приоритета
+            default_chat_id, default_topic_id: Куда отправлять, если ни одно правило не подошло
+        """
+        self.default = (default_chat_id, default_topic_id)
+        self.targets: List[Tuple[Optional[int], Optional[int]]] = []
+        # (поле, значение) -> маска правил с точным совпадением
+        self.exact: Dict[Tuple[str, str], int] = {}
+        # Правила match_by=any
+        self.any_mask = 0
+        # (номер правила, поле, скомпилированный regex) в порядке приоритета
+        self.regex: List[Tuple[int, str, re.Pattern]] = []
+        # Правила без фильтра и значение фильтра -> маска правил, которые его пропускают
+        self.no_status_filter = 0
+        self.by_status: Dict[str, int] = {}
+        self.no_geo_filter = 0
+        self.by_geo: Dict[str, int] = {}
+
+        for route in routes:
+            index = len(self.targets)
+            bit = 1 << index
+            match_by = _match_by(route['match_by'])
+            field = MATCH_FIELDS.get(match_by)
+            if field is None and match_by != MatchByType.ANY.value:
+                continue
+
+            if field is None:
+                self.any_mask |= bit
+            elif route['is_regex']:
+                try:
+                    self.regex.append((index, field, re.compile(route['match_value'])))
+                except re.error as e:
+                    logger.warning(f"Skipping Keitaro route {route.get('id')} with invalid regex: {e}")
+                    continue
+            else:
+                key = (field, route['match_value'])
+                self.exact[key] = self.exact.get(key, 0) | bit
+
+            self.no_status_filter |= self._add_filter(self.by_status, route['status_filter'], bit)
+            self.no_geo_filter |= self._add_filter(self.by_geo, route['geo_filter'], bit)
+            self.targets.append((route['target_chat_id'], route['target_topic_id']))
+
+    @staticmethod
+    def _add_filter(index: Dict[str, int], values, bit: int) -> int:
+        """Добавляет правило в индекс фильтра; возвращает bit, если фильтра нет"""
+        if isinstance(values, str):
+            # JSON-колонка, прочитанная как текст: '["deposit"]'
+            try:
+                values = json.loads(values) if values else None
+            except ValueError:
+                values = [values]
+            if isinstance(values, str):
+                values = [values]
+        if not values:
+            return bit
+        for value in values:
+            index[value] = index.get(value, 0) | bit
+        return 0
+
+    def route(self, event_data: Dict) -> Tuple[Optional[int], Optional[int]]:
+        """Первое по приоритету подходящее правило (chat_id, topic_id) или настройки по умолчанию"""
+        allowed = (self.no_status_filter | self.by_status.get(event_data.get('status'), 0)) & \
+                  (self.no_geo_filter | self.by_geo.get(event_data.get('country'), 0))
+        if not allowed:
+            return self.default
+
+        matched = self.any_mask
+        for field in MATCH_FIELDS.values():
+            matched |= self.exact.get((field, event_data.get(field, '')), 0)
+        matched &= allowed
+
+        # Младший бит - правило с наивысшим приоритетом; regex проверяем только выше него
+        best = (matched & -matched).bit_length() - 1 if matched else len(self.targets)
+        for index, field, pattern in self.regex:
+            if index >= best:
+                break
+            if allowed >> index & 1 and pattern.match(event_data.get(field, '')):
+                best = index
+                break
+
+        if best < len(self.targets):
+            return self.targets[best]
+        return self.default
+
+
+class RouteCache:
+    """Профили по secret и их таблицы маршрутизации в памяти"""
+
+    def __init__(self, ttl: float = 30.0, max_unknown: int = 10000):
+        """
+        Args:
+            ttl: Сколько секунд запись живет без invalidate() (изменения с других реплик)
+            max_unknown: Сколько неизвестных secret помнить (от перебора secret)
+        """
+        self.ttl = ttl
+        self.max_unknown = max_unknown
+        # secret -> (истекает, профиль или None)
+        self._profiles: Dict[str, Tuple[float, Optional[KeitaroProfile]]] = {}
+        # profile_id -> (истекает, таблица)
+        self._tables: Dict[int, Tuple[float, RoutingTable]] = {}
+        self._loading: Dict[Any, asyncio.Future] = {}
+        self._unknown = 0
+
+    def configure(self, ttl: Optional[float] = None) -> None:
+        if ttl is not None:
+            self.ttl = ttl
+
+    async def profile(self, database, secret: str) -> Optional[KeitaroProfile]:
+        """Включенный профиль по secret (None - нет такого)"""
+        entry = self._profiles.get(secret)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        profile = await self._load_once(('profile', secret), lambda: self._load_profile(database, secret))
+        if profile is None:
+            if self._unknown >= self.max_unknown:
+                self._drop_unknown()
+            self._unknown += 1
+        self._profiles[secret] = (time.monotonic() + self.ttl, profile)
+        return profile
+
+    async def table(self, database, profile: KeitaroProfile) -> RoutingTable:
+        """Скомпилированные правила профиля"""
+        entry = self._tables.get(profile.id)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        async def _load():
+            routes = await database.execute(ROUTES_SQL, (profile.id,), fetch=True) or []
+            return RoutingTable(routes, profile.default_chat_id, profile.default_topic_id)
+
+        table = await self._load_once(('routes', profile.id), _load)
+        self._tables[profile.id] = (time.monotonic() + self.ttl, table)
+        return table
+
+    def invalidate(self, profile_id: Optional[int] = None, owner_user_id: Optional[int] = None) -> None:
+        """
+        Сбрасывает профиль (по id или владельцу) и его правила; без аргументов - все
+
+        Неизвестные secret тоже сбрасываются - профиль мог получить один из них.
+        """
+        if profile_id is None and owner_user_id is None:
+            self._profiles.clear()
+            self._tables.clear()
+            self._unknown = 0
+            return
+
+        for secret, (_, profile) in list(self._profiles.items()):
+            if profile is None or profile.id == profile_id or profile.owner_user_id == owner_user_id:
+                if profile is not None:
+                    self._tables.pop(profile.id, None)
+                del self._profiles[secret]
+        self._unknown = 0
+        if profile_id is not None:
+            self._tables.pop(profile_id, None)
+
+    def _drop_unknown(self) -> None:
+        self._profiles = {secret: entry for secret, entry in self._profiles.items() if entry[1] is not None}
+        self._unknown = 0
+
+    async def _load_once(self, key, loader):
+        """Один запрос к БД на ключ, даже если промах случился у нескольких запросов сразу"""
+        future = self._loading.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            result = await loader()
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение получат ожидающие; если их нет - не выводить "never retrieved"
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._loading[key]
+
+    @staticmethod
+    async def _load_profile(database, secret: str) -> Optional[KeitaroProfile]:
+        result = await database.execute(PROFILE_SQL, (secret,), fetch=True)
+        return profile_from_row(result[0]) if result else None
+
+
+# Глобальный кэш профилей Keitaro
+route_cache = RouteCache()
@@ -2,7 +2,7 @@
 Шаблоны сообщений для событий Keitaro
 """
 
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple
 import html
 
 
@@ -152,6 +152,47 @@ def get_message_template(event_data: Dict[str, Any]) -> str:
     return message
 
 
+def get_digest_parts(events: List[Dict[str, Any]], limit: int = 4096) -> List[Tuple[str, int]]:
+    """
+    Сводка нескольких событий для одного чата, по сообщениям
+    
+    Args:
+        events: Данные событий в порядке поступления
+        limit: Максимальная длина сообщения Telegram
+        
+    Returns:
+        List[Tuple[str, int]]: (сообщение, сколько событий подряд в нем)
+    """
+    header = f"📦 <b>Сводка: {len(events)}</b>"
+    parts = []
+    current = header
+    count = 0
+    for event_data in events:
+        block = get_message_template(event_data)
+        if len(current) + 2 + len(block) > limit and current != header:
+            parts.append((current, count))
+            current = header
+            count = 0
+        current += "\n\n" + block
+        count += 1
+    parts.append((current[:limit], count))
+    return parts
+
+
+def get_digest_messages(events: List[Dict[str, Any]], limit: int = 4096) -> List[str]:
+    """
+    Сводка нескольких событий для одного чата
+    
+    Args:
+        events: Данные событий в порядке поступления
+        limit: Максимальная длина сообщения Telegram
+        
+    Returns:
+        List[str]: Сообщения сводки (больше одного, если события не помещаются в limit)
+    """
+    return [message for message, _ in get_digest_parts(events, limit)]
+
+
 def get_test_message() -> str:
     """Возвращает тестовое сообщение"""
     test_data = {
@@ -8,19 +8,18 @@ SLA нет → таймауты/ретраи обязательны.
 Модуль обеспечивает:
 - HTTP-клиент с ретраями и валидацией
 - Ограничения по размеру файла (≤5 МБ)
-- Антиспам и квотирование через Redis
+- Антиспам через Redis и дневную квоту (database.quotas)
 """
 
 import asyncio
 import logging
-from datetime import datetime
 from io import BytesIO
 from typing import Optional, Tuple
 
 import httpx
 from redis.asyncio import Redis
 
-from config import settings
+from database.quotas import RANDOM_FACE, QuotaEngine, quotas
 
 logger = logging.getLogger(__name__)
 
@@ -38,8 +37,14 @@ USER_AGENT = f"KashHub/1.0 (+https://t.me/kashhub_bot)"
 class RandomFaceService:
     """Сервис для генерации случайных лиц"""
     
-    def __init__(self, redis: Redis):
+    def __init__(self, redis: Redis, quota_engine: Optional[QuotaEngine] = None):
+        """
+        Args:
+            redis: Подключение к Redis (антиспам)
+            quota_engine: Дневные квоты (по умолчанию общий database.quotas)
+        """
         self.redis = redis
+        self.quotas = quota_engine or quotas
         self.endpoint_url = "https://thispersondoesnotexist.com/"
     
     async def fetch_face_image(self, user_id: int) -> Tuple[Optional[BytesIO], Optional[str]]:
@@ -52,26 +57,23 @@ class RandomFaceService:
         Returns:
             Tuple[BytesIO, None] при успехе или (None, error_message) при ошибке
         """
-        # Проверяем антиспам
-        if await self._is_rate_limited(user_id):
+        # Антиспам: флаг ставится только если его еще нет
+        if not await self._acquire_lock(user_id):
             return None, "Слишком часто, подожди 2 сек"
         
-        # Проверяем дневную квоту
-        if await self._is_quota_exceeded(user_id):
+        # Проверяем и списываем дневную квоту одним запросом
+        quota = await self.quotas.consume(RANDOM_FACE, user_id)
+        if not quota.allowed:
             return None, "Лимит на сегодня исчерпан. Доступ снова завтра."
         
-        # Устанавливаем антиспам флаг
-        await self._set_rate_limit(user_id)
-        
         # Пытаемся получить изображение с ретраями
         image_data = await self._fetch_with_retries(user_id)
         
         if image_data is None:
+            # Квота тратится только на успешную загрузку
+            await self.quotas.refund(RANDOM_FACE, user_id)
             return None, "Сервис недоступен, попробуй ещё раз позже"
         
-        # Увеличиваем счетчик только при успешной загрузке
-        await self._increment_quota(user_id)
-        
         return BytesIO(image_data), None
     
     async def _fetch_with_retries(self, user_id: int) -> Optional[bytes]:
@@ -138,53 +140,15 @@ class RandomFaceService:
         logger.error(f"All retry attempts failed for user {user_id}")
         return None
     
-    async def _is_rate_limited(self, user_id: int) -> bool:
-        """Проверить антиспам флаг"""
-        key = f"face:lock:{user_id}"
-        return await self.redis.exists(key)
-    
-    async def _set_rate_limit(self, user_id: int) -> None:
-        """Установить антиспам флаг на 2 секунды"""
+    async def _acquire_lock(self, user_id: int) -> bool:
+        """Установить антиспам флаг на 2 секунды (False - флаг уже стоит)"""
         key = f"face:lock:{user_id}"
-        await self.redis.setex(key, ANTISPAM_SECONDS, "1")
-    
-    async def _is_quota_exceeded(self, user_id: int) -> bool:
-        """Проверить превышение дневной квоты"""
-        key = self._get_quota_key(user_id)
-        current_count = await self.redis.get(key)
-        
-        if current_count is None:
-            return False
-        
-        return int(current_count) >= settings.FACE_QUOTA_PER_DAY
-    
-    async def _increment_quota(self, user_id: int) -> None:
-        """Увеличить счетчик дневной квоты"""
-        key = self._get_quota_key(user_id)
-        
-        # Увеличиваем счетчик или создаем новый
-        current_count = await self.redis.incr(key)
-        
-        # Устанавливаем TTL только для нового ключа
-        if current_count == 1:
-            # Устанавливаем срок до конца дня
-            tomorrow = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-            tomorrow = tomorrow.replace(day=tomorrow.day + 1)
-            ttl_seconds = int((tomorrow - datetime.now()).total_seconds())
-            await self.redis.expire(key, ttl_seconds)
+        return bool(await self.redis.set(key, "1", ex=ANTISPAM_SECONDS, nx=True))
     
     async def get_remaining_quota(self, user_id: int) -> int:
         """Получить оставшуюся квоту пользователя"""
-        key = self._get_quota_key(user_id)
-        current_count = await self.redis.get(key)
-        
-        if current_count is None:
-            return settings.FACE_QUOTA_PER_DAY
-        
-        remaining = settings.FACE_QUOTA_PER_DAY - int(current_count)
-        return max(0, remaining)
+        return await self.quotas.remaining(RANDOM_FACE, user_id)
     
     def _get_quota_key(self, user_id: int) -> str:
         """Получить ключ квоты для пользователя"""
-        today = datetime.now().strftime("%Y%m%d")
-        return f"face:quota:{user_id}:{today}"
+        return self.quotas.key(RANDOM_FACE, user_id, self.quotas.today())
@@ -3,13 +3,15 @@
 """
 
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, CallbackQueryHandler, CommandHandler, MessageHandler, filters, ConversationHandler
 from telegram.constants import ParseMode
 from typing import List, Dict, Any
 
 from analytics import Analytics
+from services.broadcast import send_content
+from services.dashboard import DashboardService
 from database import Database
 from utils.localization import get_text
 import config
@@ -28,6 +30,8 @@ class AdminPanel:
     def __init__(self, database: Database):
         self.db = database
         self.analytics = Analytics(database)
+        # Метрики для экранов админки считаются заранее в фоне
+        self.dashboard = DashboardService(self.analytics, ttl=config.DASHBOARD_TTL)
         self.broadcast_data: Dict[str, Any] = {}
 
     def is_admin(self, user_id: int) -> bool:
@@ -65,19 +69,13 @@ class AdminPanel:
         query = update.callback_query
         await query.answer()
         
-        # Показываем сообщение о загрузке
-        await query.edit_message_text("⏳ Загружаю метрики...")
-        
         try:
-            # Получаем метрики
-            dau_wau_mau = await self.analytics.get_dau_wau_mau()
-            total_users = await self.analytics.get_total_users()
-            retention = {
-                'D1': await self.analytics.get_average_retention(1, 30),
-                'D7': await self.analytics.get_average_retention(7, 30),
-                'D30': await self.analytics.get_average_retention(30, 30)
-            }
-            churn_rate = await self.analytics.get_churn_rate(30)
+            # Метрики из снимка дашборда (обновляется в фоне)
+            snapshot = await self.dashboard.get()
+            dau_wau_mau = snapshot.dau_wau_mau
+            total_users = snapshot.total_users
+            retention = snapshot.retention
+            churn_rate = snapshot.churn_rate
             
             # Форматируем текст
             text = f"""📊 **Основные метрики бота**
@@ -110,7 +108,7 @@ class AdminPanel:
 • Random Face генератор, Keitaro интеграция
 • Админ панель, Мультиязычность, Аналитика
 
-_Обновлено: {datetime.now().strftime('%Y-%m-%d %H:%M')}_"""
+_Обновлено: {snapshot.updated_at.strftime('%Y-%m-%d %H:%M')}_"""
             
             keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="admin_menu")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -126,18 +124,17 @@ _Обновлено: {datetime.now().strftime('%Y-%m-%d %H:%M')}_"""
         query = update.callback_query
         await query.answer()
         
-        await query.edit_message_text("⏳ Загружаю детальную аналитику...")
-        
         try:
+            snapshot = await self.dashboard.get()
+            
             # Использование команд (все функции, не ограничиваем)
-            command_usage = await self.analytics.get_command_usage(30)
-            top_commands = command_usage  # Все функции, а не топ-10
+            top_commands = snapshot.command_usage  # Все функции, а не топ-10
             
             # Новые пользователи
-            new_users_data = await self.analytics.get_new_users(7)
+            new_users_data = snapshot.new_users
             
             # Активность по часам
-            hourly_activity = await self.analytics.get_hourly_activity(7)
+            hourly_activity = snapshot.hourly_activity
             
             # Форматируем текст (убираем markdown для стабильности)
             text = "📈 Детальная аналитика бота\n\n"
@@ -233,24 +230,11 @@ _Обновлено: {datetime.now().strftime('%Y-%m-%d %H:%M')}_"""
             else:
                 text += "📊 Данные об активности отсутствуют\n"
 
-            # Добавляем статистику по интеграциям если доступна
-            try:
-                # Проверяем наличие Keitaro профилей через ORM
-                with self.db.get_session() as db_session:
-                    from database.models import KeitaroProfile
-                    keitaro_count = db_session.query(KeitaroProfile).filter(KeitaroProfile.enabled == True).count()
-                    if keitaro_count > 0:
-                        text += f"\n💚 Keitaro интеграция:\n• Активных профилей: {keitaro_count}\n"
-                    
-                    # Статистика событий Keitaro за последние 7 дней
-                    from database.models import KeitaroEvent
-                    cutoff_date = datetime.utcnow() - timedelta(days=7)
-                    events_count = db_session.query(KeitaroEvent).filter(KeitaroEvent.created_at >= cutoff_date).count()
-                    if events_count > 0:
-                        text += f"• События за 7 дней: {events_count}\n"
-            except Exception:
-                # Если таблиц нет или ошибка - просто пропускаем
-                pass
+            # Статистика по интеграциям
+            if snapshot.keitaro['profiles'] > 0:
+                text += f"\n💚 Keitaro интеграция:\n• Активных профилей: {snapshot.keitaro['profiles']}\n"
+                if snapshot.keitaro['events'] > 0:
+                    text += f"• События за 7 дней: {snapshot.keitaro['events']}\n"
             
             # Подробная статистика по функциям
             text += "\n🔧 Все доступные функции бота:\n"
@@ -283,7 +267,7 @@ _Обновлено: {datetime.now().strftime('%Y-%m-%d %H:%M')}_"""
             text += "• 🚀 Рассылка для админов\n"
             text += "• 🔄 Автоматические очереди обработки\n"
             
-            text += f"\n💡 Обновлено: {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+            text += f"\n💡 Обновлено: {snapshot.updated_at.strftime('%Y-%m-%d %H:%M')}"
             
             keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="admin_menu")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -300,18 +284,15 @@ _Обновлено: {datetime.now().strftime('%Y-%m-%d %H:%M')}_"""
         await query.answer()
         
         try:
-            total_users = await self.analytics.get_total_users()
+            snapshot = await self.dashboard.get()
+            total_users = snapshot.total_users
             
-            # Сегменты пользователей (get_users_for_broadcast не принимает параметров фильтрации)
-            all_users_list = await self.analytics.get_users_for_broadcast()
-            all_users = len(all_users_list)
-            
-            # Подсчитываем активных/неактивных пользователей по дате последней активности
-            from datetime import datetime, timedelta
-            now = datetime.now()
-            active_7d = len([u for u in all_users_list if u['last_seen'] and (now - u['last_seen']).days <= 7])
-            active_30d = len([u for u in all_users_list if u['last_seen'] and (now - u['last_seen']).days <= 30])
-            inactive_7d = len([u for u in all_users_list if u['last_seen'] and (now - u['last_seen']).days > 7])
+            # Размеры сегментов рассылки, без выборки самих пользователей
+            segments = snapshot.segments
+            all_users = segments['all']
+            active_7d = segments['active_7d']
+            active_30d = segments['active_30d']
+            inactive_7d = segments['inactive_7d']
             
             text = f"""👥 **Информация о пользователях**
 
@@ -841,8 +822,7 @@ _Обновлено: {datetime.now().strftime('%Y-%m-%d %H:%M')}_"""
         context.user_data['broadcast_segment'] = segment
 
         # Получаем количество получателей
-        recipients = self.analytics.get_users_for_broadcast(segment)
-        recipient_count = len(recipients)
+        recipient_count = await self.analytics.count_broadcast_recipients(segment)
 
         segment_name = {
             'all': 'Все активные',
@@ -854,7 +834,6 @@ _Обновлено: {datetime.now().strftime('%Y-%m-%d %H:%M')}_"""
 
         # Для тестового сообщения отправляем только админу
         if segment == 'test':
-            recipients = [update.callback_query.from_user.id]
             recipient_count = 1
 
         # Подтверждение
@@ -993,7 +972,7 @@ _Обновлено: {datetime.now().strftime('%Y-%m-%d %H:%M')}_"""
             return "❓ Неизвестный тип контента"
     
     async def send_broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        """Отправка пересланной рассылки"""
+        """Запуск пересланной рассылки фоновым заданием"""
         query = update.callback_query
         await query.answer()
 
@@ -1002,154 +981,56 @@ _Обновлено: {datetime.now().strftime('%Y-%m-%d %H:%M')}_"""
             context.user_data.clear()
             return
 
-        # Начинаем рассылку
-        await query.edit_message_text("📤 Начинаю рассылку...")
-
         broadcast_data = context.user_data.get('broadcast_data')
         if not broadcast_data:
             await query.edit_message_text("❌ Ошибка: данные для рассылки не найдены")
             return
 
         segment = context.user_data.get('broadcast_segment')
-        recipients = self.analytics.get_users_for_broadcast(segment)
-
-        if not recipients:
-            await query.edit_message_text("❌ Получатели не найдены")
-            return
 
         # Для тестового сообщения отправляем только админу
         if segment == 'test':
-            recipients = [query.from_user.id]
-            recipient_count = 1
-        else:
-            recipient_count = len(recipients)
-
-        sent = 0
-        failed = 0
-        blocked = 0
-
-        # Отправляем сообщения
-        for tg_id in recipients:
             try:
-                await self._send_message_to_user(context.bot, tg_id, broadcast_data)
-                sent += 1
+                await send_content(context.bot, query.from_user.id, broadcast_data)
+                await query.edit_message_text("✅ Тестовое сообщение отправлено")
+            except Exception as e:
+                logger.error(f"Failed to send test broadcast: {e}")
+                await query.edit_message_text(f"❌ Ошибка отправки: {e}")
+        else:
+            engine = context.bot_data.get('broadcast_engine')
+            if engine is None:
+                await query.edit_message_text("❌ Рассылки недоступны: база данных не инициализирована")
+                return
 
-                # Пауза каждые 30 сообщений
-                if sent % 30 == 0:
-                    await asyncio.sleep(1)
+            if not await self.analytics.count_broadcast_recipients(segment):
+                await query.edit_message_text("❌ Получатели не найдены")
+                return
 
-            except Exception as e:
-                error_str = str(e).lower()
-                if "blocked" in error_str or "bot was blocked" in error_str:
-                    blocked += 1
-                    # Помечаем пользователя как заблокированного
-                    try:
-                        with self.db.get_session() as db_session:
-                            from database.models import User
-                            user = db_session.query(User).filter_by(tg_id=tg_id).first()
-                            if user:
-                                user.is_blocked = True
-                                db_session.commit()
-                    except:
-                        pass
-                else:
-                    failed += 1
-
-                logger.error(f"Failed to send broadcast to {tg_id}: {e}")
-
-        # Результат
-        total = len(recipients)
-        success_rate = (sent / total * 100) if total > 0 else 0
-
-        text = f"""✅ **Рассылка завершена**
-
-📊 Статистика:
-• Отправлено: {sent}
-• Заблокировано: {blocked}
-• Ошибок: {failed}
-• Всего получателей: {total}
-
-🎯 Успешность: {success_rate:.1f}%"""
-
-        await query.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+            # Это сообщение задание обновляет по ходу рассылки
+            await query.edit_message_text("📤 Начинаю рассылку...")
+            await engine.create_job(
+                segment or 'all',
+                broadcast_data,
+                admin_chat_id=query.message.chat_id,
+                progress_message_id=query.message.message_id
+            )
 
         # Очищаем данные
         context.user_data.pop('broadcast_data', None)
         context.user_data.pop('broadcast_segment', None)
 
-    async def _send_message_to_user(self, bot, user_id: int, broadcast_data: dict):
-        """Отправить сообщение пользователю в том же виде"""
-        content_type = broadcast_data['content_type']
-        text = broadcast_data['text']
-        caption = broadcast_data['caption']
-        file_id = broadcast_data['file_id']
-
-        try:
-            if content_type == 'text':
-                await bot.send_message(
-                    chat_id=user_id,
-                    text=text,
-                    parse_mode=broadcast_data['parse_mode']
-                )
-
-            elif content_type == 'photo':
-                await bot.send_photo(
-                    chat_id=user_id,
-                    photo=file_id,
-                    caption=caption,
-                    parse_mode=ParseMode.MARKDOWN if caption else None
-                )
-
-            elif content_type == 'video':
-                await bot.send_video(
-                    chat_id=user_id,
-                    video=file_id,
-                    caption=caption,
-                    parse_mode=ParseMode.MARKDOWN if caption else None
-                )
-
-            elif content_type == 'document':
-                await bot.send_document(
-                    chat_id=user_id,
-                    document=file_id,
-                    caption=caption,
-                    parse_mode=ParseMode.MARKDOWN if caption else None
-                )
-
-            elif content_type == 'audio':
-                await bot.send_audio(
-                    chat_id=user_id,
-                    audio=file_id,
-                    caption=caption,
-                    parse_mode=ParseMode.MARKDOWN if caption else None
-                )
-
-            elif content_type == 'voice':
-                await bot.send_voice(
-                    chat_id=user_id,
-                    voice=file_id,
-                    caption=caption,
-                    parse_mode=ParseMode.MARKDOWN if caption else None
-                )
-
-            elif content_type == 'sticker':
-                await bot.send_sticker(
-                    chat_id=user_id,
-                    sticker=file_id
-                )
+    async def stop_broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Остановка выполняющейся рассылки"""
+        query = update.callback_query
+        if not self.is_admin(query.from_user.id):
+            await query.answer()
+            return
 
-            elif content_type == 'animation':
-                await bot.send_animation(
-                    chat_id=user_id,
-                    animation=file_id,
-                    caption=caption,
-                    parse_mode=ParseMode.MARKDOWN if caption else None
-                )
+        job_id = int(query.data.rsplit('_', 1)[1])
+        engine = context.bot_data.get('broadcast_engine')
+        stopped = bool(engine) and await engine.cancel(job_id)
+        await query.answer("⛔ Рассылка останавливается" if stopped else "Рассылка уже завершена")
 
-        except Exception as e:
-            # Пробрасываем ошибку для обработки в вызывающем коде
-            raise e
-    
     async def cancel_broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Отмена рассылки"""
         # Очищаем все данные рассылки
@@ -4,7 +4,6 @@
 
 import os
 import logging
-import tempfile
 from pathlib import Path
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
@@ -17,6 +16,9 @@ from utils.compress_utils import (
     is_image_file
 )
 from utils.queue_manager import compression_queue
+from utils.cancellation import job_registry, JobCancelled
+from utils.file_intake import intake_workspace, intake_telegram_file
+from utils.file_delivery import deliver_file
 import config
 
 logger = logging.getLogger(__name__)
@@ -103,6 +105,9 @@ async def wrong_media_handler_compress(update: Update, context: ContextTypes.DEF
     
     temp_document = TempDocument(file_obj, file_name)
     
+    # Токен отмены: задачу можно снять из очереди или прервать кнопкой "Назад"
+    token = job_registry.create(user.id, 'compression')
+    
     # Добавляем задачу в очередь (как в обычном обработчике)
     queue_result = await compression_queue.add_task(
         user_id=user.id,
@@ -110,10 +115,12 @@ async def wrong_media_handler_compress(update: Update, context: ContextTypes.DEF
         message=message,
         document=temp_document,
         file_name=file_name,
-        context=context
+        context=context,
+        cancel_token=token
     )
     
     if not queue_result['success']:
+        job_registry.release(token)
         # Обработка ошибок очереди
         if queue_result['error'] == 'too_many_tasks':
             await message.reply_text(
@@ -148,18 +155,19 @@ async def process_compression_task(
     message,
     document,
     file_name: str,
-    context: ContextTypes.DEFAULT_TYPE
+    context: ContextTypes.DEFAULT_TYPE,
+    cancel_token=None
 ):
     """Функция для обработки сжатия (будет вызываться из очереди)"""
     processing_msg = None
     
     try:
-        # Создаем временную директорию
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Скачиваем файл
+        # Рабочая директория задачи (на томе Bot API, если он смонтирован)
+        with intake_workspace(prefix='compress_') as temp_dir:
+            # Получаем файл: с локальным Bot API - без скачивания по HTTP
             input_path = os.path.join(temp_dir, file_name)
             file = await document.get_file()
-            await file.download_to_drive(input_path)
+            await intake_telegram_file(context.bot, document.file_id, Path(input_path), file=file)
             
             logger.info(f"Processing compression: {file_name}")
             
@@ -184,28 +192,29 @@ async def process_compression_task(
                 # Сжимаем видео
                 output_path, stats = await compress_video_for_facebook(
                     input_path,
-                    output_dir
+                    output_dir,
+                    cancel_token=cancel_token
                 )
             
             # Удаляем сообщение о процессе
             if processing_msg:
                 await processing_msg.delete()
             
-            # Отправляем сжатый файл
-            with open(output_path, 'rb') as compressed_file:
-                await message.reply_document(
-                    document=compressed_file,
-                    filename=os.path.basename(output_path),
-                    caption=get_text(
-                        context,
-                        'compression_report',
-                        original_size=stats['original_size'],
-                        new_size=stats['new_size'],
-                        percent=stats['percent'],
-                        saved=stats['saved']
-                    ),
-                    parse_mode=ParseMode.MARKDOWN
-                )
+            # Отправляем сжатый файл (документом, чтобы Telegram не пережимал)
+            await deliver_file(
+                message,
+                output_path,
+                kind='document',
+                caption=get_text(
+                    context,
+                    'compression_report',
+                    original_size=stats['original_size'],
+                    new_size=stats['new_size'],
+                    percent=stats['percent'],
+                    saved=stats['saved']
+                ),
+                parse_mode=ParseMode.MARKDOWN
+            )
             
             logger.info(f"Successfully compressed {file_name}: "
                        f"{stats['original_size']}MB -> {stats['new_size']}MB ({stats['percent']}%)")
@@ -222,6 +231,10 @@ async def process_compression_task(
                 reply_markup=reply_markup
             )
             
+    except JobCancelled:
+        logger.info(f"Compression of {file_name} cancelled")
+        if processing_msg:
+            await processing_msg.delete()
     except Exception as e:
         logger.error(f"Error in compression task: {e}")
         if processing_msg:
@@ -253,6 +266,9 @@ async def compress_file_handler(update: Update, context: ContextTypes.DEFAULT_TY
         )
         return WAITING_FOR_COMPRESS_FILE
     
+    # Токен отмены: задачу можно снять из очереди или прервать кнопкой "Назад"
+    token = job_registry.create(user.id, 'compression')
+    
     # Добавляем задачу в очередь
     queue_result = await compression_queue.add_task(
         user_id=user.id,
@@ -260,10 +276,12 @@ async def compress_file_handler(update: Update, context: ContextTypes.DEFAULT_TY
         message=message,
         document=document,
         file_name=file_name,
-        context=context
+        context=context,
+        cancel_token=token
     )
     
     if not queue_result['success']:
+        job_registry.release(token)
         # Обработка ошибок очереди
         if queue_result['error'] == 'too_many_tasks':
             await message.reply_text(
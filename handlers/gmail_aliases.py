@@ -8,6 +8,7 @@ from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
 from utils.localization import get_text
 from services.gmail_aliases import generate_gmail_aliases, validate_gmail_input
+from database.quotas import GMAIL, quotas
 
 logger = logging.getLogger(__name__)
 
@@ -15,8 +16,6 @@ logger = logging.getLogger(__name__)
 class GmailAliasHandler:
     """Обработчик Gmail-алиасов"""
     
-    MAX_DAILY_QUOTA = 10
-    
     async def show_main_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Показать главное меню Gmail-алиасов"""
         try:
@@ -35,15 +34,12 @@ class GmailAliasHandler:
             user_id = update.effective_user.id
             
             # Получаем оставшуюся квоту
-            remaining_quota = 0
-            if 'database' in context.bot_data:
-                db = context.bot_data['database']
-                remaining_quota = await db.get_gmail_remaining_quota(user_id, self.MAX_DAILY_QUOTA)
+            remaining_quota = await quotas.remaining(GMAIL, user_id)
             
             # Создаем текст сообщения
             text = get_text(context, 'gmail_aliases_menu').format(
                 remaining_quota=remaining_quota,
-                max_quota=self.MAX_DAILY_QUOTA
+                max_quota=quotas.limit(GMAIL)
             )
             
             # Создаем клавиатуру
@@ -95,10 +91,7 @@ class GmailAliasHandler:
             user_id = update.effective_user.id
             
             # Проверяем квоту
-            remaining_quota = 0
-            if 'database' in context.bot_data:
-                db = context.bot_data['database']
-                remaining_quota = await db.get_gmail_remaining_quota(user_id, self.MAX_DAILY_QUOTA)
+            remaining_quota = await quotas.remaining(GMAIL, user_id)
             
             if remaining_quota <= 0:
                 text = get_text(context, 'gmail_quota_exceeded')
@@ -228,10 +221,7 @@ class GmailAliasHandler:
             except ValueError:
                 # Получаем оставшуюся квоту для отображения в ошибке
                 user_id = update.effective_user.id
-                remaining_quota = self.MAX_DAILY_QUOTA
-                if 'database' in context.bot_data:
-                    db = context.bot_data['database']
-                    remaining_quota = await db.get_gmail_remaining_quota(user_id, self.MAX_DAILY_QUOTA)
+                remaining_quota = await quotas.remaining(GMAIL, user_id)
                 
                 await update.message.reply_text(
                     get_text(context, 'gmail_invalid_count').format(max_count=remaining_quota),
@@ -243,14 +233,11 @@ class GmailAliasHandler:
             
             user_id = update.effective_user.id
             
-            # Получаем оставшуюся квоту
-            remaining_quota = self.MAX_DAILY_QUOTA
-            if 'database' in context.bot_data:
-                db = context.bot_data['database']
-                remaining_quota = await db.get_gmail_remaining_quota(user_id, self.MAX_DAILY_QUOTA)
+            # Проверяем диапазон и сразу списываем квоту (атомарно)
+            quota = await quotas.consume(GMAIL, user_id, count) if count >= 1 else None
             
-            # Проверяем диапазон
-            if count < 1 or count > remaining_quota:
+            if quota is None or not quota.allowed:
+                remaining_quota = quota.remaining if quota else await quotas.remaining(GMAIL, user_id)
                 await update.message.reply_text(
                     get_text(context, 'gmail_invalid_count').format(max_count=remaining_quota),
                     parse_mode=ParseMode.MARKDOWN
@@ -263,18 +250,15 @@ class GmailAliasHandler:
             try:
                 aliases = generate_gmail_aliases(email, count)
             except ValueError as e:
+                # Алиасы не выданы - возвращаем списанное
+                await quotas.refund(GMAIL, user_id, count)
                 await update.message.reply_text(
                     get_text(context, 'gmail_generation_error').format(error=str(e)),
                     parse_mode=ParseMode.MARKDOWN
                 )
                 return
             
-            # Обновляем квоту в БД
-            if 'database' in context.bot_data:
-                db = context.bot_data['database']
-                await db.increment_gmail_usage(user_id, count)
-                # Получаем обновленную квоту
-                remaining_quota = await db.get_gmail_remaining_quota(user_id, self.MAX_DAILY_QUOTA)
+            remaining_quota = quota.remaining
             
             # Форматируем алиасы в моноширинный блок
             aliases_text = '\n'.join(aliases)
@@ -342,10 +326,7 @@ class GmailAliasHandler:
             user_id = update.effective_user.id
             
             # Получаем оставшуюся квоту
-            remaining_quota = self.MAX_DAILY_QUOTA
-            if 'database' in context.bot_data:
-                db = context.bot_data['database']
-                remaining_quota = await db.get_gmail_remaining_quota(user_id, self.MAX_DAILY_QUOTA)
+            remaining_quota = await quotas.remaining(GMAIL, user_id)
             
             if remaining_quota <= 0:
                 text = get_text(context, 'gmail_quota_exceeded')
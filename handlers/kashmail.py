@@ -10,6 +10,7 @@ from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
 from services.kashmail_api import MailTmApi
 from repos.kashmail_sessions import KashmailRepository
+from database.quotas import KASHMAIL, quotas
 from utils.otp_extract import extract_codes, extract_links
 from utils.localization import get_text
 from database.models import Database
@@ -64,8 +65,8 @@ async def kashmail_menu_callback(update: Update, context: ContextTypes.DEFAULT_T
         session = await repo.sessions.get_session(user_id)
         
         # Получаем дневной лимит из конфига
-        daily_limit = getattr(config, 'KASHMAIL_DAILY_LIMIT', 10)
-        remaining_quota = await repo.counters.get_remaining_quota(user_id, daily_limit)
+        daily_limit = quotas.limit(KASHMAIL)
+        remaining_quota = await repo.counters.get_remaining_quota(user_id)
         
         # Формируем текст меню
         menu_text = get_text(context, 'kashmail_menu_title')
@@ -125,31 +126,36 @@ async def kashmail_generate_callback(update: Update, context: ContextTypes.DEFAU
         db = context.bot_data['database']
         repo = KashmailRepository(db)
         
-        # Проверяем, может ли пользователь создать email
-        daily_limit = getattr(config, 'KASHMAIL_DAILY_LIMIT', 10)
-        can_create, reason = await repo.can_user_create_email(user_id, daily_limit)
+        # Проверяем, может ли пользователь создать email, и сразу списываем квоту
+        can_create, reason = await repo.reserve_email(user_id)
         
         if not can_create:
             await query.edit_message_text(f"❌ {reason}")
             return
         
-        # Показываем сообщение о создании
-        loading_text = get_text(context, 'kashmail_generating')
-        await query.edit_message_text(loading_text)
-        
-        # Создаем временный email
-        result = await kashmail_handler.api.create_temporary_email()
-        
-        if not result:
-            await query.edit_message_text(f"❌ {get_text(context, 'kashmail_generation_failed')}")
-            return
-        
-        email, jwt_token, expires_at = result
-        
-        # Сохраняем сессию в БД
-        success = await repo.create_new_email_session(user_id, email, jwt_token, expires_at)
+        try:
+            # Показываем сообщение о создании
+            loading_text = get_text(context, 'kashmail_generating')
+            await query.edit_message_text(loading_text)
+            
+            # Создаем временный email
+            result = await kashmail_handler.api.create_temporary_email()
+            
+            if not result:
+                await repo.release_email(user_id)
+                await query.edit_message_text(f"❌ {get_text(context, 'kashmail_generation_failed')}")
+                return
+            
+            email, jwt_token, expires_at = result
+            
+            # Сохраняем сессию в БД
+            success = await repo.create_new_email_session(user_id, email, jwt_token, expires_at)
+        except Exception:
+            await repo.release_email(user_id)
+            raise
         
         if not success:
+            await repo.release_email(user_id)
             await query.edit_message_text(f"❌ {get_text(context, 'kashmail_save_failed')}")
             return
         
@@ -182,8 +188,8 @@ async def _show_kashmail_status_panel(query, context):
             return
         
         # Получаем дневной лимит из конфига
-        daily_limit = getattr(config, 'KASHMAIL_DAILY_LIMIT', 10)
-        remaining_quota = await repo.counters.get_remaining_quota(user_id, daily_limit)
+        daily_limit = quotas.limit(KASHMAIL)
+        remaining_quota = await repo.counters.get_remaining_quota(user_id)
         
         # Формируем текст меню
         menu_text = get_text(context, 'kashmail_menu_title')
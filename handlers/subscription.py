@@ -63,11 +63,12 @@ async def check_subscription_callback(update: Update, context: ContextTypes.DEFA
     
     user = query.from_user
     
-    # Проверяем подписку
+    # Проверяем подписку (пользователь мог только что подписаться - "не подписан" из кэша перепроверяем)
     is_subscribed = await check_subscription(
         context.bot,
         user.id,
-        config.CHANNEL_USERNAME
+        config.CHANNEL_USERNAME,
+        recheck_negative=True
     )
     
     if is_subscribed:
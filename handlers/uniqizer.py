@@ -6,13 +6,15 @@ import os
 import logging
 import asyncio
 import zipfile
-import tempfile
 from pathlib import Path
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
 from telegram.constants import ParseMode
 from utils import create_multiple_unique_images, create_multiple_unique_videos
 from utils.localization import get_text
+from utils.cancellation import job_registry, cancel_user_jobs, JobCancelled
+from utils.file_intake import intake_workspace
+from utils.file_delivery import deliver_file
 import config
 
 logger = logging.getLogger(__name__)
@@ -77,8 +79,13 @@ async def copies_input_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             text=f"🔄 Создаем {copies} уникальных копий..."
         )
         
-        # Начинаем обработку файла
-        return await process_media_file(update, context, file_obj, file_name, processing_msg, is_compressed)
+        # Обработка идет фоновой задачей, чтобы кнопка "Назад" могла ее отменить
+        token = job_registry.create(update.effective_user.id, 'uniqizer')
+        task = context.application.create_task(
+            _run_uniqizer_job(update, context, file_obj, file_name, processing_msg, is_compressed, token)
+        )
+        token.attach_task(task)
+        return ConversationHandler.END
         
     except ValueError:
         # Если не число
@@ -92,6 +99,34 @@ async def copies_input_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         return WAITING_FOR_COPIES
 
 
+async def _run_uniqizer_job(update: Update, context: ContextTypes.DEFAULT_TYPE, file_obj, file_name: str,
+                            processing_msg, is_compressed: bool, token) -> None:
+    """Фоновая задача уникализации с поддержкой отмены"""
+    try:
+        state = await process_media_file(update, context, file_obj, file_name, processing_msg,
+                                         is_compressed, cancel_token=token)
+    except (JobCancelled, asyncio.CancelledError):
+        logger.info(f"Uniqizer job cancelled by user {token.user_id}")
+        try:
+            await processing_msg.delete()
+        except Exception:
+            pass
+        return
+    finally:
+        job_registry.release(token)
+    
+    if state != ConversationHandler.END:
+        # Диалог уже завершен - предлагаем начать заново
+        keyboard = [[
+            InlineKeyboardButton(get_text(context, 'uniqueness_tool'), callback_data='uniqueness_tool'),
+            InlineKeyboardButton(get_text(context, 'main_menu'), callback_data='main_menu')
+        ]]
+        await update.message.reply_text(
+            text=get_text(context, 'uniqueness_more_or_menu'),
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+
 async def wrong_media_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработчик сжатого медиа (видео/фото не как файл)"""
     message = update.message
@@ -133,7 +168,8 @@ async def wrong_media_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     return WAITING_FOR_COPIES
 
 
-async def process_media_file(update: Update, context: ContextTypes.DEFAULT_TYPE, file_obj, file_name: str, processing_msg=None, is_compressed: bool = False) -> int:
+async def process_media_file(update: Update, context: ContextTypes.DEFAULT_TYPE, file_obj, file_name: str, processing_msg=None, is_compressed: bool = False,
+                             cancel_token=None) -> int:
     """Универсальная функция обработки медиафайлов"""
     message = update.message
     user = update.effective_user
@@ -146,8 +182,8 @@ async def process_media_file(update: Update, context: ContextTypes.DEFAULT_TYPE,
         processing_msg = await message.reply_text(text=get_text(context, 'processing', count=copies_count))
     
     try:
-        # Создаем временную директорию для работы
-        with tempfile.TemporaryDirectory() as temp_dir:
+        # Рабочая директория задачи (на томе Bot API, если он смонтирован)
+        with intake_workspace(prefix=f"unique_{user.id}_") as temp_dir:
             temp_path = Path(temp_dir)
             
             # Автоматически обрабатываем файлы любого размера
@@ -166,7 +202,8 @@ async def process_media_file(update: Update, context: ContextTypes.DEFAULT_TYPE,
                 bot=context.bot,
                 file_id=file_obj.file_id,
                 original_filename=file_name,
-                progress_callback=progress_callback
+                progress_callback=progress_callback,
+                workspace=temp_path
             )
             
             # Если не удалось скачать - ошибка
@@ -204,7 +241,8 @@ async def process_media_file(update: Update, context: ContextTypes.DEFAULT_TYPE,
                     str(output_dir),
                     copies_count,
                     config.VIDEO_UNIQUENESS_PARAMS,
-                    progress_callback
+                    progress_callback,
+                    cancel_token=cancel_token
                 )
             else:
                 # Обновляем сообщение для изображений
@@ -234,15 +272,18 @@ async def process_media_file(update: Update, context: ContextTypes.DEFAULT_TYPE,
             # Простое сообщение об успехе без лишних деталей
             caption_text = get_text(context, 'success', count=len(results))
             
-            with open(zip_path, 'rb') as zip_file:
-                await message.reply_document(
-                    document=zip_file,
-                    filename=f"unique_files_{copies_count}.zip",
-                    caption=caption_text
-                )
+            await deliver_file(
+                message,
+                str(zip_path),
+                kind='document',
+                filename=f"unique_files_{copies_count}.zip",
+                caption=caption_text
+            )
             
             logger.info(f"Successfully processed {file_name} for user {user.id}, created {len(results)} copies")
             
+    except (JobCancelled, asyncio.CancelledError):
+        raise
     except Exception as e:
         logger.error(f"Error processing media file: {e}")
         
@@ -318,6 +359,9 @@ async def file_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
 async def cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработчик отмены операции"""
+    # Останавливаем задачи пользователя
+    cancel_user_jobs(update.effective_user.id)
+    
     # Очищаем user_data
     context.user_data.clear()
     
@@ -333,6 +377,9 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
     
+    # Останавливаем задачи пользователя, которые еще идут
+    cancel_user_jobs(update.effective_user.id)
+    
     # Очищаем user_data кроме языка
     lang = context.user_data.get('language')
     context.user_data.clear()
@@ -3,6 +3,7 @@
 """
 
 import os
+import shutil
 import logging
 import tempfile
 from pathlib import Path
@@ -15,6 +16,9 @@ from tasks.video_tasks import process_video_uniqueness_task
 from tasks.image_tasks import process_image_uniqueness_task
 from utils.localization import get_text
 from utils import is_video_file, is_image_file
+from utils.cancellation import job_registry
+from utils.file_intake import intake_telegram_file
+from utils.file_delivery import deliver_file
 import config
 
 logger = logging.getLogger(__name__)
@@ -86,7 +90,7 @@ async def process_media_file_async(
         input_path = Path(temp_dir) / file_name
         
         file_download = await file_to_process.get_file()
-        await file_download.download_to_drive(str(input_path))
+        await intake_telegram_file(context.bot, file_to_process.file_id, input_path, file=file_download)
         
         # Запускаем задачу в Celery
         if is_video:
@@ -134,22 +138,28 @@ async def process_media_file_async(
             parse_mode=ParseMode.MARKDOWN
         )
         
+        # Токен отмены: отзывает Celery-задачу и удаляет входной файл
+        token = job_registry.create(user.id, 'uniqueness_celery')
+        token.register_celery_task(task.id)
+        token.add_callback(lambda: shutil.rmtree(temp_dir, ignore_errors=True))
+        
         # Запускаем асинхронный мониторинг задачи
-        context.application.create_task(
+        monitor = context.application.create_task(
             monitor_task_progress(
                 task_id=task.id,
                 message=message,
                 processing_msg=processing_msg,
-                context=context
+                context=context,
+                cancel_token=token
             )
         )
+        token.attach_task(monitor)
         
     except Exception as e:
         logger.error(f"Error processing file for user {user.id}: {e}")
         
         # Очистка при ошибке
         if temp_dir and os.path.exists(temp_dir):
-            import shutil
             shutil.rmtree(temp_dir, ignore_errors=True)
         
         await processing_msg.edit_text(
@@ -175,7 +185,8 @@ async def monitor_task_progress(
     task_id: str,
     message,
     processing_msg,
-    context: ContextTypes.DEFAULT_TYPE
+    context: ContextTypes.DEFAULT_TYPE,
+    cancel_token=None
 ):
     """Мониторинг прогресса Celery задачи"""
     import asyncio
@@ -218,17 +229,17 @@ async def monitor_task_progress(
             if zip_path and os.path.exists(zip_path):
                 await processing_msg.delete()
                 
-                with open(zip_path, 'rb') as zip_file:
-                    await message.reply_document(
-                        document=zip_file,
-                        filename=f"unique_files_{count}.zip",
-                        caption=get_text(context, 'success', count=count)
-                    )
+                await deliver_file(
+                    message,
+                    zip_path,
+                    kind='document',
+                    filename=f"unique_files_{count}.zip",
+                    caption=get_text(context, 'success', count=count)
+                )
                 
                 # Очищаем временные файлы
                 temp_dir = result.get('temp_dir')
                 if temp_dir and os.path.exists(temp_dir):
-                    import shutil
                     shutil.rmtree(temp_dir, ignore_errors=True)
         else:
             # Ошибка
@@ -241,11 +252,21 @@ async def monitor_task_progress(
         # Удаляем информацию о задаче
         context.user_data.pop(f'task_{task_id}', None)
         
+    except asyncio.CancelledError:
+        logger.info(f"Task {task_id} cancelled by user")
+        context.user_data.pop(f'task_{task_id}', None)
+        try:
+            await processing_msg.delete()
+        except Exception:
+            pass
     except Exception as e:
         logger.error(f"Error monitoring task {task_id}: {e}")
         await processing_msg.edit_text(
             text="❌ Ошибка отслеживания задачи. Проверьте результат позже."
         )
+    finally:
+        if cancel_token:
+            job_registry.release(cancel_token)
 
 
 def create_progress_bar(current: int, total: int, length: int = 10) -> str:
@@ -4,7 +4,6 @@
 
 import os
 import logging
-import tempfile
 import asyncio
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
@@ -13,6 +12,9 @@ from utils.localization import get_text
 from utils.video_downloader_v2 import EnhancedVideoDownloader
 from utils.cookies_manager import CookiesManager
 from utils.queue_manager import compression_queue
+from utils.cancellation import job_registry, cancel_user_jobs, JobCancelled
+from utils.file_delivery import deliver_file, choose_kind
+from utils.file_intake import make_workspace
 from database import Database
 import config
 
@@ -142,30 +144,49 @@ async def action_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return ConversationHandler.END
     
+    if action == "main_menu":
+        from .subscription import show_main_menu
+        await show_main_menu(update, context)
+        return ConversationHandler.END
+    
     # Показываем сообщение о начале обработки
     processing_msg = await query.message.reply_text(
         text=get_text(context, 'downloading_video', platform=platform)
     )
     
+    # Скачивание идет фоновой задачей: иначе апдейты пользователя (кнопка
+    # "Назад", /cancel) не обрабатываются до ее завершения
+    token = job_registry.create(update.effective_user.id, action)
+    task = context.application.create_task(
+        _run_download_job(action, query.message, url, platform, context, processing_msg, token)
+    )
+    token.attach_task(task)
+    
+    return ConversationHandler.END
+
+
+async def _run_download_job(action: str, message, url: str, platform: str,
+                            context: ContextTypes.DEFAULT_TYPE, processing_msg, token) -> None:
+    """Фоновая задача скачивания с поддержкой отмены"""
     try:
         if action == "download_video":
-            await download_video_task(query.message, url, platform, context, processing_msg)
-            
+            await download_video_task(message, url, platform, context, processing_msg, token)
         elif action == "download_audio":
-            await download_audio_task(query.message, url, platform, context, processing_msg)
-            
-            
-        elif action == "main_menu":
+            await download_audio_task(message, url, platform, context, processing_msg, token)
+    except (JobCancelled, asyncio.CancelledError):
+        logger.info(f"{action} cancelled by user {token.user_id}")
+        try:
             await processing_msg.delete()
-            from .subscription import show_main_menu
-            await show_main_menu(update, context)
-            return ConversationHandler.END
-            
+        except Exception:
+            pass
+        return
     except Exception as e:
-        logger.error(f"Error in action_handler: {e}")
+        logger.error(f"Error in download job: {e}")
         await processing_msg.edit_text(
             text=get_text(context, 'error_downloading')
         )
+    finally:
+        job_registry.release(token)
     
     # Показываем главное меню
     keyboard = [[
@@ -174,22 +195,20 @@ async def action_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     ]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.message.reply_text(
+    await message.reply_text(
         text=get_text(context, 'download_more_or_menu'),
         reply_markup=reply_markup
     )
-    
-    return ConversationHandler.END
 
 
 async def download_video_task(message, url: str, platform: str, context: ContextTypes.DEFAULT_TYPE, 
-                              processing_msg):
+                              processing_msg, cancel_token=None):
     """Задача для скачивания видео с автоматической ротацией cookies"""
     temp_dir = None
     
     try:
-        # Создаем временную директорию
-        temp_dir = tempfile.mkdtemp()
+        # Создаем рабочую директорию (на томе Bot API - результат отправится по локальному пути)
+        temp_dir = make_workspace(prefix='download_')
         
         # Скачиваем видео
         await processing_msg.edit_text(
@@ -206,14 +225,16 @@ async def download_video_task(message, url: str, platform: str, context: Context
                 url=url,
                 message=processing_msg,
                 output_dir=temp_dir,
-                user_id=user_id
+                user_id=user_id,
+                cancel_token=cancel_token
             )
         elif hasattr(video_downloader, 'download_video_with_retry'):
             # Используем улучшенный загрузчик с ротацией
             video_path, error = await video_downloader.download_video_with_retry(
                 url=url,
                 user_id=user_id,
-                output_dir=temp_dir
+                output_dir=temp_dir,
+                cancel_token=cancel_token
             )
         else:
             # Fallback на старый метод
@@ -247,24 +268,15 @@ async def download_video_task(message, url: str, platform: str, context: Context
                 text=get_text(context, 'uploading_video')
             )
             
-            # Отправляем видео
-            with open(video_path, 'rb') as video_file:
-                # Если файл больше 50MB, отправляем как документ
-                LARGE_FILE_LIMIT = 50 * 1024 * 1024  # 50MB для отправки как документ
-                if file_size > LARGE_FILE_LIMIT:
-                    await message.reply_document(
-                        document=video_file,
-                        filename=os.path.basename(video_path),
-                        caption=get_text(context, 'video_downloaded_large', 
-                                       platform=platform, 
-                                       size_mb=file_size // 1024 // 1024)
-                    )
-                else:
-                    await message.reply_video(
-                        video=video_file,
-                        caption=get_text(context, 'video_downloaded', 
-                                       platform=platform)
-                    )
+            # Отправляем видео: большие файлы - документом
+            kind = choose_kind(video_path, 'video')
+            if kind == 'document':
+                caption = get_text(context, 'video_downloaded_large', 
+                                   platform=platform, 
+                                   size_mb=file_size // 1024 // 1024)
+            else:
+                caption = get_text(context, 'video_downloaded', platform=platform)
+            await deliver_file(message, video_path, kind=kind, caption=caption)
             
             # Удаляем сообщение о процессе только если не используется новый метод
             if not hasattr(video_downloader, 'download_video_async'):
@@ -279,6 +291,8 @@ async def download_video_task(message, url: str, platform: str, context: Context
                     text=get_text(context, 'error_downloading')
                 )
             
+    except (JobCancelled, asyncio.CancelledError):
+        raise
     except Exception as e:
         logger.error(f"Error downloading video: {e}")
         await processing_msg.edit_text(
@@ -294,13 +308,14 @@ async def download_video_task(message, url: str, platform: str, context: Context
                 pass
 
 
-async def download_audio_task(message, url: str, platform: str, context: ContextTypes.DEFAULT_TYPE, processing_msg):
+async def download_audio_task(message, url: str, platform: str, context: ContextTypes.DEFAULT_TYPE, processing_msg,
+                              cancel_token=None):
     """Задача для скачивания аудио"""
     temp_dir = None
     
     try:
-        # Создаем временную директорию
-        temp_dir = tempfile.mkdtemp()
+        # Создаем рабочую директорию (на томе Bot API - результат отправится по локальному пути)
+        temp_dir = make_workspace(prefix='download_')
         
         # Скачиваем аудио
         await processing_msg.edit_text(
@@ -316,7 +331,8 @@ async def download_audio_task(message, url: str, platform: str, context: Context
             audio_path, error = await video_downloader.download_audio(
                 url=url,
                 user_id=user_id,
-                output_dir=temp_dir
+                output_dir=temp_dir,
+                cancel_token=cancel_token
             )
         else:
             # Используем синхронный метод в отдельном потоке
@@ -325,7 +341,8 @@ async def download_audio_task(message, url: str, platform: str, context: Context
                 None,
                 video_downloader.download_audio,
                 url,
-                temp_dir
+                temp_dir,
+                cancel_token
             )
         
         if error:
@@ -339,13 +356,13 @@ async def download_audio_task(message, url: str, platform: str, context: Context
                 text=get_text(context, 'uploading_audio')
             )
             
-            # Отправляем аудио
-            with open(audio_path, 'rb') as audio_file:
-                await message.reply_audio(
-                    audio=audio_file,
-                    caption=get_text(context, 'audio_extracted', platform=platform),
-                    title=os.path.basename(audio_path).replace('.mp3', '')
-                )
+            # Отправляем аудио: m4a/mp3 - в плеер, ogg (Opus/Vorbis) - файлом
+            title, ext = os.path.splitext(os.path.basename(audio_path))
+            caption = get_text(context, 'audio_extracted', platform=platform)
+            if choose_kind(audio_path) == 'audio':
+                await deliver_file(message, audio_path, kind='audio', caption=caption, title=title)
+            else:
+                await deliver_file(message, audio_path, kind='document', caption=caption)
             
             # Удаляем сообщение о процессе
             await processing_msg.delete()
@@ -356,6 +373,8 @@ async def download_audio_task(message, url: str, platform: str, context: Context
                 text=get_text(context, 'error_extracting_audio')
             )
             
+    except (JobCancelled, asyncio.CancelledError):
+        raise
     except Exception as e:
         logger.error(f"Error extracting audio: {e}")
         await processing_msg.edit_text(
@@ -373,6 +392,9 @@ async def download_audio_task(message, url: str, platform: str, context: Context
 
 async def cancel_video_download(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Отмена скачивания видео"""
+    # Останавливаем активные скачивания пользователя
+    cancel_user_jobs(update.effective_user.id)
+    
     # Очищаем user_data
     context.user_data.pop('video_url', None)
     context.user_data.pop('video_platform', None)
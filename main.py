@@ -15,6 +15,7 @@ from telegram.ext import (
     CallbackQueryHandler,
     MessageHandler,
     ConversationHandler,
+    ChatMemberHandler,
     filters,
     ContextTypes
 )
@@ -23,7 +24,7 @@ from telegram.ext import (
 sys.path.insert(0, str(Path(__file__).parent))
 
 import config
-from utils import check_ffmpeg_installed, ensure_bot_can_check_subscription
+from utils import check_ffmpeg_installed, ensure_bot_can_check_subscription, subscription_cache
 from database import Database, EventTracker
 from handlers import (
     start_command,
@@ -113,11 +114,54 @@ async def post_init(application: Application) -> None:
         logger.warning(f"Subscription check warning: {error_msg}")
         logger.warning("Bot will work but subscription check will always pass!")
     
+    subscription_cache.configure(
+        positive_ttl=config.SUBSCRIPTION_CACHE_TTL,
+        negative_ttl=config.SUBSCRIPTION_NEGATIVE_TTL,
+        warmup_rate=config.SUBSCRIPTION_WARMUP_RATE,
+        warmup_days=config.SUBSCRIPTION_WARMUP_DAYS,
+        warmup_limit=config.SUBSCRIPTION_WARMUP_LIMIT
+    )
+    
+    # Дневные лимиты квот (счетчики в Redis, копия в БД - если она есть)
+    from database.quotas import quotas
+    from services.gmail_aliases import GmailAliasGenerator
+    quotas.configure(
+        gmail=GmailAliasGenerator.MAX_DAILY_QUOTA,
+        kashmail=config.KASHMAIL_DAILY_LIMIT,
+        random_face=config.FACE_QUOTA_PER_DAY
+    )
+    
     # Инициализируем базу данных и трекер
     if hasattr(config, 'DATABASE_URL') and config.DATABASE_URL:
         try:
-            database = Database(config.DATABASE_URL)
-            event_tracker = EventTracker(database)
+            database = Database(
+                config.DATABASE_URL,
+                pool_max_size=config.DB_POOL_MAX_SIZE,
+                statement_cache_size=config.DB_STATEMENT_CACHE_SIZE
+            )
+            
+            from database.query_metrics import query_metrics
+            query_metrics.configure(
+                slow_threshold=config.DB_SLOW_QUERY_MS / 1000,
+                explain_sample_rate=config.DB_EXPLAIN_SAMPLE_RATE,
+                explain_cooldown=config.DB_EXPLAIN_COOLDOWN
+            )
+            
+            from database.user_cache import user_cache
+            user_cache.configure(
+                max_size=config.USER_CACHE_SIZE,
+                last_seen_interval=config.LAST_SEEN_WRITE_INTERVAL
+            )
+            
+            event_tracker = EventTracker(
+                database,
+                buffer_size=config.EVENT_BUFFER_SIZE,
+                batch_size=config.EVENT_FLUSH_BATCH,
+                flush_interval=config.EVENT_FLUSH_INTERVAL,
+                session_collect_interval=config.SESSION_COLLECT_INTERVAL
+            )
+            # Запускает и сборщик сессий: при старте он закрывает сессии, оставшиеся открытыми в БД
+            event_tracker.start()
             
             # Сохраняем в bot_data для доступа из обработчиков
             application.bot_data['database'] = database
@@ -125,8 +169,46 @@ async def post_init(application: Application) -> None:
             
             logger.info("Database and event tracker initialized successfully")
             
-            # Закрываем старые сессии
-            event_tracker.close_old_sessions()
+            # Списания квот дописываются в дневные таблицы в фоне
+            quotas.configure(database)
+            quotas.start(config.QUOTA_FLUSH_INTERVAL)
+            
+            # Пул прокси: загрузка из БД, периодические пробы и сохранение оценок
+            from utils.proxy_pool import proxy_pool
+            proxy_pool.start_probing(config.PROXY_PROBE_INTERVAL, db=database)
+            
+            # Партиции events: заранее на будущие месяцы, удаление старше срока хранения
+            from database.partitions import EventPartitionManager
+            partition_manager = EventPartitionManager(
+                database,
+                months_ahead=config.EVENT_PARTITIONS_AHEAD,
+                retention_months=config.EVENT_RETENTION_MONTHS
+            )
+            partition_manager.start()
+            application.bot_data['partition_manager'] = partition_manager
+            
+            # Агрегаты для админ-панели (дописываются по отметкам)
+            from database.rollups import RollupManager
+            rollup_manager = RollupManager(database, batch_size=config.ROLLUP_BATCH_SIZE)
+            rollup_manager.start(config.ROLLUP_INTERVAL, reconcile_interval=config.ROLLUP_RECONCILE_INTERVAL)
+            application.bot_data['rollup_manager'] = rollup_manager
+            
+            # Рассылки: фоновые задания, прерванные перезапуском или брошенные упавшей репликой, продолжаются
+            from services.broadcast import BroadcastEngine
+            broadcast_engine = BroadcastEngine(
+                database,
+                application.bot,
+                rate=config.BROADCAST_RATE,
+                concurrency=config.BROADCAST_CONCURRENCY,
+                page_size=config.BROADCAST_PAGE_SIZE,
+                lease_ttl=config.BROADCAST_LEASE_TTL
+            )
+            broadcast_engine.start()
+            application.bot_data['broadcast_engine'] = broadcast_engine
+            
+            dashboard = application.bot_data.get('dashboard')
+            if dashboard:
+                dashboard.start(config.DASHBOARD_REFRESH_INTERVAL)
             
         except Exception as e:
             logger.error(f"Failed to initialize database: {e}")
@@ -145,16 +227,80 @@ async def post_init(application: Application) -> None:
             logger.error(f"Failed to initialize Random Face: {e}")
             logger.warning("Random Face will not be available")
     
+    # Счетчики DAU/WAU/MAU: дозаполняем из БД дни, которых нет в Redis
+    if 'database' in application.bot_data:
+        from database.active_users import active_users
+        
+        async def backfill_active_users():
+            try:
+                await active_users.backfill(application.bot_data['database'])
+            except Exception as e:
+                logger.error(f"Active user HLL backfill failed: {e}")
+        
+        application.create_task(backfill_active_users())
+        
+        # Кэш подписок: статусы недавно активных пользователей запрашиваются заранее
+        subscription_cache.start(
+            application.bot_data['database'], bot, config.CHANNEL_USERNAME,
+            interval=config.SUBSCRIPTION_WARMUP_INTERVAL
+        )
+    
     # Запускаем веб-сервер Keitaro если есть
     if 'keitaro_server' in application.bot_data:
         try:
             await application.bot_data['keitaro_server'].start()
             logger.info("Keitaro webhook server started")
+            if 'keitaro_pull' in application.bot_data:
+                application.bot_data['keitaro_pull'].start()
         except Exception as e:
             logger.error(f"Failed to start Keitaro server: {e}")
             logger.warning("Keitaro webhooks will not be available")
 
 
+async def post_shutdown(application: Application) -> None:
+    """Остановка фоновых задач до закрытия event loop"""
+    event_tracker = application.bot_data.get('event_tracker')
+    if event_tracker:
+        # Дописываем накопленные события и завершенные сессии в БД
+        await event_tracker.stop()
+    
+    partition_manager = application.bot_data.get('partition_manager')
+    if partition_manager:
+        await partition_manager.stop()
+    
+    rollup_manager = application.bot_data.get('rollup_manager')
+    if rollup_manager:
+        await rollup_manager.stop()
+    
+    dashboard = application.bot_data.get('dashboard')
+    if dashboard:
+        await dashboard.stop()
+    
+    keitaro_pull = application.bot_data.get('keitaro_pull')
+    if keitaro_pull:
+        await keitaro_pull.stop()
+    
+    keitaro_server = application.bot_data.get('keitaro_server')
+    if keitaro_server:
+        # Неотправленные события остаются в Redis Stream до следующего запуска
+        await keitaro_server.stop()
+    
+    broadcast_engine = application.bot_data.get('broadcast_engine')
+    if broadcast_engine:
+        # Начатые отправки записываются, задания остаются running и продолжатся после запуска
+        await broadcast_engine.stop()
+    
+    await subscription_cache.stop()
+    
+    # Дописываем в БД оставшиеся списания квот
+    from database.quotas import quotas
+    await quotas.stop()
+    
+    # Пулы asyncpg закрываем последними - задачи выше еще пишут в БД
+    from database.pg_pool import close_pools
+    await close_pools()
+
+
 def main() -> None:
     """Основная функция запуска бота"""
     # Проверяем наличие токена
@@ -173,12 +319,29 @@ def main() -> None:
     builder = Application.builder().token(config.BOT_TOKEN)
     
     # Используем self-hosted API если настроено
-    if config.USE_LOCAL_BOT_API:
-        base_url = f"{config.LOCAL_BOT_API_URL}/bot{config.BOT_TOKEN}/"
-        builder = builder.base_url(base_url).base_file_url(base_url)
-        logger.info(f"Using self-hosted Bot API at {config.LOCAL_BOT_API_URL}")
-    
-    application = builder.build()
+    from utils.file_delivery import configure_local_bot_api
+    application = configure_local_bot_api(builder).build()
+    
+    # Лимит запросов на пользователя: проверяется до всех обработчиков (группа -1)
+    from telegram import MessageEntity
+    from utils.rate_limit import RateLimiter, parse_rate
+    from utils.throttle import UpdateThrottle
+    limiters = {
+        cost_class: RateLimiter(*parse_rate(spec), key_prefix='ratelimit:user:')
+        for cost_class, spec in config.RATE_LIMITS.items() if spec
+    }
+    throttle = UpdateThrottle(limiters, exempt_user_ids=config.BOT_ADMINS)
+    # Загрузка файлов и ссылок на скачивание - обработка медиа
+    throttle.add_rule('media', message_filter=(
+        filters.Document.ALL | filters.VIDEO | filters.PHOTO | filters.AUDIO | filters.ANIMATION
+        | filters.Entity(MessageEntity.URL)
+    ))
+    throttle.add_rule('media', callback_pattern=r"^(download_video|download_audio)$")
+    # Генерация адресов и лиц - внешние API
+    throttle.add_rule('generate', callback_pattern=(
+        r"^(kashmail_generate|gmail_generate|random_face_generate|random_face_more)$"
+    ))
+    throttle.register(application)
     
     # Регистрируем обработчик команды /start
     application.add_handler(CommandHandler("start", start_command))
@@ -193,6 +356,8 @@ def main() -> None:
             # Создаем экземпляр админ панели
             db = Database(config.DATABASE_URL)
             admin_panel = AdminPanel(db)
+            # Снимок метрик обновляется в фоне с запуска бота (post_init)
+            application.bot_data['dashboard'] = admin_panel.dashboard
             
             # Команда /admin
             async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -238,6 +403,7 @@ def main() -> None:
             # Обработчик подтверждения рассылки
             application.add_handler(CallbackQueryHandler(admin_panel.send_broadcast, pattern="^broadcast_(send|cancel)$"))
             application.add_handler(CallbackQueryHandler(admin_panel.segment_selected, pattern="^segment_"))
+            application.add_handler(CallbackQueryHandler(admin_panel.stop_broadcast, pattern=r"^broadcast_stop_\d+$"))
             
             # ConversationHandler для добавления cookies
             cookies_conv = ConversationHandler(
@@ -483,13 +649,39 @@ def main() -> None:
             
             # Запускаем веб-сервер для приема postback
             from web_server import KeitaroWebServer
+            from features.keitaro.routing import route_cache
+            from features.keitaro.dedup import PostbackDeduplicator
+            from features.keitaro.delivery import DeliveryQueue
+            route_cache.configure(ttl=config.KEITARO_ROUTE_CACHE_TTL)
             keitaro_server = KeitaroWebServer(
                 bot=application.bot, 
                 database=db_for_keitaro,
-                port=int(os.getenv('KEITARO_WEBHOOK_PORT', '8080'))
+                port=int(os.getenv('KEITARO_WEBHOOK_PORT', '8080')),
+                dedup=PostbackDeduplicator(
+                    db_for_keitaro,
+                    max_key_ttl=config.KEITARO_DEDUP_KEY_TTL,
+                    bloom_bits=config.KEITARO_DEDUP_BLOOM_BITS
+                ),
+                delivery=DeliveryQueue(
+                    application.bot,
+                    db_for_keitaro,
+                    rate=config.KEITARO_DELIVERY_RATE,
+                    chat_rate=config.KEITARO_CHAT_RATE,
+                    batch_size=config.KEITARO_DELIVERY_BATCH,
+                    max_pending=config.KEITARO_DELIVERY_MAX_PENDING
+                )
             )
             application.bot_data['keitaro_server'] = keitaro_server
             
+            # Выгрузка конверсий для профилей с pull_enabled - в ту же очередь доставки
+            from features.keitaro.pull import KeitaroPullSync
+            application.bot_data['keitaro_pull'] = KeitaroPullSync(
+                keitaro_server,
+                interval=config.KEITARO_PULL_INTERVAL,
+                page_size=config.KEITARO_PULL_PAGE_SIZE,
+                concurrency=config.KEITARO_PULL_CONCURRENCY
+            )
+            
             # Домен для webhook URL
             application.bot_data['webhook_domain'] = os.getenv('WEBHOOK_DOMAIN', 'YOUR_DOMAIN')
             
@@ -528,13 +720,16 @@ def main() -> None:
     # Обработчики callback-кнопок вне ConversationHandler
     application.add_handler(CallbackQueryHandler(language_callback, pattern="^lang_"))
     application.add_handler(CallbackQueryHandler(check_subscription_callback, pattern="^check_subscription$"))
+    # Вступление в канал и выход из него обновляют кэш подписок
+    application.add_handler(ChatMemberHandler(subscription_cache.handle_chat_member, ChatMemberHandler.CHAT_MEMBER))
     application.add_handler(CallbackQueryHandler(main_menu_callback, pattern="^main_menu$"))
     
     # Обработчик ошибок
     application.add_error_handler(error_handler)
     
-    # Инициализация после запуска
+    # Инициализация после запуска и остановка перед выходом
     application.post_init = post_init
+    application.post_shutdown = post_shutdown
     
     # Запускаем бота
     logger.info("Starting bot...")
@@ -557,7 +752,8 @@ def main() -> None:
             logger.error(f"Error during cleanup: {e}")
     
     try:
-        application.run_polling(drop_pending_updates=True)
+        # chat_member Telegram присылает, только если запросить его явно
+        application.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
     finally:
         # Очистка ресурсов при завершении
         try:
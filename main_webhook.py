@@ -9,7 +9,9 @@ import logging
 import asyncio
 from typing import Optional
 
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, ConversationHandler, filters
+from telegram.ext import (
+    Application, CommandHandler, CallbackQueryHandler, MessageHandler, ConversationHandler, ChatMemberHandler, filters
+)
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения
@@ -21,6 +23,7 @@ from database.async_db import init_async_db, close_async_db
 from webhook_server import init_webhook_server
 from handlers import *
 from utils.error_handler import error_handler
+from utils import subscription_cache
 
 # Настройка логирования
 logging.basicConfig(
@@ -44,6 +47,13 @@ async def post_init(application: Application) -> None:
     
     # Инициализируем async database
     try:
+        from database.query_metrics import query_metrics
+        query_metrics.configure(
+            slow_threshold=config.DB_SLOW_QUERY_MS / 1000,
+            explain_sample_rate=config.DB_EXPLAIN_SAMPLE_RATE,
+            explain_cooldown=config.DB_EXPLAIN_COOLDOWN
+        )
+        
         db = await init_async_db(config.DATABASE_URL)
         application.bot_data['async_db'] = db
         logger.info("Async database initialized")
@@ -60,6 +70,7 @@ async def post_init(application: Application) -> None:
                 decode_responses=True
             )
             application.bot_data['redis'] = redis_client
+            subscription_cache.redis = redis_client
             logger.info("Redis client initialized")
         except Exception as e:
             logger.warning(f"Failed to initialize Redis: {e}")
@@ -115,8 +126,9 @@ async def post_shutdown(application: Application) -> None:
 
 def main() -> None:
     """Главная функция"""
-    # Создаем приложение
-    application = Application.builder().token(config.BOT_TOKEN).build()
+    # Создаем приложение (self-hosted API если настроено)
+    from utils.file_delivery import configure_local_bot_api
+    application = configure_local_bot_api(Application.builder().token(config.BOT_TOKEN)).build()
     
     # Регистрируем команды
     application.add_handler(CommandHandler("start", start_command))
@@ -242,6 +254,7 @@ def main() -> None:
     # Остальные обработчики
     application.add_handler(CallbackQueryHandler(language_callback, pattern="^lang_"))
     application.add_handler(CallbackQueryHandler(check_subscription_callback, pattern="^check_subscription$"))
+    application.add_handler(ChatMemberHandler(subscription_cache.handle_chat_member, ChatMemberHandler.CHAT_MEMBER))
     application.add_handler(CallbackQueryHandler(main_menu_callback, pattern="^main_menu$"))
     
     # Обработчик ошибок
@@ -267,7 +280,7 @@ def main() -> None:
         # Polling mode
         logger.info("Starting bot in POLLING mode...")
         application.run_polling(
-            allowed_updates=['message', 'callback_query', 'edited_message']
+            allowed_updates=['message', 'callback_query', 'edited_message', 'chat_member']
         )
 
 
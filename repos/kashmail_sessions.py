@@ -6,6 +6,7 @@ import logging
 from datetime import datetime, date
 from typing import Optional, Dict, Any
 from database.models import Database, KashmailSession, KashmailDailyCounter
+from database.quotas import KASHMAIL, quotas
 
 logger = logging.getLogger(__name__)
 
@@ -134,9 +135,10 @@ class KashmailCounterRepository:
     
     async def get_daily_usage(self, user_id: int, day: Optional[date] = None) -> int:
         """Получить количество использований за день"""
-        if day is None:
-            day = datetime.now().date()
+        if day is None or day == quotas.today():
+            return (await quotas.usage(KASHMAIL, user_id)).used
         
+        # Прошлые дни - из копии счетчиков в БД
         try:
             query = """
                 SELECT count FROM kashmail_daily_counters 
@@ -152,34 +154,26 @@ class KashmailCounterRepository:
             logger.error(f"Failed to get daily usage: {e}")
             return 0
     
-    async def increment_daily_usage(self, user_id: int, count: int = 1) -> bool:
-        """Увеличить счетчик использований за день"""
-        today = datetime.now().date()
+    async def consume(self, user_id: int, count: int = 1):
+        """
+        Атомарно проверить и списать count из дневной квоты
         
-        try:
-            query = """
-                INSERT INTO kashmail_daily_counters (user_id, day, count)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (user_id, day) 
-                DO UPDATE SET count = kashmail_daily_counters.count + %s
-            """
-            await self.db.execute(query, (user_id, today, count, count))
-            logger.info(f"Incremented KashMail usage for user {user_id} by {count}")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Failed to increment daily usage: {e}")
-            return False
+        Returns:
+            QuotaResult: allowed=False - лимит исчерпан, ничего не списано
+        """
+        return await quotas.consume(KASHMAIL, user_id, count)
+    
+    async def refund(self, user_id: int, count: int = 1) -> None:
+        """Вернуть списанное, если email так и не был создан"""
+        await quotas.refund(KASHMAIL, user_id, count)
     
-    async def get_remaining_quota(self, user_id: int, daily_limit: int = 10) -> int:
-        """Получить оставшуюся квоту на сегодня"""
-        used_today = await self.get_daily_usage(user_id)
-        remaining = daily_limit - used_today
-        return max(0, remaining)
+    async def get_remaining_quota(self, user_id: int, daily_limit: Optional[int] = None) -> int:
+        """Получить оставшуюся квоту на сегодня (лимит задается в quotas)"""
+        return await quotas.remaining(KASHMAIL, user_id)
     
-    async def can_create_email(self, user_id: int, daily_limit: int = 10) -> bool:
+    async def can_create_email(self, user_id: int, daily_limit: Optional[int] = None) -> bool:
         """Проверить, может ли пользователь создать еще один email"""
-        remaining = await self.get_remaining_quota(user_id, daily_limit)
+        remaining = await self.get_remaining_quota(user_id)
         return remaining > 0
     
     async def cleanup_old_counters(self, days_to_keep: int = 30) -> int:
@@ -187,7 +181,7 @@ class KashmailCounterRepository:
         try:
             query = """
                 DELETE FROM kashmail_daily_counters 
-                WHERE day < CURRENT_DATE - INTERVAL '%s days'
+                WHERE day < CURRENT_DATE - %s * INTERVAL '1 day'
             """
             result = await self.db.execute(query, (days_to_keep,))
             logger.info(f"Cleaned up old KashMail counters (older than {days_to_keep} days)")
@@ -206,36 +200,42 @@ class KashmailRepository:
         self.counters = KashmailCounterRepository(database)
         self.db = database
     
-    async def can_user_create_email(
+    async def reserve_email(
         self, 
         user_id: int, 
-        daily_limit: int = 10,
         check_active_session: bool = True
     ) -> tuple[bool, str]:
         """
-        Проверить, может ли пользователь создать новый email
+        Проверить, может ли пользователь создать новый email, и списать квоту
+        
+        Списание атомарное, поэтому параллельные запросы не превысят лимит.
+        Если email затем не удалось создать, квоту возвращает release_email.
         
         Returns:
-            tuple[can_create: bool, reason: str]
+            tuple[reserved: bool, reason: str]
         """
         try:
-            # Проверяем дневной лимит
-            if not await self.counters.can_create_email(user_id, daily_limit):
-                used_today = await self.counters.get_daily_usage(user_id)
-                return False, f"Превышен дневной лимит: {used_today}/{daily_limit}"
-            
             # Проверяем наличие активной сессии
             if check_active_session:
                 session = await self.sessions.get_session(user_id)
                 if session and session['status'] in ['active', 'waiting']:
                     return False, "У вас уже есть активная сессия KashMail"
             
+            # Проверяем и списываем дневной лимит
+            result = await self.counters.consume(user_id, 1)
+            if not result.allowed:
+                return False, f"Превышен дневной лимит: {result.used}/{result.limit}"
+            
             return True, "OK"
             
         except Exception as e:
             logger.error(f"Failed to check if user can create email: {e}")
             return False, "Ошибка проверки лимитов"
     
+    async def release_email(self, user_id: int) -> None:
+        """Вернуть квоту, списанную reserve_email"""
+        await self.counters.refund(user_id, 1)
+    
     async def create_new_email_session(
         self, 
         user_id: int, 
@@ -243,19 +243,9 @@ class KashmailRepository:
         jwt: str, 
         expires_at: datetime
     ) -> bool:
-        """Создать новую сессию и увеличить счетчик"""
+        """Создать новую сессию (квота уже списана reserve_email)"""
         try:
-            # Создаем сессию
-            session_created = await self.sessions.create_session(
-                user_id, address, jwt, expires_at
-            )
-            
-            if session_created:
-                # Увеличиваем счетчик
-                await self.counters.increment_daily_usage(user_id, 1)
-                return True
-            
-            return False
+            return await self.sessions.create_session(user_id, address, jwt, expires_at)
             
         except Exception as e:
             logger.error(f"Failed to create new email session: {e}")
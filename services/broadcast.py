@@ -0,0 +1,484 @@
+"""
+Фоновые рассылки
+
+Рассылка - задание в broadcast_jobs (миграция 010), а не цикл внутри
+обработчика кнопки. Получатели читаются страницами по users.id
+(database/recipients.py), отправка идет параллельно (не больше
+concurrency одновременно) через общий token bucket чуть ниже глобального
+лимита Telegram. RetryAfter останавливает всю рассылку на указанное
+время, после чего сообщение отправляется повторно.
+
+После каждой страницы одной транзакцией записываются результаты по
+получателям (broadcast_deliveries), пачка заблокировавших бота
+пользователей (users.is_blocked) и счетчики задания вместе с id
+последнего обработанного пользователя. После перезапуска задание
+продолжается с этого id.
+
+Доставка - не реже одного раза: записанные получатели сообщение повторно
+не получают, но отправка, результат которой записать не успели (процесс
+упал или отправка не закончилась за stop_grace при остановке), после
+перезапуска повторится. При остановке бота начатые отправки дожидаются
+и записываются, новые не начинаются.
+
+Задание выполняет один процесс: START_JOB_SQL атомарно записывает в
+задание владельца (host:pid), пока задание идет, владелец раз в
+lease_ttl / 3 обновляет heartbeat_at. Другой процесс забирает задание
+только без владельца (штатная остановка его отпускает) или с
+heartbeat_at старше lease_ttl (владелец упал). Результаты страницы
+сохраняются только владельцем - потерявший аренду процесс
+останавливается.
+"""
+
+import os
+import json
+import time
+import socket
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
+
+from database.recipients import RecipientSource
+from database.user_cache import user_cache
+from utils.rate_limit import TokenBucket, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+CREATE_JOB_SQL = """
+    INSERT INTO broadcast_jobs (segment, content, admin_chat_id, progress_message_id, total, created_at)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    RETURNING id
+"""
+
+LOAD_JOB_SQL = "SELECT * FROM broadcast_jobs WHERE id = %s"
+
+# Задание свободно: ждет запуска, отпущено владельцем или владелец перестал обновлять heartbeat_at
+CLAIMABLE_SQL = """
+    (status = 'pending' OR (status = 'running' AND (
+        owner IS NULL OR owner = %(owner)s
+        OR heartbeat_at < NOW() - make_interval(secs => %(lease)s)
+    )))
+"""
+
+ACTIVE_JOBS_SQL = f"SELECT id FROM broadcast_jobs WHERE {CLAIMABLE_SQL} ORDER BY id"
+
+START_JOB_SQL = f"""
+    UPDATE broadcast_jobs
+    SET status = 'running', owner = %(owner)s, heartbeat_at = NOW(),
+        started_at = COALESCE(started_at, NOW()), updated_at = NOW()
+    WHERE id = %(id)s AND {CLAIMABLE_SQL}
+    RETURNING id
+"""
+
+HEARTBEAT_SQL = """
+    UPDATE broadcast_jobs SET heartbeat_at = NOW()
+    WHERE id = %s AND owner = %s
+    RETURNING id
+"""
+
+RELEASE_JOB_SQL = "UPDATE broadcast_jobs SET owner = NULL, updated_at = NOW() WHERE id = %s AND owner = %s"
+
+FINISH_JOB_SQL = """
+    UPDATE broadcast_jobs SET status = 'done', finished_at = NOW(), updated_at = NOW()
+    WHERE id = %s AND owner = %s AND status = 'running'
+"""
+
+CANCEL_JOB_SQL = """
+    UPDATE broadcast_jobs SET status = 'cancelled', finished_at = NOW(), updated_at = NOW()
+    WHERE id = %s AND status IN ('pending', 'running')
+    RETURNING id
+"""
+
+DELIVERED_SQL = "SELECT user_id FROM broadcast_deliveries WHERE job_id = %s AND user_id = ANY(%s)"
+
+SAVE_DELIVERIES_SQL = """
+    INSERT INTO broadcast_deliveries (job_id, user_id, tg_id, status, error, attempts)
+    SELECT %s, d.user_id, d.tg_id, d.status, d.error, d.attempts
+    FROM unnest(%s::int[], %s::bigint[], %s::text[], %s::text[], %s::int[])
+        AS d (user_id, tg_id, status, error, attempts)
+    ON CONFLICT (job_id, user_id) DO NOTHING
+"""
+
+MARK_BLOCKED_SQL = "UPDATE users SET is_blocked = true WHERE id = ANY(%s::int[]) AND is_blocked = false"
+
+ADVANCE_JOB_SQL = """
+    UPDATE broadcast_jobs
+    SET sent = sent + %s, blocked = blocked + %s, failed = failed + %s,
+        last_user_id = GREATEST(last_user_id, %s), heartbeat_at = NOW(), updated_at = NOW()
+    WHERE id = %s AND owner = %s
+    RETURNING status, sent, blocked, failed
+"""
+
+
+class LeaseLost(Exception):
+    """Задание забрал другой процесс"""
+
+
+@dataclass
+class Delivery:
+    """Результат отправки одному получателю"""
+    user_id: int
+    tg_id: int
+    status: str  # sent | blocked | failed
+    error: Optional[str] = None
+    attempts: int = 1
+
+
+@dataclass
+class BroadcastJob:
+    """Задание рассылки"""
+    id: int
+    status: str
+    segment: str
+    content: Dict
+    admin_chat_id: Optional[int]
+    progress_message_id: Optional[int]
+    total: int
+    sent: int = 0
+    blocked: int = 0
+    failed: int = 0
+    last_user_id: int = 0
+    created_at: Optional[datetime] = None
+    started: float = field(default_factory=time.monotonic)
+    processed_at_start: int = 0
+
+    @classmethod
+    def from_row(cls, row: Dict) -> 'BroadcastJob':
+        return cls(
+            id=row['id'], status=row['status'], segment=row['segment'],
+            content=json.loads(row['content']), admin_chat_id=row['admin_chat_id'],
+            progress_message_id=row['progress_message_id'], total=row['total'],
+            sent=row['sent'], blocked=row['blocked'], failed=row['failed'],
+            last_user_id=row['last_user_id'], created_at=row['created_at'],
+            processed_at_start=row['sent'] + row['blocked'] + row['failed'],
+        )
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.blocked + self.failed
+
+
+async def send_content(bot, chat_id: int, content: Dict) -> None:
+    """Отправляет сообщение рассылки в том же виде, в каком его прислал админ"""
+    content_type = content['content_type']
+    caption = content.get('caption')
+    file_id = content.get('file_id')
+    caption_mode = ParseMode.MARKDOWN if caption else None
+
+    if content_type == 'text':
+        await bot.send_message(chat_id=chat_id, text=content['text'], parse_mode=content.get('parse_mode'))
+    elif content_type == 'sticker':
+        await bot.send_sticker(chat_id=chat_id, sticker=file_id)
+    elif content_type in ('photo', 'video', 'document', 'audio', 'voice', 'animation'):
+        send = getattr(bot, f'send_{content_type}')
+        await send(chat_id=chat_id, caption=caption, parse_mode=caption_mode, **{content_type: file_id})
+    else:
+        raise ValueError(f"Unsupported broadcast content type: {content_type}")
+
+
+def progress_text(job: BroadcastJob) -> str:
+    """Текст сообщения о ходе рассылки"""
+    percent = job.processed / job.total * 100 if job.total else 100.0
+    elapsed = max(time.monotonic() - job.started, 1e-6)
+    title = {
+        'done': '✅ **Рассылка завершена**',
+        'cancelled': '⛔ **Рассылка остановлена**',
+    }.get(job.status, '📤 **Идет рассылка**')
+    return f"""{title}
+
+📊 Прогресс: {job.processed}/{job.total} ({percent:.1f}%)
+• Отправлено: {job.sent}
+• Заблокировано: {job.blocked}
+• Ошибок: {job.failed}
+⚡ Скорость: {(job.processed - job.processed_at_start) / elapsed:.1f} сообщ./сек"""
+
+
+class BroadcastEngine:
+    """Выполнение заданий рассылки в фоне"""
+
+    def __init__(self, database, bot, rate: float = 25.0, concurrency: int = 20, page_size: int = 200,
+                 max_attempts: int = 5, progress_interval: float = 5.0, lease_ttl: float = 120.0,
+                 stop_grace: float = 10.0):
+        """
+        Args:
+            database: Экземпляр Database
+            bot: Telegram Bot
+            rate: Сообщений в секунду на все рассылки вместе (лимит Telegram - около 30)
+            concurrency: Сколько отправок выполняется одновременно
+            page_size: Получателей на страницу (и на одну транзакцию с результатами)
+            max_attempts: Попыток на получателя при RetryAfter и сетевых ошибках
+            progress_interval: Как часто обновлять сообщение о ходе рассылки, сек
+            lease_ttl: Через сколько секунд без heartbeat задание может забрать другой процесс
+            stop_grace: Сколько секунд при остановке ждать начатые отправки
+        """
+        self.db = database
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.max_attempts = max_attempts
+        self.progress_interval = progress_interval
+        self.lease_ttl = lease_ttl
+        self.stop_grace = stop_grace
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._watch: Optional[asyncio.Task] = None
+
+    async def create_job(self, segment: str, content: Dict, admin_chat_id: Optional[int] = None,
+                         progress_message_id: Optional[int] = None) -> Tuple[int, int]:
+        """
+        Создает и запускает задание
+
+        Returns:
+            (id задания, число получателей)
+        """
+        created_at = datetime.utcnow()
+        total = await RecipientSource(self.db, segment, now=created_at).count()
+        rows = await self.db.execute(
+            CREATE_JOB_SQL,
+            (segment, json.dumps(content), admin_chat_id, progress_message_id, total, created_at),
+            fetch=True
+        )
+        job_id = rows[0]['id']
+        self.start_job(job_id)
+        logger.info(f"Broadcast job {job_id} created: segment={segment}, recipients={total}")
+        return job_id, total
+
+    def start_job(self, job_id: int) -> None:
+        task = self._tasks.get(job_id)
+        if task and not task.done():
+            return
+        task = asyncio.create_task(self._run(job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def resume(self) -> List[int]:
+        """Продолжает задания, прерванные остановкой бота или брошенные упавшим процессом"""
+        rows = await self.db.execute(ACTIVE_JOBS_SQL, self._lease_params(), fetch=True) or []
+        job_ids = [row['id'] for row in rows if row['id'] not in self._tasks]
+        for job_id in job_ids:
+            self.start_job(job_id)
+        if job_ids:
+            logger.info(f"Resuming broadcast jobs: {job_ids}")
+        return job_ids
+
+    def start(self) -> None:
+        """Продолжает прерванные задания сейчас и затем раз в lease_ttl забирает брошенные"""
+        if self._watch and not self._watch.done():
+            return
+
+        async def _loop():
+            while True:
+                try:
+                    await self.resume()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Failed to resume broadcast jobs: {e}")
+                await asyncio.sleep(self.lease_ttl)
+
+        self._watch = asyncio.create_task(_loop())
+
+    def _lease_params(self, **params) -> Dict:
+        return {'owner': self.owner, 'lease': float(self.lease_ttl), **params}
+
+    async def cancel(self, job_id: int) -> bool:
+        """
+        Останавливает задание
+
+        Выполняющееся задание заканчивает текущую страницу, видит новый
+        статус при ее сохранении и выходит с итоговым отчетом.
+        """
+        rows = await self.db.execute(CANCEL_JOB_SQL, (job_id,), fetch=True)
+        return bool(rows)
+
+    async def stop(self) -> None:
+        """
+        Прерывает задания при остановке бота
+
+        Начатые отправки дожидаются (не дольше stop_grace) и записываются,
+        задания остаются running без владельца и продолжатся после запуска.
+        """
+        if self._watch:
+            self._watch.cancel()
+            self._watch = None
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, job_id: int) -> None:
+        heartbeat = None
+        try:
+            if not await self.db.execute(START_JOB_SQL, self._lease_params(id=job_id), fetch=True):
+                # Задание завершено или его выполняет другой процесс
+                return
+            heartbeat = asyncio.create_task(self._heartbeat(job_id))
+            rows = await self.db.execute(LOAD_JOB_SQL, (job_id,), fetch=True)
+            job = BroadcastJob.from_row(rows[0])
+
+            # Сегмент считается от момента создания - после перезапуска он тот же
+            source = RecipientSource(self.db, job.segment, page_size=self.page_size, now=job.created_at)
+            last_report = 0.0
+            async for page in source.pages(after_id=job.last_user_id):
+                if not await self._process_page(job, page):
+                    break
+                if time.monotonic() - last_report >= self.progress_interval:
+                    await self._report(job)
+                    last_report = time.monotonic()
+
+            if job.status == 'running':
+                await self.db.execute(FINISH_JOB_SQL, (job_id, self.owner))
+                job.status = 'done'
+            await self._report(job)
+            logger.info(f"Broadcast job {job_id} {job.status}: sent={job.sent}, "
+                        f"blocked={job.blocked}, failed={job.failed}")
+        except asyncio.CancelledError:
+            # Остановка бота: отпускаем задание, чтобы после запуска продолжить его сразу
+            await asyncio.shield(self.db.execute(RELEASE_JOB_SQL, (job_id, self.owner)))
+            raise
+        except LeaseLost:
+            logger.warning(f"Broadcast job {job_id} was taken over by another process, stopping")
+        except Exception as e:
+            logger.error(f"Broadcast job {job_id} failed: {e}")
+        finally:
+            if heartbeat:
+                heartbeat.cancel()
+
+    async def _heartbeat(self, job_id: int) -> None:
+        """Продлевает аренду задания, пока оно выполняется"""
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                if not await self.db.execute(HEARTBEAT_SQL, (job_id, self.owner), fetch=True):
+                    # Сохранение страницы увидит это и остановит задание
+                    logger.warning(f"Broadcast job {job_id} lease lost")
+                    return
+            except Exception as e:
+                logger.warning(f"Broadcast job {job_id} heartbeat failed: {e}")
+
+    async def _process_page(self, job: BroadcastJob, page: List[Tuple[int, int]]) -> bool:
+        """Отправляет страницу и сохраняет результаты (False - задание остановлено)"""
+        # Страница могла быть начата до перезапуска - этим получателям уже отправлено
+        rows = await self.db.execute(DELIVERED_SQL, (job.id, [user_id for user_id, _ in page]), fetch=True)
+        delivered = {row['user_id'] for row in rows or []}
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results: List[Delivery] = []
+        in_flight: Dict[int, asyncio.Task] = {}
+
+        async def _limited(user_id: int, tg_id: int) -> None:
+            async with semaphore:
+                # Остановка не обрывает начатую отправку - ее результат запишем
+                send = in_flight[user_id] = asyncio.ensure_future(self.deliver(user_id, tg_id, job.content))
+                result = await asyncio.shield(send)
+                del in_flight[user_id]
+                results.append(result)
+
+        try:
+            await asyncio.gather(*(
+                _limited(user_id, tg_id) for user_id, tg_id in page if user_id not in delivered
+            ))
+        except asyncio.CancelledError:
+            # Остановка бота посреди страницы: дожидаемся начатых отправок и сохраняем
+            # отправленное без сдвига отметки
+            results.extend(await self._drain(list(in_flight.values())))
+            await asyncio.shield(self._save(job, results, job.last_user_id))
+            raise
+        status = await self._save(job, results, page[-1][0])
+        return status == 'running'
+
+    async def _drain(self, sends: List[asyncio.Task]) -> List[Delivery]:
+        """Результаты начатых отправок; не закончившиеся за stop_grace отменяются"""
+        if not sends:
+            return []
+        done, pending = await asyncio.wait(sends, timeout=self.stop_grace)
+        for send in pending:
+            send.cancel()
+        if pending:
+            logger.warning(f"{len(pending)} broadcast send(s) unfinished at shutdown, will be retried")
+        return [send.result() for send in done if not send.cancelled() and send.exception() is None]
+
+    async def deliver(self, user_id: int, tg_id: int, content: Dict) -> Delivery:
+        """Отправляет одному получателю с повторами при RetryAfter и сетевых ошибках"""
+        error = None
+        for attempt in range(1, self.max_attempts + 1):
+            await self.bucket.acquire()
+            try:
+                await send_content(self.bot, tg_id, content)
+                return Delivery(user_id, tg_id, 'sent', attempts=attempt)
+            except RetryAfter as e:
+                # Флуд-лимит общий на бота - останавливаем все отправки
+                self.bucket.pause(retry_after_seconds(e.retry_after))
+                error = str(e)
+            except Forbidden as e:
+                # Бот заблокирован или аккаунт удален
+                return Delivery(user_id, tg_id, 'blocked', str(e)[:255], attempt)
+            except BadRequest as e:
+                # BadRequest - подкласс NetworkError, но повтор не поможет
+                return Delivery(user_id, tg_id, 'failed', str(e)[:255], attempt)
+            except (TimedOut, NetworkError) as e:
+                error = str(e)
+                await asyncio.sleep(min(2 ** attempt, 30))
+            except Exception as e:
+                return Delivery(user_id, tg_id, 'failed', str(e)[:255], attempt)
+        return Delivery(user_id, tg_id, 'failed', (error or 'retries exhausted')[:255], self.max_attempts)
+
+    async def _save(self, job: BroadcastJob, results: List[Delivery], last_user_id: int) -> str:
+        """Записывает результаты страницы, блокировки и отметку одной транзакцией"""
+        counts = {'sent': 0, 'blocked': 0, 'failed': 0}
+        for result in results:
+            counts[result.status] += 1
+        blocked_ids = [result.user_id for result in results if result.status == 'blocked']
+
+        async with self.db.transaction() as tx:
+            if results:
+                await tx.execute(SAVE_DELIVERIES_SQL, (
+                    job.id,
+                    [r.user_id for r in results], [r.tg_id for r in results],
+                    [r.status for r in results], [r.error for r in results],
+                    [r.attempts for r in results],
+                ))
+            if blocked_ids:
+                await tx.execute(MARK_BLOCKED_SQL, (blocked_ids,))
+            rows = await tx.execute(ADVANCE_JOB_SQL, (
+                counts['sent'], counts['blocked'], counts['failed'], last_user_id, job.id, self.owner
+            ), fetch=True)
+            if not rows:
+                # Откатываем страницу: задание продолжает новый владелец
+                raise LeaseLost(f"Broadcast job {job.id} is owned by another process")
+
+        row = rows[0]
+        job.status, job.sent, job.blocked, job.failed = row['status'], row['sent'], row['blocked'], row['failed']
+        job.last_user_id = max(job.last_user_id, last_user_id)
+
+        for result in results:
+            if result.status == 'blocked':
+                await user_cache.update(result.tg_id, is_blocked=True)
+        return job.status
+
+    async def _report(self, job: BroadcastJob) -> None:
+        """Обновляет сообщение о ходе рассылки у админа"""
+        if not job.admin_chat_id or not job.progress_message_id:
+            return
+        reply_markup = None
+        if job.status == 'running':
+            reply_markup = InlineKeyboardMarkup([[
+                InlineKeyboardButton("⛔ Остановить", callback_data=f"broadcast_stop_{job.id}")
+            ]])
+        try:
+            await self.bot.edit_message_text(
+                chat_id=job.admin_chat_id,
+                message_id=job.progress_message_id,
+                text=progress_text(job),
+                reply_markup=reply_markup,
+                parse_mode=ParseMode.MARKDOWN
+            )
+        except TelegramError as e:
+            # "message is not modified" и удаленное сообщение не мешают рассылке
+            logger.debug(f"Broadcast progress update skipped: {e}")
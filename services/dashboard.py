@@ -0,0 +1,144 @@
+"""
+Данные админ-панели
+
+Метрики дашборда - независимые запросы, поэтому они выполняются
+одновременно (каждый на своем соединении пула), а результат хранится
+снимком. Фоновая задача обновляет снимок заранее, обработчики кнопок
+показывают готовый снимок из памяти. Устаревший снимок отдается сразу,
+а обновление запускается в фоне; одновременные запросы ждут одно и то же
+обновление, а не запускают свое.
+"""
+
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Awaitable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DashboardSnapshot:
+    """Метрики дашборда на момент updated_at"""
+    dau_wau_mau: Dict[str, int]
+    total_users: Dict[str, int]
+    retention: Dict[str, float]
+    churn_rate: float
+    command_usage: List[Tuple[str, int]]
+    new_users: List[Tuple[str, int]]
+    hourly_activity: List[Tuple[int, int]]
+    segments: Dict[str, int]
+    keitaro: Dict[str, int]
+    updated_at: datetime = field(default_factory=datetime.now)
+    duration: float = 0.0  # Сколько секунд считался снимок
+    created: float = field(default_factory=time.monotonic)
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.created
+
+
+async def _safe(coro: Awaitable, default: Any, name: str) -> Any:
+    """Ошибка одной метрики не должна ронять весь снимок"""
+    try:
+        return await coro
+    except Exception as e:
+        logger.error(f"Dashboard metric {name} failed: {e}")
+        return default
+
+
+class DashboardService:
+    """Снимок метрик админ-панели с фоновым обновлением"""
+
+    def __init__(self, analytics, ttl: float = 120.0):
+        """
+        Args:
+            analytics: Экземпляр Analytics
+            ttl: Через сколько секунд снимок считается устаревшим
+        """
+        self.analytics = analytics
+        self.ttl = ttl
+        self._snapshot: Optional[DashboardSnapshot] = None
+        self._refreshing: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def _build(self) -> DashboardSnapshot:
+        started = time.monotonic()
+        a = self.analytics
+        (dau_wau_mau, total_users, matrix, churn_rate, command_usage, new_users, hourly_activity,
+         segments, keitaro) = await asyncio.gather(
+            _safe(a.get_dau_wau_mau(), {'DAU': 0, 'WAU': 0, 'MAU': 0}, 'dau_wau_mau'),
+            _safe(a.get_total_users(), {'total': 0, 'active': 0, 'blocked': 0}, 'total_users'),
+            _safe(a.get_retention_matrix(30), None, 'retention'),
+            _safe(a.get_churn_rate(30), 0.0, 'churn_rate'),
+            _safe(a.get_command_usage(30), [], 'command_usage'),
+            _safe(a.get_new_users(7), [], 'new_users'),
+            _safe(a.get_hourly_activity(7), [], 'hourly_activity'),
+            _safe(a.get_segment_counts(), {'all': 0, 'active_7d': 0, 'active_30d': 0, 'inactive_7d': 0},
+                  'segments'),
+            _safe(a.get_keitaro_stats(7), {'profiles': 0, 'events': 0}, 'keitaro'),
+        )
+        retention = {
+            f'D{days}': matrix.average(days, 30) if matrix else 0.0 for days in (1, 7, 30)
+        }
+        return DashboardSnapshot(
+            dau_wau_mau=dau_wau_mau, total_users=total_users, retention=retention, churn_rate=churn_rate,
+            command_usage=command_usage, new_users=new_users, hourly_activity=hourly_activity,
+            segments=segments, keitaro=keitaro, duration=time.monotonic() - started,
+        )
+
+    def refresh(self) -> asyncio.Task:
+        """Запускает обновление снимка (или возвращает уже идущее)"""
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.create_task(self._refresh())
+        return self._refreshing
+
+    async def _refresh(self) -> DashboardSnapshot:
+        snapshot = await self._build()
+        self._snapshot = snapshot
+        logger.debug(f"Dashboard snapshot refreshed in {snapshot.duration:.2f}s")
+        return snapshot
+
+    async def get(self) -> DashboardSnapshot:
+        """
+        Текущий снимок
+
+        Свежий и устаревший снимки возвращаются сразу (устаревший - с
+        обновлением в фоне); ждать приходится только до первого снимка.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return await asyncio.shield(self.refresh())
+        if snapshot.age >= self.ttl:
+            self.refresh()
+        return snapshot
+
+    def start(self, interval: float = 60.0) -> None:
+        """Запускает периодическое обновление снимка"""
+        if self._task and not self._task.done():
+            return
+
+        async def _loop():
+            while True:
+                try:
+                    await asyncio.shield(self.refresh())
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Dashboard refresh failed: {e}")
+                await asyncio.sleep(interval)
+
+        self._task = asyncio.create_task(_loop())
+
+    async def stop(self) -> None:
+        for task in (self._task, self._refreshing):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+        self._task = None
+        self._refreshing = None
@@ -10,6 +10,7 @@ import json
 
 from services.kashmail_api import MailTmApi, KashmailEmailWatcher, EmailMessage
 from repos.kashmail_sessions import KashmailRepository
+from database.quotas import QuotaEngine
 from database.models import Database
 
 
@@ -255,6 +256,11 @@ class TestKashmailRepositoryMocked(unittest.IsolatedAsyncioTestCase):
         """Настройка тестов"""
         self.mock_db = MagicMock(spec=Database)
         self.repo = KashmailRepository(self.mock_db)
+        
+        # Квоты без Redis - напрямую в (замоканной) БД
+        quotas_patcher = patch('repos.kashmail_sessions.quotas', QuotaEngine(self.mock_db))
+        quotas_patcher.start()
+        self.addCleanup(quotas_patcher.stop)
     
     async def test_create_session_success(self):
         """Тест успешного создания сессии"""
@@ -302,13 +308,14 @@ class TestKashmailRepositoryMocked(unittest.IsolatedAsyncioTestCase):
         self.assertTrue(result)
         self.mock_db.execute.assert_called_once()
     
-    async def test_daily_usage_increment(self):
-        """Тест увеличения дневного счетчика"""
-        self.mock_db.execute = AsyncMock(return_value=True)
+    async def test_daily_usage_consume(self):
+        """Тест списания из дневного счетчика"""
+        self.mock_db.execute = AsyncMock(return_value=[{'count': 1}])
         
-        result = await self.repo.counters.increment_daily_usage(123, 1)
+        result = await self.repo.counters.consume(123, 1)
         
-        self.assertTrue(result)
+        self.assertTrue(result.allowed)
+        self.assertEqual(result.used, 1)
         self.mock_db.execute.assert_called_once()
     
     async def test_get_remaining_quota(self):
@@ -316,41 +323,41 @@ class TestKashmailRepositoryMocked(unittest.IsolatedAsyncioTestCase):
         # Мокаем что пользователь использовал 3 адреса сегодня
         self.mock_db.execute = AsyncMock(return_value=[{'count': 3}])
         
-        remaining = await self.repo.counters.get_remaining_quota(123, daily_limit=10)
+        remaining = await self.repo.counters.get_remaining_quota(123)
         
         self.assertEqual(remaining, 7)
     
-    async def test_can_create_email_within_limit(self):
+    async def test_reserve_email_within_limit(self):
         """Тест возможности создания email в пределах лимита"""
         # Мокаем проверки
         self.mock_db.execute = AsyncMock(side_effect=[
-            [{'count': 5}],  # Использовано 5 из 10
-            []  # Нет активной сессии
+            [],  # Нет активной сессии
+            [{'count': 6}]  # Списано, использовано 6 из 10
         ])
         
-        can_create, reason = await self.repo.can_user_create_email(123, daily_limit=10)
+        can_create, reason = await self.repo.reserve_email(123)
         
         self.assertTrue(can_create)
         self.assertEqual(reason, "OK")
     
-    async def test_can_create_email_exceed_limit(self):
+    async def test_reserve_email_exceed_limit(self):
         """Тест превышения лимита"""
-        # Мокаем что пользователь использовал 10 из 10
-        self.mock_db.execute = AsyncMock(return_value=[{'count': 10}])
+        self.mock_db.execute = AsyncMock(side_effect=[
+            [],  # Нет активной сессии
+            [],  # Условный UPSERT не прошел
+            [{'count': 10}]  # Использовано 10 из 10
+        ])
         
-        can_create, reason = await self.repo.can_user_create_email(123, daily_limit=10)
+        can_create, reason = await self.repo.reserve_email(123)
         
         self.assertFalse(can_create)
         self.assertIn("Превышен дневной лимит", reason)
     
-    async def test_can_create_email_has_active_session(self):
+    async def test_reserve_email_has_active_session(self):
         """Тест наличия активной сессии"""
-        self.mock_db.execute = AsyncMock(side_effect=[
-            [{'count': 2}],  # В пределах лимита
-            [{'status': 'active'}]  # Есть активная сессия
-        ])
+        self.mock_db.execute = AsyncMock(return_value=[{'status': 'active'}])
         
-        can_create, reason = await self.repo.can_user_create_email(123, daily_limit=10)
+        can_create, reason = await self.repo.reserve_email(123)
         
         self.assertFalse(can_create)
         self.assertIn("активная сессия", reason)
@@ -0,0 +1,149 @@
+"""
+Тесты для извлечения аудио без перекодирования
+"""
+
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    from utils.audio_extractor import (
+        normalize_codec, detect_audio_codec, choose_audio_target, _resolve_output, extract_audio
+    )
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+def fake_ydl(tmp_path, info, name='clip'):
+    """YoutubeDL без сети: отдает заданный info и имя файла в tmp_path"""
+    ydl = MagicMock()
+    ydl.__enter__.return_value = ydl
+    ydl.extract_info.return_value = info
+    ydl.process_ie_result.side_effect = lambda result, download: result
+    ydl.prepare_filename.return_value = str(tmp_path / f"{name}.{info.get('ext', 'webm')}")
+    return ydl
+
+
+def test_normalize_codec():
+    assert normalize_codec('mp4a.40.2') == 'aac'
+    assert normalize_codec('AAC') == 'aac'
+    assert normalize_codec('opus') == 'opus'
+    assert normalize_codec('vorbis') == 'vorbis'
+    assert normalize_codec('mp3') == 'mp3'
+    assert normalize_codec('flac') == 'flac'
+    assert normalize_codec('none') is None
+    assert normalize_codec(None) is None
+
+
+class TestDetectAudioCodec:
+    """Кодек выбранного формата"""
+
+    def test_audio_only_format(self):
+        assert detect_audio_codec({'acodec': 'opus', 'vcodec': 'none'}) == ('opus', True)
+
+    def test_muxed_format(self):
+        assert detect_audio_codec({'acodec': 'mp4a.40.2', 'vcodec': 'avc1'}) == ('aac', False)
+
+    def test_requested_formats_use_audio_part(self):
+        info = {'requested_formats': [
+            {'acodec': 'none', 'vcodec': 'vp9'},
+            {'acodec': 'opus', 'vcodec': 'none'},
+        ]}
+        assert detect_audio_codec(info) == ('opus', True)
+
+
+class TestChooseAudioTarget:
+    """Копирование потока или перекодирование в MP3"""
+
+    def test_accepted_codec_is_copied(self):
+        assert choose_audio_target('aac', ['aac', 'opus']) == ('m4a', '.m4a')
+        assert choose_audio_target('opus', [' Opus ']) == ('opus', '.ogg')
+
+    def test_unaccepted_codec_is_transcoded(self):
+        assert choose_audio_target('opus', ['aac']) == ('mp3', '.mp3')
+        assert choose_audio_target('flac', ['flac']) == ('mp3', '.mp3')
+        assert choose_audio_target(None, ['aac']) == ('mp3', '.mp3')
+
+
+class TestResolveOutput:
+    """Поиск итогового файла после постобработки"""
+
+    def test_filepath_from_requested_downloads(self, tmp_path):
+        output = tmp_path / 'clip.m4a'
+        output.write_bytes(b'audio')
+        info = {'ext': 'm4a', 'requested_downloads': [{'filepath': str(output)}]}
+
+        assert _resolve_output(fake_ydl(tmp_path, info), info, '.m4a') == str(output)
+
+    def test_postprocessor_extension_is_found(self, tmp_path):
+        # FFmpegExtractAudioPP заменил clip.webm на clip.mp3
+        (tmp_path / 'clip.mp3').write_bytes(b'audio')
+        info = {'ext': 'webm'}
+
+        assert _resolve_output(fake_ydl(tmp_path, info), info, '.mp3') == str(tmp_path / 'clip.mp3')
+
+    def test_opus_is_renamed_to_ogg(self, tmp_path):
+        (tmp_path / 'clip.opus').write_bytes(b'audio')
+        info = {'ext': 'webm'}
+
+        path = _resolve_output(fake_ydl(tmp_path, info), info, '.ogg')
+
+        assert path == str(tmp_path / 'clip.ogg')
+        assert (tmp_path / 'clip.ogg').read_bytes() == b'audio'
+        assert not (tmp_path / 'clip.opus').exists()
+
+    def test_missing_or_non_audio_output(self, tmp_path):
+        (tmp_path / 'clip.webm').write_bytes(b'video')
+        info = {'ext': 'webm', 'filepath': str(tmp_path / 'clip.webm')}
+
+        assert _resolve_output(fake_ydl(tmp_path, info), info, '.mp3') is None
+
+
+class TestExtractAudio:
+    """Выбор постобработки по метаданным"""
+
+    def test_native_audio_only_stream_skips_postprocessing(self, tmp_path):
+        output = tmp_path / 'clip.m4a'
+        output.write_bytes(b'audio')
+        info = {'ext': 'm4a', 'acodec': 'mp4a.40.2', 'vcodec': 'none', 'filepath': str(output)}
+        ydl = fake_ydl(tmp_path, info)
+
+        with patch('utils.audio_extractor.yt_dlp.YoutubeDL', return_value=ydl) as youtube_dl:
+            assert extract_audio('https://example.com/v', {'postprocessors': [1]}, str(tmp_path)) == \
+                (str(output), 'm4a')
+
+        opts = youtube_dl.call_args.args[0]
+        assert 'postprocessors' not in opts
+        assert opts['format'].startswith('bestaudio')
+        ydl.add_post_processor.assert_not_called()
+        ydl.extract_info.assert_called_once_with('https://example.com/v', download=False)
+
+    def test_opus_in_webm_is_remuxed(self, tmp_path):
+        (tmp_path / 'clip.opus').write_bytes(b'audio')
+        info = {'ext': 'webm', 'acodec': 'opus', 'vcodec': 'none'}
+        ydl = fake_ydl(tmp_path, info)
+
+        with patch('utils.audio_extractor.yt_dlp.YoutubeDL', return_value=ydl), \
+             patch('utils.audio_extractor.FFmpegExtractAudioPP') as extract_pp:
+            path, codec = extract_audio('https://example.com/v', {}, str(tmp_path))
+
+        assert (path, codec) == (str(tmp_path / 'clip.ogg'), 'opus')
+        assert extract_pp.call_args.kwargs['preferredcodec'] == 'opus'
+        ydl.add_post_processor.assert_called_once()
+
+    def test_unaccepted_codec_is_transcoded_to_mp3(self, tmp_path):
+        (tmp_path / 'clip.mp3').write_bytes(b'audio')
+        info = {'ext': 'mp4', 'acodec': 'mp4a.40.2', 'vcodec': 'avc1'}
+        ydl = fake_ydl(tmp_path, info)
+
+        with patch('utils.audio_extractor.yt_dlp.YoutubeDL', return_value=ydl), \
+             patch('utils.audio_extractor.FFmpegExtractAudioPP') as extract_pp:
+            path, codec = extract_audio('https://example.com/v', {}, str(tmp_path),
+                                        accepted_codecs=('opus',), mp3_quality='128')
+
+        assert (path, codec) == (str(tmp_path / 'clip.mp3'), 'mp3')
+        assert extract_pp.call_args.kwargs == {'preferredcodec': 'mp3', 'preferredquality': '128'}
@@ -0,0 +1,211 @@
+"""
+Тесты для фоновых рассылок и token bucket
+"""
+
+import sys
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    from telegram.error import BadRequest, Forbidden, RetryAfter, TimedOut
+    from services.broadcast import (
+        ADVANCE_JOB_SQL, LOAD_JOB_SQL, SAVE_DELIVERIES_SQL, START_JOB_SQL,
+        BroadcastEngine, BroadcastJob, LeaseLost, progress_text, send_content
+    )
+    from utils.rate_limit import TokenBucket
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+class FakeBot:
+    """Бот, отвечающий заданной последовательностью ошибок"""
+
+    def __init__(self, errors=None):
+        self.errors = dict(errors or {})
+        self.sent = []
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        queue = self.errors.get(chat_id)
+        if queue:
+            raise queue.pop(0)
+        self.sent.append((chat_id, text))
+
+    async def send_photo(self, chat_id, photo, caption=None, parse_mode=None):
+        self.sent.append((chat_id, photo))
+
+
+TEXT = {'content_type': 'text', 'text': 'hello', 'parse_mode': None}
+
+
+def make_engine(bot, rate=1000.0):
+    return BroadcastEngine(database=None, bot=bot, rate=rate, max_attempts=3)
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=50, capacity=5)
+    started = time.monotonic()
+    for _ in range(15):
+        await bucket.acquire()
+    # 5 токенов сразу, остальные 10 - по 50 в секунду
+    assert time.monotonic() - started >= 0.18
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_pause_blocks_all():
+    bucket = TokenBucket(rate=1000)
+    bucket.pause(0.1)
+    started = time.monotonic()
+    await asyncio.gather(bucket.acquire(), bucket.acquire())
+    assert time.monotonic() - started >= 0.1
+
+
+@pytest.mark.asyncio
+async def test_deliver_retries_after_flood_wait():
+    bot = FakeBot({1: [RetryAfter(0)]})
+    engine = make_engine(bot)
+
+    result = await engine.deliver(10, 1, TEXT)
+
+    assert result.status == 'sent'
+    assert result.attempts == 2
+    assert bot.sent == [(1, 'hello')]
+
+
+@pytest.mark.asyncio
+async def test_deliver_classifies_errors():
+    bot = FakeBot({
+        1: [Forbidden("Forbidden: bot was blocked by the user")],
+        2: [BadRequest("Chat not found")],
+    })
+    engine = make_engine(bot)
+
+    blocked = await engine.deliver(10, 1, TEXT)
+    failed = await engine.deliver(20, 2, TEXT)
+
+    assert blocked.status == 'blocked'
+    assert failed.status == 'failed'
+    assert bot.sent == []
+
+
+@pytest.mark.asyncio
+async def test_deliver_gives_up_after_max_attempts(monkeypatch):
+    async def no_sleep(_):
+        return None
+
+    monkeypatch.setattr('services.broadcast.asyncio.sleep', no_sleep)
+    bot = FakeBot({1: [TimedOut(), TimedOut(), TimedOut()]})
+    engine = make_engine(bot)
+
+    result = await engine.deliver(10, 1, TEXT)
+
+    assert result.status == 'failed'
+    assert result.attempts == 3
+
+
+@pytest.mark.asyncio
+async def test_send_content_media():
+    bot = FakeBot()
+    await send_content(bot, 5, {'content_type': 'photo', 'file_id': 'abc', 'caption': None})
+    assert bot.sent == [(5, 'abc')]
+
+
+def test_progress_text():
+    job = BroadcastJob(id=1, status='running', segment='all', content=TEXT, admin_chat_id=1,
+                       progress_message_id=2, total=200, sent=90, blocked=8, failed=2)
+    text = progress_text(job)
+    assert '100/200 (50.0%)' in text
+    assert 'Заблокировано: 8' in text
+
+
+class SlowBot(FakeBot):
+    """Бот, чьи отправки висят до release"""
+
+    def __init__(self):
+        super().__init__()
+        self.started = []
+        self.release = asyncio.Event()
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        self.started.append(chat_id)
+        await self.release.wait()
+        self.sent.append((chat_id, text))
+
+
+class FakeDatabase:
+    """Задание с владельцем: сохраненные страницы и выполненные запросы"""
+
+    def __init__(self, owned=True):
+        self.owned = owned
+        self.statements = []
+        self.saved = []
+
+    async def execute(self, query, params=None, fetch=False):
+        self.statements.append(query)
+        if query == START_JOB_SQL:
+            return [{'id': params['id']}] if self.owned else []
+        if query == ADVANCE_JOB_SQL:
+            if not self.owned:
+                return []
+            return [{'status': 'running', 'sent': params[0], 'blocked': params[1], 'failed': params[2]}]
+        if query == SAVE_DELIVERIES_SQL:
+            self.saved.extend(params[1])
+        return []
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield self
+
+
+def make_job():
+    return BroadcastJob(id=1, status='running', segment='all', content=TEXT, admin_chat_id=None,
+                        progress_message_id=None, total=4)
+
+
+@pytest.mark.asyncio
+async def test_stop_records_sends_in_flight():
+    bot = SlowBot()
+    database = FakeDatabase()
+    engine = BroadcastEngine(database=database, bot=bot, rate=1000.0, concurrency=2)
+    job = make_job()
+
+    page = asyncio.create_task(engine._process_page(job, [(1, 101), (2, 102), (3, 103), (4, 104)]))
+    while len(bot.started) < 2:
+        await asyncio.sleep(0.01)
+    # Остановка бота, пока две отправки еще идут
+    page.cancel()
+    asyncio.get_running_loop().call_later(0.05, bot.release.set)
+    with pytest.raises(asyncio.CancelledError):
+        await page
+
+    # Начатые отправки дождались и записали, оставшиеся не начинались
+    assert sorted(database.saved) == [1, 2]
+    assert sorted(chat_id for chat_id, _ in bot.sent) == [101, 102]
+    assert job.sent == 2
+    assert job.last_user_id == 0
+
+
+@pytest.mark.asyncio
+async def test_job_owned_elsewhere_is_not_run():
+    database = FakeDatabase(owned=False)
+    engine = BroadcastEngine(database=database, bot=FakeBot())
+
+    await engine._run(1)
+
+    assert LOAD_JOB_SQL not in database.statements
+
+
+@pytest.mark.asyncio
+async def test_lost_lease_rejects_page():
+    bot = FakeBot()
+    database = FakeDatabase(owned=False)
+    engine = BroadcastEngine(database=database, bot=bot, rate=1000.0)
+
+    with pytest.raises(LeaseLost):
+        await engine._process_page(make_job(), [(1, 101)])
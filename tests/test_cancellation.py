@@ -0,0 +1,142 @@
+"""
+Тесты для токенов отмены и очереди сжатия
+"""
+
+import sys
+import asyncio
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    from unittest.mock import patch
+    from utils.cancellation import (
+        CancellationRegistry, JobCancelled, cancel_user_jobs, subprocess_kwargs
+    )
+    from utils.queue_manager import QueueManager
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+class TestCancellationToken:
+    """Тесты токенов"""
+
+    def test_cancel_runs_callbacks_once(self):
+        registry = CancellationRegistry()
+        token = registry.create(1, 'download')
+        calls = []
+        token.add_callback(lambda: calls.append(1))
+
+        assert registry.cancel_user(1) == 1
+        assert token.cancelled
+        assert registry.cancel_user(1) == 0
+        assert calls == [1]
+
+        with pytest.raises(JobCancelled):
+            token.raise_if_cancelled()
+
+    def test_release(self):
+        registry = CancellationRegistry()
+        token = registry.create(1)
+        registry.release(token)
+
+        assert registry.active(1) == []
+        assert not token.cancelled
+
+    def test_ytdlp_hook_aborts(self):
+        token = CancellationRegistry().create(1)
+        token.ytdlp_hook({'status': 'downloading'})
+
+        token.cancel()
+        with pytest.raises(Exception):
+            token.ytdlp_hook({'status': 'downloading'})
+
+    @pytest.mark.asyncio
+    async def test_kills_process_group(self):
+        token = CancellationRegistry().create(1)
+        process = await asyncio.create_subprocess_exec('sleep', '30', **subprocess_kwargs())
+        token.register_process(process)
+
+        token.cancel()
+        await asyncio.wait_for(process.wait(), timeout=5)
+        assert process.returncode != 0
+
+    @pytest.mark.asyncio
+    async def test_cancels_attached_task(self):
+        token = CancellationRegistry().create(1)
+        task = asyncio.ensure_future(asyncio.sleep(30))
+        token.attach_task(task)
+
+        token.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+
+class TestQueueCancellation:
+    """Тесты отмены задач в очереди сжатия"""
+
+    @pytest.mark.asyncio
+    async def test_cancel_queued_and_running(self):
+        queue = QueueManager(max_concurrent_tasks=1, cpu_threshold=100.0)
+        started = asyncio.Event()
+
+        async def job():
+            started.set()
+            await asyncio.sleep(30)
+
+        await queue.add_task(user_id=1, task_func=job)
+        await queue.add_task(user_id=1, task_func=job)
+        await asyncio.wait_for(started.wait(), timeout=5)
+
+        assert queue.cancel_user_tasks(1) == 2
+        await asyncio.sleep(0.1)
+
+        assert queue.queue.qsize() == 0
+        assert 1 not in queue.user_tasks
+        assert queue.current_tasks == 0
+
+    @pytest.mark.asyncio
+    async def test_cancelled_queued_task_is_skipped(self):
+        queue = QueueManager(max_concurrent_tasks=1, cpu_threshold=100.0)
+        started = asyncio.Event()
+        calls = []
+
+        async def job(name):
+            calls.append(name)
+            started.set()
+            await asyncio.sleep(30)
+
+        await queue.add_task(1, job, 'running')
+        await queue.add_task(1, job, 'queued')
+        await asyncio.wait_for(started.wait(), timeout=5)
+
+        assert queue.get_queue_position(1) == 1
+        assert queue.cancel_user_tasks(1) == 2
+        assert queue.get_queue_position(1) == 0
+        await asyncio.sleep(0.1)
+
+        assert calls == ['running']
+
+    @pytest.mark.asyncio
+    async def test_job_with_token_is_counted_once(self):
+        registry = CancellationRegistry()
+        queue = QueueManager(max_concurrent_tasks=1, cpu_threshold=100.0)
+        started = asyncio.Event()
+
+        async def job(cancel_token=None):
+            started.set()
+            await asyncio.sleep(30)
+
+        await queue.add_task(1, job, cancel_token=registry.create(1, 'compress'))
+        await queue.add_task(1, job, cancel_token=registry.create(1, 'compress'))
+        await asyncio.wait_for(started.wait(), timeout=5)
+
+        with patch('utils.cancellation.job_registry', registry), \
+                patch('utils.queue_manager.compression_queue', queue):
+            assert cancel_user_jobs(1) == 2
+        await asyncio.sleep(0.1)
+
+        assert registry.active(1) == []
+        assert queue.current_tasks == 0
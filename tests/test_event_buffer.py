@@ -0,0 +1,163 @@
+"""
+Тесты для буфера событий аналитики
+"""
+
+import sys
+import asyncio
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    from database.event_buffer import EventBuffer, BufferedEvent
+    from database.user_cache import UserCache
+    from database.session_store import SessionStore
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+class FakeDatabase:
+    """БД, которая выполняет пачку синхронно и может падать по команде"""
+
+    def __init__(self):
+        self.fail = False
+        self.transactions = 0
+
+    async def run_in_transaction(self, func):
+        if self.fail:
+            raise ConnectionError("db is down")
+        self.transactions += 1
+        return func(MagicMock())
+
+
+def _event(tg_id=1, seconds=0):
+    ts = datetime(2024, 1, 1, 12, 0) + timedelta(seconds=seconds)
+    return BufferedEvent(tg_id=tg_id, username=f'user{tg_id}', ts=ts, event_type='command', command='/start')
+
+
+@pytest.fixture
+def statements():
+    """Перехватывает execute_values: [(sql, rows)]"""
+    calls = []
+
+    def fake_execute_values(cursor, sql, rows, page_size=100, fetch=False):
+        calls.append((sql, list(rows)))
+        if fetch:
+            return [(tg_id * 10, tg_id, 'ru', False) for tg_id, *_ in rows]
+        return None
+
+    with patch('database.event_buffer.execute_values', side_effect=fake_execute_values):
+        yield calls
+
+
+class TestFlush:
+    """Тесты пакетной записи"""
+
+    @pytest.mark.asyncio
+    async def test_batch_is_one_transaction(self, statements):
+        db = FakeDatabase()
+        sessions = SessionStore(db)
+        buffer = EventBuffer(db, batch_size=100, cache=UserCache(), sessions=sessions)
+        with patch.object(SessionStore, '_redis', return_value=None):
+            for i in range(5):
+                buffer.append(_event(tg_id=1 + i % 2, seconds=i))
+            assert await buffer.flush()
+
+        assert db.transactions == 1
+        assert len(buffer) == 0
+
+        users_sql, users = statements[0]
+        assert 'INSERT INTO users' in users_sql and len(users) == 2
+
+        # Сессии в БД не пишутся, пока не завершатся
+        assert not any('INSERT INTO sessions' in sql for sql, _ in statements)
+        assert sessions._local[1][3] == 3  # events
+
+        events_sql, events = statements[1]
+        assert 'INSERT INTO events' in events_sql
+        assert [row[0] for row in events] == [10, 20, 10, 20, 10]
+        assert events[0][4] == events[2][4] == sessions._local[1][0]
+
+    @pytest.mark.asyncio
+    async def test_last_seen_coalesced(self, statements):
+        db = FakeDatabase()
+        cache = UserCache(last_seen_interval=300)
+        buffer = EventBuffer(db, batch_size=100, cache=cache)
+
+        buffer.append(_event(tg_id=1))
+        await buffer.flush()
+        assert cache.get_local(1).id == 10
+
+        # Повторное событие в пределах интервала - users не трогаем
+        statements.clear()
+        buffer.append(_event(tg_id=1, seconds=5))
+        await buffer.flush()
+
+        assert not any('INSERT INTO users' in sql for sql, _ in statements)
+        events_sql, events = statements[-1]
+        assert events[0][0] == 10
+
+    @pytest.mark.asyncio
+    async def test_failed_flush_keeps_events(self, statements):
+        db = FakeDatabase()
+        db.fail = True
+        buffer = EventBuffer(db, batch_size=2, cache=UserCache())
+        for i in range(3):
+            buffer.append(_event(seconds=i))
+
+        assert not await buffer.flush()
+        assert len(buffer) == 3
+        assert buffer._events[0].ts < buffer._events[1].ts
+
+    @pytest.mark.asyncio
+    async def test_retry_does_not_recount_sessions(self, statements):
+        db = FakeDatabase()
+        db.fail = True
+        sessions = SessionStore(db)
+        buffer = EventBuffer(db, batch_size=10, cache=UserCache(), sessions=sessions)
+        with patch.object(SessionStore, '_redis', return_value=None):
+            buffer.append(_event())
+            assert not await buffer.flush()
+            db.fail = False
+            assert await buffer.flush()
+
+        assert sessions._local[1][3] == 1
+
+    @pytest.mark.asyncio
+    async def test_stop_is_lossless(self, statements):
+        db = FakeDatabase()
+        buffer = EventBuffer(db, batch_size=2, flush_interval=60, cache=UserCache())
+        buffer.start()
+        for i in range(5):
+            buffer.append(_event(seconds=i))
+
+        await buffer.stop()
+
+        assert len(buffer) == 0
+        assert buffer.flushed == 5
+
+    @pytest.mark.asyncio
+    async def test_background_flush_on_batch_size(self, statements):
+        db = FakeDatabase()
+        buffer = EventBuffer(db, batch_size=3, flush_interval=60, cache=UserCache())
+        buffer.start()
+        for i in range(3):
+            buffer.append(_event(seconds=i))
+
+        await asyncio.sleep(0.05)
+        assert buffer.flushed == 3
+        await buffer.stop()
+
+
+def test_overflow_drops_oldest():
+    buffer = EventBuffer(FakeDatabase(), max_size=2, cache=UserCache())
+    for i in range(3):
+        buffer.append(_event(seconds=i))
+
+    assert len(buffer) == 2
+    assert buffer.dropped == 1
+    assert buffer._events[0].ts == _event(seconds=1).ts
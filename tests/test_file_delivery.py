@@ -0,0 +1,160 @@
+"""
+Тесты для отправки результатов через локальный Bot API
+"""
+
+import os
+import sys
+import json
+from datetime import datetime
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    import config
+    from telegram import Chat, Message
+    from telegram.ext import Application
+    from telegram.request import BaseRequest
+    from utils.file_delivery import (
+        choose_kind, configure_local_bot_api, deliver_file, deliver_media_group, VIDEO_AS_DOCUMENT_LIMIT
+    )
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+@pytest.fixture
+def volume(tmp_path):
+    """Том Bot API, смонтированный у бота в tmp_path/mount"""
+    mount = tmp_path / 'mount'
+    mount.mkdir()
+    with patch.object(config, 'USE_LOCAL_BOT_API', True), \
+         patch.object(config, 'LOCAL_BOT_API_DATA_DIR', '/var/lib/telegram-bot-api'), \
+         patch.object(config, 'LOCAL_BOT_API_MOUNT_DIR', str(mount)):
+        yield mount
+
+
+def _message():
+    message = MagicMock()
+    for method in ('reply_video', 'reply_photo', 'reply_audio', 'reply_document', 'reply_media_group'):
+        setattr(message, method, AsyncMock())
+    return message
+
+
+class RecordingRequest(BaseRequest):
+    """Запросы к Bot API без сети: запоминает их и отвечает отправленным сообщением"""
+
+    def __init__(self):
+        self.calls = []
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        self.calls.append((url, request_data))
+        result = {'message_id': 2, 'date': 0, 'chat': {'id': 1, 'type': 'private'}}
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class TestChooseKind:
+    """Тесты выбора способа отправки"""
+
+    def test_by_extension(self, tmp_path):
+        for name, kind in [('a.mp4', 'video'), ('a.jpg', 'photo'), ('a.m4a', 'audio'), ('a.zip', 'document')]:
+            (tmp_path / name).write_bytes(b'x')
+            assert choose_kind(str(tmp_path / name)) == kind
+
+    def test_large_video_as_document(self, tmp_path):
+        path = tmp_path / 'big.mp4'
+        with open(path, 'wb') as f:
+            f.truncate(VIDEO_AS_DOCUMENT_LIMIT + 1)
+        assert choose_kind(str(path), 'video') == 'document'
+
+
+class TestDeliverFile:
+    """Тесты выбора между file:// и multipart"""
+
+    @pytest.mark.asyncio
+    async def test_file_on_volume_sent_by_path(self, volume):
+        path = volume / '.bot_jobs' / 'job_1' / 'result.zip'
+        path.parent.mkdir(parents=True)
+        path.write_bytes(b'zip')
+        message = _message()
+
+        await deliver_file(message, str(path), kind='document')
+
+        document = message.reply_document.call_args.kwargs['document']
+        assert document == 'file:///var/lib/telegram-bot-api/.bot_jobs/job_1/result.zip'
+
+    @pytest.mark.asyncio
+    async def test_renamed_file_is_staged_and_removed(self, volume):
+        path = volume / 'result.zip'
+        path.write_bytes(b'zip')
+        message = _message()
+
+        await deliver_file(message, str(path), kind='document', filename='unique_files_3.zip')
+
+        document = message.reply_document.call_args.kwargs['document']
+        assert document.startswith('file:///var/lib/telegram-bot-api/.bot_jobs/outgoing/')
+        assert document.endswith('/unique_files_3.zip')
+        assert os.listdir(volume / '.bot_jobs' / 'outgoing') == []
+
+    @pytest.mark.asyncio
+    async def test_multipart_fallback(self, tmp_path):
+        path = tmp_path / 'clip.mp4'
+        path.write_bytes(b'video')
+        message = _message()
+
+        with patch.object(config, 'USE_LOCAL_BOT_API', False):
+            kind = await deliver_file(message, str(path))
+
+        assert kind == 'video'
+        assert hasattr(message.reply_video.call_args.kwargs['video'], 'read')
+
+
+class TestLocalModeBot:
+    """Отправка через настоящий telegram.Bot, собранный как в main.py"""
+
+    @pytest.mark.asyncio
+    async def test_file_uri_accepted_by_bot(self, volume):
+        path = volume / '.bot_jobs' / 'job_1' / 'result.zip'
+        path.parent.mkdir(parents=True)
+        path.write_bytes(b'zip')
+        request = RecordingRequest()
+
+        with patch.object(config, 'BOT_TOKEN', '123:abc'):
+            builder = Application.builder().token(config.BOT_TOKEN).request(request)
+            application = configure_local_bot_api(builder).build()
+        message = Message(1, datetime.now(), Chat(1, Chat.PRIVATE))
+        message.set_bot(application.bot)
+
+        assert await deliver_file(message, str(path), kind='document') == 'document'
+
+        url, request_data = request.calls[-1]
+        assert url == 'http://localhost:8081/bot123:abc/sendDocument'
+        assert request_data.parameters['document'] == 'file:///var/lib/telegram-bot-api/.bot_jobs/job_1/result.zip'
+        assert not request_data.contains_files
+
+
+@pytest.mark.asyncio
+async def test_media_group(volume):
+    paths = []
+    for i in range(3):
+        path = volume / f'copy_{i}.jpg'
+        path.write_bytes(b'img')
+        paths.append(str(path))
+    message = _message()
+
+    assert await deliver_media_group(message, paths, caption='done')
+    media = message.reply_media_group.call_args.kwargs['media']
+    assert len(media) == 3
+    assert await deliver_media_group(message, paths[:1]) is False
@@ -0,0 +1,99 @@
+"""
+Тесты для приемки файлов с локального Bot API
+"""
+
+import os
+import sys
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    import config
+    from utils.file_intake import resolve_local_path, link_or_copy, intake_telegram_file
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+@pytest.fixture
+def bot_api_dir(tmp_path):
+    """Имитация тома telegram-bot-api, смонтированного в другой каталог"""
+    mount = tmp_path / 'mount'
+    (mount / 'TOKEN' / 'videos').mkdir(parents=True)
+    (mount / 'TOKEN' / 'videos' / 'file_1.mp4').write_bytes(b'video-data')
+
+    with patch.object(config, 'USE_LOCAL_BOT_API', True), \
+         patch.object(config, 'LOCAL_BOT_API_DATA_DIR', '/var/lib/telegram-bot-api'), \
+         patch.object(config, 'LOCAL_BOT_API_MOUNT_DIR', str(mount)):
+        yield mount
+
+
+class TestResolveLocalPath:
+    """Тесты сопоставления путей сервера и бота"""
+
+    def test_absolute_server_path(self, bot_api_dir):
+        path = resolve_local_path('/var/lib/telegram-bot-api/TOKEN/videos/file_1.mp4')
+        assert path == Path(os.path.realpath(bot_api_dir / 'TOKEN' / 'videos' / 'file_1.mp4'))
+
+    def test_path_with_base_file_url(self, bot_api_dir):
+        url = 'http://telegram-bot-api:8081/botTOKEN//var/lib/telegram-bot-api/TOKEN/videos/file_1.mp4'
+        assert resolve_local_path(url) is not None
+
+    def test_missing_or_foreign_path(self, bot_api_dir):
+        assert resolve_local_path('/var/lib/telegram-bot-api/TOKEN/videos/nope.mp4') is None
+        assert resolve_local_path('https://api.telegram.org/file/botX/videos/file_1.mp4') is None
+        assert resolve_local_path('/var/lib/telegram-bot-api/../../etc/passwd') is None
+        assert resolve_local_path(None) is None
+
+
+def test_link_or_copy_hardlink(tmp_path):
+    source = tmp_path / 'source.mp4'
+    source.write_bytes(b'data')
+    destination = tmp_path / 'job' / 'input.mp4'
+    destination.parent.mkdir()
+
+    assert link_or_copy(source, destination) == 'hardlink'
+    assert os.stat(source).st_ino == os.stat(destination).st_ino
+
+
+def test_link_or_copy_falls_back_to_copy(tmp_path):
+    source = tmp_path / 'source.mp4'
+    source.write_bytes(b'data')
+    destination = tmp_path / 'input.mp4'
+
+    with patch('os.link', side_effect=OSError(18, 'EXDEV')), \
+         patch('utils.file_intake._reflink', side_effect=OSError(95, 'ENOTSUP')):
+        assert link_or_copy(source, destination) == 'copy'
+    assert destination.read_bytes() == b'data'
+
+
+class TestIntake:
+    """Тесты выбора способа приемки"""
+
+    @pytest.mark.asyncio
+    async def test_local_file_is_linked(self, bot_api_dir, tmp_path):
+        file = MagicMock(file_path='/var/lib/telegram-bot-api/TOKEN/videos/file_1.mp4')
+        file.download_to_drive = AsyncMock()
+        destination = tmp_path / 'job' / 'input.mp4'
+
+        method = await intake_telegram_file(None, 'file-id', destination, file=file)
+
+        assert method in ('hardlink', 'reflink', 'copy')
+        assert destination.read_bytes() == b'video-data'
+        file.download_to_drive.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_http_fallback(self, tmp_path):
+        file = MagicMock(file_path='https://api.telegram.org/file/botX/videos/file_1.mp4')
+        file.download_to_drive = AsyncMock()
+        bot = MagicMock()
+        bot.get_file = AsyncMock(return_value=file)
+
+        with patch.object(config, 'USE_LOCAL_BOT_API', False):
+            method = await intake_telegram_file(bot, 'file-id', tmp_path / 'input.mp4')
+
+        assert method == 'http'
+        file.download_to_drive.assert_awaited_once()
@@ -137,6 +137,14 @@ class TestKeitaroDuplication:
 class TestKeitaroRouting:
     """Тесты маршрутизации событий"""
     
+    @pytest.fixture(autouse=True)
+    def clear_route_cache(self):
+        """Правила кэшируются по id профиля - у каждого теста свои"""
+        from features.keitaro.routing import route_cache
+        route_cache.invalidate()
+        yield
+        route_cache.invalidate()
+    
     @pytest.fixture
     def mock_db(self):
         """Мок базы данных"""
@@ -242,7 +250,8 @@ class TestKeitaroRouting:
 class TestKeitaroRateLimit:
     """Тесты rate limiting"""
     
-    def test_rate_limit_basic(self):
+    @pytest.mark.asyncio
+    async def test_rate_limit_basic(self):
         """Базовый тест rate limit"""
         from web_server import KeitaroWebServer
         from telegram import Bot
@@ -256,14 +265,14 @@ class TestKeitaroRateLimit:
         
         # Первые 3 запроса должны пройти
         for i in range(3):
-            assert server._check_rate_limit(profile_id, max_rps) is True
+            assert await server._check_rate_limit(profile_id, max_rps) is True
         
         # 4-й запрос должен быть заблокирован
-        assert server._check_rate_limit(profile_id, max_rps) is False
+        assert await server._check_rate_limit(profile_id, max_rps) is False
     
-    def test_rate_limit_time_window(self):
+    @pytest.mark.asyncio
+    async def test_rate_limit_time_window(self):
         """Тест временного окна rate limit"""
-        import time
         from web_server import KeitaroWebServer
         from telegram import Bot
         
@@ -275,15 +284,33 @@ class TestKeitaroRateLimit:
         max_rps = 2
         
         # Заполняем лимит
-        assert server._check_rate_limit(profile_id, max_rps) is True
-        assert server._check_rate_limit(profile_id, max_rps) is True
-        assert server._check_rate_limit(profile_id, max_rps) is False
+        assert await server._check_rate_limit(profile_id, max_rps) is True
+        assert await server._check_rate_limit(profile_id, max_rps) is True
+        assert await server._check_rate_limit(profile_id, max_rps) is False
         
         # Ждем > 1 секунды
-        time.sleep(1.1)
+        await asyncio.sleep(1.1)
         
         # Теперь должно снова работать
-        assert server._check_rate_limit(profile_id, max_rps) is True
+        assert await server._check_rate_limit(profile_id, max_rps) is True
+    
+    @pytest.mark.asyncio
+    async def test_rate_limit_shared_between_replicas(self):
+        """Лимит профиля общий для всех реплик (корзина в Redis)"""
+        fakeredis = pytest.importorskip('fakeredis')
+        from unittest.mock import patch
+        from web_server import KeitaroWebServer
+        from utils.rate_limit import RateLimiter
+        from telegram import Bot
+        
+        redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+        replicas = [KeitaroWebServer(Mock(spec=Bot), Mock(), 8080) for _ in range(2)]
+        
+        with patch.object(RateLimiter, '_redis', return_value=redis):
+            results = [await replicas[i % 2]._check_rate_limit(3, 4) for i in range(6)]
+        
+        assert results == [True] * 4 + [False] * 2
+        assert await redis.exists('ratelimit:keitaro:profile:3')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,116 @@
+"""
+Тесты для дедупликации postback Keitaro
+"""
+
+import sys
+import asyncio
+from pathlib import Path
+from unittest.mock import AsyncMock
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    import fakeredis
+    import pytest_asyncio  # noqa: F401
+    from features.keitaro.dedup import PostbackDeduplicator
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeAsyncRedis(decode_responses=True)
+
+
+@pytest.fixture
+def database():
+    db = AsyncMock()
+    db.execute.return_value = []
+    return db
+
+
+class TestRedisClaim:
+    """Захват tx_id через SET NX"""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_retries_claim_once(self, redis, database):
+        replicas = [PostbackDeduplicator(database, redis=redis) for _ in range(3)]
+
+        results = await asyncio.gather(*(
+            replicas[i % 3].claim(1, 'tx1', 3600) for i in range(10)
+        ))
+
+        assert sum(results) == 1
+        assert 0 < await redis.ttl('keitaro:dedup:1:tx1') <= 3600
+        # Короткое окно - без запросов к БД
+        database.execute.assert_not_awaited()
+
+    @pytest.mark.asyncio
+    async def test_profiles_are_independent(self, redis, database):
+        dedup = PostbackDeduplicator(database, redis=redis)
+
+        assert await dedup.claim(1, 'tx1', 3600)
+        assert await dedup.claim(2, 'tx1', 3600)
+        assert not await dedup.claim(2, 'tx1', 3600)
+
+    @pytest.mark.asyncio
+    async def test_released_claim_can_be_retried(self, redis, database):
+        dedup = PostbackDeduplicator(database, redis=redis)
+
+        assert await dedup.claim(1, 'tx1', 3600)
+        # Обработка не удалась - повтор Keitaro должен пройти
+        await dedup.release(1, 'tx1')
+        assert await dedup.claim(1, 'tx1', 3600)
+        assert not await dedup.claim(1, 'tx1', 3600)
+
+
+class TestBloomWindow:
+    """Окно длиннее жизни ключа"""
+
+    @pytest.mark.asyncio
+    async def test_new_event_skips_database(self, redis, database):
+        dedup = PostbackDeduplicator(database, redis=redis, max_key_ttl=60)
+
+        assert await dedup.claim(1, 'tx1', 600)
+
+        assert await redis.ttl('keitaro:dedup:1:tx1') <= 60
+        assert await redis.ttl(dedup.bloom_keys(600)[0]) > 600
+        database.execute.assert_not_awaited()
+
+    @pytest.mark.asyncio
+    async def test_expired_key_is_confirmed_in_database(self, redis, database):
+        dedup = PostbackDeduplicator(database, redis=redis, max_key_ttl=60)
+        assert await dedup.claim(1, 'tx1', 600)
+        # Ключ истек, бит в bloom-фильтре остался
+        await redis.delete('keitaro:dedup:1:tx1')
+
+        database.execute.return_value = [{'id': 5}]
+        assert not await dedup.claim(1, 'tx1', 600)
+
+        await redis.delete('keitaro:dedup:1:tx1')
+        database.execute.return_value = []  # ложное срабатывание фильтра
+        assert await dedup.claim(1, 'tx1', 600)
+
+    def test_bloom_keys_cover_window(self):
+        dedup = PostbackDeduplicator(max_key_ttl=100)
+
+        assert dedup.bloom_keys(250, now=1050) == [
+            'keitaro:dedup:bloom:10', 'keitaro:dedup:bloom:9',
+            'keitaro:dedup:bloom:8', 'keitaro:dedup:bloom:7'
+        ]
+
+
+class TestDatabaseFallback:
+    """Без Redis - поиск в keitaro_events"""
+
+    @pytest.mark.asyncio
+    async def test_redis_error_falls_back_to_database(self, database):
+        broken = AsyncMock()
+        broken.set.side_effect = ConnectionError("redis down")
+        dedup = PostbackDeduplicator(database, redis=broken)
+
+        assert await dedup.claim(1, 'tx1', 3600)
+        database.execute.return_value = [{'id': 1}]
+        assert not await dedup.claim(1, 'tx1', 3600)
@@ -0,0 +1,300 @@
+"""
+Тесты для очереди доставки событий Keitaro
+"""
+
+import sys
+import asyncio
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    import fakeredis
+    import pytest_asyncio  # noqa: F401
+    from aiohttp.test_utils import TestClient, TestServer
+    from telegram.error import BadRequest, RetryAfter, TimedOut
+    from features.keitaro.dedup import PostbackDeduplicator
+    from features.keitaro.delivery import DeliveryQueue, QueuedEvent
+    from web_server import KeitaroWebServer
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+class FakeDatabase:
+    """Запоминает строки многострочных INSERT"""
+
+    def __init__(self):
+        self.rows = []
+        self.inserts = 0
+
+    async def run_in_transaction(self, func):
+        return func(MagicMock())
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeAsyncRedis(decode_responses=True)
+
+
+@pytest.fixture
+def database():
+    db = FakeDatabase()
+
+    def _execute_values(cursor, sql, rows, page_size=100):
+        db.inserts += 1
+        db.rows.extend(rows)
+
+    with patch('features.keitaro.delivery.execute_values', side_effect=_execute_values):
+        yield db
+
+
+@pytest.fixture
+def bot():
+    return AsyncMock()
+
+
+def event(tx_id, chat_id=-100, status='deposit'):
+    data = {'status': status, 'transaction_id': tx_id, 'campaign_name': 'C', 'conversion_revenue': '10'}
+    return QueuedEvent(1, tx_id, data, chat_id)
+
+
+def make_queue(bot, database, redis, **kwargs):
+    kwargs.setdefault('rate', 1000)
+    return DeliveryQueue(bot, database, redis=redis, **kwargs)
+
+
+class TestDelivery:
+    """Отправка из Redis Stream"""
+
+    @pytest.mark.asyncio
+    async def test_single_event_is_sent_saved_and_acked(self, bot, database, redis):
+        queue = make_queue(bot, database, redis)
+        await queue.enqueue(event('tx1'))
+
+        assert await queue.run_once(block=0) == 1
+
+        bot.send_message.assert_awaited_once()
+        assert 'TX: <code>tx1</code>' in bot.send_message.await_args.kwargs['text']
+        assert [row[1] for row in database.rows] == ['tx1'] and database.rows[0][7] is True
+        assert await redis.xlen('keitaro:delivery') == 0
+        assert (await redis.xpending('keitaro:delivery', 'delivery'))['pending'] == 0
+
+    @pytest.mark.asyncio
+    async def test_burst_is_coalesced_per_chat(self, bot, database, redis):
+        queue = make_queue(bot, database, redis)
+        for i in range(5):
+            await queue.enqueue(event(f'a{i}', chat_id=-1))
+        await queue.enqueue(event('b0', chat_id=-2))
+
+        assert await queue.run_once(block=0) == 6
+
+        texts = {call.kwargs['chat_id']: call.kwargs['text'] for call in bot.send_message.await_args_list}
+        assert bot.send_message.await_count == 2
+        assert texts[-1].startswith('📦 <b>Сводка: 5</b>') and texts[-1].count('💰') == 5
+        # Все строки журнала - одним INSERT
+        assert database.inserts == 1 and len(database.rows) == 6
+
+    @pytest.mark.asyncio
+    async def test_chat_limit_holds_events_until_next_slot(self, bot, database, redis):
+        queue = make_queue(bot, database, redis, chat_rate='1/60')
+        await queue.enqueue(event('tx1'))
+        await queue.run_once(block=0)
+
+        for i in range(3):
+            await queue.enqueue(event(f'later{i}'))
+        assert await queue.run_once(block=0) == 0
+
+        assert bot.send_message.await_count == 1
+        assert queue.pending_count == 3
+        # Не подтверждены - после падения их заберет другой обработчик
+        assert (await redis.xpending('keitaro:delivery', 'delivery'))['pending'] == 3
+
+        await redis.delete('ratelimit:keitaro:chat:-100')  # наступил следующий слот
+        assert await queue.run_once(block=0) == 3
+        assert bot.send_message.await_count == 2
+
+    @pytest.mark.asyncio
+    async def test_retry_after_keeps_events_queued(self, bot, database, redis):
+        bot.send_message.side_effect = [RetryAfter(0), None]
+        queue = make_queue(bot, database, redis)
+        await queue.enqueue(event('tx1'))
+
+        assert await queue.run_once(block=0) == 0
+        assert queue.pending_count == 1
+        assert database.rows == []
+
+        await redis.delete('ratelimit:keitaro:chat:-100')
+        assert await queue.run_once(block=0) == 1
+
+    @pytest.mark.asyncio
+    async def test_send_failure_is_recorded(self, bot, database, redis):
+        bot.send_message.side_effect = BadRequest("Chat not found")
+        queue = make_queue(bot, database, redis)
+        await queue.enqueue(event('tx1'))
+
+        await queue.run_once(block=0)
+
+        assert database.rows[0][7] is False and database.rows[0][10] == 'Chat not found'
+        assert await redis.xlen('keitaro:delivery') == 0
+
+    @pytest.mark.asyncio
+    async def test_timeout_is_retried_not_acked(self, bot, database, redis):
+        bot.send_message.side_effect = [TimedOut(), None]
+        queue = make_queue(bot, database, redis)
+        await queue.enqueue(event('tx1'))
+
+        assert await queue.run_once(block=0) == 0
+        assert queue.pending_count == 1 and database.rows == []
+        assert (await redis.xpending('keitaro:delivery', 'delivery'))['pending'] == 1
+
+        await redis.delete('ratelimit:keitaro:chat:-100')
+        assert await queue.run_once(block=0) == 1
+        assert database.rows[0][7] is True
+        assert await redis.xlen('keitaro:delivery') == 0
+
+    @pytest.mark.asyncio
+    async def test_retries_are_bounded(self, bot, database, redis):
+        bot.send_message.side_effect = TimedOut()
+        queue = make_queue(bot, database, redis, max_attempts=3)
+        await queue.enqueue(event('tx1'))
+
+        for _ in range(3):
+            await redis.delete('ratelimit:keitaro:chat:-100')
+            await queue.run_once(block=0)
+
+        assert bot.send_message.await_count == 3
+        assert queue.pending_count == 0
+        assert database.rows[0][7] is False and database.rows[0][10] == 'Timed out'
+        assert await redis.xlen('keitaro:delivery') == 0
+
+    @pytest.mark.asyncio
+    async def test_partial_digest_requeues_only_unsent(self, bot, database, redis):
+        # Каждое событие занимает отдельное сообщение сводки
+        bot.send_message.side_effect = [None, TimedOut(), None]
+        queue = make_queue(bot, database, redis)
+        for i in range(3):
+            queued = event(f'tx{i}')
+            queued.event_data['campaign_name'] = 'C' * 2500
+            await queue.enqueue(queued)
+
+        assert await queue.run_once(block=0) == 1
+        assert [(row[1], row[7]) for row in database.rows] == [('tx0', True)]
+        assert queue.pending_count == 2
+        assert (await redis.xpending('keitaro:delivery', 'delivery'))['pending'] == 2
+
+        await redis.delete('ratelimit:keitaro:chat:-100')
+        bot.send_message.side_effect = None
+        assert await queue.run_once(block=0) == 2
+        assert [row[1] for row in database.rows] == ['tx0', 'tx1', 'tx2']
+        assert await redis.xlen('keitaro:delivery') == 0
+
+    @pytest.mark.asyncio
+    async def test_entries_of_dead_consumer_are_claimed(self, bot, database, redis):
+        dead = make_queue(bot, database, redis)
+        dead.consumer = 'dead'
+        await dead.enqueue(event('tx1'))
+        await dead._read(block=0)  # прочитал и упал, не подтвердив
+
+        queue = make_queue(bot, database, redis, claim_idle=0)
+        assert await queue.run_once(block=0) == 1
+        assert (await redis.xpending('keitaro:delivery', 'delivery'))['pending'] == 0
+
+    @pytest.mark.asyncio
+    async def test_held_entries_stay_with_live_consumer(self, bot, database, redis):
+        queue = make_queue(bot, database, redis, chat_rate='1/60', claim_idle=0.3)
+        queue.consumer = 'live'
+        await queue.enqueue(event('tx1'))
+        await queue.run_once(block=0)
+        await queue.enqueue(event('held'))
+        await queue.run_once(block=0)
+
+        await asyncio.sleep(0.4)
+        # Чат все еще ждет лимита - обработчик продлевает событие за собой
+        assert await queue.run_once(block=0) == 0
+        other = make_queue(bot, database, redis, chat_rate='1/60', claim_idle=0.3)
+        assert await other.run_once(block=0) == 0
+        assert other.pending_count == 0 and queue.pending_count == 1
+
+        # Если событие все же забрали, прежний обработчик его забывает
+        thief = make_queue(bot, database, redis, chat_rate='1/60', claim_idle=0)
+        await thief.run_once(block=0)
+        assert thief.pending_count == 1
+        queue._last_refresh = 0.0
+        await queue.run_once(block=0)
+        assert queue.pending_count == 0
+        assert bot.send_message.await_count == 1
+
+    @pytest.mark.asyncio
+    async def test_reading_stops_at_max_pending(self, bot, database, redis):
+        queue = make_queue(bot, database, redis, chat_rate='1/60', max_pending=2)
+        await queue.enqueue(event('tx1'))
+        await queue.run_once(block=0)
+
+        for i in range(5):
+            await queue.enqueue(event(f'later{i}'))
+        await queue.run_once(block=0)
+        await queue.run_once(block=0)
+
+        assert queue.pending_count == 2
+        # Остальные ждут в потоке непрочитанными
+        assert (await redis.xpending('keitaro:delivery', 'delivery'))['pending'] == 2
+        assert await redis.xlen('keitaro:delivery') == 5
+
+    @pytest.mark.asyncio
+    async def test_in_memory_queue_without_redis(self, bot, database):
+        queue = make_queue(bot, database, None)
+        with patch.object(DeliveryQueue, '_redis', return_value=None):
+            await queue.enqueue(event('tx1'))
+            assert await queue.run_once(block=0) == 1
+        bot.send_message.assert_awaited_once()
+
+
+class TestPostbackAck:
+    """Postback подтверждается до отправки"""
+
+    @pytest.mark.asyncio
+    async def test_postback_is_queued_not_sent(self, bot, database, redis):
+        profile = MagicMock(id=1, enabled=True, rate_limit_rps=100, dedup_ttl_sec=3600)
+        route_cache = MagicMock()
+        route_cache.profile = AsyncMock(return_value=profile)
+        route_cache.table = AsyncMock(return_value=MagicMock(route=MagicMock(return_value=(-100, None))))
+        dedup = MagicMock(claim=AsyncMock(return_value=True))
+        queue = make_queue(bot, database, redis)
+        server = KeitaroWebServer(bot, MagicMock(), route_cache=route_cache, dedup=dedup, delivery=queue)
+
+        async with TestClient(TestServer(server.app)) as client:
+            response = await client.post(
+                '/integrations/keitaro/postback?secret=s',
+                data={'status': 'deposit', 'transaction_id': 'tx9'}
+            )
+            body = await response.json()
+
+        assert body == {'ok': True, 'queued': True}
+        bot.send_message.assert_not_awaited()
+        assert await redis.xlen('keitaro:delivery') == 1
+
+    @pytest.mark.asyncio
+    async def test_failed_enqueue_releases_tx_id(self, bot, redis):
+        profile = MagicMock(id=1, enabled=True, rate_limit_rps=100, dedup_ttl_sec=3600)
+        route_cache = MagicMock()
+        route_cache.profile = AsyncMock(return_value=profile)
+        route_cache.table = AsyncMock(return_value=MagicMock(route=MagicMock(return_value=(-100, None))))
+        delivery = MagicMock(enqueue=AsyncMock(side_effect=[ConnectionError("redis down"), None]))
+        server = KeitaroWebServer(bot, MagicMock(), route_cache=route_cache,
+                                  dedup=PostbackDeduplicator(redis=redis), delivery=delivery)
+
+        async with TestClient(TestServer(server.app)) as client:
+            bodies = []
+            for _ in range(2):
+                response = await client.post(
+                    '/integrations/keitaro/postback?secret=s',
+                    data={'status': 'deposit', 'transaction_id': 'tx9'}
+                )
+                bodies.append(await response.json())
+
+        # Повтор после ошибки не считается дубликатом
+        assert bodies == [{'ok': False, 'error': 'internal_error'}, {'ok': True, 'queued': True}]
+        assert delivery.enqueue.await_count == 2
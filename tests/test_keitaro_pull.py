@@ -0,0 +1,234 @@
+"""
+Тесты для pull-режима Keitaro (отчет конверсий вместо postback)
+"""
+
+import sys
+import asyncio
+from datetime import datetime
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    import fakeredis
+    import pytest_asyncio  # noqa: F401
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    from features.keitaro.dedup import PostbackDeduplicator
+    from features.keitaro.pull import CURSOR_SQL, KeitaroPullSync, build_filters
+    from features.keitaro.routing import profile_from_row
+    from web_server import KeitaroWebServer
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+UNTIL = datetime(2024, 5, 1, 12, 0, 0)
+
+
+def conversion(i, status='sale', minute=0):
+    return {
+        'postback_datetime': f'2024-05-01 11:{minute:02d}:{i % 60:02d}',
+        'tid': f'tx{i}', 'sub_id': f'click{i}', 'status': status,
+        'campaign_id': 7, 'campaign': 'Camp', 'offer': 'Offer', 'revenue': 12.5,
+        'country': 'DE', 'source': None,
+    }
+
+
+class KeitaroStandIn:
+    """Локальная замена Admin API Keitaro: журнал конверсий с пагинацией"""
+
+    def __init__(self, rows, api_key='key', delay=0.0):
+        self.rows = rows
+        self.api_key = api_key
+        self.delay = delay
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.app = web.Application()
+        self.app.router.add_post('/admin_api/v1/conversions/log', self.handle)
+
+    async def handle(self, request):
+        if request.headers.get('Api-Key') != self.api_key:
+            return web.json_response({'error': 'Unauthorized'}, status=401)
+        body = await request.json()
+        self.requests.append(body)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+
+        since, until = body['range']['from'], body['range']['to']
+        rows = [row for row in self.rows if since <= row['postback_datetime'] <= until]
+        for item in body['filters']:
+            rows = [row for row in rows if row[item['name']] in item['expression']]
+        rows.sort(key=lambda row: row['postback_datetime'])
+        page = rows[body['offset']:body['offset'] + body['limit']]
+        return web.json_response({'rows': page, 'total': len(rows)})
+
+
+class FakeDatabase:
+    """Профили keitaro_profiles и сохраненные курсоры"""
+
+    def __init__(self, profiles):
+        self.profiles = profiles
+        self.cursors = []
+
+    async def execute(self, query, params=None, fetch=False):
+        if query == CURSOR_SQL:
+            self.cursors.append((params[1], params[0]))
+            return None
+        return [dict(profile) for profile in self.profiles]
+
+
+def profile_row(profile_id, base_url, **kwargs):
+    row = {
+        'id': profile_id, 'enabled': True, 'pull_enabled': True, 'pull_base_url': base_url,
+        'pull_api_key': 'key', 'pull_filters': None, 'pull_last_check': None,
+        'dedup_ttl_sec': 3600, 'default_chat_id': -100, 'default_topic_id': None,
+    }
+    row.update(kwargs)
+    return row
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeAsyncRedis(decode_responses=True)
+
+
+def make_sync(database, redis, **kwargs):
+    route_cache = MagicMock()
+    route_cache.table = AsyncMock(return_value=MagicMock(route=MagicMock(return_value=(-100, None))))
+    server = KeitaroWebServer(
+        AsyncMock(), database, route_cache=route_cache,
+        dedup=PostbackDeduplicator(database, redis=redis),
+        delivery=MagicMock(enqueue=AsyncMock())
+    )
+    kwargs.setdefault('page_size', 2)
+    return KeitaroPullSync(server, redis=redis, **kwargs)
+
+
+def queued(sync):
+    return [call.args[0] for call in sync.server.delivery.enqueue.await_args_list]
+
+
+class TestPull:
+    """Выгрузка отчета"""
+
+    @pytest.mark.asyncio
+    async def test_pages_are_queued_and_cursor_saved(self, redis):
+        api = KeitaroStandIn([conversion(i) for i in range(5)])
+        async with TestServer(api.app) as server:
+            database = FakeDatabase([profile_row(1, str(server.make_url('')))])
+            sync = make_sync(database, redis)
+            profile = await self._profile(database)
+
+            assert await sync.sync_profile(profile, until=UNTIL) == 5
+            await sync.stop()
+
+        events = queued(sync)
+        assert [event.tx_id for event in events] == [f'tx{i}' for i in range(5)]
+        assert events[0].event_data['campaign_name'] == 'Camp'
+        assert events[0].event_data['conversion_revenue'] == '12.5'
+        assert events[0].chat_id == -100
+        # 5 строк по 2 на страницу
+        assert [body['offset'] for body in api.requests] == [0, 2, 4]
+        assert api.requests[0]['range']['from'] == '2024-05-01 11:00:00'
+        assert database.cursors[-1] == (1, UNTIL)
+
+    @pytest.mark.asyncio
+    async def test_next_run_starts_from_cursor(self, redis):
+        api = KeitaroStandIn([conversion(i) for i in range(3)])
+        async with TestServer(api.app) as server:
+            database = FakeDatabase([profile_row(1, str(server.make_url('')),
+                                                 pull_last_check=datetime(2024, 5, 1, 11, 30))])
+            sync = make_sync(database, redis, overlap=60)
+            profile = await self._profile(database)
+
+            assert await sync.sync_profile(profile, until=UNTIL) == 0
+            await sync.stop()
+
+        assert api.requests[0]['range']['from'] == '2024-05-01 11:29:00'
+
+    @pytest.mark.asyncio
+    async def test_conversions_seen_by_postback_are_skipped(self, redis):
+        api = KeitaroStandIn([conversion(i) for i in range(3)])
+        async with TestServer(api.app) as server:
+            database = FakeDatabase([profile_row(1, str(server.make_url('')))])
+            sync = make_sync(database, redis)
+            # tx1 уже пришел postback
+            assert await sync.server.dedup.claim(1, 'tx1', 3600)
+            profile = await self._profile(database)
+
+            assert await sync.sync_profile(profile, until=UNTIL) == 2
+            # Окно повторного запроса перекрывается - повторов нет
+            assert await sync.sync_profile(profile, until=UNTIL) == 0
+            await sync.stop()
+
+        assert [event.tx_id for event in queued(sync)] == ['tx0', 'tx2']
+
+    @pytest.mark.asyncio
+    async def test_failed_enqueue_is_retried_next_run(self, redis):
+        api = KeitaroStandIn([conversion(i) for i in range(3)])
+        async with TestServer(api.app) as server:
+            database = FakeDatabase([profile_row(1, str(server.make_url('')))])
+            sync = make_sync(database, redis, page_size=10)
+            sync.server.delivery.enqueue.side_effect = [None, ConnectionError("redis down"), None, None, None]
+            profile = await self._profile(database)
+
+            with pytest.raises(ConnectionError):
+                await sync.sync_profile(profile, until=UNTIL)
+            # tx1 отпущен - следующая выгрузка ставит его в очередь, tx0 уже захвачен
+            assert await sync.sync_profile(profile, until=UNTIL) == 2
+            await sync.stop()
+
+        assert [event.tx_id for event in queued(sync)] == ['tx0', 'tx1', 'tx1', 'tx2']
+
+    @pytest.mark.asyncio
+    async def test_profile_filters_are_sent(self, redis):
+        api = KeitaroStandIn([conversion(0, 'sale'), conversion(1, 'lead')])
+        async with TestServer(api.app) as server:
+            database = FakeDatabase([profile_row(1, str(server.make_url('')),
+                                                 pull_filters={'status': ['sale']})])
+            sync = make_sync(database, redis)
+            profile = await self._profile(database)
+
+            assert await sync.sync_profile(profile, until=UNTIL) == 1
+            await sync.stop()
+
+        assert api.requests[0]['filters'] == [{'name': 'status', 'operator': 'IN_LIST', 'expression': ['sale']}]
+
+    @pytest.mark.asyncio
+    async def test_concurrency_is_bounded_and_failures_isolated(self, redis):
+        api = KeitaroStandIn([conversion(i, minute=59) for i in range(2)], delay=0.05)
+        async with TestServer(api.app) as server:
+            url = str(server.make_url(''))
+            cursor = datetime(2024, 5, 1, 11, 0)
+            profiles = [profile_row(i, url, pull_last_check=cursor) for i in range(1, 6)]
+            profiles.append(profile_row(6, url, pull_api_key='wrong', pull_last_check=cursor))
+            database = FakeDatabase(profiles)
+            sync = make_sync(database, redis, concurrency=2, page_size=10)
+
+            assert await sync.run_once() == 10
+            # Профили захвачены на interval - вторая реплика их пропускает
+            assert await make_sync(database, redis).run_once() == 0
+            await sync.stop()
+
+        assert api.max_active == 2
+        assert {event.profile_id for event in queued(sync)} == {1, 2, 3, 4, 5}
+
+    def test_build_filters(self):
+        assert build_filters('{"geo": ["DE", "AT"]}') == [
+            {'name': 'country', 'operator': 'IN_LIST', 'expression': ['DE', 'AT']}
+        ]
+        raw = [{'name': 'offer_id', 'operator': 'EQUALS', 'expression': 3}]
+        assert build_filters(raw) == raw
+        assert build_filters(None) == []
+
+    @staticmethod
+    async def _profile(database):
+        return profile_from_row((await database.execute('SELECT'))[0])
@@ -0,0 +1,105 @@
+"""
+Тесты для кэша профилей и таблиц маршрутизации Keitaro
+"""
+
+import sys
+import asyncio
+from pathlib import Path
+from unittest.mock import AsyncMock
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    import pytest_asyncio  # noqa: F401
+    from features.keitaro.routing import RouteCache, RoutingTable
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+class TestRoutingTable:
+    """Тесты скомпилированной таблицы маршрутизации"""
+    
+    @staticmethod
+    def route(match_by, value, chat, is_regex=False, status=None, geo=None):
+        return {
+            'match_by': match_by, 'match_value': value, 'is_regex': is_regex,
+            'target_chat_id': chat, 'target_topic_id': None,
+            'status_filter': status, 'geo_filter': geo
+        }
+    
+    def test_priority_order_across_match_types(self):
+        """Побеждает первое по приоритету правило, какого бы типа оно ни было"""
+        table = RoutingTable([
+            self.route('CAMPAIGN_ID', r'^camp\d+$', 1, is_regex=True, status=['deposit']),
+            self.route('SOURCE', 'fb', 2),
+            self.route('campaign_id', 'camp7', 3),
+            self.route('ANY', '*', 4, geo=['US']),
+        ], default_chat_id=99)
+        
+        assert table.route({'campaign_id': 'camp7', 'status': 'deposit', 'source': 'fb'}) == (1, None)
+        assert table.route({'campaign_id': 'camp7', 'status': 'lead', 'source': 'fb'}) == (2, None)
+        assert table.route({'campaign_id': 'camp7', 'status': 'lead'}) == (3, None)
+        assert table.route({'campaign_id': 'x', 'country': 'US'}) == (4, None)
+        assert table.route({'campaign_id': 'x', 'country': 'DE'}) == (99, None)
+    
+    def test_json_string_filters(self):
+        """Фильтры, пришедшие из БД JSON-строкой, разбираются как списки"""
+        table = RoutingTable([
+            self.route('ANY', '*', 1, status='["deposit"]', geo='["DE", "AT"]'),
+            self.route('ANY', '*', 2, status='[]', geo=''),
+        ], default_chat_id=99)
+        
+        assert table.route({'status': 'deposit', 'country': 'AT'}) == (1, None)
+        assert table.route({'status': 'lead', 'country': 'DE'}) == (2, None)
+        # Символы JSON не попадают в индекс как отдельные значения
+        assert set(table.by_status) == {'deposit'}
+        assert set(table.by_geo) == {'DE', 'AT'}
+    
+    def test_invalid_regex_is_skipped(self):
+        """Правило с неверным regex не ломает остальные"""
+        table = RoutingTable([
+            self.route('source', '(', 1, is_regex=True),
+            self.route('source', 'tt', 2),
+        ], default_chat_id=99)
+        
+        assert table.route({'source': 'tt'}) == (2, None)
+        assert table.route({'source': '('}) == (99, None)
+    
+    @pytest.mark.asyncio
+    async def test_cache_loads_once_until_invalidated(self):
+        """Профиль и правила читаются из БД один раз"""
+        db = AsyncMock()
+        db.execute.side_effect = lambda query, params, fetch=False: (
+            [{'id': 1, 'owner_user_id': 5, 'enabled': True, 'default_chat_id': 10, 'default_topic_id': None}]
+            if 'keitaro_profiles' in query else [self.route('source', 'fb', 20)]
+        )
+        cache = RouteCache(ttl=60)
+        
+        for _ in range(3):
+            profile = await cache.profile(db, 'secret')
+            table = await cache.table(db, profile)
+            assert table.route({'source': 'fb'}) == (20, None)
+        assert db.execute.await_count == 2
+        
+        cache.invalidate(owner_user_id=5)
+        profile = await cache.profile(db, 'secret')
+        await cache.table(db, profile)
+        assert db.execute.await_count == 4
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_misses_share_one_query(self):
+        """Одновременные промахи по одному secret - один запрос"""
+        async def slow_execute(query, params, fetch=False):
+            await asyncio.sleep(0.01)
+            return []
+        
+        db = AsyncMock()
+        db.execute.side_effect = slow_execute
+        cache = RouteCache(ttl=60)
+        
+        results = await asyncio.gather(*(cache.profile(db, 'unknown') for _ in range(5)))
+        
+        assert results == [None] * 5
+        assert db.execute.await_count == 1
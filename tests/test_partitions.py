@@ -0,0 +1,112 @@
+"""
+Тесты для обслуживания партиций events
+"""
+
+import sys
+from datetime import date, datetime
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    from database.partitions import (
+        EventPartitionManager, add_months, partition_month, create_partition_sql
+    )
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+class FakeCursor:
+    """Курсор с заданным списком партиций"""
+
+    def __init__(self, partitions, partitioned=True, default_months=()):
+        self.partitions = partitions
+        self.partitioned = partitioned
+        self.default_months = list(default_months)
+        self.statements = []
+        self._result = []
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
+        if 'relkind = \'p\'' in sql and 'pg_inherits' not in sql:
+            self._result = [(1,)] if self.partitioned else []
+        elif 'pg_inherits' in sql:
+            self._result = [(name,) for name in self.partitions]
+        elif 'pg_partitioned_table' in sql:
+            self._result = [('events_default',)] if 'events_default' in self.partitions else []
+        elif 'date_trunc' in sql:
+            self._result = [(month,) for month in self.default_months]
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def fetchall(self):
+        return self._result
+
+
+class FakeDatabase:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    async def run_in_transaction(self, func):
+        return func(self.cursor)
+
+
+def test_month_arithmetic():
+    assert add_months(date(2025, 11, 1), 2) == date(2026, 1, 1)
+    assert add_months(date(2025, 1, 1), -1) == date(2024, 12, 1)
+    assert partition_month('events_2025_10') == date(2025, 10, 1)
+    assert partition_month('events_default') is None
+    assert "FROM ('2025-12-01') TO ('2026-01-01')" in create_partition_sql(date(2025, 12, 1))
+
+
+class TestMaintain:
+    """Тесты создания и удаления партиций"""
+
+    @pytest.mark.asyncio
+    async def test_creates_missing_future_partitions(self):
+        cursor = FakeCursor(['events_2025_10', 'events_default'])
+        manager = EventPartitionManager(FakeDatabase(cursor), months_ahead=2)
+
+        created, dropped = await manager.maintain(now=datetime(2025, 10, 15))
+
+        assert created == ['events_2025_11', 'events_2025_12']
+        assert dropped == []
+
+    @pytest.mark.asyncio
+    async def test_drops_partitions_past_retention(self):
+        cursor = FakeCursor(['events_2025_01', 'events_2025_06', 'events_2025_07',
+                             'events_2025_10', 'events_2025_11', 'events_2025_12', 'events_default'])
+        manager = EventPartitionManager(FakeDatabase(cursor), months_ahead=2, retention_months=3)
+
+        created, dropped = await manager.maintain(now=datetime(2025, 10, 15))
+
+        assert created == []
+        assert dropped == ['events_2025_01', 'events_2025_06']
+        assert not any('events_default' in sql for sql in cursor.statements if sql.startswith('DROP'))
+
+    @pytest.mark.asyncio
+    async def test_rows_in_default_are_moved_to_new_partition(self):
+        # Обслуживание пропустило ноябрь - его события лежат в events_default
+        cursor = FakeCursor(['events_2025_10', 'events_default'], default_months=[date(2025, 11, 1)])
+        manager = EventPartitionManager(FakeDatabase(cursor), months_ahead=2)
+
+        created, _ = await manager.maintain(now=datetime(2025, 11, 15))
+
+        assert created == ['events_2025_11', 'events_2025_12', 'events_2026_01']
+        november = [sql for sql in cursor.statements if 'events_2025_11' in sql]
+        assert november[0].startswith('CREATE TABLE events_2025_11 (LIKE events')
+        assert "DELETE FROM events_default WHERE ts >= '2025-11-01' AND ts < '2025-12-01'" in november[1]
+        assert november[2].startswith('ALTER TABLE events ATTACH PARTITION events_2025_11')
+        # Остальные месяцы - обычным PARTITION OF
+        assert any('events_2025_12 PARTITION OF events' in sql for sql in cursor.statements)
+
+    @pytest.mark.asyncio
+    async def test_plain_table_is_left_alone(self):
+        cursor = FakeCursor([], partitioned=False)
+        manager = EventPartitionManager(FakeDatabase(cursor), retention_months=1)
+
+        assert await manager.maintain() == ([], [])
+        assert len(cursor.statements) == 1
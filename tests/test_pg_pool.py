@@ -0,0 +1,125 @@
+"""
+Тесты для перевода запросов psycopg2 в формат asyncpg
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    from database.pg_pool import asyncpg_dsn, close_pools, convert_query, get_pool, init_connection, run
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+def test_positional_placeholders():
+    sql, args = convert_query("SELECT * FROM users WHERE tg_id = %s AND language = %s", (1, 'ru'))
+    assert sql == "SELECT * FROM users WHERE tg_id = $1 AND language = $2"
+    assert args == [1, 'ru']
+
+
+def test_named_placeholders_reuse_index():
+    sql, args = convert_query(
+        "SELECT %(start)s, %(end)s WHERE x >= %(start)s", {'start': 1, 'end': 2, 'unused': 3}
+    )
+    assert sql == "SELECT $1, $2 WHERE x >= $1"
+    assert args == [1, 2]
+
+
+def test_percent_escapes_and_literals():
+    sql, args = convert_query("SELECT 'a%%b', '%%s' WHERE name LIKE %s", ('x%',))
+    assert sql == "SELECT 'a%b', '%s' WHERE name LIKE $1"
+    assert args == ['x%']
+
+
+def test_no_params():
+    assert convert_query("SELECT 100 %% 7") == ("SELECT 100 % 7", [])
+
+
+def test_placeholder_inside_literal_is_not_convertible():
+    assert convert_query("SELECT NOW() - INTERVAL '%s days'", (3,)) is None
+
+
+def test_dollar_quotes_and_comments_are_skipped():
+    sql, args = convert_query(
+        "DO $$ BEGIN RAISE NOTICE 'it''s'; END $$; -- don't\nSELECT %s", (5,)
+    )
+    assert sql.endswith("SELECT $1")
+    assert "'it''s'" in sql
+    assert args == [5]
+
+
+def test_argument_count_mismatch():
+    assert convert_query("SELECT %s, %s", (1,)) is None
+    assert convert_query("SELECT %s", (1, 2)) is None
+
+
+def test_asyncpg_dsn_strips_driver():
+    assert asyncpg_dsn("postgresql+psycopg2://u:p@h:5432/db") == "postgresql://u:p@h:5432/db"
+    assert asyncpg_dsn("postgresql://u@h/db") == "postgresql://u@h/db"
+
+
+def test_tuple_params_are_not_convertible():
+    assert convert_query("SELECT * FROM users WHERE id IN %s", ((1, 2),)) is None
+
+
+class FakeConnection:
+    """Соединение asyncpg, запоминающее кодеки"""
+
+    def __init__(self):
+        self.codecs = {}
+
+    async def set_type_codec(self, type_name, encoder, decoder, schema, format='text'):
+        self.codecs[(schema, type_name)] = (encoder, decoder)
+
+
+@pytest.mark.asyncio
+async def test_json_codecs_are_registered():
+    conn = FakeConnection()
+    await init_connection(conn)
+
+    assert set(conn.codecs) == {('pg_catalog', 'json'), ('pg_catalog', 'jsonb')}
+    encoder, decoder = conn.codecs[('pg_catalog', 'json')]
+    assert decoder('["deposit"]') == ['deposit']
+    # Строку, сериализованную для psycopg2, не кодируем второй раз
+    assert encoder('["deposit"]') == '["deposit"]'
+    assert encoder({'geo': ['DE']}) == '{"geo": ["DE"]}'
+
+
+JSON_SQL = """
+    SELECT '["deposit"]'::json AS status_filter, '{"geo": ["DE"]}'::jsonb AS pull_filters,
+           NULL::json AS geo_filter, %s::json AS param
+"""
+
+
+@pytest.mark.integration
+@pytest.mark.asyncio
+async def test_json_columns_match_psycopg2():
+    database_url = os.getenv('TEST_DATABASE_URL')
+    if not database_url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    psycopg2 = pytest.importorskip('psycopg2')
+    pool = await get_pool(database_url)
+    if pool is None:
+        pytest.skip("asyncpg is not available")
+
+    try:
+        sql, args = convert_query(JSON_SQL, ('["RU", "KZ"]',))
+        asyncpg_row = (await run(pool, sql, args, fetch=True))[0]
+    finally:
+        await close_pools()
+
+    with psycopg2.connect(asyncpg_dsn(database_url)) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(JSON_SQL, ('["RU", "KZ"]',))
+            columns = [col[0] for col in cursor.description]
+            psycopg2_row = dict(zip(columns, cursor.fetchone()))
+
+    assert asyncpg_row == psycopg2_row == {
+        'status_filter': ['deposit'], 'pull_filters': {'geo': ['DE']},
+        'geo_filter': None, 'param': ['RU', 'KZ'],
+    }
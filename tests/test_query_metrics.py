@@ -0,0 +1,88 @@
+"""
+Тесты для метрик SQL-запросов
+"""
+
+import sys
+import asyncio
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    from database.query_metrics import QueryMetrics, explain_sql, query_name
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+def test_query_name():
+    assert query_name("SELECT id FROM users WHERE tg_id = %s") == "select:users"
+    assert query_name("\n  INSERT INTO events (user_id) VALUES (%s)") == "insert:events"
+    assert query_name("UPDATE users SET language = %s") == "update:users"
+    assert query_name("DELETE FROM kashmail_daily_counters WHERE day < %s") == "delete:kashmail_daily_counters"
+    assert query_name("SELECT 1") == "select"
+
+
+def test_explain_only_for_reads():
+    assert explain_sql("SELECT * FROM users").startswith("EXPLAIN (ANALYZE, BUFFERS) SELECT")
+    assert explain_sql("WITH x AS (SELECT 1) SELECT * FROM x") is not None
+    assert explain_sql("WITH b AS (DELETE FROM t RETURNING *) SELECT * FROM b") is None
+    assert explain_sql("UPDATE users SET is_blocked = true") is None
+
+
+def test_histogram_and_render():
+    metrics = QueryMetrics(slow_threshold=0.1)
+    metrics.observe("select:users", 0.003, rows=2, pool_wait=0.0005)
+    metrics.observe("select:users", 0.2, rows=1, pool_wait=0.01)
+    metrics.observe("update:users", 0.02, error=True)
+
+    stats = metrics.queries["select:users"]
+    assert stats.latency.count == 2
+    assert stats.rows == 3
+    assert stats.slow == 1
+    assert metrics.queries["update:users"].errors == 1
+
+    text = metrics.render()
+    assert 'db_query_duration_seconds_bucket{query="select:users",le="0.005"} 1' in text
+    assert 'db_query_duration_seconds_bucket{query="select:users",le="+Inf"} 2' in text
+    assert 'db_query_rows_total{query="select:users"} 3' in text
+    assert 'db_slow_queries_total{query="select:users"} 1' in text
+    assert 'db_pool_wait_seconds_count 2' in text
+
+
+def test_name_cardinality_is_capped():
+    metrics = QueryMetrics(max_names=2)
+    for index in range(5):
+        metrics.observe(f"select:t{index}", 0.001)
+    assert set(metrics.queries) == {"select:t0", "select:t1", "other"}
+    assert metrics.queries["other"].latency.count == 3
+
+
+def test_explain_cooldown():
+    metrics = QueryMetrics(explain_sample_rate=1.0, explain_cooldown=60)
+    assert metrics.should_explain("select:users", now=100.0)
+    assert not metrics.should_explain("select:users", now=130.0)
+    assert metrics.should_explain("select:users", now=161.0)
+
+    metrics = QueryMetrics(explain_sample_rate=0.0)
+    assert not metrics.should_explain("select:users", now=100.0)
+
+
+@pytest.mark.asyncio
+async def test_slow_query_is_explained():
+    metrics = QueryMetrics(slow_threshold=0.05, explain_sample_rate=1.0)
+    plans = []
+
+    async def explain(plan_sql):
+        plans.append(plan_sql)
+        return [{'QUERY PLAN': 'Seq Scan on users'}]
+
+    metrics.record("select:users", "SELECT * FROM users", 0.01, explain=explain)
+    metrics.record("select:users", "SELECT * FROM users", 0.5, explain=explain)
+    metrics.record("update:users", "UPDATE users SET x = 1", 0.5, explain=explain)
+    await asyncio.sleep(0)
+    await asyncio.gather(*metrics._explain_tasks)
+
+    assert plans == ["EXPLAIN (ANALYZE, BUFFERS) SELECT * FROM users"]
+    assert metrics.queries["select:users"].slow == 1
@@ -0,0 +1,193 @@
+"""
+Тесты для движка дневных квот
+"""
+
+import sys
+import asyncio
+from datetime import datetime, time, timedelta
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    import fakeredis
+    import pytest_asyncio  # noqa: F401
+    from database.quotas import GMAIL, KASHMAIL, RANDOM_FACE, QuotaEngine
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+# Ключи истекают в полночь, поэтому день - настоящий сегодняшний
+DAY = datetime.now().date()
+
+
+class FakeDatabase:
+    """Отвечает на SELECT count заданным значением, запоминает запросы"""
+
+    def __init__(self, counts=None, upsert=None):
+        self.counts = counts or {}
+        self.upsert = upsert
+        self.queries = []
+        self.cursor = MagicMock()
+
+    async def execute(self, query, params=None, fetch=False):
+        self.queries.append((query, params))
+        if query.lstrip().startswith('SELECT'):
+            count = self.counts.get(params[0])
+            return [{'count': count}] if count is not None else []
+        if 'RETURNING' in query:
+            return self.upsert
+        return None
+
+    async def run_in_transaction(self, func):
+        return func(self.cursor)
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeAsyncRedis(decode_responses=True)
+
+
+@pytest.fixture(autouse=True)
+def today():
+    with patch.object(QuotaEngine, 'today', return_value=DAY):
+        yield
+
+
+def make_engine(redis, database=None, limit=10):
+    engine = QuotaEngine(database, redis=redis)
+    engine.configure(gmail=limit, kashmail=limit, random_face=limit)
+    return engine
+
+
+class TestRedisQuota:
+    """Проверка и списание в Redis"""
+
+    @pytest.mark.asyncio
+    async def test_consume_until_limit(self, redis):
+        engine = make_engine(redis)
+
+        first = await engine.consume(GMAIL, 1, 7)
+        second = await engine.consume(GMAIL, 1, 4)
+        third = await engine.consume(GMAIL, 1, 3)
+
+        assert (first.allowed, first.used) == (True, 7)
+        assert (second.allowed, second.used) == (False, 7)
+        assert (third.allowed, third.remaining) == (True, 0)
+        assert await engine.remaining(GMAIL, 1) == 0
+        # Квоты независимы
+        assert await engine.remaining(KASHMAIL, 1) == 10
+
+    @pytest.mark.asyncio
+    async def test_key_expires_at_midnight(self, redis):
+        engine = make_engine(redis)
+        await engine.consume(RANDOM_FACE, 5)
+
+        key = engine.key(RANDOM_FACE, 5, DAY)
+        midnight = datetime.combine(DAY + timedelta(days=1), time.min).timestamp()
+        assert key == f"face:quota:5:{DAY.strftime('%Y%m%d')}"
+        assert await redis.expiretime(key) == int(midnight)
+
+    @pytest.mark.asyncio
+    async def test_concurrent_consumers_never_exceed_limit(self, redis):
+        engine = make_engine(redis, limit=10)
+        other = make_engine(redis, limit=10)  # вторая реплика
+
+        results = await asyncio.gather(*(
+            (engine if i % 2 else other).consume(KASHMAIL, 1) for i in range(25)
+        ))
+
+        assert sum(r.allowed for r in results) == 10
+        assert await redis.get(engine.key(KASHMAIL, 1, DAY)) == '10'
+
+    @pytest.mark.asyncio
+    async def test_missing_key_is_seeded_from_database(self, redis):
+        db = FakeDatabase(counts={1: 8})
+        engine = make_engine(redis, db)
+
+        rejected = await engine.consume(GMAIL, 1, 3)
+        allowed = await engine.consume(GMAIL, 1, 2)
+
+        assert (rejected.allowed, rejected.used) == (False, 8)
+        assert (allowed.allowed, allowed.used) == (True, 10)
+        # БД читается только пока ключа нет
+        assert sum(q.lstrip().startswith('SELECT') for q, _ in db.queries) == 1
+
+    @pytest.mark.asyncio
+    async def test_refund_does_not_go_below_zero(self, redis):
+        engine = make_engine(redis, FakeDatabase())
+        await engine.consume(RANDOM_FACE, 1, 2)
+
+        await engine.refund(RANDOM_FACE, 1, 5)
+
+        assert await engine.remaining(RANDOM_FACE, 1) == 10
+        # В БД уйдет только реально возвращенное - итог ноль
+        assert engine._pending == {}
+
+
+class TestWriteThrough:
+    """Запись списаний в Postgres"""
+
+    @pytest.mark.asyncio
+    async def test_flush_writes_aggregated_deltas(self, redis):
+        db = FakeDatabase()
+        engine = make_engine(redis, db)
+        await engine.consume(GMAIL, 1, 2)
+        await engine.consume(GMAIL, 1, 3)
+        await engine.consume(KASHMAIL, 2)
+        await engine.consume(RANDOM_FACE, 3)
+        await engine.refund(RANDOM_FACE, 3)
+
+        written = []
+        with patch('database.quotas.execute_values',
+                   side_effect=lambda cursor, sql, rows, page_size=100: written.append((sql, rows))):
+            assert await engine.flush() == 2
+
+        tables = {sql.split('INTO')[1].split()[0]: rows for sql, rows in written}
+        assert tables == {
+            'gmail_alias_usage': [(1, DAY, 5)],
+            'kashmail_daily_counters': [(2, DAY, 1)],
+        }
+        assert engine._pending == {}
+
+    @pytest.mark.asyncio
+    async def test_failed_flush_keeps_deltas(self, redis):
+        db = FakeDatabase()
+        engine = make_engine(redis, db)
+        await engine.consume(GMAIL, 1, 2)
+
+        with patch('database.quotas.execute_values', side_effect=RuntimeError("db down")):
+            with pytest.raises(RuntimeError):
+                await engine.flush()
+
+        assert engine._pending == {(GMAIL, 1, DAY): 2}
+
+
+class TestDatabaseFallback:
+    """Без Redis квота списывается условным UPSERT"""
+
+    @pytest.mark.asyncio
+    async def test_allowed_upsert(self):
+        db = FakeDatabase(upsert=[{'count': 4}])
+        engine = make_engine(None, db)
+
+        with patch.object(QuotaEngine, '_redis', return_value=None):
+            result = await engine.consume(KASHMAIL, 1)
+
+        assert (result.allowed, result.used) == (True, 4)
+        query, params = db.queries[0]
+        assert 'WHERE c.count + EXCLUDED.count <= %s' in query
+        assert params == (1, DAY, 1, 10)
+
+    @pytest.mark.asyncio
+    async def test_rejected_upsert_reports_usage(self):
+        db = FakeDatabase(counts={1: 10}, upsert=[])
+        engine = make_engine(None, db)
+
+        with patch.object(QuotaEngine, '_redis', return_value=None):
+            result = await engine.consume(KASHMAIL, 1)
+
+        assert (result.allowed, result.used) == (False, 10)
@@ -9,6 +9,7 @@ from pathlib import Path
 import pytest
 from unittest.mock import Mock, AsyncMock, patch
 from io import BytesIO
+from datetime import date
 
 # Добавляем путь к корню проекта
 sys.path.insert(0, str(Path(__file__).parent.parent))
@@ -16,6 +17,7 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 try:
     import httpx
     from features.random_face.service import RandomFaceService
+    from database.quotas import QuotaEngine, QuotaResult
 except ImportError as e:
     pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
 
@@ -24,25 +26,29 @@ except ImportError as e:
 def redis_mock():
     """Мок Redis клиента"""
     redis = AsyncMock()
-    redis.exists.return_value = False
-    redis.get.return_value = None
-    redis.incr.return_value = 1
-    redis.setex.return_value = True
-    redis.expire.return_value = True
+    redis.set.return_value = True  # антиспам флаг установлен (SET NX)
     return redis
 
 
 @pytest.fixture
-def service(redis_mock):
+def quota_mock():
+    """Мок движка квот: квота есть"""
+    quotas = AsyncMock()
+    quotas.consume.return_value = QuotaResult(allowed=True, used=1, limit=10)
+    return quotas
+
+
+@pytest.fixture
+def service(redis_mock, quota_mock):
     """Экземпляр сервиса для тестирования"""
-    return RandomFaceService(redis_mock)
+    return RandomFaceService(redis_mock, quota_mock)
 
 
 class TestRandomFaceService:
     """Тесты сервиса Random Face"""
     
     @pytest.mark.asyncio
-    async def test_fetch_face_image_success(self, service, redis_mock):
+    async def test_fetch_face_image_success(self, service, redis_mock, quota_mock):
         """Тест успешного получения изображения"""
         # Подготавливаем моки
         fake_image_data = b"fake_image_data_jpeg_format"
@@ -71,42 +77,42 @@ class TestRandomFaceService:
             assert isinstance(result, BytesIO)
             assert result.getvalue() == fake_image_data
             
-            # Проверяем что квота увеличилась
-            redis_mock.incr.assert_called_once()
+            # Проверяем что квота списана и не возвращена
+            quota_mock.consume.assert_called_once()
+            quota_mock.refund.assert_not_called()
     
     @pytest.mark.asyncio
-    async def test_rate_limit_check(self, service, redis_mock):
+    async def test_rate_limit_check(self, service, redis_mock, quota_mock):
         """Тест проверки антиспама"""
-        # Устанавливаем что флаг антиспама активен
-        redis_mock.exists.return_value = True
+        # Флаг антиспама уже стоит - SET NX ничего не устанавливает
+        redis_mock.set.return_value = None
         
         result, error = await service.fetch_face_image(user_id=12345)
         
         assert result is None
         assert error == "Слишком часто, подожди 2 сек"
         
-        # Проверяем что HTTP-запрос не делался
-        redis_mock.incr.assert_not_called()
+        # Проверяем что квота не тратилась
+        quota_mock.consume.assert_not_called()
     
     @pytest.mark.asyncio
-    async def test_quota_exceeded(self, service, redis_mock):
+    async def test_quota_exceeded(self, service, redis_mock, quota_mock):
         """Тест превышения дневной квоты"""
-        # Устанавливаем что квота превышена (10 >= 10)
-        redis_mock.get.return_value = "10"
+        # Квота исчерпана (10 из 10) - списание отклонено
+        quota_mock.consume.return_value = QuotaResult(allowed=False, used=10, limit=10)
         
-        with patch('config.settings') as mock_settings:
-            mock_settings.FACE_QUOTA_PER_DAY = 10
-            
+        with patch('httpx.AsyncClient') as mock_client:
             result, error = await service.fetch_face_image(user_id=12345)
         
         assert result is None
         assert error == "Лимит на сегодня исчерпан. Доступ снова завтра."
         
         # Проверяем что HTTP-запрос не делался
-        redis_mock.incr.assert_not_called()
+        mock_client.assert_not_called()
+        quota_mock.refund.assert_not_called()
     
     @pytest.mark.asyncio
-    async def test_invalid_content_type(self, service, redis_mock):
+    async def test_invalid_content_type(self, service, redis_mock, quota_mock):
         """Тест валидации Content-Type"""
         with patch('httpx.AsyncClient') as mock_client:
             # Настраиваем мок с неправильным content-type
@@ -123,11 +129,11 @@ class TestRandomFaceService:
             assert result is None
             assert error == "Сервис недоступен, попробуй ещё раз позже"
             
-            # Квота не должна увеличиваться при ошибке
-            redis_mock.incr.assert_not_called()
+            # Квота при ошибке возвращается
+            quota_mock.refund.assert_called_once()
     
     @pytest.mark.asyncio
-    async def test_file_size_limit(self, service, redis_mock):
+    async def test_file_size_limit(self, service, redis_mock, quota_mock):
         """Тест ограничения размера файла"""
         # Создаем данные размером больше 5 МБ
         large_data = b"a" * (6 * 1024 * 1024)  # 6 МБ
@@ -151,8 +157,8 @@ class TestRandomFaceService:
             assert result is None
             assert error == "Сервис недоступен, попробуй ещё раз позже"
             
-            # Квота не должна увеличиваться при ошибке
-            redis_mock.incr.assert_not_called()
+            # Квота при ошибке возвращается
+            quota_mock.refund.assert_called_once()
     
     @pytest.mark.asyncio
     async def test_server_error_with_retries(self, service, redis_mock):
@@ -199,31 +205,19 @@ class TestRandomFaceService:
             assert mock_context.__aenter__.return_value.get.call_count == 3
     
     @pytest.mark.asyncio
-    async def test_get_remaining_quota(self, service, redis_mock):
+    async def test_get_remaining_quota(self, service, quota_mock):
         """Тест получения оставшейся квоты"""
-        with patch('config.settings') as mock_settings:
-            mock_settings.FACE_QUOTA_PER_DAY = 10
-            
-            # Тест когда использовано 3 из 10
-            redis_mock.get.return_value = "3"
-            remaining = await service.get_remaining_quota(user_id=12345)
-            assert remaining == 7
-            
-            # Тест когда ничего не использовано
-            redis_mock.get.return_value = None
-            remaining = await service.get_remaining_quota(user_id=12345)
-            assert remaining == 10
-            
-            # Тест когда квота превышена
-            redis_mock.get.return_value = "12"
-            remaining = await service.get_remaining_quota(user_id=12345)
-            assert remaining == 0
+        quota_mock.remaining.return_value = 7
+        
+        remaining = await service.get_remaining_quota(user_id=12345)
+        
+        assert remaining == 7
+        quota_mock.remaining.assert_called_once_with('random_face', 12345)
     
-    def test_quota_key_generation(self, service):
-        """Тест генерации ключа квоты"""
-        with patch('features.random_face.service.datetime') as mock_datetime:
-            mock_datetime.now.return_value.strftime.return_value = "20231227"
-            
+    def test_quota_key_generation(self, redis_mock):
+        """Тест генерации ключа квоты (формат прежних ключей сервиса)"""
+        service = RandomFaceService(redis_mock, QuotaEngine())
+        with patch.object(QuotaEngine, 'today', return_value=date(2023, 12, 27)):
             key = service._get_quota_key(user_id=12345)
             assert key == "face:quota:12345:20231227"
 
@@ -233,9 +227,9 @@ class TestRandomFaceIntegration:
     """Интеграционные тесты с моками внешних сервисов"""
     
     @pytest.mark.asyncio
-    async def test_successful_image_fetch_integration(self, redis_mock):
+    async def test_successful_image_fetch_integration(self, redis_mock, quota_mock):
         """Интеграционный тест успешного получения изображения"""
-        service = RandomFaceService(redis_mock)
+        service = RandomFaceService(redis_mock, quota_mock)
         
         # Мокаем успешный ответ от thispersondoesnotexist.com
         fake_jpeg_data = b"\xff\xd8\xff\xe0\x00\x10JFIF"  # JPEG header
@@ -263,13 +257,13 @@ class TestRandomFaceIntegration:
             assert result.getvalue() == fake_jpeg_data
             
             # Проверяем взаимодействие с Redis
-            redis_mock.setex.assert_called_once()  # антиспам флаг
-            redis_mock.incr.assert_called_once()   # квота
+            redis_mock.set.assert_called_once()     # антиспам флаг
+            quota_mock.consume.assert_called_once()  # квота
     
     @pytest.mark.asyncio
-    async def test_service_unavailable_integration(self, redis_mock):
+    async def test_service_unavailable_integration(self, redis_mock, quota_mock):
         """Интеграционный тест недоступности сервиса"""
-        service = RandomFaceService(redis_mock)
+        service = RandomFaceService(redis_mock, quota_mock)
         
         with patch('httpx.AsyncClient') as mock_client:
             # Мокаем недоступность сервиса
@@ -286,6 +280,6 @@ class TestRandomFaceIntegration:
             assert error == "Сервис недоступен, попробуй ещё раз позже"
             
             # Проверяем что антиспам все равно был установлен
-            redis_mock.setex.assert_called_once()
-            # Но квота не увеличилась
-            redis_mock.incr.assert_not_called()
+            redis_mock.set.assert_called_once()
+            # А списанная квота возвращена
+            quota_mock.refund.assert_called_once()
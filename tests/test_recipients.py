@@ -0,0 +1,68 @@
+"""
+Тесты для постраничной выборки получателей рассылки
+"""
+
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    from database.recipients import RecipientSource, count_segments, segment_condition
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+class FakeDatabase:
+    """Отдает страницы пользователей по after_id/limit"""
+
+    def __init__(self, user_ids):
+        self.user_ids = sorted(user_ids)
+        self.queries = []
+
+    async def execute(self, query, params=None, fetch=False):
+        self.queries.append((query, params))
+        if 'COUNT(*) AS count' in query:
+            return [{'count': len(self.user_ids)}]
+        if 'AS total' in query:
+            return [{'total': 10, 'active_7d': 3, 'active_30d': 6}]
+        page = [uid for uid in self.user_ids if uid > params['after_id']][:params['limit']]
+        return [{'id': uid, 'tg_id': uid * 100} for uid in page]
+
+
+@pytest.mark.asyncio
+async def test_streams_all_pages_with_keyset():
+    db = FakeDatabase(range(1, 8))
+    source = RecipientSource(db, page_size=3)
+
+    received = [tg_id async for tg_id in source]
+
+    assert received == [uid * 100 for uid in range(1, 8)]
+    assert [params['after_id'] for _, params in db.queries] == [0, 3, 6]
+
+
+@pytest.mark.asyncio
+async def test_resume_after_id_and_count():
+    db = FakeDatabase(range(1, 8))
+    source = RecipientSource(db, segment='active_7d', page_size=3)
+
+    pages = [page async for page in source.pages(after_id=4)]
+
+    assert pages == [[(5, 500), (6, 600), (7, 700)]]
+    assert await source.count() == 7
+
+
+def test_segment_conditions_use_exists():
+    assert 'EXISTS' in segment_condition('active_7d')
+    assert segment_condition('inactive_7d').startswith('NOT EXISTS')
+    assert 'NOT IN' not in segment_condition('active_30d')
+    assert segment_condition('unknown') == segment_condition('all')
+
+
+@pytest.mark.asyncio
+async def test_count_segments_derives_inactive():
+    counts = await count_segments(FakeDatabase([]), now=datetime(2025, 1, 10))
+    assert counts == {'all': 10, 'active_7d': 3, 'active_30d': 6, 'inactive_7d': 7}
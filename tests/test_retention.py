@@ -0,0 +1,79 @@
+"""
+Тесты для матрицы удержания когорт
+"""
+
+import sys
+from datetime import date
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    from database.retention import RetentionEngine, build_matrix, matrix_params
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+TODAY = date(2025, 10, 31)
+
+ROWS = [
+    # cohort_day, size, day_offset, returned
+    (date(2025, 9, 1), 10, 1, 5),
+    (date(2025, 9, 1), 10, 7, 2),
+    (date(2025, 9, 1), 10, 30, 1),
+    (date(2025, 10, 1), 4, None, None),   # никто не вернулся
+    (date(2025, 10, 29), 2, 1, 2),
+]
+
+
+class FakeDatabase:
+    """БД, считающая выполненные запросы"""
+
+    def __init__(self):
+        self.queries = 0
+
+    async def execute(self, query, params=None, fetch=False):
+        self.queries += 1
+        return [dict(zip(('cohort_day', 'size', 'day_offset', 'returned'), row)) for row in ROWS]
+
+
+def test_rates_and_maturity():
+    matrix = build_matrix(ROWS, (1, 7, 30), TODAY)
+    first, empty, recent = matrix.cohorts
+
+    assert matrix.rate(first, 1) == 50.0
+    assert matrix.rate(first, 30) == 10.0
+    assert matrix.rate(empty, 7) == 0.0
+    # D7 для когорты двухдневной давности еще не наступил
+    assert matrix.rate(recent, 7) is None
+    assert matrix.as_rows()[-1] == {'day': '2025-10-29', 'size': 2, 'D1': 100.0, 'D7': None, 'D30': None}
+
+
+def test_average_uses_only_mature_cohorts():
+    matrix = build_matrix(ROWS, (1, 7, 30), TODAY)
+
+    assert matrix.average(1) == round((50.0 + 0.0 + 100.0) / 3, 1)
+    assert matrix.average(7) == round((20.0 + 0.0) / 2, 1)
+    assert matrix.average(30) == 10.0
+    assert matrix.average(1, periods=1) == 100.0
+
+
+def test_params_cover_longest_offset():
+    params = matrix_params((1, 7, 30), 30, TODAY)
+    assert params['start'] == date(2025, 9, 1)
+    assert params['end'] == TODAY
+    assert params['offsets'] == [1, 7, 30]
+
+
+@pytest.mark.asyncio
+async def test_engine_caches_matrix():
+    db = FakeDatabase()
+    engine = RetentionEngine(db)
+
+    first = await engine.get_matrix(today=TODAY)
+    second = await engine.get_matrix(today=TODAY)
+
+    assert first is second
+    assert db.queries == 1
@@ -0,0 +1,115 @@
+"""
+Тесты для хранилища сессий
+"""
+
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    from database.session_store import SessionStore, INSERT_SESSIONS_SQL, _epoch
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+START = datetime(2024, 1, 1, 12, 0)
+
+
+class FakeDatabase:
+    """БД, которая запоминает выполненные курсором запросы"""
+
+    def __init__(self):
+        self.cursor = MagicMock(rowcount=3)
+
+    async def run_in_transaction(self, func):
+        return func(self.cursor)
+
+
+@pytest.fixture
+def store():
+    """Хранилище без Redis (сессии в памяти)"""
+    with patch.object(SessionStore, '_redis', return_value=None):
+        yield SessionStore(FakeDatabase(), timeout=1800)
+
+
+@pytest.fixture
+def inserted():
+    """Перехватывает execute_values: [rows]"""
+    calls = []
+    with patch('database.session_store.execute_values',
+               side_effect=lambda cursor, sql, rows, page_size=100: calls.append(list(rows))):
+        yield calls
+
+
+class TestTouch:
+    """Тесты учета событий в открытых сессиях"""
+
+    @pytest.mark.asyncio
+    async def test_events_within_timeout_share_session(self, store):
+        ids = await store.touch_many([(1, START), (1, START + timedelta(minutes=29)), (2, START)])
+
+        assert ids[0] == ids[1] != ids[2]
+        session_id, started_at, last_ts, events = store._local[1]
+        assert events == 2
+        assert last_ts - started_at == 29 * 60
+
+    @pytest.mark.asyncio
+    async def test_pause_starts_new_session(self, store):
+        ids = await store.touch_many([(1, START), (1, START + timedelta(minutes=31))])
+
+        assert ids[0] != ids[1]
+        assert len(store._local_finished) == 1
+        assert store._local_finished[0].events == 1
+
+
+class TestCollect:
+    """Тесты записи завершенных сессий"""
+
+    @pytest.mark.asyncio
+    async def test_stale_sessions_written_in_one_batch(self, store, inserted):
+        await store.touch_many([(1, START), (1, START + timedelta(minutes=5)), (2, START)])
+
+        written = await store.collect()
+
+        assert written == 2
+        assert len(inserted) == 1
+        rows = sorted(inserted[0], key=lambda row: row[1])
+        assert rows[0][1:] == (1, START, START + timedelta(minutes=5), 2, 300)
+        assert not store._local
+
+    @pytest.mark.asyncio
+    async def test_active_sessions_stay_open(self, store, inserted):
+        now = datetime.utcnow()
+        await store.touch_many([(1, now)])
+
+        assert await store.collect() == 0
+        assert not inserted
+        assert 1 in store._local
+
+    @pytest.mark.asyncio
+    async def test_stop_writes_open_sessions(self, store, inserted):
+        await store.touch_many([(1, datetime.utcnow())])
+
+        await store.stop()
+
+        assert len(inserted) == 1 and not store._local
+
+
+@pytest.mark.asyncio
+async def test_close_stale_rows_is_single_update(store):
+    assert await store.close_stale_rows() == 3
+    store.db.cursor.execute.assert_called_once()
+    sql, params = store.db.cursor.execute.call_args[0]
+    assert sql.strip().startswith('UPDATE sessions')
+    assert params == {'timeout': 1800}
+
+
+def test_insert_resolves_user_by_tg_id():
+    assert 'LEFT JOIN users u ON u.tg_id = v.tg_id' in INSERT_SESSIONS_SQL
+    assert 'ON CONFLICT (id) DO NOTHING' in INSERT_SESSIONS_SQL
+    assert _epoch(datetime(1970, 1, 1, 0, 1)) == 60
@@ -0,0 +1,146 @@
+"""
+Тесты для кэша проверки подписки
+"""
+
+import sys
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    import fakeredis
+    import pytest_asyncio  # noqa: F401
+    from telegram import Chat, ChatMemberLeft, ChatMemberMember, ChatMemberUpdated, Update, User
+    from telegram.constants import ChatMemberStatus
+    from telegram.error import BadRequest, RetryAfter
+    from utils import subscription_check
+    from utils.subscription_check import SubscriptionCache, check_subscription
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+CHANNEL = '@news'
+
+
+def member(status):
+    return SimpleNamespace(status=status)
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeAsyncRedis(decode_responses=True)
+
+
+@pytest.fixture
+def cache(redis):
+    cache = SubscriptionCache(positive_ttl=3600, negative_ttl=60, redis=redis)
+    with patch.object(subscription_check, 'subscription_cache', cache):
+        yield cache
+
+
+@pytest.fixture
+def bot():
+    bot = AsyncMock()
+    bot.get_chat_member.return_value = member(ChatMemberStatus.MEMBER)
+    return bot
+
+
+class TestCheckSubscription:
+    """Проверка через кэш"""
+
+    @pytest.mark.asyncio
+    async def test_positive_result_is_cached(self, cache, redis, bot):
+        assert await check_subscription(bot, 1, 'news')
+        assert await check_subscription(bot, 1, '@news')
+
+        bot.get_chat_member.assert_awaited_once_with(CHANNEL, 1)
+        assert 3500 < await redis.ttl(cache.key(CHANNEL, 1)) <= 3600
+
+    @pytest.mark.asyncio
+    async def test_negative_result_has_short_ttl_and_can_be_rechecked(self, cache, redis, bot):
+        bot.get_chat_member.return_value = member(ChatMemberStatus.LEFT)
+
+        assert not await check_subscription(bot, 1, CHANNEL)
+        assert not await check_subscription(bot, 1, CHANNEL)
+        assert bot.get_chat_member.await_count == 1
+        assert await redis.ttl(cache.key(CHANNEL, 1)) <= 60
+
+        # Кнопка "Проверить подписку" после подписки
+        bot.get_chat_member.return_value = member(ChatMemberStatus.MEMBER)
+        assert await check_subscription(bot, 1, CHANNEL, recheck_negative=True)
+        assert await cache.get(CHANNEL, 1) is True
+
+    @pytest.mark.asyncio
+    async def test_api_error_allows_access_without_caching(self, cache, bot):
+        bot.get_chat_member.side_effect = BadRequest("Chat not found")
+
+        assert await check_subscription(bot, 1, CHANNEL)
+        assert await cache.get(CHANNEL, 1) is None
+
+    @pytest.mark.asyncio
+    async def test_unconfigured_channel_skips_check(self, cache, bot):
+        assert await check_subscription(bot, 1, '@channel_username')
+        bot.get_chat_member.assert_not_awaited()
+
+
+class TestInvalidation:
+    """Апдейты chat_member из канала"""
+
+    def chat_member_update(self, old, new):
+        user = User(id=5, first_name='u', is_bot=False)
+        changed = ChatMemberUpdated(
+            chat=Chat(id=-100, type='channel', username='News'),
+            from_user=user, date=datetime.now(),
+            old_chat_member=old(user=user), new_chat_member=new(user=user)
+        )
+        return Update(update_id=1, chat_member=changed)
+
+    @pytest.mark.asyncio
+    async def test_leave_and_join_update_cache(self, cache, bot):
+        await cache.set(CHANNEL, 5, True)
+
+        await cache.handle_chat_member(self.chat_member_update(ChatMemberMember, ChatMemberLeft), None)
+        assert not await check_subscription(bot, 5, CHANNEL)
+
+        await cache.handle_chat_member(self.chat_member_update(ChatMemberLeft, ChatMemberMember), None)
+        assert await check_subscription(bot, 5, CHANNEL)
+
+        bot.get_chat_member.assert_not_awaited()
+
+
+class TestWarmUp:
+    """Заполнение кэша для активных пользователей"""
+
+    @pytest.mark.asyncio
+    async def test_fetches_only_missing_and_caches_subscribed(self, cache, bot):
+        await cache.set(CHANNEL, 1, True)
+        statuses = {2: ChatMemberStatus.MEMBER, 3: ChatMemberStatus.LEFT, 4: ChatMemberStatus.ADMINISTRATOR}
+        bot.get_chat_member.side_effect = lambda channel, user_id: member(statuses[user_id])
+
+        fetched = await cache.warm_up(bot, CHANNEL, [1, 2, 3, 4, 2])
+
+        assert fetched == 3
+        assert sorted(call.args[1] for call in bot.get_chat_member.await_args_list) == [2, 3, 4]
+        assert [await cache.get(CHANNEL, user_id) for user_id in (2, 3, 4)] == [True, None, True]
+
+    @pytest.mark.asyncio
+    async def test_retry_after_pauses_and_retries(self, cache, bot):
+        bot.get_chat_member.side_effect = [RetryAfter(0), member(ChatMemberStatus.MEMBER)]
+
+        assert await cache.warm_up(bot, CHANNEL, [7]) == 1
+        assert await cache.get(CHANNEL, 7) is True
+
+    @pytest.mark.asyncio
+    async def test_active_users_come_from_database(self, cache, bot):
+        database = AsyncMock()
+        database.execute.return_value = [{'tg_id': 8}, {'tg_id': 9}]
+        cache.configure(warmup_days=3, warmup_limit=100)
+
+        assert await cache.warm_up_active(database, bot, CHANNEL) == 2
+        query, params = database.execute.await_args.args
+        assert 'last_seen_at >= %s' in query and params[1] == 100
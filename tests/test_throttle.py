@@ -0,0 +1,146 @@
+"""
+Тесты для лимита запросов пользователя
+"""
+
+import sys
+from datetime import datetime
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    import fakeredis
+    import pytest_asyncio  # noqa: F401
+    from telegram import CallbackQuery, Chat, Message, MessageEntity, Update, User
+    from telegram.ext import ApplicationHandlerStop, filters
+    from utils.rate_limit import RateLimiter, parse_rate
+    from utils.throttle import UpdateThrottle
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+USER = User(id=42, first_name='u', is_bot=False)
+CHAT = Chat(id=42, type='private')
+
+
+def message_update(text='hi', entities=None, update_id=1):
+    message = Message(message_id=update_id, date=datetime.now(), chat=CHAT, from_user=USER,
+                      text=text, entities=entities)
+    return Update(update_id=update_id, message=message)
+
+
+def callback_update(data, update_id=1):
+    query = CallbackQuery(id=str(update_id), from_user=USER, chat_instance='c', data=data)
+    return Update(update_id=update_id, callback_query=query)
+
+
+@pytest.fixture
+def context():
+    return MagicMock(user_data={})
+
+
+@pytest.fixture(autouse=True)
+def no_shared_redis():
+    # Только явно переданный клиент - без общего подключения из infra.redis
+    with patch.object(RateLimiter, '_redis', autospec=True, side_effect=lambda self: self.redis):
+        yield
+
+
+def test_parse_rate():
+    assert parse_rate("30/60") == (0.5, 30)
+    assert parse_rate("5") == (5.0, 5)
+    with pytest.raises(ValueError):
+        parse_rate("0/10")
+
+
+class TestRateLimiter:
+    """Корзины по ключу"""
+
+    def test_local_bucket_refills(self):
+        limiter = RateLimiter(rate=1, capacity=2)
+        with patch('utils.rate_limit.time.monotonic', side_effect=[100.0, 100.0, 100.0, 101.5]):
+            assert limiter.hit_local('a') == (True, 0.0)
+            assert limiter.hit_local('a') == (True, 0.0)
+            allowed, wait = limiter.hit_local('a')
+            assert not allowed and wait == pytest.approx(1.0)
+            # Через 1.5 секунды токен восстановился
+            assert limiter.hit_local('a')[0]
+
+    def test_idle_buckets_are_evicted(self):
+        with patch('utils.rate_limit.time.monotonic', return_value=100.0):
+            limiter = RateLimiter(rate=1, capacity=5)
+            limiter.hit_local('a')
+        with patch('utils.rate_limit.time.monotonic', return_value=200.0):
+            limiter.hit_local('b')
+        assert set(limiter._local) == {'b'}
+
+    @pytest.mark.asyncio
+    async def test_redis_bucket_is_shared(self):
+        redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+        first = RateLimiter(rate=0.1, capacity=3, redis=redis)
+        second = RateLimiter(rate=0.1, capacity=3, redis=redis)  # другая реплика
+
+        results = [await (first if i % 2 else second).hit('user:1') for i in range(5)]
+
+        assert [allowed for allowed, _ in results] == [True, True, True, False, False]
+        assert results[-1][1] > 0
+        assert 0 < await redis.pttl('ratelimit:user:1') <= 31000
+
+
+class TestUpdateThrottle:
+    """Проверка апдейтов до обработчиков"""
+
+    def make_throttle(self, **limits):
+        throttle = UpdateThrottle({name: RateLimiter(*parse_rate(spec)) for name, spec in limits.items()},
+                                  exempt_user_ids=[7])
+        throttle.add_rule('media', message_filter=filters.Document.ALL | filters.Entity(MessageEntity.URL))
+        throttle.add_rule('generate', callback_pattern=r'^kashmail_generate$')
+        return throttle
+
+    def test_classify(self):
+        throttle = self.make_throttle()
+        url = message_update('see https://x.y', entities=[MessageEntity(MessageEntity.URL, 4, 11)])
+
+        assert throttle.classify(url) == 'media'
+        assert throttle.classify(message_update('42')) == 'default'
+        assert throttle.classify(callback_update('kashmail_generate')) == 'generate'
+        assert throttle.classify(callback_update('main_menu')) == 'default'
+
+    @pytest.mark.asyncio
+    async def test_rejects_over_limit_and_notifies_once(self, context):
+        throttle = self.make_throttle(default='2/60')
+
+        with patch.object(Message, 'reply_text', AsyncMock()) as reply:
+            await throttle(message_update(update_id=1), context)
+            await throttle(message_update(update_id=2), context)
+            for update_id in (3, 4):
+                with pytest.raises(ApplicationHandlerStop):
+                    await throttle(message_update(update_id=update_id), context)
+
+        reply.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_classes_have_separate_buckets(self, context):
+        throttle = self.make_throttle(default='1/60', generate='1/60')
+
+        await throttle(message_update(), context)
+        await throttle(callback_update('kashmail_generate'), context)
+
+        with patch.object(CallbackQuery, 'answer', AsyncMock()) as answer:
+            with pytest.raises(ApplicationHandlerStop):
+                await throttle(callback_update('kashmail_generate', update_id=2), context)
+        answer.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_unlimited_class_and_exempt_users_pass(self, context):
+        throttle = self.make_throttle(default='1/60')
+        admin = User(id=7, first_name='a', is_bot=False)
+        admin_update = Update(update_id=5, message=Message(
+            message_id=5, date=datetime.now(), chat=CHAT, from_user=admin, text='x'))
+
+        for update_id in range(3):
+            await throttle(callback_update('kashmail_generate', update_id=update_id), context)
+            await throttle(admin_update, context)
@@ -0,0 +1,58 @@
+"""
+Тесты для кэша профилей пользователей
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    from database.user_cache import UserCache, CachedUser
+except ImportError as e:
+    pytest.skip(f"Required modules not available: {e}", allow_module_level=True)
+
+
+def test_lru_eviction():
+    cache = UserCache(max_size=2)
+    cache.put_local(1, CachedUser(id=10))
+    cache.put_local(2, CachedUser(id=20))
+    cache.get_local(1)
+    cache.put_local(3, CachedUser(id=30))
+
+    assert cache.get_local(2) is None
+    assert cache.get_local(1).id == 10
+    assert cache.get_local(3).id == 30
+
+
+def test_last_seen_due():
+    cache = UserCache(last_seen_interval=300)
+    assert cache.last_seen_due(1, now=1000)
+
+    cache.put_local(1, CachedUser(id=10, last_seen_written=1000))
+    assert not cache.last_seen_due(1, now=1200)
+    assert cache.last_seen_due(1, now=1300)
+
+
+def test_put_keeps_last_seen_mark():
+    cache = UserCache()
+    cache.put_local(1, CachedUser(id=10, last_seen_written=1000))
+    cache.put_local(1, CachedUser(id=10, language='en'))
+
+    user = cache.get_local(1)
+    assert user.language == 'en'
+    assert user.last_seen_written == 1000
+
+
+@pytest.mark.asyncio
+async def test_update_and_invalidate():
+    cache = UserCache()
+    await cache.put(1, CachedUser(id=10, language='ru'))
+    await cache.update(1, is_blocked=True)
+    assert (await cache.get(1)).is_blocked
+
+    await cache.invalidate(1)
+    assert await cache.get(1) is None
+    assert cache.misses == 1
@@ -2,7 +2,7 @@
 Пакет утилит для бота уникализации
 """
 
-from .subscription_check import check_subscription, ensure_bot_can_check_subscription
+from .subscription_check import check_subscription, ensure_bot_can_check_subscription, subscription_cache
 from .image_utils import create_multiple_unique_images
 from .ffmpeg_utils import create_multiple_unique_videos, check_ffmpeg_installed
 from .localization import get_text
@@ -18,6 +18,7 @@ from .queue_manager import compression_queue, QueueManager
 __all__ = [
     'check_subscription',
     'ensure_bot_can_check_subscription',
+    'subscription_cache',
     'create_multiple_unique_images',
     'create_multiple_unique_videos',
     'check_ffmpeg_installed',
@@ -0,0 +1,145 @@
+"""
+Извлечение аудиодорожки без перекодирования
+
+Выбирается аудио-формат (audio-only, если платформа его отдает), а поток
+AAC/Opus копируется в контейнер m4a/ogg как есть. Перекодирование в MP3
+остается запасным вариантом для кодеков, которые клиент не принимает.
+"""
+
+import os
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import yt_dlp
+from yt_dlp.postprocessor import FFmpegExtractAudioPP
+
+logger = logging.getLogger(__name__)
+
+# Предпочитаем audio-only потоки, видео берем только если аудио отдельно нет
+AUDIO_ONLY_FORMAT = 'bestaudio[ext=m4a]/bestaudio[acodec^=opus]/bestaudio/best'
+
+# Кодек -> (preferredcodec для yt-dlp, итоговое расширение)
+NATIVE_AUDIO_TARGETS = {
+    'aac': ('m4a', '.m4a'),
+    'opus': ('opus', '.ogg'),
+    'vorbis': ('vorbis', '.ogg'),
+    'mp3': ('mp3', '.mp3'),
+}
+
+# Все расширения, которые может дать извлечение
+AUDIO_EXTENSIONS = ['.m4a', '.ogg', '.opus', '.mp3']
+
+
+def normalize_codec(acodec: Optional[str]) -> Optional[str]:
+    """Приводит кодек из метаданных yt-dlp к короткому имени (mp4a.40.2 -> aac)"""
+    if not acodec or acodec == 'none':
+        return None
+    acodec = acodec.lower()
+    if acodec.startswith(('mp4a', 'aac')):
+        return 'aac'
+    if acodec.startswith('opus'):
+        return 'opus'
+    if acodec.startswith('vorbis'):
+        return 'vorbis'
+    if acodec.startswith('mp3'):
+        return 'mp3'
+    return acodec
+
+
+def detect_audio_codec(info: Dict) -> Tuple[Optional[str], bool]:
+    """
+    Определяет аудиокодек выбранного формата
+
+    Returns:
+        Tuple[кодек, является ли формат audio-only]
+    """
+    requested = info.get('requested_formats')
+    if requested:
+        audio = next((f for f in requested if f.get('acodec') not in (None, 'none')), {})
+        return normalize_codec(audio.get('acodec')), audio.get('vcodec') in (None, 'none')
+
+    return normalize_codec(info.get('acodec')), info.get('vcodec') in (None, 'none')
+
+
+def choose_audio_target(codec: Optional[str], accepted_codecs: Iterable[str]) -> Tuple[str, str]:
+    """
+    Выбирает целевой кодек и расширение
+
+    Если клиент принимает кодек источника - поток копируется, иначе MP3.
+    """
+    accepted = {c.strip().lower() for c in accepted_codecs}
+    if codec in accepted and codec in NATIVE_AUDIO_TARGETS:
+        return NATIVE_AUDIO_TARGETS[codec]
+    return NATIVE_AUDIO_TARGETS['mp3']
+
+
+def _resolve_output(ydl: yt_dlp.YoutubeDL, info: Dict, target_ext: str) -> Optional[str]:
+    """Находит итоговый файл после постобработки"""
+    candidates: List[str] = []
+    for download in info.get('requested_downloads') or []:
+        if download.get('filepath'):
+            candidates.append(download['filepath'])
+    if info.get('filepath'):
+        candidates.append(info['filepath'])
+
+    base, _ = os.path.splitext(ydl.prepare_filename(info))
+    candidates.append(f"{base}{target_ext}")
+    candidates.extend(f"{base}{ext}" for ext in AUDIO_EXTENSIONS)
+
+    for path in candidates:
+        if path and os.path.exists(path) and os.path.splitext(path)[1].lower() in AUDIO_EXTENSIONS:
+            # Opus из yt-dlp приходит как .opus - это тот же контейнер Ogg
+            if path.lower().endswith('.opus'):
+                ogg_path = f"{os.path.splitext(path)[0]}.ogg"
+                os.replace(path, ogg_path)
+                return ogg_path
+            return path
+    return None
+
+
+def extract_audio(url: str, ydl_opts: Dict, output_dir: str,
+                  accepted_codecs: Iterable[str] = ('aac', 'opus'),
+                  mp3_quality: str = '192') -> Tuple[Optional[str], Optional[str]]:
+    """
+    Скачивает аудио (синхронно - вызывать через run_in_executor)
+
+    Метаданные запрашиваются один раз: по ним выбирается постобработка,
+    затем тот же info скачивается.
+
+    Args:
+        url: URL видео
+        ydl_opts: Базовые настройки yt-dlp (cookies, прокси, заголовки)
+        output_dir: Директория для результата
+        accepted_codecs: Кодеки, которые отправляются без перекодирования
+        mp3_quality: Битрейт MP3 для запасного варианта
+
+    Returns:
+        Tuple[путь к файлу, кодек результата]
+    """
+    opts = dict(ydl_opts)
+    opts['format'] = AUDIO_ONLY_FORMAT
+    opts['outtmpl'] = os.path.join(output_dir, '%(title).100s.%(ext)s')
+    opts.pop('postprocessors', None)
+
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+
+        codec, audio_only = detect_audio_codec(info)
+        preferred, target_ext = choose_audio_target(codec, accepted_codecs)
+
+        # Audio-only поток уже в нужном контейнере - постобработка не нужна
+        already_native = audio_only and f".{info.get('ext')}" == target_ext
+        if not already_native:
+            ydl.add_post_processor(
+                FFmpegExtractAudioPP(ydl, preferredcodec=preferred, preferredquality=mp3_quality),
+                when='post_process'
+            )
+
+        transcode = preferred == 'mp3' and codec != 'mp3'
+        logger.info(f"Audio source codec={codec} audio_only={audio_only} -> {preferred} "
+                    f"({'transcode' if transcode else 'stream copy'})")
+
+        info = ydl.process_ie_result(info, download=True)
+        path = _resolve_output(ydl, info, target_ext)
+
+    return path, preferred if path else None
@@ -0,0 +1,226 @@
+"""
+Токены отмены для пользовательских задач
+
+Каждая долгая операция (скачивание, уникализация, сжатие) получает токен.
+При отмене токен убивает группы процессов ffmpeg, прерывает yt-dlp через
+прогресс-хук, отзывает задачи Celery и отменяет asyncio-задачи. Токены
+собраны в реестре по user_id, чтобы кнопка "Назад" и /cancel могли
+остановить все задачи пользователя.
+"""
+
+import os
+import signal
+import asyncio
+import logging
+import threading
+import itertools
+from typing import Callable, Dict, List, Set
+
+logger = logging.getLogger(__name__)
+
+_token_ids = itertools.count(1)
+
+
+class JobCancelled(Exception):
+    """Задача отменена пользователем"""
+
+
+def subprocess_kwargs() -> dict:
+    """
+    Аргументы для запуска подпроцессов отдельной группой
+
+    Тогда при отмене можно убить ffmpeg вместе со всеми его потомками.
+    """
+    if os.name == 'posix':
+        return {'start_new_session': True}
+    return {}
+
+
+def _kill_process_group(process) -> None:
+    """Убивает процесс (asyncio.subprocess.Process или subprocess.Popen) и его группу"""
+    if process.returncode is not None:
+        return
+    try:
+        if os.name == 'posix':
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+    except Exception as e:
+        logger.warning(f"Failed to kill process {process.pid}: {e}")
+
+
+class CancellationToken:
+    """Токен отмены одной задачи пользователя"""
+
+    def __init__(self, user_id: int, name: str = 'job'):
+        self.id = next(_token_ids)
+        self.user_id = user_id
+        self.name = name
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._processes: List = []
+        self._celery_task_ids: List[str] = []
+        self._callbacks: List[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self) -> None:
+        if self.cancelled:
+            raise JobCancelled(f"{self.name} cancelled for user {self.user_id}")
+
+    def register_process(self, process) -> None:
+        """Регистрирует подпроцесс; если токен уже отменен - процесс убивается сразу"""
+        with self._lock:
+            self._processes.append(process)
+        if self.cancelled:
+            _kill_process_group(process)
+
+    def unregister_process(self, process) -> None:
+        with self._lock:
+            if process in self._processes:
+                self._processes.remove(process)
+
+    def register_celery_task(self, task_id: str) -> None:
+        with self._lock:
+            self._celery_task_ids.append(task_id)
+        if self.cancelled:
+            self._revoke_celery([task_id])
+
+    def add_callback(self, callback: Callable[[], None]) -> None:
+        """Добавляет действие при отмене (например, task.cancel)"""
+        with self._lock:
+            self._callbacks.append(callback)
+        if self.cancelled:
+            callback()
+
+    def attach_task(self, task: asyncio.Task) -> None:
+        """Связывает asyncio-задачу с токеном"""
+        loop = task.get_loop()
+
+        def _cancel_task():
+            if loop.is_closed():
+                return
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is loop:
+                task.cancel()
+            else:
+                loop.call_soon_threadsafe(task.cancel)
+
+        self.add_callback(_cancel_task)
+
+    def cancel(self) -> bool:
+        """
+        Отменяет задачу
+
+        Returns:
+            True, если токен был активен
+        """
+        if self._event.is_set():
+            return False
+        self._event.set()
+
+        with self._lock:
+            processes = list(self._processes)
+            task_ids = list(self._celery_task_ids)
+            callbacks = list(self._callbacks)
+
+        for process in processes:
+            _kill_process_group(process)
+
+        if task_ids:
+            self._revoke_celery(task_ids)
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"Cancellation callback failed: {e}")
+
+        logger.info(f"Cancelled {self.name} #{self.id} for user {self.user_id}")
+        return True
+
+    @staticmethod
+    def _revoke_celery(task_ids: List[str]) -> None:
+        try:
+            from celery_app import app as celery_app
+            celery_app.control.revoke(task_ids, terminate=True, signal='SIGTERM')
+        except Exception as e:
+            logger.warning(f"Failed to revoke Celery tasks {task_ids}: {e}")
+
+    def ytdlp_hook(self, d: dict) -> None:
+        """Прогресс-хук yt-dlp: прерывает скачивание после отмены"""
+        if self.cancelled:
+            try:
+                from yt_dlp.utils import DownloadCancelled
+            except ImportError:
+                raise JobCancelled(f"{self.name} cancelled")
+            raise DownloadCancelled(f"{self.name} cancelled by user")
+
+
+class CancellationRegistry:
+    """Реестр активных токенов по пользователям"""
+
+    def __init__(self):
+        self._tokens: Dict[int, Set[CancellationToken]] = {}
+        self._lock = threading.Lock()
+
+    def create(self, user_id: int, name: str = 'job') -> CancellationToken:
+        token = CancellationToken(user_id, name)
+        with self._lock:
+            self._tokens.setdefault(user_id, set()).add(token)
+        return token
+
+    def release(self, token: CancellationToken) -> None:
+        """Убирает завершенную задачу из реестра"""
+        with self._lock:
+            tokens = self._tokens.get(token.user_id)
+            if tokens:
+                tokens.discard(token)
+                if not tokens:
+                    del self._tokens[token.user_id]
+
+    def active(self, user_id: int) -> List[CancellationToken]:
+        with self._lock:
+            return list(self._tokens.get(user_id, ()))
+
+    def cancel_user(self, user_id: int) -> int:
+        """Отменяет все задачи пользователя, возвращает количество отмененных"""
+        with self._lock:
+            tokens = self._tokens.pop(user_id, set())
+        return sum(1 for token in tokens if token.cancel())
+
+
+# Глобальный реестр задач
+job_registry = CancellationRegistry()
+
+
+def cancel_user_jobs(user_id: int) -> int:
+    """
+    Отменяет все задачи пользователя: записи в очереди сжатия и активные токены
+
+    Каждая задача считается один раз: токен, уже отмененный очередью,
+    реестр не считает повторно (cancel() вернет False).
+
+    Returns:
+        Количество отмененных задач
+    """
+    cancelled = 0
+    try:
+        from utils.queue_manager import compression_queue
+        cancelled += compression_queue.cancel_user_tasks(user_id)
+    except ImportError:
+        pass
+
+    cancelled += job_registry.cancel_user(user_id)
+
+    if cancelled:
+        logger.info(f"Cancelled {cancelled} job(s) for user {user_id}")
+    return cancelled
+
@@ -10,6 +10,8 @@ from typing import Dict, Tuple, Optional
 from PIL import Image
 import ffmpeg
 
+from .cancellation import CancellationToken, subprocess_kwargs
+
 logger = logging.getLogger(__name__)
 
 
@@ -101,7 +103,8 @@ def compress_image_for_facebook(
 
 async def compress_video_for_facebook(
     input_path: str,
-    output_dir: str
+    output_dir: str,
+    cancel_token: Optional[CancellationToken] = None
 ) -> Tuple[str, Dict[str, float]]:
     """
     Сжимает видео для Facebook Ads используя H.265
@@ -109,6 +112,7 @@ async def compress_video_for_facebook(
     Args:
         input_path: Путь к исходному видео
         output_dir: Директория для сохранения
+        cancel_token: Токен отмены (ffmpeg убивается вместе с группой процессов)
     
     Returns:
         Tuple[str, Dict]: Путь к сжатому файлу и статистика сжатия
@@ -173,10 +177,20 @@ async def compress_video_for_facebook(
         process = await asyncio.create_subprocess_exec(
             *cmd,
             stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+            stderr=asyncio.subprocess.PIPE,
+            **subprocess_kwargs()
         )
         
-        stdout, stderr = await process.communicate()
+        if cancel_token:
+            cancel_token.register_process(process)
+        try:
+            stdout, stderr = await process.communicate()
+        finally:
+            if cancel_token:
+                cancel_token.unregister_process(process)
+        
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
         
         if process.returncode != 0:
             logger.error(f"FFmpeg error: {stderr.decode()}")
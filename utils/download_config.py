@@ -18,7 +18,8 @@ class DownloadConfig:
     
     # Качество
     video_quality: str = "best[height<=1080]"
-    audio_quality: str = "192"
+    audio_quality: str = "192"  # Битрейт MP3, если поток нельзя скопировать как есть
+    audio_native_codecs: List[str] = None  # Кодеки, которые отправляются без перекодирования
     compression_crf: int = 23  # 18-28, чем выше - тем больше сжатие
     
     # Таймауты
@@ -40,6 +41,9 @@ class DownloadConfig:
         if self.supported_audio_formats is None:
             self.supported_audio_formats = ['.mp3', '.m4a', '.ogg']
         
+        if self.audio_native_codecs is None:
+            self.audio_native_codecs = ['aac', 'opus']
+        
         if self.platform_settings is None:
             self.platform_settings = {
                 'tiktok': {
@@ -100,6 +104,9 @@ class DownloadConfig:
         if socket_timeout := os.getenv('SOCKET_TIMEOUT'):
             config.socket_timeout = int(socket_timeout)
         
+        if native_codecs := os.getenv('AUDIO_NATIVE_CODECS'):
+            config.audio_native_codecs = [c.strip() for c in native_codecs.split(',') if c.strip()]
+        
         return config
 
 
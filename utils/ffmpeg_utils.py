@@ -12,6 +12,8 @@ from typing import List, Dict, Optional
 from pathlib import Path
 import ffmpeg
 
+from .cancellation import CancellationToken, JobCancelled, subprocess_kwargs
+
 logger = logging.getLogger(__name__)
 
 
@@ -50,7 +52,8 @@ def get_video_info(input_path: str) -> Dict:
 async def process_video_uniqueness(
     input_path: str,
     output_dir: str,
-    params: dict
+    params: dict,
+    cancel_token: Optional[CancellationToken] = None
 ) -> str:
     """
     Применяет случайные методы уникализации к видео
@@ -59,6 +62,7 @@ async def process_video_uniqueness(
         input_path: Путь к исходному видео
         output_dir: Директория для сохранения результата
         params: Параметры уникализации из конфига
+        cancel_token: Токен отмены (ffmpeg убивается вместе с группой процессов)
     
     Returns:
         str: Путь к обработанному файлу
@@ -147,10 +151,20 @@ async def process_video_uniqueness(
         process = await asyncio.create_subprocess_exec(
             *cmd,
             stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+            stderr=asyncio.subprocess.PIPE,
+            **subprocess_kwargs()
         )
         
-        stdout, stderr = await process.communicate()
+        if cancel_token:
+            cancel_token.register_process(process)
+        try:
+            stdout, stderr = await process.communicate()
+        finally:
+            if cancel_token:
+                cancel_token.unregister_process(process)
+        
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
         
         if process.returncode != 0:
             logger.error(f"FFmpeg error: {stderr.decode()}")
@@ -169,7 +183,8 @@ async def create_multiple_unique_videos(
     output_dir: str,
     count: int,
     params: dict,
-    progress_callback=None
+    progress_callback=None,
+    cancel_token: Optional[CancellationToken] = None
 ) -> List[str]:
     """
     Создает несколько уникальных копий видео
@@ -180,6 +195,7 @@ async def create_multiple_unique_videos(
         count: Количество копий
         params: Параметры уникализации
         progress_callback: Функция для отправки прогресса
+        cancel_token: Токен отмены
     
     Returns:
         List[str]: Список путей к созданным файлам
@@ -188,12 +204,17 @@ async def create_multiple_unique_videos(
     
     for i in range(count):
         try:
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            
             if progress_callback:
                 await progress_callback(i + 1, count)
             
-            output_path = await process_video_uniqueness(input_path, output_dir, params)
+            output_path = await process_video_uniqueness(input_path, output_dir, params, cancel_token)
             results.append(output_path)
             logger.info(f"Created unique video {i+1}/{count}")
+        except JobCancelled:
+            raise
         except Exception as e:
             logger.error(f"Failed to create unique video {i+1}: {e}")
     
@@ -0,0 +1,214 @@
+"""
+Отправка результатов пользователю
+
+С self-hosted Bot API (--local) сервер сам читает файл по file:// URI,
+поэтому файл не прогоняется через multipart-кодировщик python-telegram-bot.
+Файл должен лежать на общем томе Bot API: рабочие директории задач уже
+создаются там (см. file_intake), остальные файлы подкладываются жесткой
+ссылкой. Если это невозможно - обычная загрузка через multipart.
+"""
+
+import os
+import uuid
+import shutil
+import logging
+from contextlib import AsyncExitStack, asynccontextmanager
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from telegram import InputMediaDocument, InputMediaPhoto, InputMediaVideo
+
+import config
+from .file_intake import WORKSPACE_SUBDIR
+
+logger = logging.getLogger(__name__)
+
+# Видео больше этого размера отправляем документом (без перекодирования на стороне Telegram)
+VIDEO_AS_DOCUMENT_LIMIT = 50 * 1024 * 1024
+# Telegram сжимает фото и не принимает больше 10MB - крупные отправляем документом
+PHOTO_AS_DOCUMENT_LIMIT = 10 * 1024 * 1024
+# Максимум элементов в медиагруппе
+MEDIA_GROUP_LIMIT = 10
+
+VIDEO_EXTENSIONS = {'.mp4', '.mov', '.mkv', '.webm', '.avi'}
+PHOTO_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
+AUDIO_EXTENSIONS = {'.m4a', '.mp3'}
+
+
+def configure_local_bot_api(builder):
+    """
+    Направляет ApplicationBuilder на self-hosted Bot API, если он включен
+
+    local_mode обязателен: без него PTB не принимает file:// URI в send_*
+    и не читает файлы из getFile по локальному пути.
+    """
+    if not config.USE_LOCAL_BOT_API:
+        return builder
+    # PTB сам дописывает токен к base_url и base_file_url
+    logger.info(f"Using self-hosted Bot API at {config.LOCAL_BOT_API_URL}")
+    return builder.base_url(f"{config.LOCAL_BOT_API_URL}/bot") \
+        .base_file_url(f"{config.LOCAL_BOT_API_URL}/file/bot") \
+        .local_mode(True)
+
+
+def choose_kind(path: str, preferred: str = 'auto') -> str:
+    """
+    Выбирает способ отправки по типу и размеру файла
+
+    Returns:
+        'video', 'photo', 'audio' или 'document'
+    """
+    ext = Path(path).suffix.lower()
+    size = os.path.getsize(path)
+
+    if preferred == 'auto':
+        if ext in VIDEO_EXTENSIONS:
+            preferred = 'video'
+        elif ext in PHOTO_EXTENSIONS:
+            preferred = 'photo'
+        elif ext in AUDIO_EXTENSIONS:
+            preferred = 'audio'
+        else:
+            preferred = 'document'
+
+    if preferred == 'video' and size > VIDEO_AS_DOCUMENT_LIMIT:
+        return 'document'
+    if preferred == 'photo' and size > PHOTO_AS_DOCUMENT_LIMIT:
+        return 'document'
+    return preferred
+
+
+def _server_path(path: str) -> Optional[str]:
+    """Путь к файлу бота в файловой системе сервера Bot API (None - файл вне тома)"""
+    mount_dir = os.path.realpath(config.LOCAL_BOT_API_MOUNT_DIR)
+    real_path = os.path.realpath(path)
+    if os.path.commonpath([mount_dir, real_path]) != mount_dir:
+        return None
+    relative = os.path.relpath(real_path, mount_dir)
+    return os.path.join(config.LOCAL_BOT_API_DATA_DIR, relative)
+
+
+def _stage(path: str, filename: str) -> Optional[Tuple[str, str]]:
+    """
+    Подкладывает файл на том Bot API под нужным именем
+
+    Сервер берет имя файла из пути, поэтому ссылка создается и тогда, когда
+    файл уже на томе, но должен называться иначе.
+
+    Returns:
+        Tuple[путь к ссылке, директория для удаления] или None
+    """
+    stage_dir = os.path.join(config.LOCAL_BOT_API_MOUNT_DIR, WORKSPACE_SUBDIR, 'outgoing', uuid.uuid4().hex)
+    try:
+        os.makedirs(stage_dir)
+        staged = os.path.join(stage_dir, filename)
+        os.link(path, staged)
+        return staged, stage_dir
+    except OSError as e:
+        logger.debug(f"Cannot stage {path} on Bot API volume: {e}")
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        return None
+
+
+@asynccontextmanager
+async def _open_input(path: str, filename: Optional[str] = None):
+    """
+    Отдает то, что передается в send_*: file:// URI или открытый файл
+
+    Yields:
+        Tuple[значение для отправки, загружается ли файл через multipart]
+    """
+    filename = filename or os.path.basename(path)
+    stage_dir = None
+    uri = None
+
+    if config.USE_LOCAL_BOT_API:
+        server_path = _server_path(path) if filename == os.path.basename(path) else None
+        if server_path is None:
+            staged = _stage(path, filename)
+            if staged:
+                staged_path, stage_dir = staged
+                server_path = _server_path(staged_path)
+        if server_path:
+            uri = Path(server_path).as_uri()
+
+    try:
+        if uri:
+            yield uri, False
+        else:
+            with open(path, 'rb') as f:
+                yield f, True
+    finally:
+        if stage_dir:
+            shutil.rmtree(stage_dir, ignore_errors=True)
+
+
+async def deliver_file(message, path: str, kind: str = 'auto', caption: Optional[str] = None,
+                       filename: Optional[str] = None, **kwargs) -> str:
+    """
+    Отправляет файл ответом на сообщение
+
+    Args:
+        message: Сообщение, на которое отвечаем
+        path: Путь к файлу
+        kind: 'auto', 'video', 'photo', 'audio' или 'document'
+        caption: Подпись
+        filename: Имя файла у пользователя
+        **kwargs: Дополнительные параметры reply_* (parse_mode, title, ...)
+
+    Returns:
+        Фактический способ отправки
+    """
+    kind = choose_kind(path, kind)
+    filename = filename or os.path.basename(path)
+
+    async with _open_input(path, filename) as (media, multipart):
+        if kind == 'video':
+            await message.reply_video(video=media, caption=caption, filename=filename,
+                                      supports_streaming=True, **kwargs)
+        elif kind == 'photo':
+            await message.reply_photo(photo=media, caption=caption, filename=filename, **kwargs)
+        elif kind == 'audio':
+            await message.reply_audio(audio=media, caption=caption, filename=filename, **kwargs)
+        else:
+            await message.reply_document(document=media, caption=caption, filename=filename, **kwargs)
+
+    logger.info(f"Delivered {filename} as {kind} ({'multipart' if multipart else 'local path'})")
+    return kind
+
+
+async def deliver_media_group(message, paths: List[str], caption: Optional[str] = None) -> bool:
+    """
+    Отправляет несколько результатов одной медиагруппой
+
+    Видео и фото в пределах лимитов идут как медиа, иначе вся группа
+    отправляется документами (Telegram не смешивает документы с медиа).
+
+    Returns:
+        False, если файлы не помещаются в одну группу - тогда вызывающий код
+        отправляет их иначе (например, архивом)
+    """
+    if not 2 <= len(paths) <= MEDIA_GROUP_LIMIT:
+        return False
+
+    kinds = [choose_kind(path) for path in paths]
+    as_media = all(kind in ('video', 'photo') for kind in kinds)
+
+    async with AsyncExitStack() as stack:
+        media = []
+        for index, (path, kind) in enumerate(zip(paths, kinds)):
+            value, _ = await stack.enter_async_context(_open_input(path))
+            item_caption = caption if index == 0 else None
+            filename = os.path.basename(path)
+            if as_media and kind == 'video':
+                media.append(InputMediaVideo(value, caption=item_caption, filename=filename,
+                                             supports_streaming=True))
+            elif as_media:
+                media.append(InputMediaPhoto(value, caption=item_caption, filename=filename))
+            else:
+                media.append(InputMediaDocument(value, caption=item_caption, filename=filename))
+
+        await message.reply_media_group(media=media)
+
+    logger.info(f"Delivered media group of {len(paths)} files")
+    return True
@@ -0,0 +1,174 @@
+"""
+Приемка файлов пользователя в рабочую директорию задачи
+
+С self-hosted Bot API (--local) файл уже лежит на диске сервера. Вместо
+скачивания по HTTP файл связывается с рабочей директорией: жесткая ссылка,
+затем reflink (copy-on-write), затем локальное копирование. HTTP остается
+запасным вариантом, если файловая система сервера недоступна.
+
+Входные файлы должны использоваться только на чтение: жесткая ссылка
+указывает на те же данные, что и кэш сервера Bot API.
+"""
+
+import os
+import errno
+import shutil
+import asyncio
+import logging
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import config
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# ioctl FICLONE (linux/fs.h): клонирование экстентов на btrfs/xfs
+FICLONE = 0x40049409
+
+# Поддиректория для рабочих директорий задач на томе Bot API
+WORKSPACE_SUBDIR = '.bot_jobs'
+
+
+def resolve_local_path(file_path: Optional[str]) -> Optional[Path]:
+    """
+    Переводит file_path из getFile в путь в файловой системе бота
+
+    Сервер отдает абсолютный путь в своей файловой системе
+    (LOCAL_BOT_API_DATA_DIR), PTB может дописать к нему base_file_url.
+    Путь переносится в точку монтирования LOCAL_BOT_API_MOUNT_DIR.
+
+    Returns:
+        Путь к существующему файлу или None
+    """
+    if not file_path:
+        return None
+
+    data_dir = config.LOCAL_BOT_API_DATA_DIR.rstrip('/') + '/'
+    index = file_path.find(data_dir)
+    if index == -1:
+        return None
+
+    relative = file_path[index + len(data_dir):]
+    mount_dir = os.path.realpath(config.LOCAL_BOT_API_MOUNT_DIR)
+    local_path = os.path.realpath(os.path.join(mount_dir, relative))
+
+    # Не выходим за пределы тома Bot API
+    if os.path.commonpath([mount_dir, local_path]) != mount_dir:
+        logger.warning(f"Rejected local file path outside Bot API dir: {file_path}")
+        return None
+
+    if not os.path.isfile(local_path):
+        return None
+    return Path(local_path)
+
+
+def _reflink(source: Path, destination: Path) -> None:
+    """Клонирует файл через FICLONE (без копирования данных)"""
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "reflink is not supported on this platform")
+
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.unlink(destination)
+            raise
+
+
+def link_or_copy(source: Path, destination: Path) -> str:
+    """
+    Переносит локальный файл в рабочую директорию самым дешевым способом
+
+    Returns:
+        Использованный способ: 'hardlink', 'reflink' или 'copy'
+    """
+    if destination.exists():
+        destination.unlink()
+
+    try:
+        os.link(source, destination)
+        return 'hardlink'
+    except OSError as e:
+        logger.debug(f"Hardlink {source} -> {destination} failed: {e}")
+
+    try:
+        _reflink(source, destination)
+        return 'reflink'
+    except OSError as e:
+        logger.debug(f"Reflink {source} -> {destination} failed: {e}")
+
+    shutil.copyfile(source, destination)
+    return 'copy'
+
+
+async def intake_telegram_file(bot, file_id: str, destination: Path, file=None) -> str:
+    """
+    Помещает файл из Telegram в destination
+
+    Args:
+        bot: Telegram Bot instance
+        file_id: ID файла
+        destination: Путь в рабочей директории задачи
+        file: Уже полученный telegram.File (чтобы не вызывать getFile повторно)
+
+    Returns:
+        Способ приемки: 'hardlink', 'reflink', 'copy' или 'http'
+    """
+    destination = Path(destination)
+    destination.parent.mkdir(parents=True, exist_ok=True)
+
+    if file is None:
+        file = await bot.get_file(file_id)
+
+    if config.USE_LOCAL_BOT_API:
+        local_path = resolve_local_path(file.file_path)
+        if local_path:
+            try:
+                loop = asyncio.get_running_loop()
+                method = await loop.run_in_executor(None, link_or_copy, local_path, destination)
+                logger.info(f"Intake {destination.name} via {method} from {local_path}")
+                return method
+            except OSError as e:
+                logger.warning(f"Local intake of {local_path} failed, falling back to HTTP: {e}")
+
+    await file.download_to_drive(destination)
+    logger.info(f"Intake {destination.name} via http")
+    return 'http'
+
+
+def _workspace_root() -> Optional[str]:
+    """
+    Корень рабочих директорий задач
+
+    Жесткая ссылка работает только в пределах одной точки монтирования,
+    поэтому в local-режиме рабочие директории создаются на томе Bot API.
+    """
+    root = config.INTAKE_WORKSPACE_DIR
+    if not root and config.USE_LOCAL_BOT_API and os.path.isdir(config.LOCAL_BOT_API_MOUNT_DIR):
+        root = os.path.join(config.LOCAL_BOT_API_MOUNT_DIR, WORKSPACE_SUBDIR)
+    if not root:
+        return None
+
+    try:
+        os.makedirs(root, exist_ok=True)
+        return root
+    except OSError as e:
+        logger.warning(f"Intake workspace {root} is unavailable, using system temp: {e}")
+        return None
+
+
+def intake_workspace(prefix: str = 'job_') -> tempfile.TemporaryDirectory:
+    """Временная рабочая директория задачи (удаляется при выходе из with)"""
+    return tempfile.TemporaryDirectory(prefix=prefix, dir=_workspace_root())
+
+
+def make_workspace(prefix: str = 'job_') -> str:
+    """Рабочая директория задачи, которую удаляет вызывающий код"""
+    return tempfile.mkdtemp(prefix=prefix, dir=_workspace_root())
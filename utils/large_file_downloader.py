@@ -8,6 +8,7 @@ import logging
 from pathlib import Path
 from typing import Optional
 import config
+from .file_intake import intake_telegram_file
 
 logger = logging.getLogger(__name__)
 
@@ -34,11 +35,10 @@ async def download_large_file(
         # Создаем директорию если не существует
         destination.parent.mkdir(parents=True, exist_ok=True)
         
-        # Просто пытаемся скачать файл любым способом
-        file = await bot.get_file(file_id)
-        await file.download_to_drive(destination)
+        # С локальным Bot API - ссылка на файл сервера, иначе HTTP
+        method = await intake_telegram_file(bot, file_id, destination)
         
-        logger.info(f"Successfully downloaded file: {destination.name}")
+        logger.info(f"Successfully downloaded file: {destination.name} ({method})")
         return True
         
     except Exception as e:
@@ -0,0 +1,463 @@
+"""
+Пул прокси для скачивания видео с учетом задержки и пропускной способности
+
+Прокси регистрируются независимо от cookies, получают оценку по реальным
+скачиваниям и фоновым TCP-пробам, а выбор делается взвешенно по ожидаемому
+времени загрузки. Для платформ, чувствительных к смене IP (Instagram),
+поддерживаются "липкие" сессии.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# Сглаживание EWMA: доля нового измерения
+EWMA_ALPHA = 0.3
+
+# Задержка по умолчанию для прокси без измерений (оптимистичная, чтобы их пробовали)
+DEFAULT_LATENCY_MS = 300.0
+
+# Эталонный объем для оценки времени скачивания (типичное короткое видео)
+REFERENCE_BYTES = 8 * 1024 * 1024
+
+# Сколько подряд ошибок выдерживает прокси до временного отключения
+MAX_CONSECUTIVE_FAILURES = 3
+
+# Базовое время "остывания" после серии ошибок, секунды
+FAILURE_COOLDOWN = 60.0
+
+
+def _ewma(current: Optional[float], sample: float) -> float:
+    """Экспоненциальное скользящее среднее"""
+    if current is None:
+        return sample
+    return current + EWMA_ALPHA * (sample - current)
+
+
+@dataclass
+class ProxyStats:
+    """Состояние и оценка одного прокси"""
+    url: str
+    proxy_id: Optional[int] = None
+    platforms: Optional[Set[str]] = None  # None - подходит для всех платформ
+    latency_ms: Optional[float] = None
+    throughput_bps: Optional[float] = None
+    success_count: int = 0
+    error_count: int = 0
+    consecutive_failures: int = 0
+    disabled_until: float = 0.0
+    last_checked_at: Optional[float] = None
+    dirty: bool = field(default=False, repr=False)
+
+    @property
+    def host_port(self) -> Tuple[str, int]:
+        """Хост и порт прокси для TCP-проб"""
+        parsed = urlparse(self.url if '://' in self.url else f"http://{self.url}")
+        default_port = 1080 if parsed.scheme.startswith('socks') else 8080
+        return parsed.hostname or '', parsed.port or default_port
+
+    def supports(self, platform: Optional[str]) -> bool:
+        return not self.platforms or platform is None or platform in self.platforms
+
+    def is_available(self, now: float) -> bool:
+        return self.disabled_until <= now
+
+    def expected_seconds(self, fallback_latency_ms: float) -> float:
+        """Ожидаемое время скачивания эталонного файла через этот прокси"""
+        latency = self.latency_ms if self.latency_ms is not None else fallback_latency_ms
+        seconds = latency / 1000.0
+        if self.throughput_bps:
+            seconds += REFERENCE_BYTES / self.throughput_bps
+        # Штраф за недавние ошибки
+        return seconds * (1 + self.consecutive_failures)
+
+
+class ProxyPool:
+    """Пул прокси со взвешенным выбором и липкими сессиями"""
+
+    def __init__(self, sticky_platforms: Optional[Set[str]] = None,
+                 sticky_ttl: float = 600.0, probe_timeout: float = 5.0,
+                 probe_concurrency: int = 10):
+        """
+        Args:
+            sticky_platforms: Платформы, для которых сессия закрепляется за прокси
+            sticky_ttl: Время жизни липкой сессии в секундах
+            probe_timeout: Таймаут TCP-пробы
+            probe_concurrency: Максимум одновременных проб
+        """
+        self.proxies: Dict[str, ProxyStats] = {}
+        self.sticky_platforms = set(sticky_platforms or ())
+        self.sticky_ttl = sticky_ttl
+        self.probe_timeout = probe_timeout
+        self.probe_concurrency = probe_concurrency
+
+        # (platform, session_key) -> (url, expires_at)
+        self._sticky: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        self._probe_task: Optional[asyncio.Task] = None
+        self._loaded = False
+
+    # ------------------------------------------------------------------
+    # Регистрация
+    # ------------------------------------------------------------------
+
+    def register(self, url: str, platforms: Optional[Set[str]] = None,
+                 proxy_id: Optional[int] = None) -> ProxyStats:
+        """Регистрирует прокси в пуле (повторная регистрация обновляет платформы)"""
+        url = url.strip()
+        stats = self.proxies.get(url)
+        if stats is None:
+            stats = ProxyStats(url=url, proxy_id=proxy_id, platforms=set(platforms) if platforms else None)
+            self.proxies[url] = stats
+            logger.info(f"Proxy registered: {self._mask(url)}")
+        else:
+            if platforms is not None:
+                stats.platforms = set(platforms) or None
+            if proxy_id is not None:
+                stats.proxy_id = proxy_id
+        return stats
+
+    def unregister(self, url: str) -> None:
+        """Удаляет прокси из пула и все закрепленные за ним сессии"""
+        self.proxies.pop(url, None)
+        self._sticky = {k: v for k, v in self._sticky.items() if v[0] != url}
+
+    async def load_from_db(self, db) -> int:
+        """Загружает активные прокси из таблицы download_proxies"""
+        try:
+            rows = await db.execute(
+                """
+                SELECT id, url, platforms, latency_ms, throughput_bps,
+                       COALESCE(success_count, 0) AS success_count,
+                       COALESCE(error_count, 0) AS error_count
+                FROM download_proxies
+                WHERE is_active = TRUE
+                """,
+                fetch=True
+            )
+        except Exception as e:
+            logger.error(f"Error loading proxies: {e}")
+            return 0
+
+        for row in rows or []:
+            platforms = {p.strip() for p in (row.get('platforms') or '').split(',') if p.strip()}
+            stats = self.register(row['url'], platforms or None, proxy_id=row['id'])
+            if stats.latency_ms is None:
+                stats.latency_ms = row.get('latency_ms')
+            if stats.throughput_bps is None:
+                stats.throughput_bps = row.get('throughput_bps')
+            stats.success_count = max(stats.success_count, row['success_count'])
+            stats.error_count = max(stats.error_count, row['error_count'])
+
+        self._loaded = True
+        return len(rows or [])
+
+    async def add_proxy(self, db, url: str, platforms: Optional[Set[str]] = None,
+                        added_by: Optional[int] = None) -> Optional[ProxyStats]:
+        """Сохраняет прокси в БД и регистрирует его в пуле"""
+        try:
+            result = await db.execute(
+                """
+                INSERT INTO download_proxies (url, platforms, added_by, is_active)
+                VALUES (%s, %s, %s, TRUE)
+                ON CONFLICT (url) DO UPDATE SET is_active = TRUE, platforms = EXCLUDED.platforms
+                RETURNING id
+                """,
+                (url, ','.join(sorted(platforms)) if platforms else None, added_by),
+                fetch=True
+            )
+        except Exception as e:
+            logger.error(f"Error adding proxy: {e}")
+            return None
+
+        proxy_id = result[0]['id'] if result else None
+        return self.register(url, platforms, proxy_id=proxy_id)
+
+    async def persist(self, db) -> int:
+        """Сохраняет накопленные оценки в БД одним запросом"""
+        dirty = [s for s in self.proxies.values() if s.dirty and s.proxy_id is not None]
+        if not dirty:
+            return 0
+
+        values = []
+        params = []
+        for stats in dirty:
+            values.append("(%s, %s, %s, %s, %s)")
+            params.extend([stats.proxy_id, stats.latency_ms, stats.throughput_bps,
+                           stats.success_count, stats.error_count])
+
+        query = f"""
+            UPDATE download_proxies AS p
+            SET latency_ms = v.latency_ms::double precision,
+                throughput_bps = v.throughput_bps::double precision,
+                success_count = v.success_count::integer,
+                error_count = v.error_count::integer,
+                last_checked_at = NOW()
+            FROM (VALUES {', '.join(values)})
+                AS v(id, latency_ms, throughput_bps, success_count, error_count)
+            WHERE p.id = v.id::integer
+        """
+        try:
+            await db.execute(query, tuple(params))
+        except Exception as e:
+            logger.error(f"Error persisting proxy stats: {e}")
+            return 0
+
+        for stats in dirty:
+            stats.dirty = False
+        return len(dirty)
+
+    # ------------------------------------------------------------------
+    # Выбор прокси
+    # ------------------------------------------------------------------
+
+    def acquire(self, platform: Optional[str] = None,
+                session_key: Optional[str] = None) -> Optional[str]:
+        """
+        Выбирает прокси для скачивания
+
+        Args:
+            platform: Платформа (instagram, youtube, tiktok)
+            session_key: Ключ липкой сессии (например, ID cookies или пользователя)
+
+        Returns:
+            URL прокси или None, если пул пуст
+        """
+        now = time.monotonic()
+        sticky_key = None
+
+        if platform in self.sticky_platforms and session_key is not None:
+            sticky_key = (platform, str(session_key))
+            pinned = self._sticky.get(sticky_key)
+            if pinned:
+                url, expires_at = pinned
+                stats = self.proxies.get(url)
+                if expires_at > now and stats and stats.is_available(now):
+                    self._sticky[sticky_key] = (url, now + self.sticky_ttl)
+                    return url
+                del self._sticky[sticky_key]
+
+        candidates = [s for s in self.proxies.values()
+                      if s.supports(platform) and s.is_available(now)]
+        if not candidates:
+            return None
+
+        url = self._weighted_choice(candidates)
+        if sticky_key is not None:
+            self._sticky[sticky_key] = (url, now + self.sticky_ttl)
+        return url
+
+    def _weighted_choice(self, candidates: List[ProxyStats]) -> str:
+        """Случайный выбор с весом, обратным ожидаемому времени скачивания"""
+        known = sorted(s.latency_ms for s in candidates if s.latency_ms is not None)
+        fallback = known[len(known) // 2] if known else DEFAULT_LATENCY_MS
+
+        weights = [1.0 / max(s.expected_seconds(fallback), 1e-3) for s in candidates]
+        return random.choices(candidates, weights=weights, k=1)[0].url
+
+    def release_sticky(self, platform: str, session_key: str) -> None:
+        """Снимает закрепление сессии (например, после смены cookies)"""
+        self._sticky.pop((platform, str(session_key)), None)
+
+    # ------------------------------------------------------------------
+    # Учет результатов
+    # ------------------------------------------------------------------
+
+    def report_success(self, url: str, latency_ms: Optional[float] = None,
+                       bytes_downloaded: Optional[int] = None,
+                       transfer_seconds: Optional[float] = None) -> None:
+        """Учитывает успешное скачивание или пробу"""
+        stats = self.proxies.get(url)
+        if stats is None:
+            return
+
+        if latency_ms is not None:
+            stats.latency_ms = _ewma(stats.latency_ms, latency_ms)
+        if bytes_downloaded and transfer_seconds and transfer_seconds > 0:
+            stats.throughput_bps = _ewma(stats.throughput_bps, bytes_downloaded / transfer_seconds)
+
+        stats.success_count += 1
+        stats.consecutive_failures = 0
+        stats.disabled_until = 0.0
+        stats.last_checked_at = time.monotonic()
+        stats.dirty = True
+
+    def report_failure(self, url: str) -> None:
+        """Учитывает ошибку; после серии ошибок прокси временно исключается"""
+        stats = self.proxies.get(url)
+        if stats is None:
+            return
+
+        stats.error_count += 1
+        stats.consecutive_failures += 1
+        stats.last_checked_at = time.monotonic()
+        stats.dirty = True
+
+        if stats.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+            cooldown = FAILURE_COOLDOWN * 2 ** (stats.consecutive_failures - MAX_CONSECUTIVE_FAILURES)
+            stats.disabled_until = time.monotonic() + min(cooldown, 3600.0)
+            logger.warning(f"Proxy {self._mask(url)} disabled for {cooldown:.0f}s "
+                           f"after {stats.consecutive_failures} failures")
+
+    # ------------------------------------------------------------------
+    # Пробы
+    # ------------------------------------------------------------------
+
+    async def probe(self, url: str) -> Optional[float]:
+        """Измеряет время TCP-подключения к прокси, мс"""
+        stats = self.proxies.get(url)
+        if stats is None:
+            return None
+
+        host, port = stats.host_port
+        started = time.perf_counter()
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), timeout=self.probe_timeout
+            )
+            latency_ms = (time.perf_counter() - started) * 1000
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+        except Exception as e:
+            logger.debug(f"Probe failed for {self._mask(url)}: {e}")
+            self.report_failure(url)
+            return None
+
+        # Проба - не реальное скачивание, поэтому счетчик успехов не трогаем
+        stats.latency_ms = _ewma(stats.latency_ms, latency_ms)
+        stats.consecutive_failures = 0
+        stats.disabled_until = 0.0
+        stats.last_checked_at = time.monotonic()
+        stats.dirty = True
+        return latency_ms
+
+    async def probe_all(self) -> Dict[str, Optional[float]]:
+        """Пробует все прокси с ограничением параллельности"""
+        semaphore = asyncio.Semaphore(self.probe_concurrency)
+
+        async def _probe(url: str):
+            async with semaphore:
+                return url, await self.probe(url)
+
+        results = await asyncio.gather(*(_probe(url) for url in list(self.proxies)))
+        return dict(results)
+
+    def start_probing(self, interval: float = 300.0, db=None) -> None:
+        """Запускает периодические пробы (и сохранение оценок, если передана БД)"""
+        if self._probe_task and not self._probe_task.done():
+            return
+
+        async def _loop():
+            while True:
+                try:
+                    if db is not None and not self._loaded:
+                        await self.load_from_db(db)
+                    await self.probe_all()
+                    if db is not None:
+                        await self.persist(db)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Proxy probe loop error: {e}")
+                await asyncio.sleep(interval)
+
+        self._probe_task = asyncio.create_task(_loop())
+
+    async def stop(self, db=None) -> None:
+        """Останавливает фоновые пробы и сохраняет оценки"""
+        if self._probe_task:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._probe_task = None
+        if db is not None:
+            await self.persist(db)
+
+    def get_stats(self) -> List[Dict]:
+        """Снимок состояния пула для админки"""
+        now = time.monotonic()
+        return [
+            {
+                'url': self._mask(s.url),
+                'platforms': sorted(s.platforms) if s.platforms else None,
+                'latency_ms': round(s.latency_ms, 1) if s.latency_ms is not None else None,
+                'throughput_kbps': round(s.throughput_bps / 1024, 1) if s.throughput_bps else None,
+                'success_count': s.success_count,
+                'error_count': s.error_count,
+                'available': s.is_available(now),
+            }
+            for s in self.proxies.values()
+        ]
+
+    @staticmethod
+    def _mask(url: str) -> str:
+        """Скрывает логин и пароль прокси в логах"""
+        if '@' not in url:
+            return url
+        scheme, _, rest = url.rpartition('://')
+        host = rest.split('@', 1)[1]
+        return f"{scheme}://***@{host}" if scheme else f"***@{host}"
+
+
+class DownloadMeter:
+    """
+    Прогресс-хук yt-dlp для измерения скачивания через прокси
+
+    Время до первого байта используется как задержка, а объем и длительность
+    передачи - для оценки пропускной способности.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.first_byte_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.bytes_downloaded = 0
+
+    def __call__(self, d: dict) -> None:
+        status = d.get('status')
+        if status == 'downloading' and self.first_byte_at is None and d.get('downloaded_bytes'):
+            self.first_byte_at = time.perf_counter()
+        elif status == 'finished':
+            self.finished_at = time.perf_counter()
+            self.bytes_downloaded += d.get('total_bytes') or d.get('downloaded_bytes') or 0
+
+    @property
+    def latency_ms(self) -> Optional[float]:
+        if self.first_byte_at is None:
+            return None
+        return (self.first_byte_at - self.started_at) * 1000
+
+    @property
+    def transfer_seconds(self) -> Optional[float]:
+        if self.first_byte_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.first_byte_at
+
+
+def _build_default_pool() -> ProxyPool:
+    """Создает глобальный пул из настроек"""
+    try:
+        import config
+        pool = ProxyPool(
+            sticky_platforms=set(config.PROXY_STICKY_PLATFORMS),
+            sticky_ttl=config.PROXY_STICKY_TTL
+        )
+        for url in config.DOWNLOAD_PROXIES:
+            pool.register(url)
+        return pool
+    except (ImportError, AttributeError):
+        return ProxyPool(sticky_platforms={'instagram'})
+
+
+# Глобальный пул прокси
+proxy_pool = _build_default_pool()
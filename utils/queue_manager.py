@@ -8,6 +8,8 @@ import psutil
 from typing import Optional, Callable, Any
 from datetime import datetime, timedelta
 
+from .cancellation import job_registry
+
 logger = logging.getLogger(__name__)
 
 
@@ -47,12 +49,20 @@ class QueueManager:
         # Информация о пользователях в очереди
         self.user_tasks = {}  # user_id: task_count
         
+        # Ожидающие задачи по пользователям (для отмены)
+        self.queued_tasks = {}  # user_id: list of task_info
+        
+        # Выполняющиеся задачи по пользователям (для отмены)
+        self.running_tasks = {}  # user_id: {asyncio.Task: cancel_token}
+        
     def get_queue_position(self, user_id: int) -> int:
         """Получает позицию пользователя в очереди"""
-        position = 0
-        for item in list(self.queue._queue):
-            position += 1
-            if item.get('user_id') == user_id:
+        waiting = sorted(
+            (item for tasks in self.queued_tasks.values() for item in tasks),
+            key=lambda item: item['added_at']
+        )
+        for position, item in enumerate(waiting, 1):
+            if item['user_id'] == user_id:
                 return position
         return 0
     
@@ -105,12 +115,14 @@ class QueueManager:
             'task_func': task_func,
             'args': args,
             'kwargs': kwargs,
+            'cancel_token': kwargs.get('cancel_token'),
             'added_at': datetime.now()
         }
         
         try:
             await self.queue.put(task_info)
             self.user_tasks[user_id] = user_task_count + 1
+            self.queued_tasks.setdefault(user_id, []).append(task_info)
             
             # Запускаем обработчик, если он еще не запущен
             asyncio.create_task(self._process_queue())
@@ -140,51 +152,130 @@ class QueueManager:
                     logger.info("Waiting for CPU load to decrease...")
                     await asyncio.sleep(5)
                 
+                # Очередь могла опустеть, пока ждали слот (или задачи отменили)
+                try:
+                    task_info = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                
+                user_id = task_info['user_id']
+                token = task_info.get('cancel_token')
+                self._forget_queued(task_info)
+                
+                if task_info.get('cancelled'):
+                    # Отменена в очереди: слот пользователя уже освобожден
+                    logger.info(f"Task for user {user_id} was cancelled before start")
+                    continue
+                
                 try:
-                    # Получаем задачу из очереди
-                    task_info = await self.queue.get()
-                    user_id = task_info['user_id']
-                    
                     # Проверяем, не устарела ли задача
                     task_age = datetime.now() - task_info['added_at']
                     if task_age > timedelta(minutes=10):
                         logger.warning(f"Task for user {user_id} is too old, skipping")
                         continue
                     
+                    if token and token.cancelled:
+                        logger.info(f"Task for user {user_id} was cancelled before start")
+                        continue
+                    
                     self.current_tasks += 1
                     logger.info(f"Processing task for user {user_id}, "
                               f"current tasks: {self.current_tasks}/{self.max_concurrent_tasks}")
                     
-                    # Выполняем задачу с таймаутом
+                    # Запускаем задачу отдельно, чтобы ее можно было отменить
+                    job = asyncio.ensure_future(
+                        task_info['task_func'](*task_info['args'], **task_info['kwargs'])
+                    )
+                    self.running_tasks.setdefault(user_id, {})[job] = token
+                    if token:
+                        token.attach_task(job)
+                    
                     try:
-                        result = await asyncio.wait_for(
-                            task_info['task_func'](*task_info['args'], **task_info['kwargs']),
-                            timeout=self.task_timeout
-                        )
-                        self.tasks_processed += 1
-                        logger.info(f"Task completed for user {user_id}")
-                        
-                    except asyncio.TimeoutError:
+                        done, _ = await asyncio.wait({job}, timeout=self.task_timeout)
+                    finally:
+                        running = self.running_tasks.get(user_id)
+                        if running:
+                            running.pop(job, None)
+                            if not running:
+                                del self.running_tasks[user_id]
+                        self.current_tasks -= 1
+                    
+                    if not done:
+                        job.cancel()
                         logger.error(f"Task timeout for user {user_id}")
                         self.tasks_failed += 1
-                        raise
+                    elif job.cancelled():
+                        logger.info(f"Task cancelled for user {user_id}")
+                    elif job.exception():
+                        logger.error(f"Error processing task: {job.exception()}")
+                        self.tasks_failed += 1
+                    else:
+                        self.tasks_processed += 1
+                        logger.info(f"Task completed for user {user_id}")
                         
                 except Exception as e:
                     logger.error(f"Error processing task: {e}")
                     self.tasks_failed += 1
                     
                 finally:
-                    self.current_tasks -= 1
-                    # Уменьшаем счетчик задач пользователя
-                    if user_id in self.user_tasks:
-                        self.user_tasks[user_id] -= 1
-                        if self.user_tasks[user_id] <= 0:
-                            del self.user_tasks[user_id]
+                    self._release_user_slot(user_id)
+                    if token:
+                        job_registry.release(token)
+    
+    def _forget_queued(self, task_info: dict) -> None:
+        """Убирает задачу из списка ожидающих пользователя"""
+        queued = self.queued_tasks.get(task_info['user_id'])
+        if queued and task_info in queued:
+            queued.remove(task_info)
+            if not queued:
+                del self.queued_tasks[task_info['user_id']]
+    
+    def _release_user_slot(self, user_id: int) -> None:
+        """Уменьшает счетчик задач пользователя"""
+        if user_id in self.user_tasks:
+            self.user_tasks[user_id] -= 1
+            if self.user_tasks[user_id] <= 0:
+                del self.user_tasks[user_id]
+    
+    def cancel_user_tasks(self, user_id: int) -> int:
+        """
+        Отменяет задачи пользователя: помечает ожидающие (обработчик их
+        пропустит) и отменяет выполняющиеся
+        
+        Задача с токеном отменяется через токен и считается, только если
+        токен еще не был отменен - иначе ее уже посчитал реестр.
+        
+        Returns:
+            int: Количество отмененных задач
+        """
+        cancelled = 0
+        
+        for item in self.queued_tasks.pop(user_id, []):
+            item['cancelled'] = True
+            token = item.get('cancel_token')
+            if token is None or token.cancel():
+                cancelled += 1
+            self._release_user_slot(user_id)
+        
+        for job, token in list(self.running_tasks.get(user_id, {}).items()):
+            if job.done():
+                continue
+            if token is not None:
+                # Токен отменит и саму задачу (attach_task)
+                if token.cancel():
+                    cancelled += 1
+            else:
+                job.cancel()
+                cancelled += 1
+        
+        if cancelled:
+            logger.info(f"Cancelled {cancelled} queued/running task(s) for user {user_id}")
+        return cancelled
     
     def get_stats(self) -> dict:
         """Получает статистику очереди"""
         return {
-            'queue_size': self.queue.qsize(),
+            'queue_size': sum(len(tasks) for tasks in self.queued_tasks.values()),
             'current_tasks': self.current_tasks,
             'max_concurrent': self.max_concurrent_tasks,
             'tasks_processed': self.tasks_processed,
@@ -0,0 +1,204 @@
+"""
+Ограничение скорости
+
+TokenBucket выдает не больше rate операций в секунду в среднем и до
+capacity подряд. Пауза (pause) останавливает всех ожидающих сразу - так
+обрабатывается RetryAfter от Telegram: лимит общий на бота, и после
+флуд-ошибки ждать должны все отправители, а не только получивший ее.
+
+RateLimiter - те же корзины, но по ключу (пользователь, профиль) и без
+ожидания: запрос сверх лимита сразу отклоняется. Корзины хранятся в Redis
+(лимит общий для всех реплик) или, без Redis, в памяти процесса. Корзина,
+которая успела наполниться, ничем не отличается от отсутствующей, поэтому
+простаивающие ключи удаляются (в Redis - по TTL).
+"""
+
+import time
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# KEYS: корзина; ARGV: токенов в секунду, емкость, стоимость, TTL (мс)
+# Время берется у Redis - одно для всех реплик
+# Возвращает {пропущен (1/0), сколько ждать до нужного числа токенов (строкой)}
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], ARGV[4])
+return {allowed, tostring(wait)}
+"""
+
+
+def retry_after_seconds(value: Union[int, float, timedelta]) -> float:
+    """RetryAfter.retry_after в секундах (в разных версиях PTB - число или timedelta)"""
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+class TokenBucket:
+    """Асинхронный token bucket"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """
+        Args:
+            rate: Сколько токенов добавляется в секунду
+            capacity: Размер корзины (максимальная пачка подряд), по умолчанию rate
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float) -> None:
+        """Останавливает выдачу токенов на seconds (повторные паузы не сокращают текущую)"""
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        # После паузы начинаем с пустой корзины, без пачки накопленных токенов
+        self.tokens = 0.0
+        self._updated = max(self._updated, self._paused_until)
+
+    @property
+    def paused_for(self) -> float:
+        return max(0.0, self._paused_until - time.monotonic())
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        """Ждет, пока в корзине будет tokens токенов, и забирает их"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+def parse_rate(spec: str) -> Tuple[float, float]:
+    """
+    Лимит в виде "N/секунд" -> (токенов в секунду, емкость)
+
+    "30/60" - 30 запросов подряд, затем по одному каждые 2 секунды.
+    """
+    count, _, period = spec.partition('/')
+    count = float(count)
+    period = float(period or 1)
+    if count <= 0 or period <= 0:
+        raise ValueError(f"Invalid rate limit: {spec!r}")
+    return count / period, count
+
+
+class RateLimiter:
+    """Token bucket по ключу: Redis (общий для реплик) или память процесса"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None,
+                 key_prefix: str = 'ratelimit:', redis=None, max_local_keys: int = 100000):
+        """
+        Args:
+            rate: Сколько токенов добавляется в секунду
+            capacity: Размер корзины (сколько запросов подряд), по умолчанию rate
+            key_prefix: Префикс ключей Redis
+            redis: Клиент Redis (по умолчанию общее подключение из infra.redis)
+            max_local_keys: После скольких корзин в памяти удалять простаивающие
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.key_prefix = key_prefix
+        self.redis = redis
+        self.max_local_keys = max_local_keys
+        # Полная корзина = отсутствующая: через это время ключ можно удалить
+        self.idle_ttl = self.capacity / self.rate
+        # key -> [токены, время обновления]
+        self._local: Dict[str, List[float]] = {}
+        self._last_sweep = time.monotonic()
+        self._next_sweep = self._last_sweep + self.idle_ttl
+        self._scripts = {}
+
+    def _redis(self):
+        """Подключение Redis (None - корзины в памяти процесса)"""
+        if self.redis is not None:
+            return self.redis
+        try:
+            from infra.redis import redis_manager
+            return redis_manager.redis
+        except ImportError:
+            return None
+
+    def _script(self, redis):
+        script = self._scripts.get(id(redis))
+        if script is None:
+            script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+            self._scripts[id(redis)] = script
+        return script
+
+    async def hit(self, key: str, cost: float = 1.0) -> Tuple[bool, float]:
+        """
+        Забирает cost токенов из корзины key, если они есть
+
+        Returns:
+            (пропущен, через сколько секунд в корзине будет cost токенов)
+        """
+        redis = self._redis()
+        if redis is not None:
+            try:
+                ttl_ms = int(self.idle_ttl * 1000) + 1000
+                allowed, wait = await self._script(redis)(
+                    keys=[self.key_prefix + key], args=[self.rate, self.capacity, cost, ttl_ms]
+                )
+                return allowed == 1, float(wait)
+            except Exception as e:
+                logger.warning(f"Redis rate limit failed, using local buckets: {e}")
+        return self.hit_local(key, cost)
+
+    def hit_local(self, key: str, cost: float = 1.0) -> Tuple[bool, float]:
+        """То же в памяти процесса (O(1), простаивающие корзины удаляются)"""
+        now = time.monotonic()
+        self._evict(now)
+        bucket = self._local.get(key)
+        if bucket is None:
+            bucket = self._local[key] = [self.capacity, now]
+        tokens = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens >= cost:
+            bucket[0] = tokens - cost
+            return True, 0.0
+        bucket[0] = tokens
+        return False, (cost - tokens) / self.rate
+
+    def _evict(self, now: float) -> None:
+        # Проход по всем корзинам раз в idle_ttl, при переполнении - не чаще раза в секунду
+        if now < self._next_sweep and (len(self._local) < self.max_local_keys or now < self._last_sweep + 1.0):
+            return
+        cutoff = now - self.idle_ttl
+        for key in [key for key, (_, updated) in self._local.items() if updated <= cutoff]:
+            del self._local[key]
+        self._last_sweep = now
+        self._next_sweep = now + self.idle_ttl
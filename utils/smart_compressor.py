@@ -4,11 +4,11 @@
 
 import asyncio
 import logging
-import tempfile
 import os
 from pathlib import Path
 from typing import Optional, Tuple
 import config
+from .file_intake import intake_telegram_file, make_workspace
 
 logger = logging.getLogger(__name__)
 
@@ -17,7 +17,8 @@ async def compress_for_telegram(
     bot,
     file_id: str, 
     original_filename: str,
-    progress_callback: Optional[callable] = None
+    progress_callback: Optional[callable] = None,
+    workspace: Optional[Path] = None
 ) -> Tuple[Optional[Path], Optional[str]]:
     """
     Скачивает файл, автоматически сжимая большие файлы без уведомлений
@@ -27,6 +28,8 @@ async def compress_for_telegram(
         file_id: ID файла для скачивания/сжатия
         original_filename: Оригинальное имя файла
         progress_callback: Функция для уведомления о прогрессе
+        workspace: Рабочая директория задачи (иначе создается новая,
+            удалять ее должен вызывающий код)
     
     Returns:
         Tuple[Path, str]: (путь к готовому файлу, сообщение об ошибке)
@@ -36,16 +39,16 @@ async def compress_for_telegram(
         file = await bot.get_file(file_id)
         file_size_mb = file.file_size / (1024 * 1024)
         
-        temp_dir = tempfile.mkdtemp()
+        temp_dir = workspace or make_workspace()
         temp_path = Path(temp_dir) / original_filename
         
         if progress_callback:
             await progress_callback("downloading", file_size_mb)
         
-        # Скачиваем файл напрямую
-        await file.download_to_drive(temp_path)
+        # С локальным Bot API файл связывается с диска сервера, иначе - HTTP
+        method = await intake_telegram_file(bot, file_id, temp_path, file=file)
         
-        logger.info(f"Downloaded file: {temp_path.name} ({file_size_mb:.1f}MB)")
+        logger.info(f"Downloaded file: {temp_path.name} ({file_size_mb:.1f}MB, {method})")
         
         # Возвращаем скачанный файл
         return temp_path, None
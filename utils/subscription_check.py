@@ -1,17 +1,238 @@
 """
 Утилита для проверки подписки пользователя на канал
+
+Статус подписки кэшируется в Redis: подписка - надолго, ее отсутствие -
+ненадолго (пользователь подписывается и сразу жмет "Проверить"). Кэш
+обновляется апдейтами chat_member из канала (бот должен быть в нем
+админом), а для недавно активных пользователей заполняется заранее в
+фоне, так что на /start и выборе языка запроса к Telegram обычно нет.
+Без Redis статус каждый раз запрашивается у Telegram.
 """
 
+import asyncio
 import logging
-from telegram import Bot
+from datetime import datetime, timedelta
+from telegram import Bot, Update
 from telegram.constants import ChatMemberStatus
-from telegram.error import TelegramError
-from typing import Optional
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import ContextTypes
+from typing import Dict, Iterable, List, Optional
+
+from .rate_limit import TokenBucket, retry_after_seconds
 
 logger = logging.getLogger(__name__)
 
+SUBSCRIBED_STATUSES = (
+    ChatMemberStatus.MEMBER,
+    ChatMemberStatus.ADMINISTRATOR,
+    ChatMemberStatus.OWNER
+)
+
+ACTIVE_USERS_SQL = """
+    SELECT tg_id FROM users
+    WHERE last_seen_at >= %s AND NOT COALESCE(is_blocked, FALSE)
+    ORDER BY last_seen_at DESC
+    LIMIT %s
+"""
+
+
+def _channel(channel_username: str) -> Optional[str]:
+    """Username канала с @ (None - канал не настроен или указан неверно)"""
+    # Если канал не указан или пустой, пропускаем проверку
+    if not channel_username or channel_username in ['@channel_username', '']:
+        logger.info("Channel username not configured, skipping subscription check")
+        return None
+
+    # Убедимся, что username начинается с @
+    if not channel_username.startswith('@'):
+        channel_username = f'@{channel_username}'
+
+    # Проверяем, что это не ссылка
+    if channel_username.startswith('@https://') or 'https://' in channel_username:
+        logger.error(f"Invalid channel username format: {channel_username}. Use @username format instead of link")
+        return None
+    return channel_username
+
+
+class SubscriptionCache:
+    """Кэш статуса подписки в Redis"""
+
+    def __init__(self, positive_ttl: int = 21600, negative_ttl: int = 60, key_prefix: str = 'sub:',
+                 redis=None):
+        """
+        Args:
+            positive_ttl: Сколько хранить "подписан", сек
+            negative_ttl: Сколько хранить "не подписан", сек
+            key_prefix: Префикс ключей
+            redis: Клиент Redis (по умолчанию общее подключение из infra.redis)
+        """
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.key_prefix = key_prefix
+        self.redis = redis
+        # Фоновое заполнение: запросов к Telegram в секунду, окно активности (дней), максимум пользователей
+        self.warmup_rate = 10.0
+        self.warmup_days = 7
+        self.warmup_limit = 5000
+        self._task: Optional[asyncio.Task] = None
+
+    def configure(self, positive_ttl: Optional[int] = None, negative_ttl: Optional[int] = None,
+                  warmup_rate: Optional[float] = None, warmup_days: Optional[int] = None,
+                  warmup_limit: Optional[int] = None) -> None:
+        if positive_ttl is not None:
+            self.positive_ttl = positive_ttl
+        if negative_ttl is not None:
+            self.negative_ttl = negative_ttl
+        if warmup_rate is not None:
+            self.warmup_rate = warmup_rate
+        if warmup_days is not None:
+            self.warmup_days = warmup_days
+        if warmup_limit is not None:
+            self.warmup_limit = warmup_limit
+
+    def _redis(self):
+        """Подключение Redis (None - кэш выключен)"""
+        if self.redis is not None:
+            return self.redis
+        try:
+            from infra.redis import redis_manager
+            return redis_manager.redis
+        except ImportError:
+            return None
+
+    def key(self, channel: str, user_id: int) -> str:
+        return f"{self.key_prefix}{channel.lstrip('@').lower()}:{user_id}"
+
+    async def get(self, channel: str, user_id: int) -> Optional[bool]:
+        """Статус из кэша (None - нет в кэше)"""
+        redis = self._redis()
+        if redis is None:
+            return None
+        try:
+            value = await redis.get(self.key(channel, user_id))
+        except Exception as e:
+            logger.warning(f"Subscription cache read failed: {e}")
+            return None
+        return None if value is None else value == '1'
+
+    async def set(self, channel: str, user_id: int, subscribed: bool) -> None:
+        await self.set_many(channel, {user_id: subscribed})
+
+    async def set_many(self, channel: str, statuses: Dict[int, bool]) -> None:
+        redis = self._redis()
+        if redis is None or not statuses:
+            return
+        try:
+            pipe = redis.pipeline(transaction=False)
+            for user_id, subscribed in statuses.items():
+                ttl = self.positive_ttl if subscribed else self.negative_ttl
+                pipe.set(self.key(channel, user_id), '1' if subscribed else '0', ex=ttl)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Subscription cache write failed: {e}")
+
+    async def missing(self, channel: str, user_ids: List[int]) -> List[int]:
+        """Пользователи, статуса которых нет в кэше"""
+        redis = self._redis()
+        result = []
+        for start in range(0, len(user_ids), 1000):
+            chunk = user_ids[start:start + 1000]
+            values = await redis.mget([self.key(channel, user_id) for user_id in chunk])
+            result.extend(user_id for user_id, value in zip(chunk, values) if value is None)
+        return result
+
+    async def handle_chat_member(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Обработчик chat_member: пользователь вступил в канал или вышел из него"""
+        changed = update.chat_member
+        if changed is None or not changed.chat.username:
+            return
+        member = changed.new_chat_member
+        subscribed = member.status in SUBSCRIBED_STATUSES
+        logger.debug(f"User {member.user.id} subscription to @{changed.chat.username} changed: {member.status}")
+        await self.set(f"@{changed.chat.username}", member.user.id, subscribed)
+
+    async def warm_up(self, bot: Bot, channel_username: str, user_ids: Iterable[int]) -> int:
+        """
+        Запрашивает статус пользователей, которых нет в кэше
 
-async def check_subscription(bot: Bot, user_id: int, channel_username: str) -> bool:
+        Returns:
+            Сколько статусов запрошено
+        """
+        channel = _channel(channel_username)
+        if channel is None or self._redis() is None:
+            return 0
+
+        todo = await self.missing(channel, list(dict.fromkeys(user_ids)))
+        bucket = TokenBucket(self.warmup_rate)
+
+        async def _fetch(user_id: int) -> Optional[bool]:
+            for _ in range(3):
+                await bucket.acquire()
+                try:
+                    member = await bot.get_chat_member(channel, user_id)
+                    return member.status in SUBSCRIBED_STATUSES
+                except RetryAfter as e:
+                    # Флуд-лимит общий на бота - пропускаем вперед запросы пользователей
+                    bucket.pause(retry_after_seconds(e.retry_after))
+                except TelegramError as e:
+                    logger.debug(f"Subscription warm-up failed for user {user_id}: {e}")
+                    return None
+            return None
+
+        fetched = 0
+        for start in range(0, len(todo), 50):
+            chunk = todo[start:start + 50]
+            statuses = await asyncio.gather(*(_fetch(user_id) for user_id in chunk))
+            fetched += sum(status is not None for status in statuses)
+            # "Не подписан" истекло бы раньше, чем понадобится - кэшируем только подписки
+            await self.set_many(channel, {
+                user_id: True for user_id, status in zip(chunk, statuses) if status
+            })
+        return fetched
+
+    async def warm_up_active(self, database, bot: Bot, channel_username: str) -> int:
+        """Заполняет кэш для пользователей, активных за последние warmup_days дней"""
+        since = datetime.utcnow() - timedelta(days=self.warmup_days)
+        rows = await database.execute(ACTIVE_USERS_SQL, (since, self.warmup_limit), fetch=True) or []
+        fetched = await self.warm_up(bot, channel_username, [row['tg_id'] for row in rows])
+        logger.info(f"Subscription cache warm-up: {fetched} of {len(rows)} active users fetched")
+        return fetched
+
+    def start(self, database, bot: Bot, channel_username: str, interval: float = 3600.0) -> None:
+        """Запускает периодическое заполнение кэша (истекшие записи активных пользователей)"""
+        if self._task and not self._task.done():
+            return
+        if _channel(channel_username) is None:
+            return
+
+        async def _loop():
+            while True:
+                try:
+                    await self.warm_up_active(database, bot, channel_username)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Subscription cache warm-up failed: {e}")
+                await asyncio.sleep(interval)
+
+        self._task = asyncio.create_task(_loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Глобальный кэш подписок
+subscription_cache = SubscriptionCache()
+
+
+async def check_subscription(bot: Bot, user_id: int, channel_username: str,
+                             recheck_negative: bool = False) -> bool:
     """
     Проверяет, подписан ли пользователь на указанный канал
     
@@ -19,40 +240,22 @@ async def check_subscription(bot: Bot, user_id: int, channel_username: str) -> b
         bot: Экземпляр бота
         user_id: ID пользователя для проверки
         channel_username: Username канала (с @ или без)
+        recheck_negative: Не доверять закэшированному "не подписан" (кнопка "Проверить подписку")
     
     Returns:
         bool: True если подписан, False если нет
     """
-    # Если канал не указан или пустой, пропускаем проверку
-    if not channel_username or channel_username in ['@channel_username', '']:
-        logger.info("Channel username not configured, skipping subscription check")
-        return True
-        
+    channel = _channel(channel_username)
+    if channel is None:
+        return True  # Пропускаем проверку при неправильном формате
+
+    cached = await subscription_cache.get(channel, user_id)
+    if cached or (cached is False and not recheck_negative):
+        return cached
+
     try:
-        # Убедимся, что username начинается с @
-        if not channel_username.startswith('@'):
-            channel_username = f'@{channel_username}'
-        
-        # Проверяем, что это не ссылка
-        if channel_username.startswith('@https://') or 'https://' in channel_username:
-            logger.error(f"Invalid channel username format: {channel_username}. Use @username format instead of link")
-            return True  # Пропускаем проверку при неправильном формате
-        
         # Получаем информацию о статусе пользователя в канале
-        member = await bot.get_chat_member(channel_username, user_id)
-        
-        # Проверяем статус
-        if member.status in [
-            ChatMemberStatus.MEMBER,
-            ChatMemberStatus.ADMINISTRATOR,
-            ChatMemberStatus.OWNER
-        ]:
-            logger.info(f"User {user_id} is subscribed to {channel_username}")
-            return True
-        else:
-            logger.info(f"User {user_id} is NOT subscribed to {channel_username} (status: {member.status})")
-            return False
-            
+        member = await bot.get_chat_member(channel, user_id)
     except TelegramError as e:
         logger.error(f"Error checking subscription for user {user_id}: {e}")
         # В случае ошибки (например, бот не админ в канале) разрешаем доступ
@@ -61,6 +264,15 @@ async def check_subscription(bot: Bot, user_id: int, channel_username: str) -> b
         logger.error(f"Unexpected error checking subscription: {e}")
         return True
 
+    # Проверяем статус
+    subscribed = member.status in SUBSCRIBED_STATUSES
+    if subscribed:
+        logger.info(f"User {user_id} is subscribed to {channel}")
+    else:
+        logger.info(f"User {user_id} is NOT subscribed to {channel} (status: {member.status})")
+    await subscription_cache.set(channel, user_id, subscribed)
+    return subscribed
+
 
 async def ensure_bot_can_check_subscription(bot: Bot, channel_username: str) -> Optional[str]:
     """
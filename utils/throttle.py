@@ -0,0 +1,103 @@
+"""
+Ограничение частоты запросов пользователя
+
+UpdateThrottle регистрируется как TypeHandler в группе -1 и выполняется
+до всех остальных обработчиков. Каждый апдейт относится к классу
+стоимости по правилам (фильтр сообщения или шаблон callback_data; первое
+подходящее правило, иначе default) и забирает токен из корзины
+пользователя этого класса. Если токенов нет, апдейт дальше не идет
+(ApplicationHandlerStop) - до обращений к БД и обработки медиа.
+"""
+
+import re
+import time
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes, TypeHandler
+
+from .localization import get_text
+from .rate_limit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CLASS = 'default'
+
+
+class UpdateThrottle:
+    """Per-user token bucket по классам стоимости апдейтов"""
+
+    def __init__(self, limiters: Dict[str, RateLimiter], exempt_user_ids: Iterable[int] = ()):
+        """
+        Args:
+            limiters: Класс стоимости -> лимитер (класса нет - без ограничения)
+            exempt_user_ids: Пользователи без ограничений (админы)
+        """
+        self.limiters = limiters
+        self.exempt_user_ids = set(exempt_user_ids)
+        self._rules: List[Tuple[str, object, Optional[re.Pattern]]] = []
+        # user_id -> до какого момента уже предупрежден (чтобы не отвечать на каждое сообщение)
+        self._notified: Dict[int, float] = {}
+
+    def add_rule(self, cost_class: str, message_filter=None, callback_pattern: Optional[str] = None) -> None:
+        """
+        Относит к cost_class сообщения под message_filter или callback_data под callback_pattern
+        """
+        pattern = re.compile(callback_pattern) if callback_pattern else None
+        self._rules.append((cost_class, message_filter, pattern))
+
+    def classify(self, update: Update) -> str:
+        """Класс стоимости апдейта"""
+        query = update.callback_query
+        for cost_class, message_filter, pattern in self._rules:
+            if pattern is not None and query is not None and query.data and pattern.match(query.data):
+                return cost_class
+            if message_filter is not None and update.effective_message and query is None:
+                if message_filter.check_update(update):
+                    return cost_class
+        return DEFAULT_CLASS
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        if user is None or user.id in self.exempt_user_ids:
+            return
+        # Служебные апдейты (chat_member и т.п.) не ограничиваются
+        if update.callback_query is None and update.message is None and update.edited_message is None:
+            return
+
+        cost_class = self.classify(update)
+        limiter = self.limiters.get(cost_class)
+        if limiter is None:
+            return
+
+        allowed, wait = await limiter.hit(f"{cost_class}:{user.id}")
+        if allowed:
+            return
+
+        logger.info(f"Rate limited user {user.id} ({cost_class}), retry in {wait:.1f}s")
+        try:
+            await self._notify(update, context, user.id, wait)
+        except Exception as e:
+            logger.debug(f"Failed to notify rate limited user {user.id}: {e}")
+        raise ApplicationHandlerStop
+
+    async def _notify(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, wait: float) -> None:
+        text = get_text(context, 'rate_limited', seconds=max(1, round(wait)))
+        if update.callback_query:
+            # На нажатие кнопки нужно ответить в любом случае - иначе висят "часики"
+            await update.callback_query.answer(text)
+            return
+
+        now = time.monotonic()
+        if self._notified.get(user_id, 0) > now:
+            return
+        if len(self._notified) > 10000:
+            self._notified = {uid: until for uid, until in self._notified.items() if until > now}
+        self._notified[user_id] = now + max(wait, 1.0)
+        if update.effective_message:
+            await update.effective_message.reply_text(text)
+
+    def register(self, application) -> None:
+        """Добавляет проверку перед всеми обработчиками приложения"""
+        application.add_handler(TypeHandler(Update, self), group=-1)
@@ -17,7 +17,9 @@ from datetime import datetime
 from .url_validator import URLValidator
 from .secure_file_handler import SecureFileHandler, secure_temp_context
 from .download_config import DownloadConfig, ErrorMessages
+from .audio_extractor import extract_audio, AUDIO_EXTENSIONS
 from .progress_tracker import VideoProcessingProgressTracker
+from .cancellation import CancellationToken, JobCancelled
 
 logger = logging.getLogger(__name__)
 
@@ -84,7 +86,8 @@ class VideoDownloader:
         return None
     
     async def download_video_async(self, url: str, message=None, output_dir: Optional[str] = None, 
-                                   user_id: Optional[int] = None) -> Tuple[Optional[str], Optional[str]]:
+                                   user_id: Optional[int] = None,
+                                   cancel_token: Optional[CancellationToken] = None) -> Tuple[Optional[str], Optional[str]]:
         """
         Асинхронная загрузка видео с прогресс-трекингом
         
@@ -93,9 +96,13 @@ class VideoDownloader:
             message: Telegram сообщение для отображения прогресса
             output_dir: Директория для сохранения
             user_id: ID пользователя для персонализации
+            cancel_token: Токен отмены задачи
             
         Returns:
             Tuple[путь к файлу, сообщение об ошибке]
+            
+        Raises:
+            JobCancelled: если задача отменена пользователем
         """
         # Валидация URL
         is_valid, error_msg = URLValidator.validate_url(url)
@@ -134,6 +141,8 @@ class VideoDownloader:
                 if progress_tracker:
                     opts['progress_hooks'] = [progress_tracker.get_progress_callback()]
                     await progress_tracker.set_stage('downloading')
+                if cancel_token:
+                    opts.setdefault('progress_hooks', []).append(cancel_token.ytdlp_hook)
                 
                 # Выполняем загрузку в executor для избежания блокировки
                 loop = asyncio.get_event_loop()
@@ -143,6 +152,9 @@ class VideoDownloader:
                     sanitized_url, opts
                 )
                 
+                if cancel_token:
+                    cancel_token.raise_if_cancelled()
+                
                 if result[1]:  # Если есть ошибка
                     if progress_tracker:
                         await progress_tracker.finish_error(platform, 'download_failed', error=result[1])
@@ -170,6 +182,8 @@ class VideoDownloader:
                 
                 return processed_path, None
                 
+        except JobCancelled:
+            raise
         except Exception as e:
             logger.error(f"Unexpected error downloading video: {e}")
             error_msg = ErrorMessages.get_error_message('general', 'processing_error')
@@ -307,16 +321,21 @@ class VideoDownloader:
             logger.error(f"Unexpected error downloading video: {e}")
             return None, "Произошла непредвиденная ошибка при скачивании"
     
-    def download_audio(self, url: str, output_dir: Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
+    def download_audio(self, url: str, output_dir: Optional[str] = None,
+                       cancel_token: Optional[CancellationToken] = None) -> Tuple[Optional[str], Optional[str]]:
         """
         Скачивает только аудио из видео с проверками безопасности
         
         Args:
             url: URL видео
             output_dir: Директория для сохранения
+            cancel_token: Токен отмены задачи
             
         Returns:
             Tuple[путь к файлу, сообщение об ошибке]
+            
+        Raises:
+            JobCancelled: если задача отменена пользователем
         """
         # Валидация URL
         is_valid, error_msg = URLValidator.validate_url(url)
@@ -340,39 +359,36 @@ class VideoDownloader:
                 if not output_dir:
                     output_dir = file_handler.create_secure_temp_dir(suffix="_audio")
             
-            # Настройки для извлечения аудио
-            opts = self.base_ydl_opts.copy()
-            opts['format'] = 'bestaudio[ext=m4a]/bestaudio'
-            opts['outtmpl'] = os.path.join(output_dir, '%(title)s.%(ext)s')
-            opts['postprocessors'] = [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }]
+            ydl_opts = dict(self.base_ydl_opts)
+            if cancel_token:
+                ydl_opts['progress_hooks'] = [cancel_token.ytdlp_hook]
             
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                info = ydl.extract_info(sanitized_url, download=True)
-                
-                # Получаем имя файла
-                filename = ydl.prepare_filename(info)
-                base, _ = os.path.splitext(filename)
-                audio_filename = f"{base}.mp3"
-                
-                # Проверяем файл на существование и валидность
-                if os.path.exists(audio_filename):
-                    # Валидируем аудиофайл
-                    if SecureFileHandler.validate_file_path(audio_filename, ['.mp3']):
-                        file_size = os.path.getsize(audio_filename)
-                        if file_size > 0:
-                            logger.debug(f"Audio file size: {file_size} bytes")
-                            return audio_filename, None
-                        else:
-                            return None, "Извлеченный аудиофайл пустой"
+            # Извлекаем аудио: AAC/Opus копируются без перекодирования, MP3 - запасной вариант
+            audio_filename, _ = extract_audio(
+                sanitized_url,
+                ydl_opts,
+                output_dir,
+                accepted_codecs=self.config.audio_native_codecs,
+                mp3_quality=self.config.audio_quality
+            )
+            
+            # Проверяем файл на существование и валидность
+            if audio_filename and os.path.exists(audio_filename):
+                # Валидируем аудиофайл
+                if SecureFileHandler.validate_file_path(audio_filename, AUDIO_EXTENSIONS):
+                    file_size = os.path.getsize(audio_filename)
+                    if file_size > 0:
+                        logger.debug(f"Audio file size: {file_size} bytes")
+                        return audio_filename, None
                     else:
-                        return None, "Аудиофайл не прошел проверку безопасности"
+                        return None, "Извлеченный аудиофайл пустой"
                 else:
-                    return None, "Не удалось извлечь аудио"
+                    return None, "Аудиофайл не прошел проверку безопасности"
+            else:
+                return None, "Не удалось извлечь аудио"
                     
+        except (yt_dlp.utils.DownloadCancelled, JobCancelled):
+            raise JobCancelled("audio download cancelled")
         except Exception as e:
             logger.error(f"Error extracting audio: {e}")
             return None, "Ошибка при извлечении аудио"
@@ -13,24 +13,34 @@ import cv2
 import numpy as np
 import asyncio
 import json
+import time
 from datetime import datetime
 
+from utils.proxy_pool import proxy_pool as default_proxy_pool, DownloadMeter
+from utils.audio_extractor import extract_audio
+from utils.download_config import DownloadConfig
+from utils.cancellation import CancellationToken, JobCancelled, subprocess_kwargs
+
 logger = logging.getLogger(__name__)
 
 
 class EnhancedVideoDownloader:
     """Улучшенный класс для скачивания видео с ротацией cookies"""
     
-    def __init__(self, cookies_manager=None, db=None, max_file_size: int = 50 * 1024 * 1024):
+    def __init__(self, cookies_manager=None, db=None, max_file_size: int = 50 * 1024 * 1024,
+                 proxy_pool=None):
         """
         Args:
             cookies_manager: Менеджер cookies для ротации
             db: База данных для логирования
             max_file_size: Максимальный размер файла в байтах (50MB по умолчанию)
+            proxy_pool: Пул прокси (по умолчанию глобальный)
         """
         self.max_file_size = max_file_size
         self.cookies_manager = cookies_manager
         self.db = db
+        self.proxy_pool = proxy_pool or default_proxy_pool
+        self.download_config = DownloadConfig.from_env()
         
         # Счетчики попыток
         self.max_retries = 3
@@ -56,6 +66,22 @@ class EnhancedVideoDownloader:
             'instagram': r'(?:instagram\.com|instagr\.am)',
         }
     
+    def _select_proxy(self, platform: str, cookie_data: Optional[Dict],
+                      user_id: Optional[int]) -> Optional[str]:
+        """
+        Выбирает прокси для попытки скачивания
+
+        Прокси, привязанный к строке cookies, имеет приоритет (аккаунт должен
+        ходить с одного IP). Иначе прокси берется из пула; липкая сессия
+        привязывается к cookies, а без них - к пользователю.
+        """
+        if cookie_data and cookie_data.get('proxy'):
+            return cookie_data['proxy']
+        if not self.proxy_pool:
+            return None
+        session_key = f"cookie:{cookie_data['id']}" if cookie_data else f"user:{user_id}"
+        return self.proxy_pool.acquire(platform, session_key)
+    
     def detect_platform(self, url: str) -> Optional[str]:
         """Определяет платформу по URL"""
         for platform, pattern in self.platform_patterns.items():
@@ -63,13 +89,27 @@ class EnhancedVideoDownloader:
                 return platform
         return None
     
+    @staticmethod
+    def _run_ytdlp(opts: dict, url: str) -> Tuple[Dict, str]:
+        """Синхронно скачивает через yt-dlp (для run_in_executor)"""
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(url, download=True)
+            return info, ydl.prepare_filename(info)
+    
     async def download_video_with_retry(self, url: str, user_id: Optional[int] = None,
-                                       output_dir: Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
+                                       output_dir: Optional[str] = None,
+                                       cancel_token: Optional[CancellationToken] = None) -> Tuple[Optional[str], Optional[str]]:
         """
         Скачивает видео с автоматической ротацией cookies при ошибках
         
+        Args:
+            cancel_token: Токен отмены; скачивание прерывается через прогресс-хук
+        
         Returns:
             Tuple[путь к файлу, сообщение об ошибке]
+        
+        Raises:
+            JobCancelled: если задача отменена пользователем
         """
         platform = self.detect_platform(url)
         if not platform:
@@ -87,8 +127,12 @@ class EnhancedVideoDownloader:
         fingerprint = FingerprintGenerator.generate(platform)
         
         while attempts < self.max_retries:
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
             attempts += 1
             cookie_data = None
+            proxy_url = None
+            meter = DownloadMeter()
             
             try:
                 # Настройки для попытки
@@ -108,69 +152,89 @@ class EnhancedVideoDownloader:
                         cookie_file = self._create_temp_cookie_file(cookie_data['cookies'])
                         opts['cookiefile'] = cookie_file
                         
-                        # Используем user-agent и proxy из cookies если есть
+                        # Используем user-agent из cookies если есть
                         if cookie_data.get('user_agent'):
                             opts['user_agent'] = cookie_data['user_agent']
-                        if cookie_data.get('proxy'):
-                            opts['proxy'] = cookie_data['proxy']
                         
                         logger.info(f"Using cookies {cookie_data['id']} for {platform}")
                 
+                # Прокси: из cookies или из пула
+                proxy_url = self._select_proxy(platform, cookie_data, user_id)
+                if proxy_url:
+                    opts['proxy'] = proxy_url
+                opts['progress_hooks'] = [meter]
+                if cancel_token:
+                    opts['progress_hooks'].append(cancel_token.ytdlp_hook)
+                
                 # Специфичные настройки для платформ
                 opts = self._apply_platform_settings(opts, platform)
                 
                 # Пробуем скачать
                 logger.info(f"Downloading video from {platform} (attempt {attempts}/{self.max_retries}): {url}")
                 
-                with yt_dlp.YoutubeDL(opts) as ydl:
-                    info = ydl.extract_info(url, download=True)
-                    
-                    # Получаем имя скачанного файла
-                    filename = ydl.prepare_filename(info)
-                    # Заменяем расширение на актуальное
-                    base, _ = os.path.splitext(filename)
-                    actual_filename = f"{base}.{info.get('ext', 'mp4')}"
-                    
-                    # Проверяем существование файла
-                    if not os.path.exists(actual_filename):
-                        # Пробуем найти файл с любым расширением
-                        for ext in ['mp4', 'webm', 'mkv', 'avi', 'mov', 'flv']:
-                            test_path = f"{base}.{ext}"
-                            if os.path.exists(test_path):
-                                actual_filename = test_path
-                                break
-                        else:
-                            raise Exception("Файл не был скачан")
-                    
-                    # Проверяем размер файла
-                    file_size = os.path.getsize(actual_filename)
-                    
-                    # Логируем успешное скачивание
-                    await self._log_download(
-                        user_id=user_id,
-                        platform=platform,
-                        url=url,
-                        cookie_id=cookie_data['id'] if cookie_data else None,
-                        success=True,
-                        file_size=file_size
+                # yt-dlp блокирующий - выполняем в пуле потоков, чтобы отмена
+                # и остальные апдейты обрабатывались во время скачивания
+                loop = asyncio.get_event_loop()
+                info, filename = await loop.run_in_executor(None, self._run_ytdlp, opts, url)
+                
+                # Заменяем расширение на актуальное
+                base, _ = os.path.splitext(filename)
+                actual_filename = f"{base}.{info.get('ext', 'mp4')}"
+                
+                # Проверяем существование файла
+                if not os.path.exists(actual_filename):
+                    # Пробуем найти файл с любым расширением
+                    for ext in ['mp4', 'webm', 'mkv', 'avi', 'mov', 'flv']:
+                        test_path = f"{base}.{ext}"
+                        if os.path.exists(test_path):
+                            actual_filename = test_path
+                            break
+                    else:
+                        raise Exception("Файл не был скачан")
+                
+                # Проверяем размер файла
+                file_size = os.path.getsize(actual_filename)
+                
+                # Обновляем оценку прокси по реальному скачиванию
+                if proxy_url and self.proxy_pool:
+                    self.proxy_pool.report_success(
+                        proxy_url,
+                        latency_ms=meter.latency_ms,
+                        bytes_downloaded=meter.bytes_downloaded or file_size,
+                        transfer_seconds=meter.transfer_seconds
                     )
-                    
-                    # Отмечаем успешное использование cookies
-                    if cookie_data and self.cookies_manager:
-                        await self.cookies_manager.mark_success(cookie_data['id'])
-                    
-                    # Проверяем размер и сжимаем если нужно
-                    if file_size > self.max_file_size:
-                        compressed_path = await self._compress_video_async(actual_filename, output_dir)
-                        if compressed_path:
-                            os.remove(actual_filename)
-                            return compressed_path, None
-                        else:
-                            os.remove(actual_filename)
-                            max_size_mb = self.max_file_size // (1024 * 1024)
-                            return None, f"Видео слишком большое ({file_size // 1024 // 1024}MB). Максимум {max_size_mb}MB."
-                    
-                    return actual_filename, None
+                
+                # Логируем успешное скачивание
+                await self._log_download(
+                    user_id=user_id,
+                    platform=platform,
+                    url=url,
+                    cookie_id=cookie_data['id'] if cookie_data else None,
+                    success=True,
+                    file_size=file_size,
+                    download_time=time.perf_counter() - meter.started_at
+                )
+                
+                # Отмечаем успешное использование cookies
+                if cookie_data and self.cookies_manager:
+                    await self.cookies_manager.mark_success(cookie_data['id'])
+                
+                # Проверяем размер и сжимаем если нужно
+                if file_size > self.max_file_size:
+                    compressed_path = await self._compress_video_async(actual_filename, output_dir, cancel_token)
+                    if compressed_path:
+                        os.remove(actual_filename)
+                        return compressed_path, None
+                    else:
+                        os.remove(actual_filename)
+                        max_size_mb = self.max_file_size // (1024 * 1024)
+                        return None, f"Видео слишком большое ({file_size // 1024 // 1024}MB). Максимум {max_size_mb}MB."
+                
+                return actual_filename, None
+                
+            except (yt_dlp.utils.DownloadCancelled, JobCancelled):
+                logger.info(f"Download cancelled by user {user_id}: {url}")
+                raise JobCancelled("video download cancelled")
                 
             except yt_dlp.utils.DownloadError as e:
                 error_msg = str(e)
@@ -196,6 +260,10 @@ class EnhancedVideoDownloader:
                     logger.info(f"Authentication error, trying different cookies...")
                     continue
                 
+                # Остальные ошибки (таймауты, обрывы) засчитываем прокси
+                if proxy_url and self.proxy_pool:
+                    self.proxy_pool.report_failure(proxy_url)
+                
             except Exception as e:
                 last_error = f"Неожиданная ошибка: {str(e)}"
                 logger.error(f"Unexpected error (attempt {attempts}): {e}")
@@ -300,7 +368,8 @@ class EnhancedVideoDownloader:
     async def _log_download(self, user_id: Optional[int], platform: str, url: str,
                            cookie_id: Optional[int], success: bool,
                            error_message: Optional[str] = None,
-                           file_size: Optional[int] = None) -> None:
+                           file_size: Optional[int] = None,
+                           download_time: Optional[float] = None) -> None:
         """Логирует попытку скачивания в БД"""
         if not self.db:
             return
@@ -308,19 +377,20 @@ class EnhancedVideoDownloader:
         try:
             query = """
                 INSERT INTO download_logs 
-                (user_id, platform, url, cookie_id, success, error_message, file_size, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
+                (user_id, platform, url, cookie_id, success, error_message, file_size, download_time, created_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())
             """
             
             await self.db.execute(
                 query,
-                (user_id or 0, platform, url, cookie_id, success, error_message, file_size)
+                (user_id or 0, platform, url, cookie_id, success, error_message, file_size, download_time)
             )
             
         except Exception as e:
             logger.error(f"Error logging download: {e}")
     
-    async def _compress_video_async(self, input_path: str, output_dir: str) -> Optional[str]:
+    async def _compress_video_async(self, input_path: str, output_dir: str,
+                                    cancel_token: Optional[CancellationToken] = None) -> Optional[str]:
         """Асинхронно сжимает видео с помощью ffmpeg"""
         try:
             base_name = os.path.basename(input_path)
@@ -340,14 +410,24 @@ class EnhancedVideoDownloader:
                 output_path
             ]
             
-            # Запускаем асинхронно
+            # Запускаем асинхронно отдельной группой процессов (для отмены)
             process = await asyncio.create_subprocess_exec(
                 *cmd,
                 stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
+                stderr=asyncio.subprocess.PIPE,
+                **subprocess_kwargs()
             )
             
-            stdout, stderr = await process.communicate()
+            if cancel_token:
+                cancel_token.register_process(process)
+            try:
+                stdout, stderr = await process.communicate()
+            finally:
+                if cancel_token:
+                    cancel_token.unregister_process(process)
+            
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
             
             if process.returncode != 0:
                 logger.error(f"FFmpeg compression error: {stderr.decode()}")
@@ -360,13 +440,16 @@ class EnhancedVideoDownloader:
                 os.remove(output_path)
                 return None
                 
+        except JobCancelled:
+            raise
         except Exception as e:
             logger.error(f"Error compressing video: {e}")
             return None
     
     async def download_audio(self, url: str, user_id: Optional[int] = None,
-                           output_dir: Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
-        """Скачивает только аудио из видео"""
+                           output_dir: Optional[str] = None,
+                           cancel_token: Optional[CancellationToken] = None) -> Tuple[Optional[str], Optional[str]]:
+        """Скачивает только аудио из видео (JobCancelled - при отмене пользователем)"""
         platform = self.detect_platform(url)
         if not platform:
             return None, "Неподдерживаемая платформа"
@@ -379,47 +462,56 @@ class EnhancedVideoDownloader:
             from utils.cookies_manager import FingerprintGenerator
             fingerprint = FingerprintGenerator.generate(platform)
             
-            # Настройки для извлечения аудио
+            # Настройки для извлечения аудио (формат и постобработку выбирает extract_audio)
             opts = self.base_ydl_opts.copy()
-            opts['format'] = 'bestaudio[ext=m4a]/bestaudio/best[height<=720]/best'
-            opts['outtmpl'] = os.path.join(output_dir, '%(title).100s.%(ext)s')
             opts['user_agent'] = fingerprint['user_agent']
-            opts['postprocessors'] = [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }]
             
             # Получаем cookies если доступны
+            cookie_data = None
             if self.cookies_manager:
                 cookie_data = await self.cookies_manager.get_cookies(platform)
                 if cookie_data:
                     cookie_file = self._create_temp_cookie_file(cookie_data['cookies'])
                     opts['cookiefile'] = cookie_file
             
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                
-                # Получаем имя файла
-                filename = ydl.prepare_filename(info)
-                base, _ = os.path.splitext(filename)
-                audio_filename = f"{base}.mp3"
+            proxy_url = self._select_proxy(platform, cookie_data, user_id)
+            if proxy_url:
+                opts['proxy'] = proxy_url
+            
+            if cancel_token:
+                opts['progress_hooks'] = [cancel_token.ytdlp_hook]
+            
+            # AAC/Opus копируются в m4a/ogg без перекодирования, MP3 - только как запасной вариант
+            loop = asyncio.get_event_loop()
+            audio_filename, _ = await loop.run_in_executor(
+                None,
+                lambda: extract_audio(
+                    url,
+                    opts,
+                    output_dir,
+                    accepted_codecs=self.download_config.audio_native_codecs,
+                    mp3_quality=self.download_config.audio_quality
+                )
+            )
+            
+            if audio_filename and os.path.exists(audio_filename):
+                # Логируем успешное скачивание
+                await self._log_download(
+                    user_id=user_id,
+                    platform=platform,
+                    url=url,
+                    cookie_id=cookie_data['id'] if cookie_data else None,
+                    success=True,
+                    file_size=os.path.getsize(audio_filename)
+                )
                 
-                if os.path.exists(audio_filename):
-                    # Логируем успешное скачивание
-                    await self._log_download(
-                        user_id=user_id,
-                        platform=platform,
-                        url=url,
-                        cookie_id=cookie_data['id'] if 'cookie_data' in locals() and cookie_data else None,
-                        success=True,
-                        file_size=os.path.getsize(audio_filename)
-                    )
-                    
-                    return audio_filename, None
-                else:
-                    return None, "Не удалось извлечь аудио"
+                return audio_filename, None
+            else:
+                return None, "Не удалось извлечь аудио"
                     
+        except (yt_dlp.utils.DownloadCancelled, JobCancelled):
+            logger.info(f"Audio extraction cancelled by user {user_id}: {url}")
+            raise JobCancelled("audio download cancelled")
         except Exception as e:
             logger.error(f"Error extracting audio: {e}")
             return None, "Ошибка при извлечении аудио"
@@ -3,9 +3,9 @@
 """
 
 import json
+import asyncio
 import logging
 import hashlib
-from datetime import datetime, timedelta
 from typing import Dict, Optional, Any
 from urllib.parse import parse_qs
 
@@ -14,8 +14,12 @@ from telegram import Bot
 from telegram.constants import ParseMode
 
 from database import Database
-from database.keitaro_models import KeitaroProfile, KeitaroRoute, KeitaroEvent, MatchByType
+from database.keitaro_models import KeitaroProfile
 from features.keitaro.templates import get_message_template
+from features.keitaro.routing import RouteCache, route_cache as default_route_cache
+from features.keitaro.dedup import PostbackDeduplicator
+from features.keitaro.delivery import DeliveryQueue, QueuedEvent
+from utils.rate_limit import RateLimiter
 
 logger = logging.getLogger(__name__)
 
@@ -23,12 +27,21 @@ logger = logging.getLogger(__name__)
 class KeitaroWebServer:
     """Веб-сервер для приема postback от Keitaro"""
     
-    def __init__(self, bot: Bot, database: Database, port: int = 8080):
+    def __init__(self, bot: Bot, database: Database, port: int = 8080,
+                 route_cache: Optional[RouteCache] = None, dedup: Optional[PostbackDeduplicator] = None,
+                 delivery: Optional[DeliveryQueue] = None):
         self.bot = bot
         self.db = database
         self.port = port
+        # Профили и правила маршрутизации в памяти (сбрасываются при изменении профиля)
+        self.route_cache = route_cache or default_route_cache
+        # Захват tx_id в Redis (SET NX), без Redis - поиск в keitaro_events
+        self.dedup = dedup or PostbackDeduplicator(database)
+        # Очередь доставки: postback подтверждается сразу, отправка - в фоне (None - сразу в обработчике)
+        self.delivery = delivery
         self.app = web.Application()
-        self.rate_limiter = {}  # Простой in-memory rate limiter
+        # rate_limit_rps -> token bucket профилей с этим лимитом (в Redis - общий для реплик)
+        self.rate_limiters: Dict[int, RateLimiter] = {}
         
         # Регистрируем маршруты
         self.app.router.add_post('/integrations/keitaro/postback', self.handle_postback)
@@ -43,6 +56,7 @@ class KeitaroWebServer:
         Обработчик postback от Keitaro
         Принимает application/x-www-form-urlencoded или application/json
         """
+        claimed = False
         try:
             # Получаем secret из query параметров
             secret = request.query.get('secret')
@@ -80,16 +94,18 @@ class KeitaroWebServer:
                 tx_id = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:32]
                 event_data['no_tx'] = True
             
+            # Проверяем rate limit (до захвата tx_id - иначе повтор отклоненного станет дубликатом)
+            if not await self._check_rate_limit(profile.id, profile.rate_limit_rps):
+                logger.warning(f"Rate limit exceeded for profile {profile.id}")
+                return web.json_response({'ok': False, 'error': 'rate_limit_exceeded'})
+            
             # Проверяем дедупликацию
             is_duplicate = await self._check_duplicate(profile.id, tx_id, profile.dedup_ttl_sec)
             if is_duplicate:
                 logger.info(f"Duplicate event for tx_id: {tx_id}")
                 return web.json_response({'ok': True, 'dedup': True})
-            
-            # Проверяем rate limit
-            if not self._check_rate_limit(profile.id, profile.rate_limit_rps):
-                logger.warning(f"Rate limit exceeded for profile {profile.id}")
-                return web.json_response({'ok': False, 'error': 'rate_limit_exceeded'})
+            # Дальше любая ошибка отпускает tx_id - повтор Keitaro обработает событие заново
+            claimed = True
             
             # Определяем маршрутизацию
             target_chat, target_topic = await self._route_event(profile, event_data)
@@ -98,6 +114,10 @@ class KeitaroWebServer:
                 logger.info(f"No matching route for event: {event_data}")
                 return web.json_response({'ok': True, 'routed': False})
             
+            if self.delivery is not None:
+                await self.delivery.enqueue(QueuedEvent(profile.id, tx_id, event_data, target_chat, target_topic))
+                return web.json_response({'ok': True, 'queued': True})
+            
             # Формируем и отправляем сообщение
             message = get_message_template(event_data)
             
@@ -134,10 +154,19 @@ class KeitaroWebServer:
                     target_chat, target_topic, 
                     processed=False, error=str(e)
                 )
+                claimed = False
+                await self.dedup.release(profile.id, tx_id)
                 return web.json_response({'ok': False, 'error': 'send_failed'})
             
+        except asyncio.CancelledError:
+            # Клиент отключился посреди обработки
+            if claimed:
+                await self.dedup.release(profile.id, tx_id)
+            raise
         except Exception as e:
             logger.error(f"Error in postback handler: {e}", exc_info=True)
+            if claimed:
+                await self.dedup.release(profile.id, tx_id)
             return web.json_response({'ok': False, 'error': 'internal_error'})
     
     def _extract_event_data(self, payload: Dict) -> Dict[str, Any]:
@@ -169,112 +198,28 @@ class KeitaroWebServer:
         }
     
     async def _get_profile_by_secret(self, secret: str) -> Optional[KeitaroProfile]:
-        """Получает профиль по secret"""
-        query = """
-            SELECT * FROM keitaro_profiles 
-            WHERE secret = %s AND enabled = true 
-            LIMIT 1
-        """
-        result = await self.db.execute(query, (secret,), fetch=True)
-        if result:
-            # Простое преобразование в объект
-            profile = KeitaroProfile()
-            for key, value in result[0].items():
-                setattr(profile, key, value)
-            return profile
-        return None
+        """Получает профиль по secret (из кэша, БД - только при промахе)"""
+        return await self.route_cache.profile(self.db, secret)
     
     async def _check_duplicate(self, profile_id: int, tx_id: str, ttl_sec: int) -> bool:
-        """Проверяет дупликат события"""
-        query = """
-            SELECT id FROM keitaro_events 
-            WHERE profile_id = %s 
-            AND transaction_id = %s 
-            AND created_at > %s
-            LIMIT 1
-        """
-        threshold = datetime.utcnow() - timedelta(seconds=ttl_sec)
-        result = await self.db.execute(query, (profile_id, tx_id, threshold), fetch=True)
-        return bool(result)
+        """Проверяет дупликат события и захватывает tx_id, если это не дубликат"""
+        return not await self.dedup.claim(profile_id, tx_id, ttl_sec)
     
-    def _check_rate_limit(self, profile_id: int, max_rps: int) -> bool:
-        """Простая проверка rate limit"""
-        import time
-        now = time.time()
-        
-        if profile_id not in self.rate_limiter:
-            self.rate_limiter[profile_id] = []
-        
-        # Очищаем старые записи
-        self.rate_limiter[profile_id] = [
-            t for t in self.rate_limiter[profile_id] 
-            if now - t < 1.0
-        ]
-        
-        # Проверяем лимит
-        if len(self.rate_limiter[profile_id]) >= max_rps:
-            return False
-        
-        # Добавляем текущий запрос
-        self.rate_limiter[profile_id].append(now)
-        return True
+    async def _check_rate_limit(self, profile_id: int, max_rps: int) -> bool:
+        """Token bucket профиля: max_rps запросов в секунду, до max_rps подряд"""
+        limiter = self.rate_limiters.get(max_rps)
+        if limiter is None:
+            limiter = RateLimiter(max_rps, key_prefix='ratelimit:keitaro:profile:')
+            self.rate_limiters[max_rps] = limiter
+        allowed, _ = await limiter.hit(str(profile_id))
+        return allowed
     
     async def _route_event(
         self, profile: KeitaroProfile, event_data: Dict
     ) -> tuple[Optional[int], Optional[int]]:
         """Определяет маршрутизацию события"""
-        # Получаем правила маршрутизации
-        query = """
-            SELECT * FROM keitaro_routes 
-            WHERE profile_id = %s 
-            ORDER BY priority ASC, id ASC
-        """
-        routes = await self.db.execute(query, (profile.id,), fetch=True)
-        
-        for route in routes:
-            # Проверяем соответствие
-            if route['match_by'] == MatchByType.CAMPAIGN_ID.value:
-                if not self._match_value(
-                    event_data.get('campaign_id', ''), 
-                    route['match_value'], 
-                    route['is_regex']
-                ):
-                    continue
-            elif route['match_by'] == MatchByType.SOURCE.value:
-                if not self._match_value(
-                    event_data.get('source', ''), 
-                    route['match_value'], 
-                    route['is_regex']
-                ):
-                    continue
-            elif route['match_by'] != MatchByType.ANY.value:
-                continue
-            
-            # Проверяем фильтры
-            if route['status_filter']:
-                if event_data.get('status') not in route['status_filter']:
-                    continue
-            
-            if route['geo_filter']:
-                if event_data.get('country') not in route['geo_filter']:
-                    continue
-            
-            # Правило подошло
-            return route['target_chat_id'], route['target_topic_id']
-        
-        # Используем настройки по умолчанию
-        return profile.default_chat_id, profile.default_topic_id
-    
-    def _match_value(self, value: str, pattern: str, is_regex: bool) -> bool:
-        """Проверяет соответствие значения паттерну"""
-        if is_regex:
-            import re
-            try:
-                return bool(re.match(pattern, value))
-            except:
-                return False
-        else:
-            return value == pattern
+        table = await self.route_cache.table(self.db, profile)
+        return table.route(event_data)
     
     async def _save_event(
         self, profile_id: int, tx_id: str, event_data: Dict,
@@ -304,4 +249,11 @@ class KeitaroWebServer:
         await runner.setup()
         site = web.TCPSite(runner, '0.0.0.0', self.port)
         await site.start()
+        if self.delivery is not None:
+            self.delivery.start()
         logger.info(f"Keitaro web server started on port {self.port}")
+    
+    async def stop(self):
+        """Останавливает фоновую доставку"""
+        if self.delivery is not None:
+            await self.delivery.stop()
@@ -13,6 +13,8 @@ from telegram import Update, Bot
 from telegram.ext import Application
 import orjson
 
+from database.query_metrics import query_metrics
+
 logger = logging.getLogger(__name__)
 
 
@@ -70,7 +72,8 @@ telegram_webhooks_total{{status="failed"}} {self.metrics['webhooks_failed']}
 # HELP telegram_last_update_id Last processed update ID
 # TYPE telegram_last_update_id gauge
 telegram_last_update_id {self.metrics['last_update_id']}
-"""
+
+{query_metrics.render()}"""
         return web.Response(text=metrics_text, content_type='text/plain')
     
     async def handle_webhook(self, request: web.Request) -> web.Response: